@@ -5,3 +5,4 @@ SimNIBS mesh handling functions
 
 from .mesh_io import *
 from .eeg_positions import *
+from .mesh_container import *
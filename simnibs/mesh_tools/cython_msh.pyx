@@ -446,6 +446,90 @@ def gauss_smooth_simple(
     return
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def gauss_smooth_positions(
+    np.uint_t[::1] nodes,
+    double[:, ::1] nodes_pos,
+    np.uint_t[::1] adj_indices,
+    np.uint_t[::1] adj_indptr,
+    double factor,
+    double[:, ::1] new_pos
+    ):
+    ''' Positions of the nodes after a Gaussian smoothing step, written to
+    new_pos. nodes_pos is not changed, so that the nodes can be split between
+    threads. Releases the GIL
+    '''
+    cdef np.uint_t n
+    cdef double[3] bar
+    cdef Py_ssize_t i, j, k
+
+    with nogil:
+        for i in range(nodes.shape[0]):
+            n = nodes[i]
+            for k in range(3):
+                bar[k] = 0.
+
+            for j in range(adj_indptr[n], adj_indptr[n+1]):
+                for k in range(3):
+                    bar[k] = bar[k] + nodes_pos[adj_indices[j], k]
+
+            for k in range(3):
+                bar[k] = bar[k]/<double>(adj_indptr[n+1] - adj_indptr[n])
+
+            for k in range(3):
+                new_pos[i, k] = nodes_pos[n, k] + factor * (bar[k] - nodes_pos[n, k])
+
+    return
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def gamma_tetrahedra(
+    double[:, ::1] nodes_pos,
+    np.uint_t[:, ::1] tetrahedra,
+    np.uint_t[::1] th_indices,
+    double[::1] gamma
+    ):
+    ''' Gamma metric (see _calc_gamma) of the tetrahedra in th_indices, written
+    to gamma[th_indices]. Inverted tetrahedra get -1. Releases the GIL
+    '''
+    cdef double[3][3] M
+    cdef np.uint_t t
+    cdef Py_ssize_t i, j, k, l
+    cdef double det, edge_rms
+
+    with nogil:
+        for l in range(th_indices.shape[0]):
+            t = th_indices[l]
+            for i in range(3):
+                for j in range(3):
+                    M[i][j] = nodes_pos[tetrahedra[t, i + 1], j] - \
+                              nodes_pos[tetrahedra[t, 0], j]
+
+            det = M[0][0]*(M[1][1]*M[2][2] - M[2][1]*M[1][2]) - \
+                  M[0][1]*(M[1][0]*M[2][2] - M[2][0]*M[1][2]) + \
+                  M[0][2]*(M[1][0]*M[2][1] - M[2][0]*M[1][1])
+
+            if det < 0.:
+                gamma[t] = -1.
+                continue
+
+            edge_rms = 0.
+            for i in range(4):
+                for j in range(i + 1, 4):
+                    for k in range(3):
+                        edge_rms += (nodes_pos[tetrahedra[t, i], k] -
+                                     nodes_pos[tetrahedra[t, j], k])**2
+
+            edge_rms = edge_rms/6.
+            gamma[t] = edge_rms ** 1.5/(det/6.)/8.479670
+
+    return
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cdef int _test_sign(
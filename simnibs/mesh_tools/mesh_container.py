@@ -0,0 +1,370 @@
+'''
+    HDF5 container for one mesh and many fields defined on it
+
+    This program is part of the SimNIBS package.
+    Please check on www.simnibs.org how to cite our work in publications.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import hashlib
+import os
+
+import h5py
+import numpy as np
+
+from .mesh_io import Msh, Nodes, Elements, NodeData, ElementData, read_msh
+
+__all__ = [
+    'MeshContainer',
+    'mesh_hash',
+    'pack_msh_files'
+]
+
+# When reading some of the nodes, rows closer than this are read in a single range
+_MAX_ROW_GAP = 1024
+
+
+def mesh_hash(mesh):
+    ''' SHA-256 hash of the mesh geometry (nodes, elements and tags)
+
+    Parameters
+    ----------
+    mesh: simnibs.msh.Msh
+        Mesh structure
+
+    Returns
+    --------
+    hash: str
+        Hexadecimal digest
+    '''
+    h = hashlib.sha256()
+    for array, dtype in [
+        (mesh.nodes.node_coord, '<f8'),
+        (mesh.elm.node_number_list, '<i4'),
+        (mesh.elm.elm_type, '<i4'),
+        (mesh.elm.tag1, '<i4'),
+        (mesh.elm.tag2, '<i4'),
+    ]:
+        h.update(np.ascontiguousarray(array, dtype=dtype).tobytes())
+    return h.hexdigest()
+
+
+class MeshContainer(object):
+    ''' HDF5 file with one mesh and many sets of fields ("results") defined on it
+
+    The elements are stored sorted by tag, so that the elements and element fields
+    of a tissue are contiguous in the file and can be read without reading the
+    rest of the mesh. Fields are stored in chunked and compressed datasets.
+
+    File layout::
+
+        /mesh/nodes                         node coordinates
+        /mesh/elm/{node_number_list, elm_type, tag1, tag2}
+        /mesh/elm/order                     original index of each element
+        /mesh/elm/tag_ranges                (tag, start, stop) of each tag
+        /results/<name>/nodedata/<field>
+        /results/<name>/elmdata/<field>
+
+    The /mesh group has the attribute "hash" (see mesh_hash)
+
+    Parameters
+    ----------
+    fn: str
+        Name of the HDF5 file
+    mode: 'r', 'a' or 'w' (optional)
+        Read only, read and add results, or create a new file. Default: 'r'
+    dtype: numpy dtype (optional)
+        Data type of new fields in the file. Default: float32
+    compression: str (optional)
+        HDF5 compression filter for the mesh and fields. Default: 'gzip'
+    compression_opts: optional
+        Options for the compression filter. Default: 4
+    chunk_size: int (optional)
+        Maximum number of nodes or elements per chunk. Default: 65536
+
+    Example
+    -------
+    >>> with MeshContainer('results.hdf5', 'w') as c:
+    ...     c.write_mesh(mesh)
+    ...     c.add_result('position_1', mesh.nodedata + mesh.elmdata)
+    >>> with MeshContainer('results.hdf5') as c:
+    ...     gm = c.read('position_1', fields=['magnE'], tags=[2])
+    '''
+    def __init__(self, fn, mode='r', dtype=np.float32, compression='gzip',
+                 compression_opts=4, chunk_size=65536):
+        if mode not in ['r', 'a', 'w']:
+            raise ValueError("mode must be 'r', 'a' or 'w'")
+        self.fn = fn
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.chunk_size = chunk_size
+        self._file = h5py.File(fn, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        ''' Closes the HDF5 file '''
+        self._file.close()
+
+    @property
+    def hash(self):
+        ''' Hash of the stored mesh, or None if there is no mesh '''
+        if 'mesh' not in self._file:
+            return None
+        return self._file['mesh'].attrs['hash']
+
+    @property
+    def results(self):
+        ''' Names of the stored results '''
+        if 'results' not in self._file:
+            return []
+        return list(self._file['results'].keys())
+
+    def fields(self, name):
+        ''' Names of the fields in a result '''
+        g = self._file['results'][name]
+        return [
+            f for k in ['nodedata', 'elmdata'] if k in g for f in g[k].keys()
+        ]
+
+    def _create_dataset(self, g, name, data):
+        chunks = None
+        if len(data) > 0:
+            chunks = (min(self.chunk_size, len(data)),) + data.shape[1:]
+        g.create_dataset(
+            name, data=data, chunks=chunks, shuffle=True,
+            compression=self.compression,
+            compression_opts=self.compression_opts
+        )
+
+    def write_mesh(self, mesh):
+        ''' Writes the mesh to the file
+
+        If the file already has a mesh, checks that it is the same
+
+        Parameters
+        ----------
+        mesh: simnibs.msh.Msh
+            Mesh structure
+        '''
+        h = mesh_hash(mesh)
+        if 'mesh' in self._file:
+            if self.hash != h:
+                raise ValueError(
+                    'The mesh is different from the mesh in ' + str(self.fn))
+            return
+        g = self._file.create_group('mesh')
+        g.attrs['hash'] = h
+        g.attrs['fn'] = mesh.fn
+        self._create_dataset(g, 'nodes', np.asarray(mesh.nodes.node_coord, '<f8'))
+        order = np.argsort(mesh.elm.tag1, kind='stable')
+        elm = g.create_group('elm')
+        self._create_dataset(elm, 'order', order.astype('<i4'))
+        for key in ['node_number_list', 'elm_type', 'tag1', 'tag2']:
+            self._create_dataset(
+                elm, key, np.asarray(getattr(mesh.elm, key), '<i4')[order])
+        tags, start, count = np.unique(
+            mesh.elm.tag1[order], return_index=True, return_counts=True)
+        elm.create_dataset(
+            'tag_ranges', data=np.stack([tags, start, start + count], axis=1))
+
+    def add_result(self, name, fields, mesh=None):
+        ''' Adds a set of fields to the file
+
+        Parameters
+        ----------
+        name: str
+            Name of the result, e.g. the name of the simulation or position
+        fields: list of NodeData and ElementData
+            Fields to be stored
+        mesh: simnibs.msh.Msh (optional)
+            Mesh of the fields. If set, it is written to the file or checked against
+            the mesh in the file
+        '''
+        if mesh is not None:
+            self.write_mesh(mesh)
+        if 'mesh' not in self._file:
+            raise ValueError('Please write the mesh before adding results')
+        g = self._file.require_group('results').create_group(name)
+        n_nodes = len(self._file['mesh/nodes'])
+        order = self._file['mesh/elm/order'][:]
+        for d in fields:
+            value = np.asarray(d.value)
+            if isinstance(d, NodeData):
+                if len(value) != n_nodes:
+                    raise ValueError(
+                        'Field {0} does not have one value per node'.format(d.field_name))
+                group = 'nodedata'
+            elif isinstance(d, ElementData):
+                if len(value) != len(order):
+                    raise ValueError(
+                        'Field {0} does not have one value per element'.format(d.field_name))
+                group, value = 'elmdata', value[order]
+            else:
+                raise TypeError('Fields must be NodeData or ElementData')
+            if value.dtype.kind == 'f':
+                value = value.astype(self.dtype)
+            self._create_dataset(g.require_group(group), d.field_name, value)
+
+    def _elements(self, tags=None):
+        ''' Returns the slices of the stored elements with the given tags '''
+        tag_ranges = self._file['mesh/elm/tag_ranges'][:]
+        if tags is None:
+            return [slice(0, int(tag_ranges[-1, 2]) if len(tag_ranges) else 0)]
+        tags = np.atleast_1d(tags)
+        return [
+            slice(int(start), int(stop)) for tag, start, stop in tag_ranges
+            if tag in tags
+        ]
+
+    def _read_elements(self, dset, slices):
+        if len(slices) == 1:
+            return dset[slices[0]]
+        return np.concatenate(
+            [dset[s] for s in slices] + [np.zeros((0,) + dset.shape[1:], dset.dtype)])
+
+    def _read_rows(self, dset, rows):
+        ''' Reads the rows with the given (sorted) indices
+
+        Rows closer than _MAX_ROW_GAP are read together in a contiguous range, the
+        others are not read
+        '''
+        groups = np.split(rows, np.flatnonzero(np.diff(rows) > _MAX_ROW_GAP) + 1)
+        return np.concatenate(
+            [dset[r[0]:r[-1] + 1][r - r[0]] for r in groups if len(r) > 0] +
+            [np.zeros((0,) + dset.shape[1:], dset.dtype)])
+
+    def read_mesh(self, tags=None):
+        ''' Reads the mesh
+
+        Parameters
+        ----------
+        tags: list of ints (optional)
+            Only reads the elements with these tags, and the nodes they use.
+            The elements are then ordered by tag. Default: read the whole mesh, in the
+            original order
+
+        Returns
+        --------
+        mesh: simnibs.msh.Msh
+            Mesh structure
+        '''
+        return self._read(tags)[0]
+
+    def _read(self, tags=None):
+        g = self._file['mesh']
+        slices = self._elements(tags)
+        elm = Elements()
+        for key in ['node_number_list', 'elm_type', 'tag1', 'tag2']:
+            setattr(elm, key, self._read_elements(g['elm'][key], slices))
+        if tags is None:
+            node_coord = g['nodes'][:]
+            # Back to the original order
+            inverse = np.empty_like(g['elm/order'][:])
+            inverse[g['elm/order'][:]] = np.arange(len(inverse))
+            for key in ['node_number_list', 'elm_type', 'tag1', 'tag2']:
+                setattr(elm, key, getattr(elm, key)[inverse])
+            nodes = None
+        else:
+            # Only read the nodes used by the elements
+            nodes = np.unique(elm.node_number_list[elm.node_number_list > 0]) - 1
+            renumber = np.zeros(len(g['nodes']) + 1, dtype='int32')
+            renumber[nodes + 1] = np.arange(1, len(nodes) + 1)
+            elm.node_number_list = np.where(
+                elm.node_number_list > 0, renumber[elm.node_number_list], -1
+            ).astype('int32')
+            node_coord = self._read_rows(g['nodes'], nodes)
+            inverse = None
+        mesh = Msh(Nodes(node_coord), elm)
+        mesh.fn = g.attrs['fn']
+        return mesh, slices, nodes, inverse
+
+    def read(self, name, fields=None, tags=None):
+        ''' Reads a result and its mesh
+
+        Parameters
+        ----------
+        name: str
+            Name of the result
+        fields: list of str (optional)
+            Names of the fields to read. Default: all fields
+        tags: list of ints (optional)
+            Only reads the elements with these tags, and the nodes they use.
+            Default: read the whole mesh
+
+        Returns
+        --------
+        mesh: simnibs.msh.Msh
+            Mesh structure with the fields as float64
+        '''
+        mesh, slices, nodes, inverse = self._read(tags)
+        g = self._file['results'][name]
+        for group, cls in [('nodedata', NodeData), ('elmdata', ElementData)]:
+            if group not in g:
+                continue
+            for field_name, dset in g[group].items():
+                if fields is not None and field_name not in fields:
+                    continue
+                if cls is NodeData:
+                    if nodes is None:
+                        value = dset[:]
+                    else:
+                        value = self._read_rows(dset, nodes)
+                else:
+                    value = self._read_elements(dset, slices)
+                    if inverse is not None:
+                        value = value[inverse]
+                if value.dtype.kind == 'f':
+                    value = value.astype(np.float64)
+                data = cls(value, field_name, mesh=mesh)
+                if cls is NodeData:
+                    mesh.nodedata.append(data)
+                else:
+                    mesh.elmdata.append(data)
+        return mesh
+
+
+def pack_msh_files(fn_out, fn_msh, names=None, **kwargs):
+    ''' Stores the fields of ".msh" files with the same mesh in a MeshContainer
+
+    Parameters
+    ----------
+    fn_out: str
+        Name of the HDF5 file. Results are added if it already exists
+    fn_msh: list of str
+        Names of the ".msh" files
+    names: list of str (optional)
+        Names of the results. Default: the file names without extension
+    kwargs:
+        Other arguments for MeshContainer
+
+    Returns
+    --------
+    names: list of str
+        Names of the results
+    '''
+    if names is None:
+        names = [os.path.splitext(os.path.basename(fn))[0] for fn in fn_msh]
+    if len(names) != len(fn_msh):
+        raise ValueError('Please give one name per file')
+    with MeshContainer(fn_out, 'a', **kwargs) as c:
+        for fn, name in zip(fn_msh, names):
+            m = read_msh(fn)
+            c.add_result(name, m.nodedata + m.elmdata, mesh=m)
+    return names
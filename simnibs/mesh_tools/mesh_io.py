@@ -25,12 +25,16 @@ import os
 import struct
 import copy
 import datetime
+import io
 import warnings
 import gc
-import hashlib
+import zlib
+import mmap as _mmap
 import subprocess
 import threading
-from itertools import combinations
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations, count
 from typing import Union
 from functools import partial
 from pathlib import Path
@@ -73,6 +77,8 @@ __all__ = [
     'write_stl',
     'read_off',
     'write_off',
+    'read_meshb',
+    'write_meshb',
     'write_geo_spheres',
     'write_geo_text',
     'Msh',
@@ -85,7 +91,72 @@ __all__ = [
 # CLASSES
 # =============================================================================
 
-class Nodes:
+# Every modification takes a new number, so that versions are never reused
+_versions = count(1)
+
+
+class _Versioned(object):
+    """ Base class for objects caching data derived from their attributes
+
+    Assigning a public attribute marks the object as modified, which invalidates
+    the cache. In-place changes of the attributes (e.g.
+    msh.nodes.node_coord[0] = 0 or msh.elm.node_number_list[:, 3] = -1) are
+    not detected and leave stale faces, adjacency lists and search trees: they
+    must be followed by a reassignment of the attribute or by mark_modified().
+    The version and the cache are not part of __dict__, are not pickled and
+    are not copied.
+    """
+    __slots__ = ('_version', '_cache')
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            self.mark_modified()
+
+    def mark_modified(self):
+        ''' Marks the object as modified, clearing the cached derived data '''
+        object.__setattr__(self, '_version', next(_versions))
+        object.__setattr__(self, '_cache', {})
+
+    def _get_version(self):
+        try:
+            return self._version
+        except AttributeError:
+            self.mark_modified()
+            return self._version
+
+    def _cached(self, name, compute, version=None):
+        ''' Returns the cached value of "name", calling compute() if the cache
+        is empty or was filled with another version '''
+        if version is None:
+            version = self._get_version()
+        try:
+            cached_version, value = self._cache[name]
+        except (AttributeError, KeyError):
+            pass
+        else:
+            if cached_version == version:
+                return value
+        value = compute()
+        self._set_cache(name, value, version)
+        return value
+
+    def _set_cache(self, name, value, version=None):
+        if version is None:
+            version = self._get_version()
+        try:
+            self._cache[name] = (version, value)
+        except AttributeError:
+            object.__setattr__(self, '_cache', {name: (version, value)})
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+class Nodes(_Versioned):
     """class to handle the node information:
 
     Parameters
@@ -154,7 +225,8 @@ class Nodes:
         if len(self.node_coord) == 0:
             raise InvalidMeshError('Mesh has no nodes defined')
 
-        kd_tree = scipy.spatial.cKDTree(self.node_coord)
+        kd_tree = self._cached(
+            'kd_tree', lambda: scipy.spatial.cKDTree(self.node_coord))
         _, indexes = kd_tree.query(querry_points)
         coords = self.node_coord[indexes, :]
 
@@ -177,7 +249,7 @@ class Nodes:
         return str(self.node_coord)
 
 
-class Elements:
+class Elements(_Versioned):
     """ Mesh elements.
 
     Can only handle triangles and tetrahedra!
@@ -374,9 +446,16 @@ class Elements:
             List of tetrahedron adjacent to each face, filled with -1 if a face is in a
             single tetrahedron. Not in the normal element ordering, but only in the order
             the tetrahedra are presented
+
+        Notes
+        ------
+        The result for all tetrahedra is cached
         '''
         if tetrahedra_indexes is None:
-            tetrahedra_indexes = self.tetrahedra
+            return tuple(
+                a.copy() for a in
+                self._cached('faces', lambda: self.get_faces(self.tetrahedra))
+            )
         th = self[tetrahedra_indexes]
         faces = th[:, [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]]
         faces = faces.reshape(-1, 3)
@@ -500,6 +579,10 @@ class Elements:
             List of adjacent tetrahedra to each element. 1-based. -1 marks no adjacent
             tetrahedra
         '''
+        return self._cached(
+            'adjacent_tetrahedra', self._find_adjacent_tetrahedra).copy()
+
+    def _find_adjacent_tetrahedra(self):
         faces, th_faces, adjacency_list = self.get_faces()
         adj_th = -np.ones((self.nr, 4), dtype=int)
         # Triangles
@@ -639,6 +722,10 @@ class Elements:
         M: scipy.sparse.csr_matrix
             Sparse matrix such that M[node_idx].data = adj_elm_index
         '''
+        return self._cached(
+            'node_elm_adjacency', self._node_elm_adjacency).copy()
+
+    def _node_elm_adjacency(self):
         n_nodes = np.max(self.node_number_list)
         #indptr = np.zeros(n_nodes + 1, int)
         M = scipy.sparse.csr_matrix((n_nodes + 1, self.nr + 1), dtype=int)
@@ -729,7 +816,7 @@ def make_surface_mesh(vertices, faces):
     return Msh(Nodes(vertices), Elements(faces))
 
 
-class Msh:
+class Msh(_Versioned):
     """class to handle the meshes.
     Gathers Nodes, Elements and Data
 
@@ -782,6 +869,28 @@ class Msh:
         return dict(
             [(data.field_name, data) for data in self.nodedata + self.elmdata])
 
+    def mark_modified(self):
+        ''' Marks the mesh, its nodes and its elements as modified, clearing the
+        cached derived data (baricenters, faces, search trees, ...)
+
+        Needs to be called after in-place changes of the nodes or elements
+        '''
+        _Versioned.mark_modified(self)
+        for attr in ['nodes', 'elm']:
+            if attr in self.__dict__:
+                getattr(self, attr).mark_modified()
+
+    def _geometry_version(self):
+        ''' Version of the mesh, nodes and elements together '''
+        return (self._get_version(),
+                self.nodes._get_version(),
+                self.elm._get_version())
+
+    def _cached(self, name, compute, version=None):
+        if version is None:
+            version = self._geometry_version()
+        return _Versioned._cached(self, name, compute, version)
+
     def write(self, out_fn):
         ''' Writes out the mesh as a ".msh" file
 
@@ -890,8 +999,32 @@ class Msh:
                             ed.field_name,
                             mesh=cropped))
 
+        self._crop_cache(cropped, idx)
         return cropped
 
+    def _crop_cache(self, cropped, idx):
+        ''' Copies the cached data that is still valid to a mesh cropped
+        to the elements idx (0-based, sorted) '''
+        version = self._geometry_version()
+        cache = getattr(self, '_cache', {})
+        # Element-wise quantities
+        for name in ['baricenters', 'volumes_and_areas']:
+            if name in cache and cache[name][0] == version:
+                cropped._set_cache(name, cache[name][1][idx])
+        # Adjacency restricted to the remaining elements
+        cache = getattr(self.elm, '_cache', {})
+        if 'adjacent_tetrahedra' in cache and \
+                cache['adjacent_tetrahedra'][0] == self.elm._get_version():
+            new_number = -np.ones(self.elm.nr + 1, dtype=int)
+            new_number[idx + 1] = np.arange(1, len(idx) + 1)
+            adj_th = cache['adjacent_tetrahedra'][1][idx]
+            adj_th = np.where(adj_th > 0, new_number[adj_th], -1)
+            # The adjacent tetrahedra of triangles come first
+            tr = cropped.elm.elm_type == 2
+            swap = tr * (adj_th[:, 0] == -1)
+            adj_th[swap, :2] = adj_th[swap, 1::-1]
+            cropped.elm._set_cache('adjacent_tetrahedra', adj_th)
+
     def join_mesh(self, other):
         """ Join the current mesh with another
 
@@ -935,6 +1068,7 @@ class Msh:
         joined.elm.node_number_list[joined.elm.elm_type == 2, 3] = -1
         joined.elm.node_number_list[joined.elm.elm_type == 1, 2:] = -1
         joined.elm.node_number_list[joined.elm.elm_type == 15, 1:] = -1
+        joined.elm.mark_modified()
 
         for nd in self.nodedata:
             assert len(nd.value) == self.nodes.nr
@@ -1033,21 +1167,22 @@ class Msh:
             ElementData with the baricentes of the elements
 
         """
-        bar = ElementData(
-            np.zeros((self.elm.nr, 3), dtype=float),
-            'baricenter', mesh=self)
-        bar.mesh = self
-        th_indexes = self.elm.tetrahedra
-        tr_indexes = self.elm.triangles
+        value = self._cached('baricenters', self._elements_baricenters)
+        return ElementData(value.copy(), 'baricenter', mesh=self)
+
+    def _elements_baricenters(self):
+        bar = np.zeros((self.elm.nr, 3), dtype=float)
+        th = self.elm.elm_type == 4
+        tr = self.elm.elm_type == 2
 
-        if len(th_indexes) > 0:
-            bar[th_indexes] = np.average(
-                self.nodes[self.elm[th_indexes]],
+        if np.any(th):
+            bar[th] = np.average(
+                self.nodes.node_coord[self.elm.node_number_list[th] - 1],
                 axis=1)
 
-        if len(tr_indexes) > 0:
-            bar[tr_indexes] = np.average(
-                self.nodes[self.elm[tr_indexes][:, :3]],
+        if np.any(tr):
+            bar[tr] = np.average(
+                self.nodes.node_coord[self.elm.node_number_list[tr, :3] - 1],
                 axis=1)
 
         return bar
@@ -1064,20 +1199,24 @@ class Msh:
         ------
             In the mesh's unit (normally mm)
         """
-        vol = ElementData(np.zeros(self.elm.nr, dtype=float),
-                          'volumes_and_areas')
+        value = self._cached(
+            'volumes_and_areas', self._elements_volumes_and_areas)
+        return ElementData(value.copy(), 'volumes_and_areas')
 
-        tr_indexes = self.elm.triangles
-        node_tr = self.nodes[self.elm[tr_indexes, :3]]
+    def _elements_volumes_and_areas(self):
+        vol = np.zeros(self.elm.nr, dtype=float)
+
+        tr = self.elm.elm_type == 2
+        node_tr = self.nodes.node_coord[self.elm.node_number_list[tr, :3] - 1]
         sideA = node_tr[:, 1] - node_tr[:, 0]
         sideB = node_tr[:, 2] - node_tr[:, 0]
         n = np.cross(sideA, sideB)
-        vol[tr_indexes] = np.linalg.norm(n, axis=1) * 0.5
+        vol[tr] = np.linalg.norm(n, axis=1) * 0.5
 
-        th_indexes = self.elm.tetrahedra
-        node_th = self.nodes[self.elm[th_indexes]]
+        th = self.elm.elm_type == 4
+        node_th = self.nodes.node_coord[self.elm.node_number_list[th] - 1]
         M = node_th[:, 1:] - node_th[:, 0, None]
-        vol[th_indexes] = np.abs(np.linalg.det(M)) / 6.
+        vol[th] = np.abs(np.linalg.det(M)) / 6.
 
         return vol
 
@@ -1119,11 +1258,13 @@ class Msh:
         baricenters = self.elements_baricenters()
         if elements_of_interest is not None:
             bar = baricenters[elements_of_interest]
+            kd_tree = scipy.spatial.cKDTree(bar)
         else:
             elements_of_interest = baricenters.elm_number
-            bar = baricenters.value
+            kd_tree = self._cached(
+                'baricenters_tree',
+                lambda: scipy.spatial.cKDTree(baricenters.value))
 
-        kd_tree = scipy.spatial.cKDTree(bar)
         d, indexes = kd_tree.query(querry_points, k=k)
         indexes = elements_of_interest[indexes]
         coords = baricenters[indexes]
@@ -1576,6 +1717,7 @@ class Msh:
         '''
         #
         th_indices = self.elm.tetrahedra
+        n_th = len(th_indices)
         th_nodes = self.nodes[self.elm[th_indices]]
         # Reduce the number of elements
         points_max = np.max(points, axis=0)
@@ -1596,10 +1738,16 @@ class Msh:
         th_nodes = th_nodes[th_in_box]
 
         # Calculate a few things we will use later
-        faces, th_faces, adjacency_list = self.elm.get_faces(th_indices)
-        # Find initial positions
-        th_baricenters = np.average(th_nodes, axis=1)
-        kdtree = scipy.spatial.cKDTree(th_baricenters)
+        if len(th_in_box) == n_th:
+            # All tetrahedra, use the cached faces and tree
+            faces, th_faces, adjacency_list = self.elm.get_faces()
+            kdtree = self._cached(
+                'tetrahedra_tree',
+                lambda: scipy.spatial.cKDTree(np.average(th_nodes, axis=1)))
+        else:
+            faces, th_faces, adjacency_list = self.elm.get_faces(th_indices)
+            # Find initial positions
+            kdtree = scipy.spatial.cKDTree(np.average(th_nodes, axis=1))
 
         # Starting position for walking algorithm: the closest baricenter
         _, closest_th = kdtree.query(points)
@@ -1697,6 +1845,7 @@ class Msh:
         tmp = np.copy(self.elm.node_number_list[switch, 1])
         self.elm.node_number_list[switch, 1] = self.elm.node_number_list[switch, 0]
         self.elm.node_number_list[switch, 0] = tmp
+        self.elm.mark_modified()
         del tmp
         gc.collect()
 
@@ -1718,6 +1867,7 @@ class Msh:
         tmp = np.copy(self.elm.node_number_list[switch, 1])
         self.elm.node_number_list[switch, 1] = self.elm.node_number_list[switch, 0]
         self.elm.node_number_list[switch, 0] = tmp
+        self.elm.mark_modified()
         del tmp
         gc.collect()
 
@@ -1746,6 +1896,7 @@ class Msh:
             buffer = self.elm.node_number_list[idx_tr, 1].copy()
             self.elm.node_number_list[idx_tr, 1] = self.elm.node_number_list[idx_tr, 2]
             self.elm.node_number_list[idx_tr, 2] = buffer
+            self.elm.mark_modified()
 
 
     def compact_ordering(self, node_number):
@@ -1760,6 +1911,7 @@ class Msh:
         rel[node_number] = np.arange(1, self.nodes.nr + 1, dtype=int)
         self.elm.node_number_list = rel[self.elm.node_number_list]
         self.elm.node_number_list[self.elm.elm_type == 2, 3] = -1
+        self.elm.mark_modified()
 
     def prepare_surface_tags(self):
         triangles = self.elm.elm_type == 2
@@ -1769,9 +1921,16 @@ class Msh:
                 self.elm.tag1[triangles *
                               (self.elm.tag1 == s)] += 1000
 
-    def find_corresponding_tetrahedra(self):
+    def find_corresponding_tetrahedra(self, triangles=None):
         ''' Finds the tetrahedra corresponding to each triangle
 
+        Parameters
+        -----------
+        triangles: ndarray of ints (optional)
+            Element numbers of the triangles (starting at 1). If set, only the
+            tetrahedra around these triangles are searched. Default: all
+            triangles
+
         Returns
         ---------
         corresponding_th_indices: ndarray of ints
@@ -1779,21 +1938,36 @@ class Msh:
            Note: This is in mesh ordering (starts at 1), -1 if there's no corresponding
 
         '''
-        # Look into the cache
-        node_nr_list_hash = hashlib.sha1(
-            np.hstack((self.elm.tag1[:, None], self.elm.node_number_list))).hexdigest()
+        # Look into the cache. The tags are often changed in-place, so they are
+        # also checked
+        version = self.elm._get_version(), zlib.crc32(
+            np.ascontiguousarray(self.elm.tag1))
         try:
-            if self._correspondance_node_nr_list_hash == node_nr_list_hash:
-                return self._corresponding_tetrahedra
-            else:
-                raise AttributeError
-
-        except AttributeError:
+            cached_version, corresponding = self._cache['corresponding_tetrahedra']
+        except (AttributeError, KeyError):
             pass
+        else:
+            if cached_version == version:
+                if triangles is None:
+                    return corresponding.copy()
+                return corresponding[
+                    np.searchsorted(self.elm.triangles, triangles)]
 
-        # If could not find correspondence in cache
-        tr_tags = np.unique(self.elm.tag1[self.elm.elm_type == 2])
-        corresponding_th_indices = -np.ones(len(self.elm.triangles), dtype=int)
+        if triangles is None:
+            tr_indices = self.elm.triangles - 1
+            th_candidates = self.elm.elm_type == 4
+        else:
+            tr_indices = np.asarray(triangles, dtype=int).reshape(-1) - 1
+            if np.any(self.elm.elm_type[tr_indices] != 2):
+                raise ValueError('Not all elements are triangles')
+            # Only tetrahedra with a face on the triangles can correspond
+            node_mask = np.zeros(self.nodes.nr + 1, dtype=bool)
+            node_mask[self.elm.node_number_list[tr_indices, :3]] = True
+            th_candidates = (self.elm.elm_type == 4) * \
+                (np.sum(node_mask[self.elm.node_number_list], axis=1) >= 3)
+
+        corresponding_th_indices = -np.ones(len(tr_indices), dtype=int)
+        tr_tags = np.unique(self.elm.tag1[tr_indices])
         for t in tr_tags:
             # look into tetrahedra with tags t, 1000-t
             to_crop = [t]
@@ -1804,19 +1978,18 @@ class Msh:
                 to_crop.append(t - 2000)
                 to_crop.append(t - 1600)
             # Select triangles and tetrahedra with tags
-            th_of_interest = np.where((self.elm.elm_type == 4) *
+            th_of_interest = np.where(th_candidates *
                                       np.in1d(self.elm.tag1, to_crop))[0]
             if len(th_of_interest) == 0:
                 continue
-            tr_of_interest = np.where((self.elm.elm_type == 2) *
-                                      (self.elm.tag1 == t))[0]
+            tr_of_interest = np.where(self.elm.tag1[tr_indices] == t)[0]
 
             th = self.elm.node_number_list[th_of_interest]
             faces = th[:, [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]].reshape(-1, 3)
             faces = faces.reshape(-1, 3)
             faces_hash_array = _hash_rows(faces)
 
-            tr = self.elm.node_number_list[tr_of_interest, :3]
+            tr = self.elm.node_number_list[tr_indices[tr_of_interest], :3]
             tr_hash_array = _hash_rows(tr)
             # This will check if all triangles have a corresponding face
             has_tetra = np.in1d(tr_hash_array, faces_hash_array)
@@ -1827,15 +2000,13 @@ class Msh:
             index = faces_argsort[tr_search] // 4
 
             # Put the values in corresponding_th_indices
-            position = np.searchsorted(self.elm.triangles,
-                                       self.elm.elm_number[tr_of_interest[has_tetra]])
-            corresponding_th_indices[position] = \
+            corresponding_th_indices[tr_of_interest[has_tetra]] = \
                 self.elm.elm_number[th_of_interest[index]]
 
         if np.any(corresponding_th_indices==-1):
             # add triangles at the outer boundary, irrespective of tag
             # get all tet faces, except those of "air" tetrahedra (i.e., tag1 = -1)
-            idx_th_all = np.where((self.elm.elm_type == 4)*(self.elm.tag1 != -1))[0]
+            idx_th_all = np.where(th_candidates*(self.elm.tag1 != -1))[0]
             th = self.elm.node_number_list[idx_th_all]
             faces = th[:, [[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]]]
             faces = faces.reshape(-1, 3)
@@ -1847,8 +2018,8 @@ class Msh:
             faces_hash_array = faces_hash_array[counts == 1]
             idx_fc = idx_fc[counts == 1]
 
-            tr_of_interest = self.elm.triangles[corresponding_th_indices==-1]-1
-            tr = self.elm.node_number_list[tr_of_interest, :3]
+            tr_of_interest = np.where(corresponding_th_indices==-1)[0]
+            tr = self.elm.node_number_list[tr_indices[tr_of_interest], :3]
             tr_hash_array = _hash_rows(tr)
             _, idx_tr, idx_th = np.intersect1d(tr_hash_array, faces_hash_array,
                                                return_indices = True)
@@ -1857,9 +2028,10 @@ class Msh:
             idx_th = idx_th_all[ idx_fc[idx_th]//4 ] + 1
             corresponding_th_indices[idx_tr] = idx_th
 
-        self._correspondance_node_nr_list_hash = node_nr_list_hash
-        self._corresponding_tetrahedra = corresponding_th_indices
-        gc.collect()
+        if triangles is None:
+            self._set_cache(
+                'corresponding_tetrahedra', corresponding_th_indices.copy(), version)
+            gc.collect()
         return corresponding_th_indices
 
  
@@ -2616,10 +2788,12 @@ class Msh:
         AABBTree: pyAABBTree cython object
         precalculated AABBTree
 
-        NOTE: In order to free up memory you might have to call
-        __del__() explicitly on the return object!
+        NOTE: The tree is cached in the mesh, do not call __del__() on it.
+        Call mark_modified() to free up the memory
         """
+        return self._cached('aabb_tree', self._build_AABBTree)
 
+    def _build_AABBTree(self):
         AABBTree = cgal.pyAABBTree()
         AABBTree.set_data(self.nodes[:], self.elm[self.elm.elm_type == 2, :3] - 1)
         return AABBTree
@@ -3054,7 +3228,8 @@ class Msh:
         self.fix_tr_node_ordering()
 
 
-    def smooth_surfaces(self, n_steps, step_size=.3, tags=None, max_gamma=5):
+    def smooth_surfaces(self, n_steps, step_size=.3, tags=None, max_gamma=5,
+                        num_threads=1):
         ''' In-place smoothing of the mesh surfaces using Taubin smoothing,
             ensures that the tetrahedra quality does not fall below
             a minimal level. Can still decrease overall tetrahedra quality, though.
@@ -3075,6 +3250,8 @@ class Msh:
             would exceed max_gamma otherwise. Default: 5
             (for gamma metric see Parthasarathy et al., Finite Elements in
              Analysis and Design, 1994)
+        num_threads: (optional) int
+            Number of threads for smoothing and for calculating gamma. Default: 1
         '''
         assert step_size > 0 and step_size < 1
         # Surface nodes and surface node mask
@@ -3084,91 +3261,70 @@ class Msh:
         surf_nodes = np.unique(self.elm.node_number_list[idx,:3]) - 1
         nodes_mask = np.zeros(self.nodes.nr, dtype=bool)
         nodes_mask[surf_nodes] = True
+        # position of each node in surf_nodes
+        surf_index = -np.ones(self.nodes.nr, dtype=int)
+        surf_index[surf_nodes] = np.arange(len(surf_nodes))
 
         # Triangle neighbourhood information
-        adj_tr = scipy.sparse.csr_matrix((self.nodes.nr, self.nodes.nr), dtype=bool)
-        tr = self.elm[self.elm.triangles, :3] - 1
-        ones = np.ones(len(tr), dtype=bool)
-        for i in range(3):
-            for j in range(3):
-                adj_tr += scipy.sparse.csr_matrix(
-                    (ones, (tr[:, i], tr[:, j])),
-                    shape=adj_tr.shape
-                )
-        adj_tr -= scipy.sparse.dia_matrix((np.ones(adj_tr.shape[0]), 0), shape=adj_tr.shape)
+        adj_tr = _triangle_adjacency(
+            self.elm[self.elm.triangles, :3] - 1, self.nodes.nr)
+        adj_indices = np.ascontiguousarray(adj_tr.indices, np.uint)
+        adj_indptr = np.ascontiguousarray(adj_tr.indptr, np.uint)
 
-        # Tetrahedron neighbourhood information
-        th = self.elm[self.elm.tetrahedra] - 1
-        adj_th = scipy.sparse.csr_matrix((self.nodes.nr, len(th)), dtype=bool)
-        th_indices = np.arange(len(th))
-        ones = np.ones(len(th), dtype=bool)
-        for i in range(4):
-            adj_th += scipy.sparse.csr_matrix(
-                (ones, (th[:, i], th_indices)),
-                shape=adj_th.shape
-            )
+        # Tetrahedron neighbourhood information,
         # keep only tets connected to surface nodes
-        idx = np.sum(adj_th[nodes_mask], axis=0) > 0
-        idx = np.asarray(idx).reshape(-1)
-        th = th[idx,:]
-        adj_th = adj_th[:,idx]
-        adj_th = adj_th.tocsc()
-
-        def calc_gamma(nodes_coords,th):
-            ''' gamma of tetrahedra '''
-            node_th = nodes_coords[th]
-            # tet volumes
-            M = node_th[:, 1:] - node_th[:, 0, None]
-            vol = np.linalg.det(M) / 6.
-            # edge lengths
-            edge_rms = np.zeros(len(th))
-            for i in range(4):
-                for j in range(i+1, 4):
-                    edge_rms += np.sum(
-                        (node_th[:,i,:] - node_th[:,j,:])**2,
-                        axis=1
-                    )
-            edge_rms = edge_rms/6.
-            # gamma
-            gamma = edge_rms**1.5/vol
-            gamma /= 8.479670
-            gamma[vol<0] = -1
-            return gamma
+        th = self.elm[self.elm.tetrahedra] - 1
+        th = np.ascontiguousarray(th[np.any(nodes_mask[th], axis=1)], np.uint)
+        adj_th = scipy.sparse.coo_matrix(
+            (np.ones(th.size, dtype=bool),
+             (th.reshape(-1), np.repeat(np.arange(len(th)), 4))),
+            shape=(self.nodes.nr, len(th))
+        ).tocsr()
 
         nodes_coords = np.ascontiguousarray(self.nodes.node_coord, float)
-        gamma = calc_gamma(nodes_coords,th)
-        n_badgamma = np.sum((gamma < 0) + (gamma > max_gamma))
-        for i in range(n_steps):
-            nc_before = nodes_coords.copy()
-            cython_msh.gauss_smooth_simple(
-                surf_nodes.astype(np.uint),
-                nodes_coords,
-                np.ascontiguousarray(adj_tr.indices, np.uint),
-                np.ascontiguousarray(adj_tr.indptr, np.uint),
-                float(step_size)
-            )
-            # Taubin step
-            cython_msh.gauss_smooth_simple(
-                surf_nodes.astype(np.uint),
-                nodes_coords,
-                np.ascontiguousarray(adj_tr.indices, np.uint),
-                np.ascontiguousarray(adj_tr.indptr, np.uint),
-                -1.05 * float(step_size)
-            )
-            # revert where gamma exceeded max_gamma
-            gamma = calc_gamma(nodes_coords,th)
-            idx_badtet = (gamma < 0) + (gamma > max_gamma)
-            for k in range(4): # mostly < 4 iterations required, limit to ensure stability
-                if np.sum(idx_badtet) <= n_badgamma: break
-
-                idx_badnodes = np.sum(adj_th[:,idx_badtet], axis=1) > 0
-                idx_badnodes = np.asarray(idx_badnodes).reshape(-1)
-                nodes_coords[idx_badnodes] = nc_before[idx_badnodes]
-
-                gamma = calc_gamma(nodes_coords,th)
+        gamma = np.empty(len(th), dtype=float)
+        surf_nodes_u = surf_nodes.astype(np.uint)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            def smooth(factor):
+                new_pos = np.empty((len(surf_nodes), 3), dtype=float)
+                _run_in_chunks(
+                    pool, num_threads, len(surf_nodes),
+                    lambda c: cython_msh.gauss_smooth_positions(
+                        surf_nodes_u[c], nodes_coords, adj_indices, adj_indptr,
+                        factor, new_pos[c]))
+                nodes_coords[surf_nodes] = new_pos
+
+            def update_gamma(nodes):
+                ''' recalculates gamma of the tetrahedra around the nodes '''
+                th_indices = np.unique(adj_th[nodes].indices).astype(np.uint)
+                _run_in_chunks(
+                    pool, num_threads, len(th_indices),
+                    lambda c: cython_msh.gamma_tetrahedra(
+                        nodes_coords, th, th_indices[c], gamma))
+
+            update_gamma(surf_nodes)
+            n_badgamma = np.sum((gamma < 0) + (gamma > max_gamma))
+            for i in range(n_steps):
+                surf_before = nodes_coords[surf_nodes]
+                smooth(float(step_size))
+                # Taubin step
+                smooth(-1.05 * float(step_size))
+                moved = np.any(nodes_coords[surf_nodes] != surf_before, axis=1)
+                update_gamma(surf_nodes[moved])
+                # revert where gamma exceeded max_gamma
                 idx_badtet = (gamma < 0) + (gamma > max_gamma)
+                for k in range(4): # mostly < 4 iterations required, limit to ensure stability
+                    if np.sum(idx_badtet) <= n_badgamma: break
+                    # only the surface nodes have moved
+                    idx_badnodes = surf_index[np.unique(th[idx_badtet])]
+                    idx_badnodes = idx_badnodes[idx_badnodes >= 0]
+                    nodes_coords[surf_nodes[idx_badnodes]] = surf_before[idx_badnodes]
 
-            n_badgamma = np.sum(idx_badtet)
+                    update_gamma(surf_nodes[idx_badnodes])
+                    idx_badtet = (gamma < 0) + (gamma > max_gamma)
+
+                n_badgamma = np.sum(idx_badtet)
 
         self.nodes.node_coord = nodes_coords
 
@@ -3205,16 +3361,8 @@ class Msh:
             surf_nodes = np.where(mask)[0]
 
         # Triangle neighbourhood information
-        adj_tr = scipy.sparse.csr_matrix((self.nodes.nr, self.nodes.nr), dtype=bool)
-        tr = self.elm[self.elm.triangles, :3] - 1
-        ones = np.ones(len(tr), dtype=bool)
-        for i in range(3):
-            for j in range(3):
-                adj_tr += scipy.sparse.csr_matrix(
-                    (ones, (tr[:, i], tr[:, j])),
-                    shape=adj_tr.shape
-                )
-        adj_tr -= scipy.sparse.dia_matrix((np.ones(adj_tr.shape[0]), 0), shape=adj_tr.shape)
+        adj_tr = _triangle_adjacency(
+            self.elm[self.elm.triangles, :3] - 1, self.nodes.nr)
 
         nodes_coords = np.ascontiguousarray(self.nodes.node_coord, float)
         for i in range(n_steps):
@@ -3335,6 +3483,7 @@ class Msh:
         # connect old tets to to the new node and node n1
         idx = np.where(self.elm.node_number_list[idx_orgtets] == idx_n2)[1]
         self.elm.node_number_list[idx_orgtets,idx] = idx_newnode
+        self.elm.mark_modified()
 
         if return_tetindices:
             return idx_orgtets+1, idx_newtets+1
@@ -3380,6 +3529,42 @@ class Data(object):
             warnings.warn('Second axis larger than the first '
                           'Field is probably transposed')
 
+    @classmethod
+    def _from_loader(cls, load, name='', mesh=None):
+        ''' Creates a field whose value is only loaded when first accessed
+
+        Parameters
+        -----------
+        load: callable
+            Function without arguments which returns the value
+        '''
+        data = cls.__new__(cls)
+        data.field_name = name
+        data.mesh = mesh
+        data._value = None
+        data._load = load
+        return data
+
+    @property
+    def value(self):
+        '''Value of field in nodes or elements'''
+        if self._load is not None:
+            self._value = self._load()
+            self._load = None
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._load = None
+
+    def __setstate__(self, state):
+        # Data pickled before "value" was a property
+        if 'value' in state:
+            state['_value'] = state.pop('value')
+        state.setdefault('_load', None)
+        self.__dict__.update(state)
+
     @property
     def type(self):
         '''NodeData of ElementData'''
@@ -3828,6 +4013,40 @@ class Data(object):
         ''' Nodes or element numbers '''
         raise Exception('indexing_nr is not defined')
 
+    def _msh_blocks(self, mode='binary', mmg_fix=False):
+        ''' Returns the $NodeData or $ElementData section of a ".msh" file
+
+        Parameters
+        ----------
+        mode: binary or ascii
+            mode in which to write
+        mmg_fix: bool
+            Leave out the last integer tag, as expected by MMG (Default: False)
+
+        Returns
+        --------
+        blocks: list
+            Header, data and footer of the section, to be written in order
+        '''
+        section = 'NodeData' if isinstance(self, NodeData) else 'ElementData'
+        integer_tags = [0, self.nr_comp, self.nr] + ([] if mmg_fix else [0])
+        header = '${0}\n1\n"{1}"\n1\n0\n{2}\n'.format(
+            section, self.field_name, len(integer_tags))
+        header += ''.join('{0}\n'.format(t) for t in integer_tags)
+
+        value = np.reshape(self.value, (self.nr, self.nr_comp))
+        if mode == 'ascii':
+            data = _format_ascii(self.indexing_nr, value)
+        elif mode == 'binary':
+            data = np.empty(self.nr, dtype=[
+                ('id', '<i4'), ('values', '<f8', (self.nr_comp,))])
+            data['id'] = self.indexing_nr
+            data['values'] = value
+        else:
+            raise IOError("invalid mode:", mode)
+
+        return [header.encode('ascii'), data, '$End{0}\n'.format(section).encode('ascii')]
+
     def __eq__(self, other):
         try:
             return self.__dict__ == other.__dict__
@@ -4451,46 +4670,9 @@ class ElementData(Data):
             mode: binary or ascii
                 mode in which to write
         """
+        blocks = self._msh_blocks(mode)
         with open(fn, 'ab') as f:
-            f.write(b'$ElementData\n')
-            # string tags
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write(('"' + self.field_name + '"\n').encode('ascii'))
-
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            f.write((str(4) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-            f.write((str(self.nr_comp) + '\n').encode('ascii'))
-            f.write((str(self.nr) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            if mode == 'ascii':
-                for ii in range(self.nr):
-                    f.write((str(self.elm_number[ii]) + ' ' +
-                             str(self.value[ii]).translate(None, '[](),') +
-                             '\n').encode('ascii'))
-
-            elif mode == 'binary':
-
-                elm_number = self.elm_number.astype('int32')
-                value = self.value.astype('float64')
-                try:
-                    value.shape[1]
-                except IndexError:
-                    value = value[:, np.newaxis]
-                m = elm_number[:, np.newaxis]
-                for i in range(self.nr_comp):
-                    m = np.concatenate((m,
-                                        value[:, i].astype('float64').view('int32').reshape(-1, 2)),
-                                       axis=1)
-                f.write(m.tobytes())
-
-            else:
-                raise IOError("invalid mode:", mode)
-
-            f.write(b'$EndElementData\n')
+            f.writelines(blocks)
 
     def write(self, fn):
         """Writes this ElementData fields to a file with field information only
@@ -4503,38 +4685,12 @@ class ElementData(Data):
             mode: binary or ascii
                 mode in which to write
         """
+        blocks = self._msh_blocks('binary')
         with open(fn, 'wb') as f:
             f.write(b'$MeshFormat\n2.2 1 8\n')
             f.write(struct.pack('i', 1))
             f.write(b'\n$EndMeshFormat\n')
-            f.write(b'$ElementData\n')
-            # string tags
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write(('"' + self.field_name + '"\n').encode('ascii'))
-
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            f.write((str(4) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-            f.write((str(self.nr_comp) + '\n').encode('ascii'))
-            f.write((str(self.nr) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            elm_number = self.elm_number.astype('int32')
-            value = self.value.astype('float64')
-            try:
-                value.shape[1]
-            except IndexError:
-                value = value[:, np.newaxis]
-            m = elm_number[:, np.newaxis]
-            for i in range(self.nr_comp):
-                m = np.concatenate((m,
-                                    value[:, i].astype('float64').view('int32').reshape(-1, 2)),
-                                   axis=1)
-            f.write(m.tobytes())
-
-            f.write(b'$EndElementData\n')
+            f.writelines(blocks)
 
 
 class NodeData(Data):
@@ -5055,52 +5211,9 @@ class NodeData(Data):
             mode: binary or ascii
                 mode in which to write
         """
+        blocks = self._msh_blocks(mode, mmg_fix)
         with open(fn, 'ab') as f:
-            f.write(b'$NodeData\n')
-            # string tags
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write(('"' + self.field_name + '"\n').encode('ascii'))
-
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            if mmg_fix:
-                f.write((str(3) + '\n').encode('ascii'))
-                f.write((str(0) + '\n').encode('ascii'))
-                f.write((str(self.nr_comp) + '\n').encode('ascii'))
-                f.write((str(self.nr) + '\n').encode('ascii'))
-            else:
-                f.write((str(4) + '\n').encode('ascii'))
-                f.write((str(0) + '\n').encode('ascii'))
-                f.write((str(self.nr_comp) + '\n').encode('ascii'))
-                f.write((str(self.nr) + '\n').encode('ascii'))
-                f.write((str(0) + '\n').encode('ascii'))
-
-            if mode == 'ascii':
-                for ii in range(self.nr):
-                    f.write((
-                        str(self.node_number[ii]) + ' ' +
-                        str(self.value[ii]).translate(None, '[](),') +
-                        '\n').encode('ascii'))
-
-            elif mode == 'binary':
-                value = self.value.astype('float64')
-                try:
-                    value.shape[1]
-                except IndexError:
-                    value = value[:, np.newaxis]
-
-                m = self.node_number[:, np.newaxis].astype('int32')
-                for i in range(self.nr_comp):
-                    m = np.concatenate((m,
-                                        value[:, i].astype('float64').view('int32').reshape(-1, 2)),
-                                       axis=1)
-
-                f.write(m.tobytes())
-            else:
-                raise IOError("invalid mode:", mode)
-
-            f.write(b'$EndNodeData\n')
+            f.writelines(blocks)
 
 
     def write(self, fn):
@@ -5112,41 +5225,15 @@ class NodeData(Data):
             fn: str
                 file name
         """
+        blocks = self._msh_blocks('binary')
         with open(fn, 'wb') as f:
             f.write(b'$MeshFormat\n2.2 1 8\n')
             f.write(struct.pack('i', 1))
             f.write(b'\n$EndMeshFormat\n')
-            f.write(b'$NodeData\n')
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write(('"' + self.field_name + '"\n').encode('ascii'))
-
-            f.write((str(1) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            f.write((str(4) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-            f.write((str(self.nr_comp) + '\n').encode('ascii'))
-            f.write((str(self.nr) + '\n').encode('ascii'))
-            f.write((str(0) + '\n').encode('ascii'))
-
-            value = self.value.astype('float64')
-            try:
-                value.shape[1]
-            except IndexError:
-                value = value[:, np.newaxis]
-
-            m = self.node_number[:, np.newaxis].astype('int32')
-            for i in range(self.nr_comp):
-                m = np.concatenate((m,
-                                    value[:, i].astype('float64').view('int32').reshape(-1, 2)),
-                                   axis=1)
-
-            f.write(m.tobytes())
-
-            f.write(b'$EndNodeData\n')
+            f.writelines(blocks)
 
 
-def read_msh(fn, m=None, skip_data=False):
+def read_msh(fn, m=None, skip_data=False, mmap=False, fields=None, lazy=False):
     ''' Reads a gmsh '.msh' file
 
     Parameters
@@ -5157,6 +5244,17 @@ def read_msh(fn, m=None, skip_data=False):
         Mesh structure to be overwritten. If unset, will create a new structure
     skip_data: bool (optional)
         If True, reading of NodeData and ElementData will be skipped (Default: False)
+    mmap: bool (optional)
+        If True, the values of NodeData and ElementData in binary files are
+        copy-on-write views of a memory map of the file, and are only read from
+        disk when accessed. The file must not be modified while the mesh is in
+        use. Default: False
+    fields: list of str (optional)
+        Names of the NodeData and ElementData fields to read. Default: all
+    lazy: bool (optional)
+        If True, the values of NodeData and ElementData are only read from the file
+        the first time they are accessed. The file must not be modified while the
+        mesh is in use. Default: False
 
     Returns
     --------
@@ -5171,12 +5269,17 @@ def read_msh(fn, m=None, skip_data=False):
     if not os.path.isfile(fn):
         raise IOError(fn + ' not found')
 
+    buf = None
+    if mmap:
+        with open(fn, 'rb') as f:
+            buf = _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY)
+
     version_number = _find_mesh_version(fn)
     if version_number == 2:
-        m = _read_msh_2(fn, m, skip_data)
+        m = _read_msh_2(fn, m, skip_data, buf, fields, lazy)
 
     elif version_number == 4:
-        m = _read_msh_4(fn, m, skip_data)
+        m = _read_msh_4(fn, m, skip_data, buf, fields, lazy)
 
     else:
         raise IOError('Unrecgnized Mesh file version : {}'.format(version_number))
@@ -5203,7 +5306,160 @@ def _find_mesh_version(fn):
     return version_number
 
 
-def _read_msh_2(fn, m, skip_data=False):
+def _read_binary(f, dtype, count, buf=None):
+    ''' Reads "count" items of type "dtype" from a binary file, like np.fromfile
+
+    If "buf" is a memory map of the file, returns a view of it instead of a copy.
+    In both cases, the file position is moved to the end of the items
+    '''
+    if buf is None:
+        return np.fromfile(f, dtype=dtype, count=count)
+    a = np.frombuffer(buf, dtype=dtype, count=count, offset=f.tell())
+    f.seek(a.nbytes, 1)
+    return a
+
+
+def _read_ascii(f, nr, nr_cols, dtype=np.float64):
+    ''' Reads "nr" lines with "nr_cols" numbers each from a text file '''
+    values = np.fromstring(
+        b' '.join([f.readline() for _ in range(nr)]), dtype=np.float64, sep=' '
+    )
+    if len(values) != nr * nr_cols:
+        raise IOError(
+            'Expected {0} lines with {1} values each'.format(nr, nr_cols))
+    return values.reshape(nr, nr_cols).astype(dtype, copy=False)
+
+
+def _index_msh_data(f, fn, binary):
+    ''' Scans the $NodeData and $ElementData sections until the end of the file
+
+    Only the section headers are parsed, the data blocks are skipped.
+
+    Returns
+    --------
+    sections: list
+        List of (section, name, nr, nr_comp, offset) tuples, where "offset" is the
+        position of the first data line in the file
+    '''
+    sections = []
+    while True:
+        section = f.readline()
+        if section == b'':
+            return sections
+        section = section.strip()
+        if section not in [b'$NodeData', b'$ElementData']:
+            raise IOError("Can't recognize section name:" + section.decode())
+        # string tags
+        number_of_string_tags = int(f.readline().decode('ascii'))
+        assert number_of_string_tags == 1, "Invalid Mesh File: invalid number of string tags"
+        name = f.readline().decode('ascii').strip().strip('"')
+        # real tags
+        number_of_real_tags = int(f.readline().decode('ascii'))
+        assert number_of_real_tags == 1, "Invalid Mesh File: invalid number of real tags"
+        f.readline()
+        # integer tags
+        number_of_integer_tags = int(f.readline().decode('ascii'))  # usually 3 or 4
+        integer_tags = [int(f.readline().decode('ascii'))
+                        for i in range(number_of_integer_tags)]
+        nr = integer_tags[2]
+        nr_comp = integer_tags[1]
+        offset = f.tell()
+        # skip the data
+        if binary:
+            f.seek(nr * (4 + 8 * nr_comp), 1)
+        else:
+            for _ in range(nr):
+                f.readline()
+        end = b'$End' + section[1:] + b'\n'
+        if f.readline() != end:
+            raise IOError(fn + " expected " + end.decode().strip() + " after reading " +
+                          str(nr) + " lines in " + section.decode())
+        sections.append((section, name, nr, nr_comp, offset))
+
+
+def _read_msh_values(f, binary, section, nr, nr_comp, offset, buf=None):
+    ''' Reads the values of a data section found with _index_msh_data
+
+    Values read from a memory map "buf" are not copied, and only the first and last
+    node or element numbers are checked, so that the data is not read from disk
+    '''
+    f.seek(offset)
+    if binary:
+        if nr_comp == 1:
+            value_dt = ('values', np.float64)
+        else:
+            value_dt = ('values', np.float64, nr_comp)
+        temp = _read_binary(f, np.dtype([('id', np.int32), value_dt]), nr, buf)
+        if buf is None:
+            number = np.copy(temp['id'])
+            value = np.copy(temp['values'])
+        else:
+            number = temp['id'][[0, -1]] if nr > 0 else temp['id']
+            value = temp['values']
+    else:
+        buf = None
+        temp = _read_ascii(f, nr, nr_comp + 1)
+        number = temp[:, 0].astype(np.int32)
+        value = np.copy(temp[:, 1:])
+
+    if buf is None:
+        valid = np.all(number == np.arange(1, nr + 1))
+    else:
+        valid = np.all(number == [1, nr][:len(number)])
+
+    if not valid and section == b'$NodeData':
+        raise IOError("Can't read NodeData field: "
+                      "it does not have one data point per node")
+    if not valid:
+        raise IOError("Can't read ElementData field: "
+                      "it does not have one data point per element")
+    return value
+
+
+def _load_msh_values(fn, stat, *args):
+    ''' Reads the values of a data section the first time they are accessed '''
+    st = os.stat(fn)
+    if (st.st_size, st.st_mtime_ns) != stat:
+        raise IOError(fn + ' was modified after the mesh was read')
+    with open(fn, 'rb') as f:
+        return _read_msh_values(f, *args)
+
+
+def _read_msh_data(f, m, binary, sections, elm_ok=True, buf=None,
+                   fields=None, lazy=False):
+    ''' Adds the data sections found with _index_msh_data to the mesh
+
+    Only the sections named in "fields" are added, if it is set. If "lazy" is set,
+    the values are only read the first time they are accessed
+    '''
+    if lazy:
+        fn = os.path.abspath(f.name)
+        st = os.stat(fn)
+    for section, name, nr, nr_comp, offset in sections:
+        if fields is not None and name not in fields:
+            continue
+        if section == b'$NodeData':
+            if nr != m.nodes.nr:
+                raise IOError("Can't read NodeData field: "
+                              "it does not have one data point per node")
+            cls, data_list = NodeData, m.nodedata
+        else:
+            if not elm_ok:
+                raise IOError('Could not read ElementData: '
+                              'Element ordering not compact or invalid element type')
+            if nr != m.elm.nr:
+                raise IOError("Can't read ElementData field: "
+                              "it does not have one data point per element")
+            cls, data_list = ElementData, m.elmdata
+        args = (binary, section, nr, nr_comp, offset)
+        if lazy and buf is None:
+            load = partial(_load_msh_values, fn, (st.st_size, st.st_mtime_ns), *args)
+            data_list.append(cls._from_loader(load, name=name, mesh=m))
+        else:
+            data_list.append(cls(_read_msh_values(f, *args, buf=buf), name=name, mesh=m))
+
+
+def _read_msh_2(fn, m, skip_data=False, buf=None, fields=None, lazy=False):
     m.fn = fn
 
     # file open
@@ -5263,7 +5519,7 @@ def _read_msh_2(fn, m, skip_data=False):
                 ('id', np.int32),
                 ('coord', np.float64, 3)])
 
-            temp = np.fromfile(f, dtype=dt, count=node_nr)
+            temp = _read_binary(f, dt, node_nr, buf)
             node_number = np.copy(temp['id'])
             node_coord = np.copy(temp['coord'])
 
@@ -5276,17 +5532,9 @@ def _read_msh_2(fn, m, skip_data=False):
 
         else:
             # nodes has 4 entries: [node_ID x y z]
-            node_number = np.empty(node_nr, dtype='int32')
-            # array Nx3 for (x,y,z) coordinates of the nodes
-            node_coord = np.empty(3 * node_nr, dtype='float64')
-            for ii in range(node_nr):
-                line = f.readline().decode().strip().split()
-                node_number[ii] = line[0]
-                # it's faster to use a linear array and than reshape
-                node_coord[3 * ii] = line[1]
-                node_coord[3 * ii + 1] = line[2]
-                node_coord[3 * ii + 2] = line[3]
-            node_coord = node_coord.reshape((node_nr, 3))
+            temp = _read_ascii(f, node_nr, 4)
+            node_number = temp[:, 0].astype('int32')
+            node_coord = np.copy(temp[:, 1:])
 
         if not np.all(node_number == np.arange(1, node_nr + 1)):
             warnings.warn("Mesh file with discontinuos nodes, things can fail"
@@ -5321,9 +5569,9 @@ def _read_msh_2(fn, m, skip_data=False):
             nr_nodes_elm = [None, 2, 3, 4, 4, 8, 6, 5, 3, 6, 9,
                             10, 27, 18, 14, 1, 8, 20, 15, 13]
             while current_element < elm_nr:
-                elm_type, nr, _ = np.fromfile(f, 'int32', 3)
+                elm_type, nr, _ = _read_binary(f, 'int32', 3, buf)
                 if elm_type == 1:
-                    tmp = np.fromfile(f, 'int32', nr * 5).reshape(-1, 5)
+                    tmp = _read_binary(f, 'int32', nr * 5, buf).reshape(-1, 5)
 
                     m.elm.elm_type[current_element:current_element+nr] = \
                         1 * np.ones(nr, 'int32')
@@ -5334,7 +5582,7 @@ def _read_msh_2(fn, m, skip_data=False):
                     read[current_element:current_element+nr] = 1
 
                 elif elm_type == 2:
-                    tmp = np.fromfile(f, 'int32', nr * 6).reshape(-1, 6)
+                    tmp = _read_binary(f, 'int32', nr * 6, buf).reshape(-1, 6)
 
                     m.elm.elm_type[current_element:current_element+nr] = \
                         2 * np.ones(nr, 'int32')
@@ -5345,7 +5593,7 @@ def _read_msh_2(fn, m, skip_data=False):
                     read[current_element:current_element+nr] = 1
 
                 elif elm_type == 4:
-                    tmp = np.fromfile(f, 'int32', nr * 7).reshape(-1, 7)
+                    tmp = _read_binary(f, 'int32', nr * 7, buf).reshape(-1, 7)
 
                     m.elm.elm_type[current_element:current_element+nr] = \
                         4 * np.ones(nr, 'int32')
@@ -5356,7 +5604,7 @@ def _read_msh_2(fn, m, skip_data=False):
                     read[current_element:current_element+nr] = 1
 
                 elif elm_type == 15:
-                    tmp = np.fromfile(f, 'int32', nr * 4).reshape(-1, 4)
+                    tmp = _read_binary(f, 'int32', nr * 4, buf).reshape(-1, 4)
 
                     m.elm.elm_type[current_element:current_element+nr] = \
                         15 * np.ones(nr, 'int32')
@@ -5368,7 +5616,7 @@ def _read_msh_2(fn, m, skip_data=False):
                 else:
                     warnings.warn('element of type {0} '
                                   'cannot be read, ignoring it'.format(elm_type))
-                    np.fromfile(f, 'int32', nr * (3 + nr_nodes_elm[elm_type]))
+                    _read_binary(f, 'int32', nr * (3 + nr_nodes_elm[elm_type]), buf)
                     read[current_element:current_element+nr] = 0
                 current_element += nr
 
@@ -5379,44 +5627,28 @@ def _read_msh_2(fn, m, skip_data=False):
             m.elm.node_number_list = m.elm.node_number_list[read]
 
         else:
-
-            elm_number = np.empty(elm_nr, dtype='int32')
-            m.elm.elm_type = np.empty(elm_nr, dtype='int32')
-            m.elm.tag1 = np.empty(elm_nr, dtype='int32')
-            m.elm.tag2 = np.empty(elm_nr, dtype='int32')
+            # each line has [elm_ID elm_type nr_tags tag1 tag2 ... node_IDs]
+            lines = [f.readline() for _ in range(elm_nr)]
+            n_values = np.array([len(l.split()) for l in lines], dtype=int)
+            values = np.fromstring(b' '.join(lines), dtype=int, sep=' ')
+            if len(values) != np.sum(n_values):
+                raise IOError(fn + " something wrong when reading the elements")
+            start = np.cumsum(n_values) - n_values
+            elm_number = values[start].astype('int32')
+            m.elm.elm_type = values[start + 1].astype('int32')
+            m.elm.tag1 = values[start + 3].astype('int32')
+            m.elm.tag2 = values[start + 4].astype('int32')
             m.elm.node_number_list = -np.ones((elm_nr, 4), dtype='int32')
-            read = np.ones(elm_nr, dtype=bool)
+            nr_nodes = n_values - 3 - values[start + 2]
+            for i in range(4):
+                has_node = nr_nodes > i
+                m.elm.node_number_list[has_node, i] = \
+                    values[start[has_node] + n_values[has_node] - nr_nodes[has_node] + i]
 
-            for ii in range(elm_nr):
-                line = f.readline().decode().strip().split()
-                if line[1] == '1':
-                    elm_number[ii] = line[0]
-                    m.elm.elm_type[ii] = line[1]
-                    m.elm.tag1[ii] = line[3]
-                    m.elm.tag2[ii] = line[4]
-                    m.elm.node_number_list[ii, :2] = [int(i) for i in line[5:]]
-                elif line[1] == '2':
-                    elm_number[ii] = line[0]
-                    m.elm.elm_type[ii] = line[1]
-                    m.elm.tag1[ii] = line[3]
-                    m.elm.tag2[ii] = line[4]
-                    m.elm.node_number_list[ii, :3] = [int(i) for i in line[5:]]
-                elif line[1] == '4':
-                    elm_number[ii] = line[0]
-                    m.elm.elm_type[ii] = line[1]
-                    m.elm.tag1[ii] = line[3]
-                    m.elm.tag2[ii] = line[4]
-                    m.elm.node_number_list[ii] = [int(i) for i in line[5:]]
-                elif line[1] == '15':
-                    elm_number[ii] = line[0]
-                    m.elm.elm_type[ii] = line[1]
-                    m.elm.tag1[ii] = line[3]
-                    m.elm.tag2[ii] = line[4]
-                    m.elm.node_number_list[ii, :1] = [int(i) for i in line[5:]]
-                else:
-                    read[ii] = 0
-                    warnings.warn('element of type {0} '
-                                  'cannot be read, ignoring it'.format(line[1]))
+            read = np.isin(m.elm.elm_type, [1, 2, 4, 15])
+            for elm_type in np.unique(m.elm.elm_type[~read]):
+                warnings.warn('element of type {0} '
+                              'cannot be read, ignoring it'.format(elm_type))
 
             elm_number = elm_number[read]
             m.elm.elm_type = m.elm.elm_type[read]
@@ -5437,112 +5669,18 @@ def _read_msh_2(fn, m, skip_data=False):
                 raise IOError(fn + " expected $EndElements after reading " +
                               str(m.elm.nr) + " elements. Read " + line)
 
-        # read the header in the beginning of a data section
-        def parse_Data():
-            section = f.readline()
-            if section == b'':
-                return 'EOF', '', 0, 0
-            # string tags
-            number_of_string_tags = int(f.readline().decode('ascii'))
-            assert number_of_string_tags == 1, "Invalid Mesh File: invalid number of string tags"
-            name = f.readline().decode('ascii').strip().strip('"')
-            # real tags
-            number_of_real_tags = int(f.readline().decode('ascii'))
-            assert number_of_real_tags == 1, "Invalid Mesh File: invalid number of real tags"
-            f.readline()
-            # integer tags
-            number_of_integer_tags = int(f.readline().decode().strip())  # usually 3 or 4
-            integer_tags = [int(f.readline().decode().strip())
-                            for i in range(number_of_integer_tags)]
-            nr = integer_tags[2]
-            nr_comp = integer_tags[1]
-            return section.strip(), name, nr, nr_comp
-
-        def read_NodeData(t, name, nr, nr_comp, m):
-            data = NodeData(np.empty((nr, nr_comp)), name=name, mesh=m)
-            if binary:
-                if nr_comp == 1:
-                    value_dt = ('values', np.float64)
-                else:
-                    value_dt = ('values', np.float64, nr_comp)
-                dt = np.dtype([('id', np.int32), value_dt])
-                temp = np.fromfile(f, dtype=dt, count=nr)
-                node_number = np.copy(temp['id'])
-                data.value = np.copy(temp['values'])
-            else:
-                node_number = np.empty(nr, dtype='int32')
-                data.value = np.empty((nr, nr_comp), dtype='float64')
-                for ii in range(nr):
-                    line = f.readline().decode().strip().split()
-                    node_number[ii] = int(line[0])
-                    data.value[ii, :] = [float(v) for v in line[1:]]
-
-            if f.readline() != b'$EndNodeData\n':
-                raise IOError(fn + " expected $EndNodeData after reading " +
-                              str(nr) + " lines in $NodeData")
-
-            if np.any(node_number != m.nodes.node_number):
-                raise IOError("Can't read NodeData field: "
-                              "it does not have one data point per node")
-
-            return data
-
-        def read_ElementData(t, name, nr, nr_comp, m):
-            if elm_nr_changed or not np.all(read):
-                raise IOError('Could not read ElementData: '
-                              'Element ordering not compact or invalid element type')
-            data = ElementData(np.empty((nr, nr_comp)), name=name, mesh=m)
-            if binary:
-                if nr_comp == 1:
-                    value_dt = ('values', np.float64)
-                else:
-                    value_dt = ('values', np.float64, nr_comp)
-                dt = np.dtype([('id', np.int32), value_dt])
-                temp = np.fromfile(f, dtype=dt, count=nr)
-                elm_number = np.copy(temp['id'])
-                data.value = np.copy(temp['values'])
-
-            else:
-                elm_number = np.empty(nr, dtype='int32')
-                data.value = np.empty([nr, nr_comp], dtype='float64')
-
-                for ii in range(nr):
-                    line = f.readline().decode().strip().split()
-                    elm_number[ii] = int(line[0])
-                    data.value[ii, :] = [float(jj) for jj in line[1:]]
-
-            if f.readline() != b'$EndElementData\n':
-                raise IOError(fn + " expected $EndElementData after reading " +
-                              str(nr) + " lines in $ElementData")
-
-            if np.any(elm_number != m.elm.elm_number):
-                raise IOError("Can't read ElementData field: "
-                              "it does not have one data point per element")
-
-            return data
-
-        # read sections recursively
-        def read_next_section():
-            t, name, nr, nr_comp = parse_Data()
-            if t == 'EOF':
-                return
-            elif t == b'$NodeData':
-                m.nodedata.append(read_NodeData(t, name, nr, nr_comp, m))
-            elif t == b'$ElementData':
-                m.elmdata.append(read_ElementData(t, name, nr, nr_comp, m))
-            else:
-                raise IOError("Can't recognize section name:" + t)
-
-            read_next_section()
-            return
-
         if not skip_data:
-            read_next_section()
+            sections = _index_msh_data(f, fn, binary)
+            _read_msh_data(
+                f, m, binary, sections,
+                elm_ok=not elm_nr_changed and np.all(read), buf=buf,
+                fields=fields, lazy=lazy
+            )
     m.compact_ordering(node_number)
     return m
 
 
-def _read_msh_4(fn, m, skip_data=False):
+def _read_msh_4(fn, m, skip_data=False, buf=None, fields=None, lazy=False):
     m.fn = fn
     # file open
     with open(fn, 'rb') as f:
@@ -5615,19 +5753,13 @@ def _read_msh_4(fn, m, skip_data=False):
                 dt = np.dtype([
                     ('id', np.int32, 1),
                     ('coord', np.float64, 3)])
-                temp = np.fromfile(f, dtype=dt, count=n_in_block)
+                temp = _read_binary(f, dt, n_in_block, buf)
                 node_nbr_block = temp['id']
                 node_coord_block = temp['coord']
             else:
-                node_nbr_block = np.zeros(n_in_block, dtype=int)
-                node_coord_block = np.zeros(3 * n_in_block, dtype=float)
-                for i in range(n_in_block):
-                    line = f.readline().decode().strip().split()
-                    node_nbr_block[i] = line[0]
-                    node_coord_block[3*i] = line[1]
-                    node_coord_block[3*i + 1] = line[2]
-                    node_coord_block[3*i + 2] = line[3]
-                node_coord_block = node_coord_block.reshape(-1, 3)
+                temp = _read_ascii(f, n_in_block, 4)
+                node_nbr_block = temp[:, 0].astype(int)
+                node_coord_block = temp[:, 1:]
 
             node_number[n_read:n_read+n_in_block] = node_nbr_block
             node_coord[n_read:n_read+n_in_block, :] = node_coord_block
@@ -5682,18 +5814,14 @@ def _read_msh_4(fn, m, skip_data=False):
                 dt = np.dtype([
                     ('id', np.int32, 1),
                     ('nodes', np.int32, nr_nodes_elm)])
-                temp = np.fromfile(f, dtype=dt, count=n_in_block)
+                temp = _read_binary(f, dt, n_in_block, buf)
                 elm_nbr_block = temp['id']
                 elm_node_block = temp['nodes']
 
             else:
-                elm_nbr_block = np.zeros(n_in_block, dtype=np.int32)
-                elm_node_block = -np.ones(nr_nodes_elm * n_in_block, dtype=np.int32)
-                for i in range(n_in_block):
-                    line = f.readline().decode().strip().split()
-                    elm_nbr_block[i] = int(line[0])
-                    elm_node_block[nr_nodes_elm*i:nr_nodes_elm*(i+1)] = [int(l) for l in line[1:]]
-                elm_node_block = elm_node_block.reshape(-1, nr_nodes_elm)
+                temp = _read_ascii(f, n_in_block, nr_nodes_elm + 1, np.int32)
+                elm_nbr_block = temp[:, 0]
+                elm_node_block = temp[:, 1:]
 
             elm_number[n_read:n_read+n_in_block] = elm_nbr_block
             m.elm.node_number_list[n_read:n_read+n_in_block, :nr_nodes_elm] = elm_node_block
@@ -5721,111 +5849,18 @@ def _read_msh_4(fn, m, skip_data=False):
                 raise IOError(fn + " expected $EndElements after reading " +
                               str(m.elm.nr) + " elements. Read " + line)
 
-        # read the header in the beginning of a data section
-        def parse_Data():
-            section = f.readline()
-            if section == b'':
-                return 'EOF', '', 0, 0
-            # string tags
-            number_of_string_tags = int(f.readline().decode('ascii'))
-            assert number_of_string_tags == 1, "Invalid Mesh File: invalid number of string tags"
-            name = f.readline().decode('ascii').strip().strip('"')
-            # real tags
-            number_of_real_tags = int(f.readline().decode('ascii'))
-            assert number_of_real_tags == 1, "Invalid Mesh File: invalid number of real tags"
-            f.readline()
-            # integer tags
-            number_of_integer_tags = int(f.readline().decode('ascii'))  # usually 3 or 4
-            integer_tags = [int(f.readline().decode('ascii'))
-                            for i in range(number_of_integer_tags)]
-            nr = integer_tags[2]
-            nr_comp = integer_tags[1]
-            return section.strip(), name, nr, nr_comp
-
-        def read_NodeData(t, name, nr, nr_comp, m):
-            data = NodeData(np.empty((nr, nr_comp)), name=name, mesh=m)
-            if binary:
-                dt = np.dtype([
-                    ('id', np.int32, 1),
-                    ('values', np.float64, nr_comp)])
-
-                temp = np.fromfile(f, dtype=dt, count=nr)
-                node_number = np.copy(temp['id'])
-                data.value = np.copy(temp['values'])
-            else:
-                node_number = np.empty(nr, dtype='int32')
-                data.value = np.empty((nr, nr_comp), dtype='float64')
-                for ii in range(nr):
-                    line = f.readline().decode('ascii').split()
-                    node_number[ii] = int(line[0])
-                    data.value[ii, :] = [float(v) for v in line[1:]]
-
-            if f.readline() != b'$EndNodeData\n':
-                raise IOError(fn + " expected $EndNodeData after reading " +
-                              str(nr) + " lines in $NodeData")
-
-            if np.any(node_number != m.nodes.elm_number):
-                raise IOError("Can't read NodeData field: "
-                              "it does not have one data point per node")
-
-            return data
-
-        def read_ElementData(t, name, nr, nr_comp, m):
-            if not np.all(read):
-                raise IOError('Could not read ElementData: '
-                              'Element ordering not compact or invalid element type')
-            data = ElementData(np.empty((nr, nr_comp)), name=name, mesh=m)
-            if binary:
-                dt = np.dtype([
-                    ('id', np.int32, 1),
-                    ('values', np.float64, nr_comp)])
-
-                temp = np.fromfile(f, dtype=dt, count=nr)
-                elm_number = np.copy(temp['id'])
-                data.value = np.copy(temp['values'])
-
-            else:
-                elm_number = np.empty(nr, dtype='int32')
-                data.value = np.empty([nr, nr_comp], dtype='float64')
-
-                for ii in range(nr):
-                    line = f.readline().decode('ascii').split()
-                    elm_number[ii] = int(line[0])
-                    data.value[ii, :] = [float(jj) for jj in line[1:]]
-
-            if f.readline() != b'$EndElementData\n':
-                raise IOError(fn + " expected $EndElementData after reading " +
-                              str(nr) + " lines in $ElementData")
-
-            if np.any(elm_number != m.elm.elm_number):
-                raise IOError("Can't read ElementData field: "
-                              "it does not have one data point per element")
-
-            return data
-
-        # read sections recursively
-        def read_next_section():
-            t, name, nr, nr_comp = parse_Data()
-            if t == 'EOF':
-                return
-            elif t == b'$NodeData':
-                m.nodedata.append(read_NodeData(t, name, nr, nr_comp, m))
-            elif t == b'$ElementData':
-                m.elmdata.append(read_ElementData(t, name, nr, nr_comp, m))
-            else:
-                raise IOError("Can't recognize section name:" + t)
-
-            read_next_section()
-            return
-
         if not skip_data:
-            read_next_section()
+            sections = _index_msh_data(f, fn, binary)
+            _read_msh_data(
+                f, m, binary, sections, elm_ok=np.all(read), buf=buf,
+                fields=fields, lazy=lazy
+            )
     m.compact_ordering(node_number)
     return m
 
 
 # write msh to mesh file
-def write_msh(msh, file_name=None, mode='binary', mmg_fix=False):
+def write_msh(msh, file_name=None, mode='binary', mmg_fix=False, n_workers=2):
     """ Writes a gmsh 'msh' file
 
     Parameters
@@ -5836,6 +5871,11 @@ def write_msh(msh, file_name=None, mode='binary', mmg_fix=False):
         Name of file to be writte. Default: msh.fn
     mode: 'binary' or 'ascii':
         The mode in which the file should be read
+    mmg_fix: bool (optional)
+        Write the NodeData headers in the format expected by MMG. Default: False
+    n_workers: int (optional)
+        Number of threads preparing the NodeData and ElementData sections while
+        the file is written. Default: 2
     """
     if file_name is not None:
         msh.fn = file_name
@@ -5848,6 +5888,12 @@ def write_msh(msh, file_name=None, mode='binary', mmg_fix=False):
     if mode not in ['ascii', 'binary']:
         raise ValueError("Only 'ascii' and 'binary' are allowed")
 
+    unsupported = np.setdiff1d(msh.elm.elm_type, [15, 1, 2, 4])
+    if len(unsupported) > 0:
+        raise IOError(
+            "ERROR: cant write meshes with elements of type",
+            unsupported[0])
+
     with open(fn, 'wb') as f:
         if mode == 'ascii':
             f.write(b'$MeshFormat\n2.2 0 8\n$EndMeshFormat\n')
@@ -5860,116 +5906,87 @@ def write_msh(msh, file_name=None, mode='binary', mmg_fix=False):
         # write nodes
         f.write(b'$Nodes\n')
         f.write('{0}\n'.format(msh.nodes.nr).encode('ascii'))
-
         if mode == 'ascii':
-            for ii in range(msh.nodes.nr):
-                f.write((str(msh.nodes.node_number[ii]) + ' ' +
-                         str(msh.nodes.node_coord[ii][0]) + ' ' +
-                         str(msh.nodes.node_coord[ii][1]) + ' ' +
-                         str(msh.nodes.node_coord[ii][2]) + '\n').encode('ascii'))
+            f.write(_format_ascii(msh.nodes.node_number, msh.nodes.node_coord))
 
         elif mode == 'binary':
-            node_number = msh.nodes.node_number.astype('int32')
-            node_coord = msh.nodes.node_coord.astype('float64')
-            m = node_number[:, np.newaxis]
-            for i in range(3):
-                nc = node_coord[:, i].astype('float64')
-                m = np.concatenate((m,
-                                    nc.view('int32').reshape(-1, 2)), axis=1)
-            f.write(m.tobytes())
+            nodes = np.empty(msh.nodes.nr, dtype=[('id', '<i4'), ('coord', '<f8', (3,))])
+            nodes['id'] = msh.nodes.node_number
+            nodes['coord'] = msh.nodes.node_coord
+            f.write(nodes)
         f.write(b'$EndNodes\n')
-        # write elements
+
+        # write elements, one block per element type
         f.write(b'$Elements\n')
         f.write((str(msh.elm.nr) + '\n').encode('ascii'))
+        for elm_type, nr_nodes in [(15, 1), (1, 2), (2, 3), (4, 4)]:
+            idx = np.flatnonzero(msh.elm.elm_type == elm_type)
+            if len(idx) == 0:
+                continue
+            # [elm_number, (elm_type, number_of_tags,) tag1, tag2, nodes]
+            block = np.empty(
+                (len(idx), 3 + nr_nodes + 2 * (mode == 'ascii')), dtype='<i4')
+            block[:, 0] = msh.elm.elm_number[idx]
+            if mode == 'ascii':
+                block[:, 1] = elm_type
+                block[:, 2] = 2
+            block[:, -nr_nodes - 2] = msh.elm.tag1[idx]
+            block[:, -nr_nodes - 1] = msh.elm.tag2[idx]
+            block[:, -nr_nodes:] = msh.elm.node_number_list[idx, :nr_nodes]
+            if mode == 'ascii':
+                f.write(_format_ascii(block))
+            else:
+                f.write(np.array((elm_type, len(idx), 2), '<i4'))
+                f.write(block)
 
-        if mode == 'ascii':
-            for ii in range(msh.elm.nr):
-                line = str(msh.elm.elm_number[ii]) + ' ' + \
-                    str(msh.elm.elm_type[ii]) + ' ' + str(2) + ' ' +\
-                    str(msh.elm.tag1[ii]) + ' ' + str(msh.elm.tag2[ii]) + ' '
-
-                if msh.elm.elm_type[ii] == 2:
-                    line += str(msh.elm.node_number_list[ii, :3]
-                                ).translate(None, '[](),') + '\n'
-                elif msh.elm.elm_type[ii] == 4:
-                    line += str(msh.elm.node_number_list[ii, :]
-                                ).translate(None, '[](),') + '\n'
-                elif msh.elm.elm_type[ii] == 15:
-                    line += str(msh.elm.node_number_list[ii, :1]
-                                ).translate(None, '[](),') + '\n'
-                elif msh.elm.elm_type[ii] == 1:
-                    line += str(msh.elm.node_number_list[ii, :2]
-                                ).translate(None, '[](),') + '\n'
-                else:
-                    raise IOError(
-                        "ERROR: cant write meshes with elements of type",
-                        msh.elm.elm_type[ii])
+        f.write(b'$EndElements\n')
 
-                f.write(line.encode('ascii'))
+        # write nodeData and elementData, preparing the next sections in
+        # other threads while the current one is written
+        def blocks(data):
+            if isinstance(data, NodeData):
+                return data._msh_blocks(mode, mmg_fix)
+            return data._msh_blocks(mode)
+
+        fields = msh.nodedata + msh.elmdata
+        if n_workers > 1 and len(fields) > 1:
+            with ThreadPoolExecutor(n_workers) as executor:
+                pending = deque()
+                for data in fields:
+                    pending.append(executor.submit(blocks, data))
+                    if len(pending) > n_workers:
+                        f.writelines(pending.popleft().result())
+                while pending:
+                    f.writelines(pending.popleft().result())
+        else:
+            for data in fields:
+                f.writelines(blocks(data))
 
-        elif mode == 'binary':
-            points = np.where(msh.elm.elm_type == 15)[0]
-            if len(points > 0):
-                points_header = np.array((15, len(points), 2), 'int32')
-                points_number = msh.elm.elm_number[points].astype('int32')
-                points_tag1 = msh.elm.tag1[points].astype('int32')
-                points_tag2 = msh.elm.tag2[points].astype('int32')
-                points_node_list = msh.elm.node_number_list[
-                    points, :1].astype('int32')
-                f.write(points_header.tobytes())
-                f.write(np.concatenate((points_number[:, np.newaxis],
-                                        points_tag1[:, np.newaxis],
-                                        points_tag2[:, np.newaxis],
-                                        points_node_list), axis=1).tobytes())
-            lines = np.where(msh.elm.elm_type == 1)[0]
-            if len(lines > 0):
-                lines_header = np.array((1, len(lines), 2), 'int32')
-                lines_number = msh.elm.elm_number[lines].astype('int32')
-                lines_tag1 = msh.elm.tag1[lines].astype('int32')
-                lines_tag2 = msh.elm.tag2[lines].astype('int32')
-                lines_node_list = msh.elm.node_number_list[
-                    lines, :2].astype('int32')
-                f.write(lines_header.tobytes())
-                f.write(np.concatenate((lines_number[:, np.newaxis],
-                                        lines_tag1[:, np.newaxis],
-                                        lines_tag2[:, np.newaxis],
-                                        lines_node_list), axis=1).tobytes())
-            triangles = np.where(msh.elm.elm_type == 2)[0]
-            if len(triangles > 0):
-                triangles_header = np.array((2, len(triangles), 2), 'int32')
-                triangles_number = msh.elm.elm_number[triangles].astype('int32')
-                triangles_tag1 = msh.elm.tag1[triangles].astype('int32')
-                triangles_tag2 = msh.elm.tag2[triangles].astype('int32')
-                triangles_node_list = msh.elm.node_number_list[
-                    triangles, :3].astype('int32')
-                f.write(triangles_header.tobytes())
-                f.write(np.concatenate((triangles_number[:, np.newaxis],
-                                        triangles_tag1[:, np.newaxis],
-                                        triangles_tag2[:, np.newaxis],
-                                        triangles_node_list), axis=1).tobytes())
-
-            tetra = np.where(msh.elm.elm_type == 4)[0]
-            if len(tetra > 0):
-                tetra_header = np.array((4, len(tetra), 2), 'int32')
-                tetra_number = msh.elm.elm_number[tetra].astype('int32')
-                tetra_tag1 = msh.elm.tag1[tetra].astype('int32')
-                tetra_tag2 = msh.elm.tag2[tetra].astype('int32')
-                tetra_node_list = msh.elm.node_number_list[tetra].astype('int32')
-
-                f.write(tetra_header.tobytes())
-                f.write(np.concatenate((tetra_number[:, np.newaxis],
-                                        tetra_tag1[:, np.newaxis],
-                                        tetra_tag2[:, np.newaxis],
-                                        tetra_node_list), axis=1).tobytes())
 
-        f.write(b'$EndElements\n')
+def _format_ascii(number, values=None):
+    ''' Formats rows of numbers as lines of text
 
-    # write nodeData, if existent
-    for nd in msh.nodedata:
-        nd.append_to_mesh(fn, mode, mmg_fix)
+    Parameters
+    -----------
+    number: ndarray of ints
+        Integer values. Either a column (N,) with the row numbers or a N x M array
+    values: N x K ndarray (optional)
+        Floating point values to be written after the integers
 
-    for eD in msh.elmdata:
-        eD.append_to_mesh(fn, mode)
+    Returns
+    ---------
+    text: bytes
+        One line per row, separated by spaces
+    '''
+    number = np.asarray(number).reshape(len(number), -1)
+    fmt = ['%d'] * number.shape[1]
+    if values is not None:
+        values = np.asarray(values, dtype=float).reshape(len(number), -1)
+        fmt += ['%.17g'] * values.shape[1]
+        number = np.hstack([number.astype(object), values.astype(object)])
+    f = io.BytesIO()
+    np.savetxt(f, number, fmt=' '.join(fmt))
+    return f.getvalue()
 
 
 '''
@@ -6549,7 +6566,7 @@ def read_off(fn):
     return make_surface_mesh(vertices, faces+1)
 
 def read(fn):
-    """Read a mesh from disk. Reads gii,[ mesh,] msh, off, stl, and freesurface
+    """Read a mesh from disk. Reads gii,[ mesh,] msh, meshb, off, stl, and freesurface
     surface files.
 
     PARAMETERS
@@ -6570,6 +6587,8 @@ def read(fn):
         msh = read_gifti_surface(fn)
     #elif ext == ".mesh":
     #    msh = read_medit(fn)
+    elif ext == ".meshb":
+        msh = read_meshb(fn)
     elif ext == ".msh":
         msh = read_msh(fn) # m arg not supported...
     elif ext == ".off":
@@ -6700,6 +6719,184 @@ def read_medit(fn):
         return Msh(nodes, elm)
 
 
+# Keywords of the binary MEDIT (GMF) format
+_GMF_DIMENSION = 3
+_GMF_VERTICES = 4
+_GMF_EDGES = 5
+_GMF_TRIANGLES = 6
+_GMF_TETRAHEDRA = 8
+_GMF_END = 54
+_GMF_SOL_AT_VERTICES = 62
+# GMF keyword: (gmsh element type, number of nodes)
+_GMF_ELEMENTS = {
+    _GMF_EDGES: (1, 2),
+    _GMF_TRIANGLES: (2, 3),
+    _GMF_TETRAHEDRA: (4, 4),
+}
+
+
+def _gmf_types(version, byteorder='<'):
+    ''' Data types of the reals, integers and file positions in a GMF file '''
+    if version not in [1, 2, 3, 4]:
+        raise IOError(f'Unsupported .meshb version: {version}')
+    real = byteorder + ('f4' if version == 1 else 'f8')
+    integer = byteorder + ('i8' if version == 4 else 'i4')
+    position = byteorder + ('i8' if version >= 3 else 'i4')
+    return real, integer, position
+
+
+def read_meshb(fn):
+    ''' Reads a binary MEDIT ".meshb" file
+
+    Reads the vertices, edges, triangles and tetrahedra, other keywords are
+    skipped. The element references are stored in tag1 and tag2
+
+    Parameters
+    -----------
+    fn: str
+        Name of the file
+
+    Returns
+    --------
+    mesh: Msh
+        Mesh class
+    '''
+    with open(fn, 'rb') as f:
+        code = np.fromfile(f, '<i4', 1)
+        if len(code) == 0 or code[0] not in [1, 1 << 24]:
+            raise IOError(f'{fn} is not a binary MEDIT file')
+        byteorder = '<' if code[0] == 1 else '>'
+        version = int(np.fromfile(f, byteorder + 'i4', 1)[0])
+        real, integer, position = _gmf_types(version, byteorder)
+        kwd_header = np.dtype([('kwd', byteorder + 'i4'), ('next', position)])
+        vertices = np.zeros((0, 3), dtype=float)
+        elements = {}
+        while True:
+            header = np.fromfile(f, kwd_header, 1)
+            if len(header) == 0 or header['kwd'][0] == _GMF_END:
+                break
+            kwd, next_pos = int(header['kwd'][0]), int(header['next'][0])
+            if kwd == _GMF_DIMENSION:
+                if int(np.fromfile(f, integer, 1)[0]) != 3:
+                    raise IOError('Can only read 3D meshes')
+            elif kwd == _GMF_VERTICES:
+                n = int(np.fromfile(f, integer, 1)[0])
+                data = np.fromfile(
+                    f, np.dtype([('x', real, 3), ('ref', integer)]), n)
+                vertices = data['x'].astype(float)
+            elif kwd in _GMF_ELEMENTS:
+                n = int(np.fromfile(f, integer, 1)[0])
+                n_nodes = _GMF_ELEMENTS[kwd][1]
+                elements[kwd] = np.fromfile(
+                    f, np.dtype([('v', integer, n_nodes), ('ref', integer)]), n)
+            if next_pos == 0:
+                break
+            f.seek(next_pos)
+
+    elm = Elements()
+    node_number_list, elm_type, tag = [elm.node_number_list], [elm.elm_type], [elm.tag1]
+    for kwd in sorted(elements):
+        data = elements[kwd]
+        nnl = -np.ones((len(data), 4), dtype='int32')
+        nnl[:, :_GMF_ELEMENTS[kwd][1]] = data['v'].reshape(len(data), -1)
+        node_number_list.append(nnl)
+        elm_type.append(np.full(len(data), _GMF_ELEMENTS[kwd][0], dtype='int8'))
+        tag.append(data['ref'].astype('int16'))
+    elm.node_number_list = np.vstack(node_number_list)
+    elm.elm_type = np.hstack(elm_type)
+    elm.tag1 = np.hstack(tag)
+    elm.tag2 = elm.tag1.copy()
+    return Msh(Nodes(vertices), elm)
+
+
+def _write_gmf(fn, blocks, version=2):
+    ''' Writes a binary GMF file
+
+    Parameters
+    -----------
+    fn: str
+        Name of the file
+    blocks: list of (keyword, header, data)
+        header is a list of integers written after the file position, data is a
+        structured array or None
+    version: int
+        File version, 2 or 3. Version 2 files are limited to 2 GB
+    '''
+    _, integer, position = _gmf_types(version)
+    pos = 8
+    with open(fn, 'wb') as f:
+        np.array([1, version], '<i4').tofile(f)
+        for kwd, header, data in blocks:
+            pos += 4 + np.dtype(position).itemsize + 4 * len(header)
+            if data is not None:
+                pos += data.nbytes
+            if pos >= 2 ** 31 and version < 3:
+                raise ValueError('File too large for .meshb version 2')
+            np.array([kwd], '<i4').tofile(f)
+            np.array([pos], position).tofile(f)
+            np.array(header, integer).tofile(f)
+            if data is not None:
+                data.tofile(f)
+        np.array([_GMF_END], '<i4').tofile(f)
+        np.array([0], position).tofile(f)
+
+
+def write_meshb(msh, fn):
+    ''' Writes the vertices, lines, triangles and tetrahedra of a mesh in a binary
+    MEDIT ".meshb" file, with tag1 as the element references
+
+    Parameters
+    -----------
+    msh: Msh
+        Mesh object
+    fn: str
+        Name of the file
+    '''
+    vertices = np.zeros(
+        msh.nodes.nr, dtype=np.dtype([('x', '<f8', 3), ('ref', '<i4')]))
+    vertices['x'] = msh.nodes.node_coord
+    blocks = [
+        (_GMF_DIMENSION, [3], None),
+        (_GMF_VERTICES, [len(vertices)], vertices)
+    ]
+    for kwd, (elm_type, n_nodes) in sorted(_GMF_ELEMENTS.items()):
+        sel = msh.elm.elm_type == elm_type
+        if not np.any(sel):
+            continue
+        data = np.empty(
+            np.count_nonzero(sel),
+            dtype=np.dtype([('v', '<i4', n_nodes), ('ref', '<i4')]))
+        data['v'] = msh.elm.node_number_list[sel, :n_nodes]
+        data['ref'] = msh.elm.tag1[sel]
+        blocks.append((kwd, [len(data)], data))
+    try:
+        _write_gmf(fn, blocks, 2)
+    except ValueError:
+        _write_gmf(fn, blocks, 3)
+
+
+def write_solb(values, fn):
+    ''' Writes a scalar field defined in the vertices in a binary MEDIT ".solb"
+    file, e.g. a metric for mmg
+
+    Parameters
+    -----------
+    values: ndarray
+        Value in each vertex
+    fn: str
+        Name of the file
+    '''
+    values = np.ascontiguousarray(values, dtype='<f8').reshape(-1)
+    blocks = [
+        (_GMF_DIMENSION, [3], None),
+        (_GMF_SOL_AT_VERTICES, [len(values), 1, 1], values)
+    ]
+    try:
+        _write_gmf(fn, blocks, 2)
+    except ValueError:
+        _write_gmf(fn, blocks, 3)
+
+
 
 def open_in_gmsh(fn, new_thread=False):
     ''' Opens the mesh in gmsh
@@ -6723,6 +6920,32 @@ def open_in_gmsh(fn, new_thread=False):
         subprocess.run([gmsh_bin, fn], check=True)
 
 
+def _triangle_adjacency(tr, n_nodes):
+    ''' Sparse (n_nodes x n_nodes) matrix with the neighbours of each node in
+    the triangles tr (0-based), built from the triangle edges in one go '''
+    edges = tr[:, [[0, 1], [1, 2], [2, 0]]].reshape(-1, 2)
+    edges = np.vstack([edges, edges[:, ::-1]])
+    edges = edges[edges[:, 0] != edges[:, 1]]
+    adj = scipy.sparse.coo_matrix(
+        (np.ones(len(edges), dtype=bool), (edges[:, 0], edges[:, 1])),
+        shape=(n_nodes, n_nodes)
+    ).tocsr()
+    adj.sum_duplicates()
+    return adj
+
+
+def _run_in_chunks(pool, n_chunks, n, func):
+    ''' Calls func(chunk) for n_chunks contiguous slices of range(n), in a
+    thread pool if n_chunks > 1 '''
+    bounds = np.linspace(0, n, max(1, min(n_chunks, n)) + 1).astype(int)
+    chunks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+    if len(chunks) == 1:
+        func(chunks[0])
+    else:
+        for f in [pool.submit(func, c) for c in chunks]:
+            f.result()
+
+
 def _hash_rows(array, mult=1000003, dtype=np.uint64):
     # Code based on python's tupleobject hasing
     # Generate hash
@@ -1,4 +1,5 @@
 import os
+import shutil
 import tempfile
 import logging
 import numpy as np
@@ -6,6 +7,7 @@ import nibabel as nib
 import scipy.sparse
 import scipy.ndimage
 import time
+from subprocess import CalledProcessError
 
 from simnibs.utils import transformations
 
@@ -1394,10 +1396,103 @@ def _relabel_microtets(m, el_max = 0.0001):
     return m
 
 
+def _mmg_cmd(fn_in, fn_out, mmg_noinsert=True, sizing_field=None, fn_sol=None):
+    """ Command line call of mmg """
+    cmd = [file_finder.path2bin("mmg3d_O3"), "-v", "6", "-nosurf", "-nofem", "-hgrad", "-1", "-rmc"]
+    if mmg_noinsert:
+        cmd += ["-noinsert"]
+    elif sizing_field is None:
+        cmd += ["-hsiz", "100.0", "-hmin", "1.3"]
+    # else: hsiz is coming from the sizing field
+    cmd += ["-in", fn_in, "-out", fn_out]
+    if fn_sol is not None:
+        cmd += ["-sol", fn_sol]
+    return cmd
+
+
+def _mmg_tmpdir(m):
+    """ Temporary directory for the files exchanged with mmg
+
+    Uses /dev/shm (memory) if it is available and has space for the files
+    """
+    shm = "/dev/shm"
+    # input and output mesh, sizing field, and some margin
+    size = 4 * (32 * m.nodes.nr + 20 * m.elm.nr)
+    try:
+        if os.access(shm, os.W_OK) and shutil.disk_usage(shm).free > size:
+            return tempfile.mkdtemp(prefix="simnibs_mmg_", dir=shm)
+    except OSError:
+        pass
+    return tempfile.mkdtemp(prefix="simnibs_mmg_")
+
+
+def _run_mmg_meshb(m, repeats, mmg_noinsert, sizing_field, affine, tmpdir):
+    """ Runs mmg exchanging the mesh in binary MEDIT (.meshb) files """
+    fn_in = os.path.join(tmpdir, "in.meshb")
+    fn_out = os.path.join(tmpdir, "out.meshb")
+    fn_sol = os.path.join(tmpdir, "in.solb")
+    for i in range(repeats):
+        # sizing field in the nodes, from the sizing image or from a ":metric" field
+        if sizing_field is not None:
+            mmg_sizing_field = np.copy(sizing_field)
+            mmg_sizing_field[mmg_sizing_field <= 0] = 100.0
+            m.add_sizing_field(sizing_field=mmg_sizing_field, affine=affine)
+            metric = m.nodedata.pop().value
+            del mmg_sizing_field
+        else:
+            metric = next(
+                (d.value for d in m.nodedata if ':metric' in d.field_name), None)
+
+        mesh_io.write_meshb(m, fn_in)
+        if metric is not None:
+            mesh_io.write_solb(metric, fn_sol)
+        del m
+        spawn_process(
+            _mmg_cmd(fn_in, fn_out, mmg_noinsert, sizing_field,
+                     None if metric is None else fn_sol),
+            lvl=logging.DEBUG
+        )
+
+        m = mesh_io.read_meshb(fn_out)
+        m = m.crop_mesh(elm_type=[2, 4])
+
+        logger.info(f'Tetraedras after remeshing run {i + 1}: {len(m.elm.tetrahedra)}')
+    return m
+
+
+def _run_mmg_msh(m, repeats, mmg_noinsert, sizing_field, affine, tmpdir):
+    """ Runs mmg exchanging the mesh in .msh files """
+    tmp_in = os.path.join(tmpdir, "in.msh")
+    tmp_out = os.path.join(tmpdir, "out.msh")
+    cmd = _mmg_cmd(tmp_in, tmp_out, mmg_noinsert, sizing_field)
+    for i in range(repeats):
+        # add user defined sizing field from sizing image to mesh in a NodeData field called "sizing_field:metric" for mmg
+        if sizing_field is not None:
+            mmg_sizing_field = np.copy(sizing_field)
+            mmg_sizing_field[mmg_sizing_field <= 0] = 100.0
+            m.add_sizing_field(sizing_field=mmg_sizing_field, affine=affine)
+            del mmg_sizing_field
+
+        mesh_io.write_msh(m, tmp_in, mmg_fix=True)
+        del m
+        spawn_process(cmd, lvl=logging.DEBUG)
+
+        # read mesh written by MMG (msh in ascii format)
+        m = mesh_io.read_msh(tmp_out, skip_data=True)
+        m = m.crop_mesh(elm_type=[2, 4])
+
+        logger.info(f'Tetraedras after remeshing run {i + 1}: {len(m.elm.tetrahedra)}')
+    return m
+
+
 def _run_mmg(m, repeats=2, mmg_noinsert=True, sizing_field=None, affine=None):
     """
     Wrapper around mmg command line call to improve mesh quality.
 
+    The mesh is exchanged with mmg in binary MEDIT (.meshb) files, in memory
+    (/dev/shm) if possible. The same files are reused in all repeats. If this
+    fails, falls back to .msh files.
+
     Parameters
     ----------
     m : simnibs.Msh
@@ -1418,50 +1513,20 @@ def _run_mmg(m, repeats=2, mmg_noinsert=True, sizing_field=None, affine=None):
         Mesh structure.
     """
     logger.info('Improving Mesh Quality')
-    with tempfile.NamedTemporaryFile(suffix=".msh", delete=False) as tmpfile:
-        tmp_in = tmpfile.name
-    with tempfile.NamedTemporaryFile(suffix=".msh", delete=False) as tmpfile:
-        tmp_out = tmpfile.name
+    tmpdir = _mmg_tmpdir(m)
+    try:
+        return _run_mmg_meshb(m, repeats, mmg_noinsert, sizing_field, affine, tmpdir)
+    except (OSError, ValueError, CalledProcessError) as e:
+        logger.warning(f'Running mmg with .meshb files failed ({e}), using .msh files')
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    # set MMG command
-    if mmg_noinsert:
-        cmd = [file_finder.path2bin("mmg3d_O3"), "-v", "6", "-nosurf", "-nofem", "-hgrad", "-1", "-rmc", "-noinsert",
-               "-in", tmp_in, "-out", tmp_out]
-    else:
-        if sizing_field is not None:
-            # hsiz is now coming from the sizing field
-            cmd = [file_finder.path2bin("mmg3d_O3"), "-v", "6", "-nosurf", "-nofem", "-hgrad", "-1", "-rmc",
-                   "-in", tmp_in, "-out", tmp_out]
-        else:
-            cmd = [file_finder.path2bin("mmg3d_O3"), "-v", "6", "-nosurf", "-nofem", "-hgrad", "-1", "-rmc",
-                   "-hsiz", "100.0", "-hmin", "1.3", "-in", tmp_in, "-out", tmp_out]
-        
-    # run MMG to improve mesh
-    for i in range(repeats):
-        # add user defined sizing field from sizing image to mesh in a NodeData field called "sizing_field:metric" for mmg
-        if sizing_field is not None:
-            mmg_sizing_field = np.copy(sizing_field)
-            mmg_sizing_field[mmg_sizing_field <= 0] = 100.0
-            m.add_sizing_field(sizing_field=mmg_sizing_field, affine=affine)
-            del mmg_sizing_field
-
-        mesh_io.write_msh(m, tmp_in, mmg_fix=True)
-        del m
-        spawn_process(cmd, lvl=logging.DEBUG)
+    tmpdir = tempfile.mkdtemp(prefix="simnibs_mmg_")
+    try:
+        return _run_mmg_msh(m, repeats, mmg_noinsert, sizing_field, affine, tmpdir)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-        # read mesh written by MMG (msh in ascii format)
-        m = mesh_io.read_msh(tmp_out, skip_data=True)
-        m = m.crop_mesh(elm_type=[2, 4])
-
-        logger.info(f'Tetraedras after remeshing run {i + 1}: {len(m.elm.tetrahedra)}')
-
-    # remove tmp-files
-    if os.path.exists(tmp_in):
-        os.remove(tmp_in)
-    if os.path.exists(tmp_out):
-        os.remove(tmp_out)
-    return m
-    
 
 def create_mesh(label_img, affine,
                 elem_sizes={"standard": {"range": [1, 5], "slope": 1.0}},
@@ -1708,11 +1773,13 @@ def create_mesh(label_img, affine,
     # smooth surfaces
     if smooth_steps > 0:
         logger.info('Smoothing Mesh Surfaces')
-        m.smooth_surfaces(smooth_steps, step_size=0.3, max_gamma=10)
+        m.smooth_surfaces(smooth_steps, step_size=0.3, max_gamma=10,
+                          num_threads=num_threads)
 
     if skin_care > 0:
         logger.info('Extra Skin Care')
-        m.smooth_surfaces(skin_care, step_size=0.3, tags=skin_tag, max_gamma=10)
+        m.smooth_surfaces(skin_care, step_size=0.3, tags=skin_tag, max_gamma=10,
+                          num_threads=num_threads)
 
     if debug:
         mesh_io.write_msh(m, os.path.join(debug_path, 'before_mmg.msh'), mmg_fix=True)
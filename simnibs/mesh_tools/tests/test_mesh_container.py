@@ -0,0 +1,109 @@
+import copy
+import os
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from ... import SIMNIBSDIR
+from .. import mesh_io
+from .. import mesh_container
+
+
+@pytest.fixture(scope='module')
+def sphere3_msh():
+    fn = os.path.join(
+            SIMNIBSDIR, '_internal_resources', 'testing_files', 'sphere3.msh')
+    return mesh_io.read_msh(fn)
+
+
+@pytest.fixture
+def sphere3_fields(sphere3_msh):
+    m = copy.deepcopy(sphere3_msh)
+    m.nodedata = [mesh_io.NodeData(m.nodes.node_coord[:, 0], 'x', mesh=m)]
+    m.elmdata = [
+        mesh_io.ElementData(m.elm.tag1.astype(float), 'tag', mesh=m),
+        mesh_io.ElementData(m.elements_baricenters().value, 'bar', mesh=m)
+    ]
+    return m
+
+
+class TestMeshContainer:
+    def test_write_read(self, sphere3_fields, tmpdir):
+        m = sphere3_fields
+        fn = str(tmpdir.join('results.hdf5'))
+        with mesh_container.MeshContainer(fn, 'w') as c:
+            c.add_result('a', m.nodedata + m.elmdata, mesh=m)
+            c.add_result('b', m.elmdata[:1], mesh=m)
+        with mesh_container.MeshContainer(fn) as c:
+            assert c.results == ['a', 'b']
+            assert c.fields('a') == ['x', 'bar', 'tag']
+            assert c.hash == mesh_container.mesh_hash(m)
+            m2 = c.read('a')
+            assert c.fields('b') == ['tag']
+        assert np.allclose(m2.nodes.node_coord, m.nodes.node_coord)
+        assert np.all(m2.elm.node_number_list == m.elm.node_number_list)
+        assert np.all(m2.elm.tag1 == m.elm.tag1)
+        assert np.all(m2.elm.elm_type == m.elm.elm_type)
+        assert m2.field['x'].value.dtype == np.float64
+        assert np.allclose(m2.field['x'].value, m.field['x'].value, rtol=1e-6)
+        assert np.allclose(m2.field['bar'].value, m.field['bar'].value, rtol=1e-6)
+        assert np.all(m2.field['tag'].value == m.field['tag'].value)
+
+    @pytest.mark.parametrize('max_gap', [0, 1024])
+    def test_read_tags(self, max_gap, sphere3_fields, tmpdir):
+        m = sphere3_fields
+        fn = str(tmpdir.join('results.hdf5'))
+        with mesh_container.MeshContainer(fn, 'w') as c:
+            c.add_result('a', m.nodedata + m.elmdata, mesh=m)
+        with mesh_container.MeshContainer(fn) as c, \
+             patch.object(mesh_container, '_MAX_ROW_GAP', max_gap):
+            m2 = c.read('a', fields=['x', 'tag'], tags=[4, 1004])
+        assert [d.field_name for d in m2.nodedata + m2.elmdata] == ['x', 'tag']
+        assert np.all(np.isin(m2.elm.tag1, [4, 1004]))
+        assert m2.elm.nr == np.sum(np.isin(m.elm.tag1, [4, 1004]))
+        assert np.allclose(m2.field['x'].value, m2.nodes.node_coord[:, 0], rtol=1e-6)
+        assert np.all(m2.field['tag'].value == m2.elm.tag1)
+        cropped = m.crop_mesh(tags=[4, 1004])
+        assert np.isclose(np.sum(m2.elements_volumes_and_areas().value),
+                          np.sum(cropped.elements_volumes_and_areas().value))
+
+    def test_read_rows(self, tmpdir):
+        data = np.random.rand(10000, 3)
+        read = []
+
+        class Dataset:
+            shape = data.shape
+            dtype = data.dtype
+
+            def __getitem__(self, s):
+                read.append(s)
+                return data[s]
+
+        rows = np.array([1, 2, 5, 4000, 4001, 9999])
+        c = mesh_container.MeshContainer.__new__(mesh_container.MeshContainer)
+        with patch.object(mesh_container, '_MAX_ROW_GAP', 10):
+            assert np.all(c._read_rows(Dataset(), rows) == data[rows])
+        assert read == [slice(1, 6), slice(4000, 4002), slice(9999, 10000)]
+
+    def test_different_mesh(self, sphere3_msh, tmpdir):
+        m = sphere3_msh
+        fn = str(tmpdir.join('results.hdf5'))
+        m2 = m.crop_mesh(tags=[4])
+        with mesh_container.MeshContainer(fn, 'w') as c:
+            c.write_mesh(m)
+            with pytest.raises(ValueError):
+                c.add_result('a', [], mesh=m2)
+
+    def test_pack_msh_files(self, sphere3_fields, tmpdir):
+        m = sphere3_fields
+        fn_msh = [str(tmpdir.join('pos{0}.msh'.format(i))) for i in range(2)]
+        for fn in fn_msh:
+            mesh_io.write_msh(m, fn)
+        fn = str(tmpdir.join('results.hdf5'))
+        names = mesh_container.pack_msh_files(fn, fn_msh)
+        assert names == ['pos0', 'pos1']
+        with mesh_container.MeshContainer(fn) as c:
+            assert c.results == names
+            m2 = c.read('pos1', fields=['tag'])
+        assert np.all(m2.field['tag'].value == m.field['tag'].value)
@@ -135,6 +135,123 @@ class TestGmshRead:
         np.testing.assert_array_equal(sphere3_msh.elm.node_number_list[-1, :],
                                       np.array([31, 4149, 4272, 1118]))
 
+    def test_read_mmap(self, sphere3_msh, tmp_path):
+        m = copy.deepcopy(sphere3_msh)
+        m.add_node_field(np.random.rand(m.nodes.nr, 3), 'vec')
+        m.add_element_field(np.random.rand(m.elm.nr), 'scalar')
+        fn = str(tmp_path / 'mmap.msh')
+        m.write(fn)
+        m2 = mesh_io.read_msh(fn, mmap=True)
+        assert np.allclose(m2.nodes[:], m.nodes[:])
+        assert np.all(m2.elm[:] == m.elm[:])
+        assert np.all(m2.field['vec'][:] == m.field['vec'][:])
+        assert np.all(m2.field['scalar'][:] == m.field['scalar'][:])
+        # Changes are not written to the file
+        m2.field['scalar'].value[:] = 0
+        m3 = mesh_io.read_msh(fn)
+        assert np.all(m3.field['scalar'][:] == m.field['scalar'][:])
+
+    @pytest.mark.parametrize('lazy', [False, True])
+    def test_read_fields(self, lazy, sphere3_msh, tmp_path):
+        m = copy.deepcopy(sphere3_msh)
+        m.add_node_field(np.random.rand(m.nodes.nr, 3), 'vec')
+        m.add_element_field(np.random.rand(m.elm.nr), 'scalar')
+        m.add_element_field(np.random.rand(m.elm.nr, 3), 'E')
+        fn = str(tmp_path / 'fields.msh')
+        m.write(fn)
+        m2 = mesh_io.read_msh(fn, fields=['vec', 'E'], lazy=lazy)
+        assert list(m2.field.keys()) == ['vec', 'E']
+        assert (m2.field['E']._load is not None) == lazy
+        assert np.all(m2.field['E'][:] == m.field['E'][:])
+        assert m2.field['E']._load is None
+        assert np.all(m2.field['vec'][:] == m.field['vec'][:])
+
+    def test_read_lazy_modified(self, sphere3_msh, tmp_path):
+        m = copy.deepcopy(sphere3_msh)
+        m.add_element_field(np.random.rand(m.elm.nr), 'scalar')
+        fn = str(tmp_path / 'lazy.msh')
+        m.write(fn)
+        m2 = mesh_io.read_msh(fn, lazy=True)
+        with open(fn, 'ab') as f:
+            f.write(b'\n')
+        with pytest.raises(IOError):
+            m2.field['scalar'].value
+
+    def test_read_ascii(self, tmp_path):
+        fn = str(tmp_path / 'ascii.msh')
+        with open(fn, 'w') as f:
+            f.write(
+                '$MeshFormat\n2.2 0 8\n$EndMeshFormat\n'
+                '$Nodes\n4\n1 0 0 0\n2 1 0 0\n3 0 1 0\n4 0 0 1.5\n$EndNodes\n'
+                '$Elements\n3\n1 2 2 1001 1001 1 2 3\n2 4 2 1 1 1 2 3 4\n'
+                '3 15 2 5 5 4\n$EndElements\n'
+                '$NodeData\n1\n"v"\n1\n0.0\n3\n0\n1\n4\n'
+                '1 0.5\n2 1.5\n3 2.5\n4 3.5\n$EndNodeData\n'
+                '$ElementData\n1\n"E"\n1\n0.0\n3\n0\n3\n3\n'
+                '1 1 2 3\n2 4 5 6\n3 7 8 9\n$EndElementData\n'
+            )
+        m = mesh_io.read_msh(fn)
+        assert np.allclose(m.nodes[4], [0, 0, 1.5])
+        assert np.all(m.elm.elm_type == [2, 4, 15])
+        assert np.all(m.elm.tag1 == [1001, 1, 5])
+        assert np.all(m.elm.node_number_list[:2] == [[1, 2, 3, -1], [1, 2, 3, 4]])
+        assert m.elm.node_number_list[2, 0] == 4
+        assert np.allclose(m.field['v'][:].squeeze(), [0.5, 1.5, 2.5, 3.5])
+        assert np.allclose(m.field['E'][3], [7, 8, 9])
+
+    @pytest.mark.parametrize('mode', ['binary', 'ascii'])
+    def test_write_read(self, mode, sphere3_msh, tmp_path):
+        m = copy.deepcopy(sphere3_msh)
+        m.add_node_field(np.random.rand(m.nodes.nr, 3), 'vec')
+        m.add_element_field(np.random.rand(m.elm.nr), 'scalar')
+        fn = str(tmp_path / 'write.msh')
+        mesh_io.write_msh(m, fn, mode=mode)
+        m2 = mesh_io.read_msh(fn)
+        assert np.all(m2.nodes[:] == m.nodes[:])
+        assert np.all(m2.elm.node_number_list == m.elm.node_number_list)
+        assert np.all(m2.elm.tag1 == m.elm.tag1)
+        assert np.all(m2.field['vec'][:] == m.field['vec'][:])
+        assert np.all(m2.field['scalar'][:].squeeze() == m.field['scalar'][:])
+        # The same file is written without threads and by appending the fields
+        fn2 = str(tmp_path / 'write2.msh')
+        mesh_io.write_msh(m, fn2, mode=mode, n_workers=1)
+        fn3 = str(tmp_path / 'write3.msh')
+        m3 = copy.deepcopy(m)
+        m3.nodedata, m3.elmdata = [], []
+        mesh_io.write_msh(m3, fn3, mode=mode)
+        for data in m.nodedata + m.elmdata:
+            data.append_to_mesh(fn3, mode)
+        with open(fn, 'rb') as f, open(fn2, 'rb') as f2, open(fn3, 'rb') as f3:
+            content = f.read()
+            assert content == f2.read()
+            assert content == f3.read()
+
+    @pytest.mark.parametrize('mode', ['binary', 'ascii'])
+    def test_write_unsupported_elm_type(self, mode, sphere3_msh, tmp_path):
+        m = copy.deepcopy(sphere3_msh)
+        m.elm.elm_type[0] = 3
+        fn = str(tmp_path / 'write.msh')
+        with pytest.raises(IOError):
+            mesh_io.write_msh(m, fn, mode=mode)
+        assert not os.path.exists(fn)
+
+    def test_read_v4_ascii(self, tmp_path):
+        fn = str(tmp_path / 'v4.msh')
+        with open(fn, 'w') as f:
+            f.write(
+                '$MeshFormat\n4 0 8\n$EndMeshFormat\n'
+                '$Nodes\n1 4\n1 3 0 4\n1 0 0 0\n2 1 0 0\n3 0 1 0\n4 0 0 1.5\n$EndNodes\n'
+                '$Elements\n2 2\n2 3 4 1\n2 1 2 3 4\n1001 2 2 1\n1 1 2 3\n$EndElements\n'
+                '$NodeData\n1\n"v"\n1\n0.0\n3\n0\n1\n4\n'
+                '1 0.5\n2 1.5\n3 2.5\n4 3.5\n$EndNodeData\n'
+            )
+        m = mesh_io.read_msh(fn)
+        assert np.allclose(m.nodes[4], [0, 0, 1.5])
+        assert np.all(m.elm.elm_type == [2, 4])
+        assert np.all(m.elm.tag1 == [1001, 2])
+        assert np.all(m.elm.node_number_list == [[1, 2, 3, -1], [1, 2, 3, 4]])
+        assert np.allclose(m.field['v'][:].squeeze(), [0.5, 1.5, 2.5, 3.5])
+
 
 class TestNodes:
 
@@ -792,6 +909,19 @@ class TestMsh:
         assert np.allclose(direction[corrensponding], tr_data,
                            rtol=1e-1, atol=1e-1)
 
+    def test_find_corresponding_tetrahedra_subset(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        triangles = m.elm.triangles[np.isin(m.elm.tag1[m.elm.triangles - 1],
+                                            [1003, 1005])]
+        subset = m.find_corresponding_tetrahedra(triangles)
+        m2 = copy.deepcopy(sphere3_msh)
+        full = m2.find_corresponding_tetrahedra()
+        assert np.all(subset == full[np.searchsorted(m2.elm.triangles, triangles)])
+        # also from the cache
+        subset = m2.find_corresponding_tetrahedra(triangles[::-1])
+        assert np.all(subset[::-1] ==
+                      full[np.searchsorted(m2.elm.triangles, triangles)])
+
     def test_fix_surface_labels(self, sphere3_msh):
         msh = copy.deepcopy(sphere3_msh)
         msh.elm.tag1[msh.elm.elm_type == 2] -= 1000
@@ -1171,6 +1301,16 @@ class TestMsh:
         low_q = mesh_before.gamma_metric()[:] >= 3
         assert np.all(mesh_before.gamma_metric()[~low_q] < 3)
 
+    def test_smooth_threads(self, sphere3_msh):
+        mesh = copy.deepcopy(sphere3_msh)
+        np.random.seed(0)
+        mesh.nodes.node_coord += \
+            np.random.standard_normal((mesh.nodes.nr, 3)) * 0.5
+        mesh_threads = copy.deepcopy(mesh)
+        mesh.smooth_surfaces(5, max_gamma=3)
+        mesh_threads.smooth_surfaces(5, max_gamma=3, num_threads=3)
+        assert np.all(mesh.nodes.node_coord == mesh_threads.nodes.node_coord)
+
     def test_split_tets_along_line(self, sphere3_msh):
         m=sphere3_msh.crop_mesh(elm_type = 4)
         n_nodes_pre = m.nodes.nr
@@ -1990,6 +2130,92 @@ class TestSurfaceIO:
         assert np.allclose(surf.nodes[surf.elm[:, :3]],
                            surf_read.nodes[surf_read.elm[:, :3]])
 
+    def test_meshb_io(self, sphere3_msh, tmp_path):
+        fn = str(tmp_path / 'tst.meshb')
+        mesh_io.write_meshb(sphere3_msh, fn)
+        m = mesh_io.read(fn)
+        order = np.argsort(sphere3_msh.elm.elm_type, kind='stable')
+        assert np.allclose(m.nodes[:], sphere3_msh.nodes[:])
+        assert np.all(m.elm[:] == sphere3_msh.elm[:][order])
+        assert np.all(m.elm.elm_type == sphere3_msh.elm.elm_type[order])
+        assert np.all(m.elm.tag1 == sphere3_msh.elm.tag1[order])
+        assert np.all(m.elm.tag2 == m.elm.tag1)
+
+
+
+class TestDerivedCache:
+    def test_cache(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        adj = m.elm.find_adjacent_tetrahedra()
+        assert m.elm.find_adjacent_tetrahedra() is not adj
+        assert m.elm._cache['adjacent_tetrahedra'][1] is not adj
+        adj[:] = 0
+        assert np.all(m.elm.find_adjacent_tetrahedra() ==
+                      sphere3_msh.elm.find_adjacent_tetrahedra())
+        vol = m.elements_volumes_and_areas().value
+        assert np.allclose(m.elements_volumes_and_areas().value, vol)
+        m.nodes.node_coord = 2 * m.nodes.node_coord
+        assert np.allclose(m.elements_volumes_and_areas()[m.elm.tetrahedra],
+                           8 * vol[m.elm.tetrahedra - 1])
+        m.nodes.node_coord *= 0.5
+        m.mark_modified()
+        assert np.allclose(m.elements_volumes_and_areas().value, vol)
+
+    def test_in_place_node_change(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        _, idx = m.nodes.find_closest_node([[0., 0., 200.]], return_index=True)
+        bar = m.elements_baricenters().value
+        m.nodes.node_coord[idx - 1] = [300., 0., 0.]
+        # The in-place change is not detected, the cached baricenters are stale
+        assert np.allclose(m.elements_baricenters().value, bar)
+        m.nodes.mark_modified()
+        assert not np.allclose(m.elements_baricenters().value, bar)
+        assert m.nodes.find_closest_node([[300., 0., 0.]], return_index=True)[1] == idx
+
+    def test_in_place_elm_change(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        faces = m.elm.get_faces()[0]
+        th = m.elm.elm_type == 4
+        m.elm.node_number_list[th] = m.elm.node_number_list[th][:, [1, 0, 2, 3]]
+        assert np.all(m.elm.get_faces()[0] == faces)
+        m.elm.mark_modified()
+        assert not np.all(m.elm.get_faces()[0] == faces)
+        # compact_ordering changes the elements in-place
+        m.compact_ordering(np.arange(m.nodes.nr, 0, -1))
+        new_faces = m.elm.get_faces()[0]
+        assert set(map(frozenset, new_faces)) == \
+            set(map(frozenset, m.nodes.nr + 1 - faces))
+
+    def test_corresponding_tetrahedra_tags(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        corresponding = m.find_corresponding_tetrahedra()
+        tags = m.elm.tag1.copy()
+        # In-place change of the tags is detected
+        m.elm.tag1[m.elm.elm_type == 2] = 1003
+        assert not np.all(m.find_corresponding_tetrahedra() == corresponding)
+        m.elm.tag1[:] = tags
+        assert np.all(m.find_corresponding_tetrahedra() == corresponding)
+
+    def test_crop(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        m.elements_baricenters()
+        m.elements_volumes_and_areas()
+        m.elm.find_adjacent_tetrahedra()
+        cropped = m.crop_mesh([3, 1004, 5])
+        assert set(cropped._cache.keys()) == {'baricenters', 'volumes_and_areas'}
+        adj_th = cropped.elm.find_adjacent_tetrahedra()
+        bar = cropped.elements_baricenters().value
+        vol = cropped.elements_volumes_and_areas().value
+        cropped.mark_modified()
+        assert np.all(cropped.elm.find_adjacent_tetrahedra() == adj_th)
+        assert np.allclose(cropped.elements_baricenters().value, bar)
+        assert np.allclose(cropped.elements_volumes_and_areas().value, vol)
+
+    def test_copy(self, sphere3_msh):
+        m = copy.deepcopy(sphere3_msh)
+        m.elements_baricenters()
+        assert not hasattr(copy.deepcopy(m), '_cache')
+        assert '_cache' not in vars(m)
 
 
 class TestHashing:
@@ -365,6 +365,19 @@ def test_remesh(sphere3):
     assert np.isclose(vols[1], 4/3*np.pi*(90**3 - 85**3), rtol=1e-1)
     assert np.isclose(vols[2], 4/3*np.pi*(95**3 - 90**3), rtol=1e-1)
 
+def test_run_mmg(sphere3, monkeypatch):
+    sphere3 = sphere3.crop_mesh(elm_type=[2, 4])
+    mesh = meshing._run_mmg(copy.deepcopy(sphere3), 1)
+    assert np.all(np.unique(mesh.elm.tag1) == np.unique(sphere3.elm.tag1))
+    # .msh files as a fallback
+    def fail(*args):
+        raise IOError
+    monkeypatch.setattr(mesh_io, 'write_meshb', fail)
+    mesh_msh = meshing._run_mmg(copy.deepcopy(sphere3), 1)
+    assert np.allclose(mesh.nodes[:], mesh_msh.nodes[:])
+    assert np.all(mesh.elm[:] == mesh_msh.elm[:])
+    assert np.all(mesh.elm.tag1 == mesh_msh.elm.tag1)
+
 class TestRelabelSpikes:
     def update_tag_from_label_img(self, sphere3):
         m = sphere3.crop_mesh(elm_type=4)
@@ -1,6 +1,7 @@
 #!/usr/local/bin/python
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import fmm3dpy as fmm
 import time
@@ -44,46 +45,31 @@ logger = logging.getLogger('simnibs')
    and without the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
 '''
 
-def recipcode(rv,jv,rs,ks,A):
+def recipcode(rv,jv,rs,ks,A,chunk_size=256,n_threads=1):
 	#this function computes E-fields via reciprocity no auxiliary dipoles
 	#rv is 3 by ntetra and has mesh tetrahedron centroid positions
 	#jv is 3 by ntetra and has total conduction current at each tetrahedron
 	#rs is 3 by ncoil and has the coil dipole positions centered about the origin
 	#ks is 3 by ncoil and has the coil dipole weights
 	#A is 4 by 4 by number of coilpositions and each 4 by 4 matrix is a translation of the coil to a point above the scalp
+	#chunk_size is the number of coil positions processed at once
+	#n_threads is the number of threads used to process the coil positions
 
 	#paramameter:
 	prec=10**(-3); #this number determines the accuracy of H-primary evaluation higher accuracy=slower time increases ~log(accuracy)
 
-	#reads in sizes of each array
-	npos=A.shape[2]; #number of scalp positions
-	ncoil=rs.shape[1]; 
-	nsource=rv.shape[1];
-	ntarget=ncoil*npos;
-	
 	#generate copies of coil
-	rp=np.transpose(np.c_[np.transpose(rs) ,np.ones([ncoil])]); #pads coil positions to 4 by ncoil
-	robs=np.array(np.zeros([3,ntarget]));
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		robs[:,st:en]=np.matmul(A[0:3,:,i],rp);
+	robs=coilcopies(rs,A);
 
 	start = time.time()
 	logger.debug("Computing H-primary");
 	Hprimary=computeHprimary(rv,jv,robs,prec);
 	end = time.time()
 	logger.debug(f"H-primary time: {end-start:.2f}s");
-	kp=ks;
-	Etotal=np.zeros(npos);
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		kp=np.matmul(A[0:3,0:3,i],ks);
-		Etotal[i]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
-	return Etotal;
+	Etotal=reciprocalE(Hprimary,ks[:,:,None],A,chunk_size,n_threads);
+	return Etotal[0];
 
-def ADM(rv,jv,rs,ks,A,coildir):
+def ADM(rv,jv,rs,ks,A,coildir,chunk_size=256,n_threads=1):
 	#this function computes E-fields via reciprocity with auxiliary dipoles
 	#rv is 3 by ntetra and has mesh tetrahedron centroid positions
 	#jv is 3 by ntetra and has total conduction current at each tetrahedron
@@ -91,6 +77,8 @@ def ADM(rv,jv,rs,ks,A,coildir):
 	#ks is 3 by ncoil and has the coil dipole weights
 	#A is 4 by 4 by number of coilpositions and each 4 by 4 matrix is a translation of the coil to a point above the scalp
 	#coildir is a 3 by number of coil orientations that gives the y-direction orientation
+	#chunk_size is the number of coil positions processed at once
+	#n_threads is the number of threads used to process the coil positions
 
 
 	#paramameter:
@@ -99,99 +87,45 @@ def ADM(rv,jv,rs,ks,A,coildir):
 	#generate auxiliary dipoles
 	Nj=coildir.shape[1];
 	raux,kaux=resamplecoil(rs,ks,N,Nj,coildir);
-	#reads in sizes of each array
-	npos=A.shape[2]; #number of scalp positions
-	ncoil=raux.shape[1]; 
-	nsource=rv.shape[1];
-	ntarget=ncoil*npos;
-	
+
 	#generate copies of coil
-	rp=np.transpose(np.c_[np.transpose(raux) ,np.ones([ncoil])]); #pads coil positions to 4 by ncoil
-	robs=np.array(np.zeros([3,ntarget]));
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		robs[:,st:en]=np.matmul(A[0:3,:,i],rp);
+	robs=coilcopies(raux,A);
 
 	start = time.time()
 	logger.debug("Computing H-primary");
 	Hprimary=computeHprimary(rv,jv,robs,prec);
 	end = time.time()
 	logger.debug(f"H-primary time: {end-start:.2f}s")
-	kp=kaux[:,:,0];
-	
-	Etotal=np.zeros([Nj,npos]);
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		for j in range(0,Nj):
-			kp=np.matmul(A[0:3,0:3,i],kaux[:,:,j]);#for flat coils you only need the 3rd element
-			Etotal[j,i]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
+	Etotal=reciprocalE(Hprimary,kaux,A,chunk_size,n_threads);
 	return Etotal;
 
-def recipcodemag(rv,jvx,jvy,jvz,rs,ks,A):
+def recipcodemag(rv,jvx,jvy,jvz,rs,ks,A,chunk_size=256,n_threads=1):
 	#this function computes E-field unidirectional approximation of the magnitude via reciprocity no auxiliary dipoles
 	#rv is 3 by ntetra and has mesh tetrahedron centroid positions
 	#jv is 3 by ntetra and has total conduction current at each tetrahedron
 	#rs is 3 by ncoil and has the coil dipole positions centered about the origin
 	#ks is 3 by ncoil and has the coil dipole weights
 	#A is 4 by 4 by number of coilpositions and each 4 by 4 matrix is a translation of the coil to a point above the scalp
+	#chunk_size is the number of coil positions processed at once
+	#n_threads is the number of threads used to process the coil positions
 
 	#paramameter:
 	prec=10**(-3); #this number determines the accuracy of H-primary evaluation higher accuracy=slower time increases ~log(accuracy)
 
-	#reads in sizes of each array
-	npos=A.shape[2]; #number of scalp positions
-	ncoil=rs.shape[1]; 
-	nsource=rv.shape[1];
-	ntarget=ncoil*npos;
-	
 	#generate copies of coil
-	rp=np.transpose(np.c_[np.transpose(rs) ,np.ones([ncoil])]); #pads coil positions to 4 by ncoil
-	robs=np.array(np.zeros([3,ntarget]));
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		robs[:,st:en]=np.matmul(A[0:3,:,i],rp);
-	Etotal=np.zeros([npos,3]);
-	kp=ks;
+	robs=coilcopies(rs,A);
 	start = time.time()
 	logger.debug("Computing H-primary");
-	Hprimary=computeHprimary(rv,jvx,robs,prec);
-	end = time.time()	
-	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		kp=np.matmul(A[0:3,0:3,i],ks);
-		Etotal[i,0]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
-	start = time.time()
-	logger.debug("Computing H-primary");
-	Hprimary=computeHprimary(rv,jvy,robs,prec);
-	end = time.time()	
-	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		kp=np.matmul(A[0:3,0:3,i],ks);
-		Etotal[i,1]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
-	start = time.time()
-	logger.debug("Computing H-primary");
-	Hprimary=computeHprimary(rv,jvz,robs,prec);
-	end = time.time()	
+	Hprimaries=computeHprimaries(rv,[jvx,jvy,jvz],robs,prec);
+	end = time.time()
 	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		kp=np.matmul(A[0:3,0:3,i],ks);
-		Etotal[i,2]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
+	Etotal=np.zeros([A.shape[2],3]);
+	for k,Hprimary in enumerate(Hprimaries):
+		Etotal[:,k]=reciprocalE(Hprimary,ks[:,:,None],A,chunk_size,n_threads)[0];
 	Etotal=np.sqrt(Etotal[:,0]**2+Etotal[:,1]**2+Etotal[:,2]**2);
 	return Etotal;
 
-def ADMmag(rv,jvx,jvy,jvz,rs,ks,A,coildir):
+def ADMmag(rv,jvx,jvy,jvz,rs,ks,A,coildir,chunk_size=256,n_threads=1):
 	#this function computes E-field unidirectional approximation of the magnitude via reciprocity with auxiliary dipoles
 	#rv is 3 by ntetra and has mesh tetrahedron centroid positions
 	#jv is 3 by ntetra and has total conduction current at each tetrahedron
@@ -199,6 +133,8 @@ def ADMmag(rv,jvx,jvy,jvz,rs,ks,A,coildir):
 	#ks is 3 by ncoil and has the coil dipole weights
 	#A is 4 by 4 by number of coilpositions and each 4 by 4 matrix is a translation of the coil to a point above the scalp
 	#coildir is a 3 by number of coil orientations that gives the y-direction orientation
+	#chunk_size is the number of coil positions processed at once
+	#n_threads is the number of threads used to process the coil positions
 
 
 	#paramameter:
@@ -207,57 +143,54 @@ def ADMmag(rv,jvx,jvy,jvz,rs,ks,A,coildir):
 	#generate auxiliary dipoles
 	Nj=coildir.shape[1];
 	raux,kaux=resamplecoil(rs,ks,N,Nj,coildir);
-	#reads in sizes of each array
-	npos=A.shape[2]; #number of scalp positions
-	ncoil=raux.shape[1]; 
-	nsource=rv.shape[1];
-	ntarget=ncoil*npos;
-	
+
 	#generate copies of coil
-	rp=np.transpose(np.c_[np.transpose(raux) ,np.ones([ncoil])]); #pads coil positions to 4 by ncoil
-	robs=np.array(np.zeros([3,ntarget]));
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		robs[:,st:en]=np.matmul(A[0:3,:,i],rp);
+	robs=coilcopies(raux,A);
 
 	start = time.time()
-	Etotal=np.zeros([Nj,npos,3]);
 	logger.debug("Computing H-primary");
-	Hprimary=computeHprimary(rv,jvx,robs,prec);
-	end = time.time()
-	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	kp=kaux[:,:,0];
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		for j in range(0,Nj):
-			kp=np.matmul(A[0:3,0:3,i],kaux[:,:,j]);#for flat coils you only need the 3rd element
-			Etotal[j,i,0]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
-	Hprimary=computeHprimary(rv,jvy,robs,prec);
+	Hprimaries=computeHprimaries(rv,[jvx,jvy,jvz],robs,prec);
 	end = time.time()
 	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		for j in range(0,Nj):
-			kp=np.matmul(A[0:3,0:3,i],kaux[:,:,j]);#for flat coils you only need the 3rd element
-			Etotal[j,i,1]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
-	Hprimary=computeHprimary(rv,jvz,robs,prec);
-	end = time.time()
-	logger.info(f"H-primary time: {end-start:.2f}s")
-	start = end
-	for i in range(0,npos):
-		st=i*ncoil;
-		en=(i+1)*ncoil;
-		for j in range(0,Nj):
-			kp=np.matmul(A[0:3,0:3,i],kaux[:,:,j]);#for flat coils you only need the 3rd element
-			Etotal[j,i,2]=-np.inner(Hprimary[:,st:en].flatten(),kp.flatten());
+	Etotal=np.zeros([Nj,A.shape[2],3]);
+	for k,Hprimary in enumerate(Hprimaries):
+		Etotal[:,:,k]=reciprocalE(Hprimary,kaux,A,chunk_size,n_threads);
 	Etotal=np.sqrt(Etotal[:,:,0]**2+Etotal[:,:,1]**2+Etotal[:,:,2]**2);
 	return Etotal;
-	
+
+def coilcopies(rs,A):
+	#this function places a copy of the coil at each coil position
+	#rs is 3 by ncoil and has the coil dipole positions centered about the origin
+	#A is 4 by 4 by number of coilpositions
+	#returns a 3 by ncoil*npos array, the dipoles of each position are contiguous
+	robs=np.einsum('ijp,jn->ipn',A[0:3,0:3,:],rs)+A[0:3,3,:][:,:,None];
+	return robs.reshape(3,-1);
+
+def reciprocalE(Hprimary,ks,A,chunk_size=256,n_threads=1):
+	#this function computes -H.k summed over the coil dipoles for each position and orientation
+	#Hprimary is 3 by ncoil*npos and has the H-field at the coil copies from coilcopies
+	#ks is 3 by ncoil by Nj and has the coil dipole weights for each orientation
+	#A is 4 by 4 by number of coilpositions
+	#the positions are processed in chunks of chunk_size, optionally in n_threads threads
+	#returns Nj by npos
+	npos=A.shape[2];
+	ncoil=ks.shape[1];
+	Nj=ks.shape[2];
+	H=Hprimary.reshape(3,npos,ncoil);
+	Etotal=np.zeros([Nj,npos]);
+	def chunk(st):
+		en=min(st+chunk_size,npos);
+		#sum over the dipoles before rotating the weights
+		Hk=np.tensordot(H[:,st:en,:],ks,axes=([2],[1]));
+		Etotal[:,st:en]=-np.einsum('cdi,cidj->ji',A[0:3,0:3,st:en],Hk);
+	starts=range(0,npos,chunk_size);
+	if n_threads>1:
+		with ThreadPoolExecutor(n_threads) as executor:
+			list(executor.map(chunk,starts));
+	else:
+		for st in starts:
+			chunk(st);
+	return Etotal;
 
 def computeHprimary(rs,js,robs,prec):
 	#this function computes H-fields via FMM3D library
@@ -266,26 +199,28 @@ def computeHprimary(rs,js,robs,prec):
 	#Note: for magnetic dipoles electromagnetic duality implies that
 	#if we pass magnetic dipoles weights as js we get negative E-primary.
 	# As such, this function is used to compute E-primary due to magnetic currents also.
-	outex=fmm.Output();
-	Hprimary=np.zeros([3,robs.shape[1]]);
+	return computeHprimaries(rs,[js],robs,prec)[0];
+
+def computeHprimaries(rs,jss,robs,prec):
+	#this function computes the H-fields of several current distributions
+	#jss is a list of 3 by number of sources current distributions
+	#all components of all distributions are evaluated in a single FMM3D call
+	#returns a list with a 3 by number of targets H-field for each distribution
+	nj=len(jss);
 	muover4pi=-1e-7;
-	js1=js[0,:];
-	out=fmm.lfmm3d(eps=prec,sources=rs,targets=robs,charges=js1,pgt=2);
-	logger.debug("Run 1")
-	Hprimary[1,:]=-out.gradtarg[2,:];
-	Hprimary[2,:]=out.gradtarg[1,:];
-	js1=js[1,:];
-	out=fmm.lfmm3d(eps=prec,sources=rs,targets=robs,charges=js1,pgt=2);
-	logger.debug("Run 2")
-	Hprimary[0,:]=out.gradtarg[2,:];
-	Hprimary[2,:]=Hprimary[2,:]-out.gradtarg[0,:];
-	js1=js[2,:];
-	out=fmm.lfmm3d(eps=prec,sources=rs,targets=robs,charges=js1,pgt=2);
-	logger.debug("Run 3")
-	Hprimary[0,:]=Hprimary[0,:]-out.gradtarg[1,:];
-	Hprimary[1,:]=Hprimary[1,:]+out.gradtarg[0,:];
-	Hprimary *= muover4pi
-	return Hprimary;
+	charges=np.ascontiguousarray(np.concatenate(jss,axis=0));
+	out=fmm.lfmm3d(eps=prec,sources=rs,targets=robs,charges=charges,nd=3*nj,pgt=2);
+	logger.debug("Run FMM")
+	grad=out.gradtarg.reshape(nj,3,3,robs.shape[1]);
+	Hprimaries=[];
+	for g in grad:
+		Hprimary=np.zeros([3,robs.shape[1]]);
+		Hprimary[0,:]=g[1,2,:]-g[2,1,:];
+		Hprimary[1,:]=g[2,0,:]-g[0,2,:];
+		Hprimary[2,:]=g[0,1,:]-g[1,0,:];
+		Hprimary *= muover4pi
+		Hprimaries.append(Hprimary);
+	return Hprimaries;
 
 def resamplecoil(rs,ks,N,Nj,coildir):
 	#rs is 3 by ncoil and has the coil dipole positions centered about the origin
@@ -294,17 +229,15 @@ def resamplecoil(rs,ks,N,Nj,coildir):
 	#Nj is an integer number of orientations 
 	#coildir is 3 by Nj and has the y orientation of the coil
 	#create copies of coil with different orientations
+	#x=y cross z = y[1] x -y[0] y
 	rs2=np.zeros([3,rs.shape[1],Nj]);
 	ks2=np.zeros([3,ks.shape[1],Nj]);
-	#x=y cross z = y[1] x -y[0] y
-	for i in range(0,Nj):
-		rs2[2,:,i]=rs[2,:];
-		rs2[2,:,i]=rs[2,:];
-		rs2[0,:,i]= rs[0,:]*coildir[1,i]+rs[1,:]*coildir[0,i];
-		rs2[1,:,i]=-rs[0,:]*coildir[0,i]+rs[1,:]*coildir[1,i];
-		ks2[2,:,i]=ks[2,:];
-		ks2[0,:,i]= ks[0,:]*coildir[1,i]+ks[1,:]*coildir[0,i];#unnecessary ks is z oriented
-		ks2[1,:,i]=-ks[0,:]*coildir[0,i]+ks[1,:]*coildir[1,i];#unnecessary ks is z oriented
+	rs2[2,:,:]=rs[2,:,None];
+	rs2[0,:,:]= np.outer(rs[0,:],coildir[1,:Nj])+np.outer(rs[1,:],coildir[0,:Nj]);
+	rs2[1,:,:]=-np.outer(rs[0,:],coildir[0,:Nj])+np.outer(rs[1,:],coildir[1,:Nj]);
+	ks2[2,:,:]=ks[2,:,None];
+	ks2[0,:,:]= np.outer(ks[0,:],coildir[1,:Nj])+np.outer(ks[1,:],coildir[0,:Nj]);#unnecessary ks is z oriented
+	ks2[1,:,:]=-np.outer(ks[0,:],coildir[0,:Nj])+np.outer(ks[1,:],coildir[1,:Nj]);#unnecessary ks is z oriented
 	#find range for interpolation
 	Xm=min(rs2[0,:,:].flatten());
 	Xp=max(rs2[0,:,:].flatten());
@@ -336,17 +269,12 @@ def resamplecoil(rs,ks,N,Nj,coildir):
 	del Y;
 	del Z;
 	#generate auxiliary dipole weights
+	#auxiliary dipole i+(j+k*N[1])*N[0] has weight sum(ks2*Lx[i]*Ly[j]*Lz[k])
 	for kk in range(0,Nj):
 		Lx=lagrange(rs2[0,:,kk],XX);
 		Ly=lagrange(rs2[1,:,kk],YY);
 		Lz=lagrange(rs2[2,:,kk],ZZ);
-		for k in range(0,N[2]):
-			for j in range(0,N[1]):
-				for i in range(0,N[0]):
-					L=Lx[i,:]*Ly[j,:]*Lz[k,:];
-					kaux[0,int(i+(j+k*N[1])*N[0]),kk]=np.inner(ks2[0,:,kk],L);
-					kaux[1,int(i+(j+k*N[1])*N[0]),kk]=np.inner(ks2[1,:,kk],L);
-					kaux[2,int(i+(j+k*N[1])*N[0]),kk]=np.inner(ks2[2,:,kk],L);
+		kaux[:,:,kk]=np.einsum('cn,kn,jn,in->ckji',ks2[:,:,kk],Lz,Ly,Lx,optimize=True).reshape(3,-1);
 	return raux,kaux
 def lagrange(x,pointx):
 	n=pointx.size;
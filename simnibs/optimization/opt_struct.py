@@ -20,8 +20,11 @@
 '''
 
 
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import copy
 import csv
+import hashlib
 import re
 import os
 import time
@@ -47,6 +50,15 @@ from ..utils.simnibs_logger import logger
 from ..utils.file_finder import SubjectFiles
 from ..utils.matlab_read import try_to_read_matlab_field, remove_None
 from ..utils.mesh_element_properties import ElementTags
+from ..utils.leadfield_utils import LazyLeadfield
+
+# Energy matrices of leadfields read from files, shared by all TDCSoptimize objects.
+# Keys are (file name, dataset path, file inode, size and modification time, weights
+# digest). The matrices are also stored next to the leadfield file, see _Q_sidecar
+_TDCS_Q_CACHE = collections.OrderedDict()
+_TDCS_Q_CACHE_SIZE = 16
+# Approximate size of the blocks of fields calculated in TDCSoptimize.optimize_batch
+_FIELD_BLOCK_BYTES = 2**28
 
 class TMSoptimize():
     """
@@ -94,8 +106,9 @@ class TMSoptimize():
         Options for the FEM solver. Default: CG+AMG
     method (optional): 'direct' or 'ADM'
         Method to be used. Either 'direct' for running full TMS optimizations or
-        'ADM' for using the Auxiliary Dipole Method. 'ADM' is only compatible with ".ccd"
-        coil format
+        'ADM' for using reciprocity. For ".ccd" coils, the Auxiliary Dipole Method is
+        used, for other coil formats the reciprocal fields are evaluated directly
+        at the coil elements
     scalp_normals_smoothing_steps (optional): float
         Number of iterations for smoothing the scalp normals to control tangential scalp placement of TMS coil
     keep_hdf5: bool
@@ -403,7 +416,7 @@ class TMSoptimize():
                 mesh_io.open_in_gmsh(fn_target, True)
             E_roi = self._direct_optimize(cond_field, target_region, pos_matrices, cpus)
         elif self.method.lower() == 'adm':
-            E_roi, pos_matrices = self._ADM_optimize(cond_field, target_region)
+            E_roi, pos_matrices = self._ADM_optimize(cond_field, target_region, cpus)
         else:
             raise ValueError("method should be 'direct' or 'ADM'")
         # Update the .geo file with the E values
@@ -546,7 +559,7 @@ class TMSoptimize():
 
         return E_roi
 
-    def _ADM_optimize(self, cond_field, target_region):
+    def _ADM_optimize(self, cond_field, target_region, cpus=1):
         coil_matrices, rotations = optimize_tms.get_opt_grid_ADM(
             self.mesh, self.centre,
             handle_direction_ref=self.pos_ydir,
@@ -562,12 +575,14 @@ class TMSoptimize():
         baricenters = self.mesh.elements_baricenters()
 
         th = self.mesh.elm.elm_type == 4
-        if not self.fnamecoil.endswith('.ccd'):
-            raise ValueError('ADM optimization is only possible with ".ccd" coil files')
         if not np.all(th[target_region - 1]):
             raise ValueError('Target region must contain only tetrahedra')
-        ccd_file = np.loadtxt(self.fnamecoil, skiprows=2)
-        dipoles, moments = ccd_file[:, 0:3], ccd_file[:, 3:]
+        use_adm = self.fnamecoil.endswith('.ccd')
+        if use_adm:
+            ccd_file = np.loadtxt(self.fnamecoil, skiprows=2)
+            dipoles, moments = ccd_file[:, 0:3], ccd_file[:, 3:]
+        else:
+            tms_coil = fem._load_coil(self.fnamecoil)
         # Run dipole simulations
         S = fem.DipoleFEM(self.mesh, cond_field, self.solver_options)
         vols = self.mesh.elements_volumes_and_areas()
@@ -595,45 +610,64 @@ class TMSoptimize():
             J /= np.sum(vols[target_region])
             return J
 
+        z = np.array([0., 0., 1.])
+        pos_matrices = []
+        for cm in coil_matrices.transpose(2, 0, 1):
+            for r in rotations.T:
+                R = np.eye(4)
+                R[:3, :3] = np.array([np.cross(r, z), r, z]).T
+                M = cm.dot(R)
+                M[:3, 3] *= 1e3
+                pos_matrices.append(M)
+
         if self.target_direction is None:
             J_x = calc_dipole_J([1, 0, 0]) * vols[:, None]
             J_y = calc_dipole_J([0, 1, 0]) * vols[:, None]
             J_z = calc_dipole_J([0, 0, 1]) * vols[:, None]
             del S
             gc.collect()
-            logger.info('Running ADM')
-            # Notice that there is an unknown scale factor
-            # as we need to know the pulse angular frequency
-            # \Omega and amplitude A
-            E_roi = ADMlib.ADMmag(
-                baricenters[th].T * 1e-3,
-                J_x[th].T, J_y[th].T, J_z[th].T,
-                dipoles.T, moments.T,  # .ccd file is already in SI units
-                coil_matrices, rotations
-            ) * self.didt
+            if use_adm:
+                logger.info('Running ADM')
+                # Notice that there is an unknown scale factor
+                # as we need to know the pulse angular frequency
+                # \Omega and amplitude A
+                E_roi = ADMlib.ADMmag(
+                    baricenters[th].T * 1e-3,
+                    J_x[th].T, J_y[th].T, J_z[th].T,
+                    dipoles.T, moments.T,  # .ccd file is already in SI units
+                    coil_matrices, rotations, n_threads=cpus
+                ).T.reshape(-1) * self.didt
+            else:
+                logger.info('Evaluating reciprocal fields')
+                E_roi = optimize_tms.get_E_reciprocity(
+                    tms_coil, baricenters[th],
+                    np.stack([J_x[th], J_y[th], J_z[th]]),
+                    pos_matrices
+                )
+                E_roi = np.linalg.norm(E_roi, axis=0) * self.didt
         else:
             if len(self.target_direction) != 3:
                 raise ValueError('target direction should have 3 elements!')
             direction = np.array(self.target_direction, dtype=float)
             direction /= np.linalg.norm(direction)
             J_d = calc_dipole_J(direction) * vols[:, None]
-            E_roi = ADMlib.ADM(
-                baricenters[th].T * 1e-3,
-                J_d[th].T,
-                dipoles.T, moments.T,  # .ccd file is already in SI units
-                coil_matrices, rotations
-            ) * self.didt
-
-        z = np.array([0., 0., 1.])
-        pos_matrices = []
-        coil_matrices[:3, 3, :] *= 1e3
-        for cm in coil_matrices.transpose(2, 0, 1):
-            for r in rotations.T:
-                R = np.eye(4)
-                R[:3, :3] = np.array([np.cross(r, z), r, z]).T
-                pos_matrices.append(cm.dot(R))
+            del S
+            gc.collect()
+            if use_adm:
+                logger.info('Running ADM')
+                E_roi = ADMlib.ADM(
+                    baricenters[th].T * 1e-3,
+                    J_d[th].T,
+                    dipoles.T, moments.T,  # .ccd file is already in SI units
+                    coil_matrices, rotations, n_threads=cpus
+                ).T.reshape(-1) * self.didt
+            else:
+                logger.info('Evaluating reciprocal fields')
+                E_roi = optimize_tms.get_E_reciprocity(
+                    tms_coil, baricenters[th], J_d[th], pos_matrices
+                ) * self.didt
 
-        return E_roi.T.reshape(-1), pos_matrices
+        return E_roi, pos_matrices
 
     def __str__(self):
         string = 'Subject Folder: %s\n' % self.subpath
@@ -757,6 +791,9 @@ class TDCSoptimize():
         self.open_in_gmsh = open_in_gmsh
         self._mesh = None
         self._leadfield = None
+        self._leadfield_key = None
+        self._Q_cache = {}
+        self._volumes = None
         self._field_name = None
         self._field_units = None
         self.name = name
@@ -785,10 +822,14 @@ class TDCSoptimize():
 
     @property
     def leadfield(self):
-        ''' Reads the leadfield from the HDF5 file'''
+        ''' Leadfield in the HDF5 file, read lazily one electrode at a time'''
         if self._leadfield is None and self.leadfield_hdf is not None:
-            with h5py.File(self.leadfield_hdf, 'r') as f:
-                self.leadfield = f[self.leadfield_path][:]
+            self.leadfield = LazyLeadfield(self.leadfield_hdf, self.leadfield_path)
+            st = os.stat(self.leadfield_hdf)
+            self._leadfield_key = (
+                os.path.abspath(self.leadfield_hdf), self.leadfield_path,
+                st.st_ino, st.st_size, st.st_mtime_ns
+            )
 
         return self._leadfield
 
@@ -798,6 +839,8 @@ class TDCSoptimize():
             assert leadfield.ndim == 3, 'leadfield should be 3 dimensional'
             assert leadfield.shape[2] == 3, 'Size of last dimension of leadfield should be 3'
         self._leadfield = leadfield
+        self._leadfield_key = None
+        self._Q_cache = {}
 
     @property
     def mesh(self):
@@ -813,6 +856,7 @@ class TDCSoptimize():
             raise ValueError('Mesh has both tetrahedra and triangles')
         else:
             self._mesh = mesh
+            self._volumes = None
 
     @property
     def field_name(self):
@@ -922,23 +966,85 @@ class TDCSoptimize():
                    max_individual_current, max_active_electrodes,
                    name, target, avoid, open_in_gmsh)
 
-    def get_weights(self):
-        ''' Calculates the volumes or areas of the mesh associated with the leadfield
+    def get_weights(self, avoid=None):
+        ''' Calculates the volumes or areas of the mesh associated with the leadfield,
+        multiplied by the weights of the avoid regions
+
+        Parameters
+        ------------
+        avoid: list of TDCSavoid objects (optional)
+            Regions to avoid. Default: self.avoid
         '''
         assert self.mesh is not None, 'Mesh not defined'
-        if self.lf_type == 'node':
-            weights = self.mesh.nodes_volumes_or_areas().value
-        elif self.lf_type == 'element':
-            weights = self.mesh.elements_volumes_and_areas().value
-        else:
-            raise ValueError('Cant calculate weights: mesh or leadfield not set')
+        if self._volumes is None or self._volumes[0] != self.lf_type:
+            if self.lf_type == 'node':
+                volumes = self.mesh.nodes_volumes_or_areas().value
+            elif self.lf_type == 'element':
+                volumes = self.mesh.elements_volumes_and_areas().value
+            else:
+                raise ValueError('Cant calculate weights: mesh or leadfield not set')
+            self._volumes = (self.lf_type, volumes)
 
-        weights *= self._get_avoid_field()
+        weights = self._volumes[1] * self._get_avoid_field(avoid)
         return weights
 
-    def _get_avoid_field(self):
+    def get_Q(self, weights=None):
+        ''' Returns the energy matrix Q of the leadfield
+
+        The matrices are cached, so that optimizations with different targets, but the
+        same leadfield and avoid regions, do not need to go through the leadfield again.
+        The cache of leadfields read from "leadfield_hdf" is shared by all TDCSoptimize
+        objects, and invalidated if the file changes. These matrices are also saved
+        in ".npy" files next to the leadfield file, so that they persist between
+        sessions.
+
+        Parameters
+        ------------
+        weights: ndarray (optional)
+            Weights, including the avoid regions. Default: get_weights()
+
+        Returns
+        ---------
+        Q: N_elec x N_elec ndarray
+            Energy matrix, see optimization_methods.TESOptimizationProblem
+        '''
+        if weights is None:
+            weights = self.get_weights()
+        leadfield = self.leadfield
+        digest = hashlib.sha1(
+            np.ascontiguousarray(weights, dtype=float).tobytes()
+        ).hexdigest()
+        if self._leadfield_key is not None:
+            cache = _TDCS_Q_CACHE
+            key = self._leadfield_key + (digest,)
+        else:
+            cache = self._Q_cache
+            key = digest
+
+        if key in cache:
+            logger.debug('Using cached energy matrix')
+            if cache is _TDCS_Q_CACHE:
+                cache.move_to_end(key)
+            return cache[key]
+
+        Q = None
+        if cache is _TDCS_Q_CACHE:
+            fn_Q, stale = _Q_sidecar(key)
+            Q = _load_Q_sidecar(fn_Q, leadfield.shape[0] + 1)
+        if Q is None:
+            Q = optimization_methods._calc_Q(leadfield, weights)
+            if cache is _TDCS_Q_CACHE:
+                _save_Q_sidecar(fn_Q, Q, stale)
+        cache[key] = Q
+        if cache is _TDCS_Q_CACHE and len(cache) > _TDCS_Q_CACHE_SIZE:
+            cache.popitem(last=False)
+        return Q
+
+    def _get_avoid_field(self, avoid=None):
+        if avoid is None:
+            avoid = self.avoid
         fields = []
-        for a in self.avoid:
+        for a in avoid:
             a.mesh = self.mesh
             a.lf_type = self.lf_type
             fields.append(a.avoid_field())
@@ -999,26 +1105,8 @@ class TDCSoptimize():
             if a.mesh is None: a.mesh = self.mesh
             if a.lf_type is None: a.lf_type = self.lf_type
 
-    def optimize(self, fn_out_mesh=None, fn_out_csv=None):
-        ''' Runs the optimization problem
-
-        Parameters
-        -------------
-        fn_out_mesh: str
-            If set, will write out the electric field and currents to the mesh
-
-        fn_out_mesh: str
-            If set, will write out the currents and electrode names to a CSV file
-
-
-        Returns
-        ------------
-        currents: N_elec x 1 ndarray
-            Optimized currents. The first value is the current in the reference electrode
-        '''
-        assert len(self.target) > 0, 'No target defined'
-        assert self.leadfield is not None, 'Leadfield not defined'
-        assert self.mesh is not None, 'Mesh not defined'
+    def _current_limits(self):
+        ''' Checks the current limits and returns the total and individual limits '''
         if self.max_active_electrodes is not None:
             assert self.max_active_electrodes > 1, \
                     'The maximum number of active electrodes should be at least 2'
@@ -1038,32 +1126,52 @@ class TDCSoptimize():
             assert self.max_individual_current > 0
             max_individual_current = self.max_individual_current
 
-        self._assign_mesh_lf_type_to_target()
-        weights = self.get_weights()
-        norm_constrained = [t.directions is None for t in self.target]
+        return max_total_current, max_individual_current
+
+    def _create_opt_problem(self, targets, leadfield, weights, Q,
+                            max_total_current, max_individual_current,
+                            columns=None):
+        ''' Creates the optimization problem for a list of targets
+
+        If "columns" is set, "leadfield" and "weights" only contain these (sorted)
+        columns of the full leadfield, which must include all target indices
+        '''
+        def target_indices(t):
+            indices, directions = t.get_indexes_and_directions()
+            if columns is not None:
+                indices = np.searchsorted(columns, indices)
+            return indices, directions
+
+        def target_weights(t):
+            w = t.get_weights()
+            if columns is not None:
+                w = w[columns]
+            return w
+
+        norm_constrained = [t.directions is None for t in targets]
 
         # Angle-constrained optimization
-        if any([t.max_angle is not None for t in self.target]):
-            if len(self.target) > 1:
+        if any([t.max_angle is not None for t in targets]):
+            if len(targets) > 1:
                 raise ValueError("Can't apply angle constraints with multiple target")
-            t = self.target[0]
+            t = targets[0]
             max_angle = t.max_angle
-            indices, directions = t.get_indexes_and_directions()
+            indices, directions = target_indices(t)
             assert max_angle > 0, 'max_angle must be >= 0'
             if self.max_active_electrodes is None:
                 opt_problem = optimization_methods.TESLinearAngleConstrained(
                     indices, directions,
-                    t.target_mean, max_angle, self.leadfield,
+                    t.intensity, max_angle, leadfield,
                     max_total_current, max_individual_current,
-                    weights=weights, weights_target=t.get_weights()
+                    weights=weights, target_weights=target_weights(t), Q=Q
                 )
 
             else:
                 opt_problem = optimization_methods.TESLinearAngleElecConstrained(
                     self.max_active_electrodes, indices, directions,
-                    t.target_mean, max_angle, self.leadfield,
+                    t.intensity, max_angle, leadfield,
                     max_total_current, max_individual_current,
-                    weights, weights_target=t.get_weights()
+                    weights, target_weights=target_weights(t), Q=Q
                 )
 
         # Norm-constrained optimization
@@ -1072,44 +1180,81 @@ class TDCSoptimize():
                 raise ValueError("Can't mix norm and linear constrained optimization")
             if self.max_active_electrodes is None:
                 opt_problem = optimization_methods.TESNormConstrained(
-                        self.leadfield, max_total_current,
-                        max_individual_current, weights
+                        leadfield, max_total_current,
+                        max_individual_current, weights, Q=Q
                 )
             else:
                 opt_problem = optimization_methods.TESNormElecConstrained(
                         self.max_active_electrodes,
-                        self.leadfield, max_total_current,
-                        max_individual_current, weights
+                        leadfield, max_total_current,
+                        max_individual_current, weights, Q=Q
                 )
-            for t in self.target:
+            for t in targets:
                 if t.intensity < 0:
                     raise ValueError('Intensity must be > 0')
                 opt_problem.add_norm_constraint(
-                    t.get_indexes_and_directions()[0], t.intensity,
-                    t.get_weights()
+                    target_indices(t)[0], t.intensity,
+                    target_weights(t)
                 )
 
         # Simple QP-style optimization
         else:
             if self.max_active_electrodes is None:
                 opt_problem = optimization_methods.TESLinearConstrained(
-                    self.leadfield, max_total_current,
-                    max_individual_current, weights)
+                    leadfield, max_total_current,
+                    max_individual_current, weights, Q=Q)
 
             else:
                 opt_problem = optimization_methods.TESLinearElecConstrained(
-                    self.max_active_electrodes, self.leadfield,
-                    max_total_current, max_individual_current, weights)
+                    self.max_active_electrodes, leadfield,
+                    max_total_current, max_individual_current, weights, Q=Q)
 
-            for t in self.target:
+            for t in targets:
                 opt_problem.add_linear_constraint(
-                    *t.get_indexes_and_directions(), t.intensity,
-                    t.get_weights()
+                    *target_indices(t), t.intensity,
+                    target_weights(t)
                 )
 
+        return opt_problem
+
+    def optimize(self, fn_out_mesh=None, fn_out_csv=None):
+        ''' Runs the optimization problem
+
+        Parameters
+        -------------
+        fn_out_mesh: str
+            If set, will write out the electric field and currents to the mesh
+
+        fn_out_mesh: str
+            If set, will write out the currents and electrode names to a CSV file
+
+
+        Returns
+        ------------
+        currents: N_elec x 1 ndarray
+            Optimized currents. The first value is the current in the reference electrode
+        '''
+        assert len(self.target) > 0, 'No target defined'
+        assert self.leadfield is not None, 'Leadfield not defined'
+        assert self.mesh is not None, 'Mesh not defined'
+        max_total_current, max_individual_current = self._current_limits()
+
+        self._assign_mesh_lf_type_to_target()
+        weights = self.get_weights()
+        Q = self.get_Q(weights)
+        # Only the target columns of the leadfield are needed for the problem
+        columns = np.unique(np.hstack([
+            t.get_indexes_and_directions()[0] for t in self.target
+        ]))
+        opt_problem = self._create_opt_problem(
+            self.target, self.leadfield[:, columns], weights[columns], Q,
+            max_total_current, max_individual_current,
+            columns=columns
+        )
+
         currents = opt_problem.solve()
 
-        logger.log(25, '\n' + self.summary(currents))
+        logger.log(25, '\n' + self.summary(currents, full_field=fn_out_mesh is not None))
 
         if fn_out_mesh is not None:
             fn_out_mesh = os.path.abspath(fn_out_mesh)
@@ -1146,6 +1291,140 @@ class TDCSoptimize():
 
         return currents
 
+    def optimize_batch(self, targets, fn_out_csv=None, fn_out_hdf5=None, n_workers=1):
+        ''' Runs many independent optimizations with the same leadfield
+
+        The leadfield is read once, the target columns are gathered in a single
+        operation and the energy matrix is shared between the optimizations with the
+        same avoid regions. Instead of meshes, the results are written as a table with
+        one row per optimization
+
+        Parameters
+        -------------
+        targets: list
+            Targets for each optimization. Each entry can be a TDCStarget, a list of
+            TDCStarget objects, or a tuple (targets, avoid), where avoid is a list of
+            TDCSavoid objects which replaces the "avoid" attribute for this optimization
+        fn_out_csv: str (optional)
+            If set, will write the currents and field summaries to a CSV file
+        fn_out_hdf5: str (optional)
+            If set, will write the currents and field summaries to an HDF5 file, in the
+            "currents" and "summary" datasets
+        n_workers: int (optional)
+            Number of processes used to solve the optimization problems. Default: 1
+
+        Returns
+        ------------
+        currents: N_opt x N_elec ndarray
+            Optimized currents. The first column is the current in the reference
+            electrode
+        summary: dict
+            Field summaries, each entry is an array with one value per optimization
+        '''
+        assert len(targets) > 0, 'No target defined'
+        assert self.leadfield is not None, 'Leadfield not defined'
+        assert self.mesh is not None, 'Mesh not defined'
+        max_total_current, max_individual_current = self._current_limits()
+
+        problems = []
+        for entry in targets:
+            if isinstance(entry, tuple):
+                target, avoid = entry
+            else:
+                target, avoid = entry, self.avoid
+            if isinstance(target, TDCStarget):
+                target = [target]
+            target, avoid = list(target), list(avoid)
+            for t in target + avoid:
+                if t.mesh is None: t.mesh = self.mesh
+                if t.lf_type is None: t.lf_type = self.lf_type
+            problems.append((target, avoid))
+
+        # Read all target columns at once
+        columns = np.unique(np.hstack([
+            t.get_indexes_and_directions()[0] for target, _ in problems for t in target
+        ]))
+        leadfield = self.leadfield
+        lf_columns = leadfield[:, columns]
+
+        opt_problems = []
+        for target, avoid in problems:
+            weights = self.get_weights(avoid)
+            opt_problems.append(self._create_opt_problem(
+                target, lf_columns, weights[columns], self.get_Q(weights),
+                max_total_current, max_individual_current,
+                columns=columns
+            ))
+
+        logger.info(f'Solving {len(opt_problems)} optimization problems')
+        if n_workers > 1:
+            with ProcessPoolExecutor(n_workers) as executor:
+                currents = list(executor.map(_solve_opt_problem, opt_problems))
+        else:
+            currents = [_solve_opt_problem(p) for p in opt_problems]
+        currents = np.array(currents)
+
+        # Calculate the fields in blocks
+        summary = []
+        block_size = max(1, int(
+            _FIELD_BLOCK_BYTES // (np.prod(leadfield.shape[1:]) * leadfield.dtype.itemsize)
+        ))
+        for start in range(0, len(currents), block_size):
+            fields = self._stream_field(currents[start:start + block_size])
+            for c, E, (target, avoid) in zip(
+                currents[start:start + block_size], fields,
+                problems[start:start + block_size]
+            ):
+                summary.append(self._field_summary(c, E, target, avoid))
+
+        keys = list(dict.fromkeys(k for s in summary for k in s))
+        summary = {k: np.array([s.get(k, np.nan) for s in summary]) for k in keys}
+
+        electrode_names = self._electrode_names()
+        if electrode_names is None:
+            electrode_names = [str(i) for i in range(currents.shape[1])]
+
+        if fn_out_csv is not None:
+            with open(fn_out_csv, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(list(electrode_names) + keys)
+                for i, c in enumerate(currents):
+                    writer.writerow(list(c) + [summary[k][i] for k in keys])
+
+        if fn_out_hdf5 is not None:
+            with h5py.File(fn_out_hdf5, 'w') as f:
+                f.create_dataset('currents', data=currents)
+                f['currents'].attrs['electrode_names'] = electrode_names
+                f.create_dataset(
+                    'summary', data=np.array([summary[k] for k in keys]).T
+                )
+                f['summary'].attrs['columns'] = keys
+                f['summary'].attrs['units'] = self.field_units
+
+        return currents, summary
+
+    def _field_summary(self, currents, E, target, avoid):
+        ''' Returns a dictionary with the summary of the field E, see summary '''
+        if self.lf_type == 'node':
+            field = mesh_io.NodeData(E, self.field_name, mesh=self.mesh)
+        else:
+            field = mesh_io.ElementData(E, self.field_name, mesh=self.mesh)
+        s = {}
+        s['total_current'] = np.linalg.norm(currents, ord=1)/2
+        s['max_current'] = np.max(np.abs(currents))
+        s['active_electrodes'] = np.linalg.norm(currents, ord=0)
+        s['peak_field'] = field.get_percentiles(99.9)[0]
+        s['mean_field_norm'] = field.mean_field_norm()
+        s['focality_50'], s['focality_70'] = field.get_focality(
+            cuttofs=[50, 70], peak_percentile=99.9
+        )
+        for i, t in enumerate(target):
+            s[f'target_{i + 1}_intensity'] = t.mean_intensity(field)
+            s[f'target_{i + 1}_angle'] = t.mean_angle(field)
+        for i, a in enumerate(avoid):
+            s[f'avoid_{i + 1}_mean_field_norm'] = a.mean_field_norm_in_region(field)
+        return s
+
     def field(self, currents):
         ''' Outputs the electric fields caused by the current combination
 
@@ -1162,7 +1441,7 @@ class TDCSoptimize():
         '''
 
         assert np.isclose(np.sum(currents), 0, atol=1e-5), 'Currents should sum to zero'
-        E = np.einsum('ijk,i->jk', self.leadfield, currents[1:])
+        E = self._stream_field(currents)
 
         if self.lf_type == 'node':
             E = mesh_io.NodeData(E, self.field_name, mesh=self.mesh)
@@ -1172,6 +1451,33 @@ class TDCSoptimize():
 
         return E
 
+    def _stream_field(self, currents, columns=None):
+        ''' Sums the leadfield weighted by the currents one electrode at a time
+
+        Parameters
+        -----------
+        currents: N_elec or N_opt x N_elec ndarray
+            Electrode currents, the first value is the reference electrode
+        columns: ndarray of ints (optional)
+            Sorted 0-based indices of the leadfield columns to calculate. Default: all
+
+        Returns
+        ----------
+        E: (N_opt x) M x 3 ndarray
+            Field values
+        '''
+        currents = np.asarray(currents)
+        leadfield = self.leadfield
+        n_columns = leadfield.shape[1] if columns is None else len(columns)
+        E = np.zeros(currents.shape[:-1] + (n_columns, 3))
+        for i in range(leadfield.shape[0]):
+            c = currents[..., i + 1]
+            if np.all(c == 0):
+                continue
+            row = leadfield[i] if columns is None else leadfield[i, columns]
+            E += np.multiply.outer(c, row)
+        return E
+
     def electrode_geo(self, fn_out, currents=None, mesh_elec=None, elec_tags=None,
                       elec_positions=None):
         ''' Creates a mesh with the electrodes and their currents
@@ -1320,11 +1626,8 @@ class TDCSoptimize():
             the leadfield dataset
         '''
         if electrode_names is None:
-            if self.leadfield_hdf is not None:
-                with h5py.File(self.leadfield_hdf, 'r') as f:
-                    electrode_names = f[self.leadfield_path].attrs['electrode_names']
-                    electrode_names = [n.decode() if isinstance(n,bytes) else n for n in electrode_names]
-            else:
+            electrode_names = self._electrode_names()
+            if electrode_names is None:
                 raise ValueError('Please define the electrode names')
 
         assert len(electrode_names) == len(currents)
@@ -1333,6 +1636,16 @@ class TDCSoptimize():
             for n, c in zip(electrode_names, currents):
                 writer.writerow([n, c])
 
+    def _electrode_names(self):
+        ''' Reads the electrode names from the leadfield file, or returns None '''
+        if self.leadfield_hdf is None:
+            return None
+        with h5py.File(self.leadfield_hdf, 'r') as f:
+            if 'electrode_names' not in f[self.leadfield_path].attrs:
+                return None
+            electrode_names = f[self.leadfield_path].attrs['electrode_names']
+        return [n.decode() if isinstance(n,bytes) else n for n in electrode_names]
+
     def run(self, cpus=1):
         ''' Interface to use with the run_simnibs function
 
@@ -1410,13 +1723,17 @@ class TDCSoptimize():
         return s
 
 
-    def summary(self, currents):
+    def summary(self, currents, full_field=True):
         ''' Returns a string with a summary of the optimization
 
         Parameters
         ------------
-        field: ElementData or NodeData
-            Field of interest
+        currents: N_elec x 1 ndarray
+            Electrode currents
+        full_field: bool (optional)
+            Whether to calculate the field everywhere. If False, the field is only
+            calculated in the targets and avoid regions and the field summary (peak,
+            mean and focality) is left out. Default: True
 
         Returns
         ------------
@@ -1428,20 +1745,23 @@ class TDCSoptimize():
         s += 'Total current: {0:.2e} (A)\n'.format(np.linalg.norm(currents, ord=1)/2)
         s += 'Maximum current: {0:.2e} (A)\n'.format(np.max(np.abs(currents)))
         s += 'Active electrodes: {0}\n'.format(int(np.linalg.norm(currents, ord=0)))
-        field = self.field(currents)
-        s += 'Field Summary\n'
-        s += '----------------------------\n'
-        s += 'Peak Value (99.9 percentile): {0:.2f} ({1})\n'.format(
-            field.get_percentiles(99.9)[0], self.field_units)
-        s += 'Mean field magnitude: {0:.2e} ({1})\n'.format(
-            field.mean_field_norm(), self.field_units)
-        if np.any(self.mesh.elm.elm_type==4):
-            v_units = 'mm3'
+        if full_field:
+            field = self.field(currents)
+            s += 'Field Summary\n'
+            s += '----------------------------\n'
+            s += 'Peak Value (99.9 percentile): {0:.2f} ({1})\n'.format(
+                field.get_percentiles(99.9)[0], self.field_units)
+            s += 'Mean field magnitude: {0:.2e} ({1})\n'.format(
+                field.mean_field_norm(), self.field_units)
+            if np.any(self.mesh.elm.elm_type==4):
+                v_units = 'mm3'
+            else:
+                v_units = 'mm2'
+            s += 'Focality: 50%: {0:.2e} 70%: {1:.2e} ({2})\n'.format(
+                *field.get_focality(cuttofs=[50, 70], peak_percentile=99.9),
+                v_units)
         else:
-            v_units = 'mm2'
-        s += 'Focality: 50%: {0:.2e} 70%: {1:.2e} ({2})\n'.format(
-            *field.get_focality(cuttofs=[50, 70], peak_percentile=99.9),
-            v_units)
+            field = self._region_field(currents)
         for i, t in enumerate(self.target):
             s += 'Target {0}\n'.format(i + 1)
             s += '    Intensity specified:{0:.2f} achieved: {1:.2f} ({2})\n'.format(
@@ -1461,6 +1781,80 @@ class TDCSoptimize():
 
         return s
 
+    def _region_field(self, currents):
+        ''' Field calculated only in the targets and avoid regions, zero elsewhere '''
+        self._assign_mesh_lf_type_to_target()
+        indexes = [t.get_indexes_and_directions()[0] for t in self.target]
+        indexes += [a._get_avoid_region() - 1 for a in self.avoid]
+        E = np.zeros((self.leadfield.shape[1], 3))
+        if len(indexes) > 0:
+            columns = np.unique(np.hstack(indexes)).astype(int)
+            E[columns] = self._stream_field(currents, columns)
+        if self.lf_type == 'node':
+            return mesh_io.NodeData(E, self.field_name, mesh=self.mesh)
+        else:
+            return mesh_io.ElementData(E, self.field_name, mesh=self.mesh)
+
+
+def _Q_sidecar(key):
+    ''' File where the energy matrix for a _TDCS_Q_CACHE key is stored
+
+    Returns
+    -------
+    fn_Q: str
+        Name of the ".npy" file, next to the leadfield file
+    stale: list of str
+        Files with energy matrices of other versions of the same leadfield
+    '''
+    fn_hdf, lf_path = key[:2]
+    path_digest = hashlib.sha1(lf_path.encode()).hexdigest()[:8]
+    state_digest = hashlib.sha1(repr(key[2:5]).encode()).hexdigest()[:8]
+    prefix = '{0}.Q_{1}_'.format(fn_hdf, path_digest)
+    fn_Q = '{0}{1}_{2}.npy'.format(prefix, state_digest, key[5][:16])
+    stale = [
+        fn for fn in glob.glob(glob.escape(prefix) + '*.npy')
+        if not fn.startswith(prefix + state_digest)
+    ]
+    return fn_Q, stale
+
+
+def _load_Q_sidecar(fn_Q, n_elec):
+    ''' Loads an energy matrix saved by _save_Q_sidecar. Returns None if it can
+    not be used. "n_elec" is the number of electrodes, including the reference '''
+    if not os.path.isfile(fn_Q):
+        return None
+    try:
+        Q = np.load(fn_Q)
+    except (OSError, ValueError) as e:
+        logger.warning(f'Could not read energy matrix {fn_Q}: {e}')
+        return None
+    if Q.shape != (n_elec, n_elec):
+        return None
+    logger.debug(f'Loaded energy matrix from {fn_Q}')
+    return Q
+
+
+def _save_Q_sidecar(fn_Q, Q, stale=()):
+    ''' Saves the energy matrix and removes the ones of old versions of the
+    leadfield file '''
+    fn_tmp = fn_Q + '.{0}.tmp'.format(os.getpid())
+    try:
+        with open(fn_tmp, 'wb') as f:
+            np.save(f, Q)
+        os.replace(fn_tmp, fn_Q)
+        for fn in stale:
+            os.remove(fn)
+    except OSError as e:
+        # e.g. the leadfield is in a read-only folder
+        logger.debug(f'Could not write energy matrix {fn_Q}: {e}')
+        if os.path.isfile(fn_tmp):
+            os.remove(fn_tmp)
+
+
+def _solve_opt_problem(opt_problem):
+    return opt_problem.solve()
+
+
 class TDCStarget:
     ''' Defines a target for TDCS optimization
 
@@ -2421,10 +2815,17 @@ class TDCSDistributedOptimize():
         y, W = self._target_distribution()
         normals = self.normal_directions()
         weights = np.sqrt(self._tdcs_opt_obj.get_weights())
+        # Positions with W == 0 (and therefore y == 0) do not contribute to the
+        # objective. This only changes its scale, so we do not read them
+        columns = np.flatnonzero(W)
+        # Leadfields are often stored in single or half precision
+        leadfield = np.asarray(self.leadfield[:, columns], dtype=float)
+        leadfield *= W[None, columns, None]
+        y, normals, weights = y[columns], normals[columns], weights[columns]
 
         if self.max_active_electrodes is None:
             opt_problem = optimization_methods.TESDistributed(
-                W[None, :, None] * self.leadfield,
+                leadfield,
                 y[:, None]*normals, weights[:, None]*normals,
                 max_total_current,
                 max_individual_current
@@ -2432,7 +2833,7 @@ class TDCSDistributedOptimize():
         else:
             opt_problem = optimization_methods.TESDistributedElecConstrained(
                 self.max_active_electrodes,
-                W[None, :, None] * self.leadfield,
+                leadfield,
                 y[:, None]*normals, weights[:, None]*normals,
                 max_total_current,
                 max_individual_current
@@ -2440,7 +2841,7 @@ class TDCSDistributedOptimize():
 
         currents = opt_problem.solve()
 
-        logger.log(25, '\n' + self.summary(currents))
+        logger.log(25, '\n' + self.summary(currents, full_field=fn_out_mesh is not None))
 
         if fn_out_mesh is not None:
             fn_out_mesh = os.path.abspath(fn_out_mesh)
@@ -2484,26 +2885,35 @@ class TDCSDistributedOptimize():
         return s
 
 
-    def summary(self, currents):
+    def summary(self, currents, full_field=True):
         ''' Returns a string with a summary of the optimization
 
         Parameters
         ------------
-        field: ElementData or NodeData
-            Field of interest
+        currents: N_elec x 1 ndarray
+            Electrode currents
+        full_field: bool (optional)
+            Whether to calculate the field everywhere. If False, the field summary
+            (peak, mean and focality) is left out and the ERNI is calculated only where
+            the target image weights are non-zero. Default: True
 
         Returns
         ------------
         summary: str
             Summary of field
         '''
-        s = self._tdcs_opt_obj.summary(currents)
+        s = self._tdcs_opt_obj.summary(currents, full_field=full_field)
         # Calculate erri
-        field = self.field(currents)[:]
-        normals = self.normal_directions()
-        field_normal = np.sum(field * normals, axis=1)
         y, W = self._target_distribution()
-        erri =  np.sum((y - field_normal * W)**2 - y**2)
+        # y and W are zero where the field is not needed
+        columns = slice(None) if full_field else np.flatnonzero(W)
+        if full_field:
+            field = self.field(currents)[:]
+        else:
+            field = self._tdcs_opt_obj._stream_field(currents, columns)
+        normals = self.normal_directions()[columns]
+        field_normal = np.sum(field * normals, axis=1)
+        erri =  np.sum((y[columns] - field_normal * W[columns])**2 - y[columns]**2)
         erri *= len(y) /np.sum(W**2)
         # add Erri to messaga
         s += f'Error Relative to Non Intervention (ERNI): {erri:.2e}\n'
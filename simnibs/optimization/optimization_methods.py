@@ -1,12 +1,20 @@
 # -*- coding: utf-8 -*-\
 import copy
 import functools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 import scipy.optimize
 import scipy.linalg
 
 from simnibs.utils.simnibs_logger import logger
 
+# Approximate size of the leadfield chunks used to build the energy matrices
+_LEADFIELD_CHUNK_BYTES = 2**26
+
 
 class TESConstraints:
     def __init__(self, n, max_total_current, max_el_current):
@@ -42,18 +50,36 @@ class TESOptimizationProblem(TESConstraints):
 
     Parameters
     -------------
-    leadfield: N_elec x N_roi x N_comp ndarray
-        Leadfield
+    leadfield: N_elec x N_roi x N_comp ndarray or LazyLeadfield
+        Leadfield. The energy matrices are calculated by reading chunks of
+        N_roi, so the leadfield can be kept on disk
 
     max_total_current: float
         Maximum total current flow through all electrodes
 
     max_el_current: float
         Maximum current flow through each electrode
+
+    n_workers: int
+        Number of threads used to calculate the energy matrices, and of processes
+        used in the branch-and-bound search of the problems with a limited number of
+        electrodes. Default: 1
+
+    Q: N_elec x N_elec ndarray (optional)
+        Precomputed quadratic component, see _calc_Q. Default: calculate from the
+        leadfield and the weights
+
+    Attributes
+    -------------
+    qp_stats: QPStatistics
+        Iteration and timing statistics of the QPs solved by the problem
     '''
-    def __init__(self, leadfield, max_total_current=1e4, max_el_current=1e4, weights=None):
+    def __init__(self, leadfield, max_total_current=1e4, max_el_current=1e4, weights=None,
+                 n_workers=1, Q=None):
         super().__init__(leadfield.shape[0] + 1, max_total_current, max_el_current)
         self.leadfield = leadfield
+        self.n_workers = n_workers
+        self.qp_stats = QPStatistics()
 
         if weights is None:
             self.weights = np.ones(leadfield.shape[1])
@@ -63,7 +89,12 @@ class TESOptimizationProblem(TESConstraints):
         if len(self.weights) != leadfield.shape[1]:
             raise ValueError('Define a weight per leadfield element')
 
-        self.Q = self._quadratic_component()
+        if Q is None:
+            self.Q = self._quadratic_component()
+        else:
+            if Q.shape != (self.n, self.n):
+                raise ValueError('Q should be a N_elec x N_elec matrix')
+            self.Q = Q
 
     def _quadratic_component(self):
         ''' Calculate the energy matrix for optimization
@@ -76,15 +107,7 @@ class TESOptimizationProblem(TESConstraints):
         Q: np.ndarray
             Quadratic component
         '''
-        lf = self.leadfield
-        Q = sum(lf[..., i].dot((lf[..., i] * self.weights).T)
-                for i in range(lf.shape[2]))
-        Q /= np.sum(self.weights)
-
-        P = np.linalg.pinv(np.vstack([-np.ones(Q.shape[0]), np.eye(Q.shape[0])]))
-
-        Q = P.T.dot(Q).dot(P)
-        return Q
+        return _calc_Q(self.leadfield, self.weights, n_workers=self.n_workers)
 
     def extend_currents(self, x):
         '''
@@ -120,9 +143,10 @@ class TESLinearConstrained(TESOptimizationProblem):
     This corresponds to Problem 8 in Saturnino et al., 2019
     '''
     def __init__(self, leadfield, max_total_current=1e5,
-                 max_el_current=1e5, weights=None):
+                 max_el_current=1e5, weights=None, n_workers=1, Q=None):
 
-        super().__init__(leadfield, max_total_current, max_el_current, weights)
+        super().__init__(leadfield, max_total_current, max_el_current, weights,
+                         n_workers, Q)
         self.l = np.empty((0, self.n), dtype=float)
         self.target_means = np.empty(0, dtype=float)
 
@@ -145,7 +169,8 @@ class TESLinearConstrained(TESOptimizationProblem):
         '''
         if target_weights is None:
             target_weights = self.weights
-        l = _calc_l(self.leadfield, target_indices, target_direction, target_weights)
+        l = _calc_l(self.leadfield, target_indices, target_direction, target_weights,
+                    n_workers=self.n_workers)
         l *= np.sign(target_mean)
         self.l = np.vstack([self.l, l])
         self.target_means = np.hstack([self.target_means, np.abs(target_mean)])
@@ -162,7 +187,8 @@ class TESLinearConstrained(TESOptimizationProblem):
         return _linear_constrained_tes_opt(
             self.l, self.target_means, self.Q,
             self.max_el_current, self.max_total_current,
-            log_level=log_level
+            log_level=log_level,
+            qp_stats=self.qp_stats
         )
 
 
@@ -173,26 +199,31 @@ class TESLinearAngleConstrained(TESOptimizationProblem):
     '''
     def __init__(self, target_indices, target_direction, target_mean, max_angle,
                  leadfield, max_total_current=1e5,
-                 max_el_current=1e5, weights=None, target_weights=None):
+                 max_el_current=1e5, weights=None, target_weights=None,
+                 n_workers=1, Q=None):
 
-        super().__init__(leadfield, max_total_current, max_el_current, weights)
+        super().__init__(leadfield, max_total_current, max_el_current, weights,
+                         n_workers, Q)
         if target_weights is None:
             target_weights = self.weights
 
         self.l = np.atleast_2d(
-            _calc_l(leadfield, target_indices, target_direction, target_weights)
+            _calc_l(leadfield, target_indices, target_direction, target_weights,
+                    n_workers=n_workers)
         )
-        self.Qnorm = _calc_Qnorm(leadfield, target_indices, self.weights)
+        self.Qnorm = _calc_Qnorm(leadfield, target_indices, self.weights,
+                                 n_workers=n_workers)
         self.target_mean = np.atleast_1d(target_mean)
         self.max_angle = max_angle
 
     def solve(self, log_level=20):
         return _linear_angle_constrained_tes_opt(
             self.l, self.target_mean, self.Q,
-            self.max_total_current,
             self.max_el_current,
+            self.max_total_current,
             self.Qnorm, self.max_angle,
-            log_level=log_level
+            log_level=log_level,
+            qp_stats=self.qp_stats
         )
 
 
@@ -204,9 +235,10 @@ class TESLinearElecConstrained(TESLinearConstrained):
     '''
     def __init__(self, n_elec, leadfield,
                  max_total_current=1e5,
-                 max_el_current=1e5, weights=None):
+                 max_el_current=1e5, weights=None, n_workers=1, Q=None):
 
-        super().__init__(leadfield, max_total_current, max_el_current, weights)
+        super().__init__(leadfield, max_total_current, max_el_current, weights,
+                         n_workers, Q)
         self.n_elec = n_elec
 
     def _solve_reduced(self, linear, quadratic, extra_ineq=None):
@@ -216,7 +248,8 @@ class TESLinearElecConstrained(TESLinearConstrained):
             l, self.target_means, Q,
             self.max_el_current, self.max_total_current,
             extra_ineq=extra_ineq,
-            log_level=10
+            log_level=10,
+            qp_stats=self.qp_stats
         )
         if np.any(l.dot(x) < self.target_means*0.99):
             return x, 1e20
@@ -224,6 +257,7 @@ class TESLinearElecConstrained(TESLinearConstrained):
             return x, x.dot(Q).dot(x)
 
     def solve(self, log_level=20, eps_bb=1e-1, max_bb_iter=100, init_startegy='compact'):
+        self.qp_stats.reset()
         # Heuristically eliminate electrodes
         max_el_current = min(self.max_el_current, self.max_total_current)
         el = np.arange(self.n)
@@ -231,7 +265,8 @@ class TESLinearElecConstrained(TESLinearConstrained):
             x = _linear_constrained_tes_opt(
                 self.l, self.target_means, self.Q,
                 self.max_el_current, self.max_total_current,
-                log_level=10
+                log_level=10,
+                qp_stats=self.qp_stats
             )
             active = np.abs(x) > 1e-3 * max_el_current
             if not np.any(active):
@@ -256,8 +291,11 @@ class TESLinearElecConstrained(TESLinearConstrained):
         final_state = _branch_and_bound(
             init, bounds_function,
             eps_bb, max_bb_iter,
-            log_level=log_level
+            log_level=log_level,
+            n_workers=self.n_workers,
+            qp_stats=self.qp_stats
         )
+        logger.log(log_level, f'QP statistics: {self.qp_stats}')
 
         return final_state.x_ub
 
@@ -273,13 +311,13 @@ class TESLinearAngleElecConstrained(TESLinearAngleConstrained):
                  target_mean, max_angle,
                  leadfield, max_total_current=1e5,
                  max_el_current=1e5, weights=None,
-                 target_weights=None):
+                 target_weights=None, n_workers=1, Q=None):
 
         super().__init__(
             target_indices, target_direction,
             target_mean, max_angle,
             leadfield, max_total_current,
-            max_el_current, weights, target_weights)
+            max_el_current, weights, target_weights, n_workers, Q)
 
         self.n_elec = n_elec
         self._feasible = True
@@ -296,6 +334,7 @@ class TESLinearAngleElecConstrained(TESLinearAngleConstrained):
             Qnorm, self.max_angle,
             extra_ineq=extra_ineq,
             log_level=10,
+            qp_stats=self.qp_stats
         )
 
         field = l.dot(x)
@@ -309,6 +348,7 @@ class TESLinearAngleElecConstrained(TESLinearAngleConstrained):
             return x, x.dot(Q).dot(x)
 
     def solve(self, log_level=20, eps_bb=1e-1, max_bb_iter=100, init_startegy='compact'):
+        self.qp_stats.reset()
         # Heuristically eliminate electrodes
         max_el_current = min(self.max_el_current, self.max_total_current)
         el = np.arange(self.n)
@@ -317,7 +357,8 @@ class TESLinearAngleElecConstrained(TESLinearAngleConstrained):
             self.l, self.target_mean, self.Q,
             self.max_el_current, self.max_total_current,
             self.Qnorm, self.max_angle,
-            log_level=10
+            log_level=10,
+            qp_stats=self.qp_stats
         )
 
         feasible = np.allclose(self.l.dot(x), self.target_mean, rtol=1e-2)
@@ -348,16 +389,21 @@ class TESLinearAngleElecConstrained(TESLinearAngleConstrained):
         final_state = _branch_and_bound(
             init, bounds_function,
             eps_bb, max_bb_iter,
-            log_level=log_level
+            log_level=log_level,
+            n_workers=self.n_workers,
+            qp_stats=self.qp_stats
         )
+        logger.log(log_level, f'QP statistics: {self.qp_stats}')
 
         return final_state.x_ub
 
 class TESNormConstrained(TESOptimizationProblem):
     ''' Class for solving the TES Problem with norm-type constraints
     '''
-    def __init__(self, leadfield, max_total_current=1e5, max_el_current=1e5, weights=None):
-        super().__init__(leadfield, max_total_current, max_el_current, weights)
+    def __init__(self, leadfield, max_total_current=1e5, max_el_current=1e5, weights=None,
+                 n_workers=1, Q=None):
+        super().__init__(leadfield, max_total_current, max_el_current, weights,
+                         n_workers, Q)
         self.Qnorm = np.empty((0, self.n, self.n), dtype=float)
         self.target_means = np.empty(0, dtype=float)
 
@@ -379,7 +425,8 @@ class TESNormConstrained(TESOptimizationProblem):
         '''
         if target_weights is None:
             target_weights = self.weights
-        Qnorm = _calc_Qnorm(self.leadfield, target_indices, target_weights)
+        Qnorm = _calc_Qnorm(self.leadfield, target_indices, target_weights,
+                            n_workers=self.n_workers)
         self.Qnorm = np.concatenate([self.Qnorm, Qnorm[None, ...]])
         self.target_means = np.hstack([self.target_means, np.abs(target_mean)])
 
@@ -395,7 +442,8 @@ class TESNormConstrained(TESOptimizationProblem):
         return _norm_constrained_tes_opt(
             self.Qnorm, self.target_means, self.Q,
             self.max_el_current, self.max_total_current,
-            log_level=log_level
+            log_level=log_level,
+            qp_stats=self.qp_stats
         )
 
 
@@ -405,9 +453,10 @@ class TESNormElecConstrained(TESNormConstrained):
     '''
     def __init__(self, n_elec, leadfield,
                  max_total_current=1e5,
-                 max_el_current=1e5, weights=None):
+                 max_el_current=1e5, weights=None, n_workers=1, Q=None):
 
-        super().__init__(leadfield, max_total_current, max_el_current, weights)
+        super().__init__(leadfield, max_total_current, max_el_current, weights,
+                         n_workers, Q)
         self.n_elec = n_elec
 
     def _solve_reduced(self, linear, quadratic, extra_ineq=None):
@@ -417,7 +466,8 @@ class TESNormElecConstrained(TESNormConstrained):
         x = _norm_constrained_tes_opt(
             Qnorm, self.target_means, Q,
             self.max_el_current, self.max_total_current,
-            log_level=10
+            log_level=10,
+            qp_stats=self.qp_stats
         )
         if np.any(np.sqrt(x.T.dot(Qnorm).dot(x)) < self.target_means*0.99):
             return x, 1e20
@@ -425,6 +475,7 @@ class TESNormElecConstrained(TESNormConstrained):
             return x, x.dot(Q).dot(x)
 
     def solve(self, log_level=20, eps_bb=1e-1, max_bb_iter=100, init_startegy='compact'):
+        self.qp_stats.reset()
         # Heuristically eliminate electrodes
         max_el_current = min(self.max_el_current, self.max_total_current)
         el = np.arange(self.n)
@@ -432,7 +483,8 @@ class TESNormElecConstrained(TESNormConstrained):
             x = _norm_constrained_tes_opt(
                 self.Qnorm, self.target_means, self.Q,
                 self.max_el_current, self.max_total_current,
-                log_level=10
+                log_level=10,
+                qp_stats=self.qp_stats
             )
             active = np.abs(x) > 1e-3 * max_el_current
             if not np.any(active):
@@ -457,8 +509,11 @@ class TESNormElecConstrained(TESNormConstrained):
         final_state = _branch_and_bound(
             init, bounds_function,
             eps_bb, max_bb_iter,
-            log_level=log_level
+            log_level=log_level,
+            n_workers=self.n_workers,
+            qp_stats=self.qp_stats
         )
+        logger.log(log_level, f'QP statistics: {self.qp_stats}')
 
         return final_state.x_ub
 
@@ -487,16 +542,29 @@ class TESDistributed(TESConstraints):
 
     weights: N_roi x 1 or N_roi x 3 ndarray
         Weight for each element / field component
+
+    n_workers: int
+        Number of threads used to calculate the energy matrices, and of processes
+        used in the branch-and-bound search of the problems with a limited number of
+        electrodes. Default: 1
+
+    Attributes
+    -------------
+    qp_stats: QPStatistics
+        Iteration and timing statistics of the QPs solved by the problem
     '''
     def __init__(self, leadfield, target_field,
                  weights=None,
                  max_total_current=1e4,
-                 max_el_current=1e4):
+                 max_el_current=1e4,
+                 n_workers=1):
         super().__init__(leadfield.shape[0] + 1, max_total_current, max_el_current)
         if weights is None:
             weights = np.ones(leadfield.shape[1])
         else:
             weights = weights
+        self.n_workers = n_workers
+        self.qp_stats = QPStatistics()
         self.l, self.Q = self._calc_l_Q(leadfield, target_field, weights)
 
     def _calc_l_Q(self, leadfield, target_field, weights):
@@ -504,24 +572,28 @@ class TESDistributed(TESConstraints):
 
         '''
         if weights.ndim == 1:
-            Q = sum(
-                leadfield[..., i].dot(
-                    (leadfield[..., i] * weights**2).T)
-                for i in range(leadfield.shape[2])
-            )
-            l = -2*np.einsum(
-                'ijk, jk -> i', leadfield,
-                target_field*weights[:, None]**2
-            )
+            def l_Q_chunk(lf, idx):
+                w = weights[idx]
+                Q = _gram(lf, w**2)
+                l = -2*np.einsum(
+                    'ijk, jk -> i', lf,
+                    target_field[idx]*w[:, None]**2
+                )
+                return np.vstack([l, Q])
 
         elif weights.ndim == 2 and weights.shape[1] == 3:
-            A = np.einsum('ijk, jk -> ij', leadfield, weights)
-            Q = A.dot(A.T)
-            l = -2*np.sum(target_field*weights, axis=1).dot(A.T)
+            def l_Q_chunk(lf, idx):
+                A = np.einsum('ijk, jk -> ij', lf, weights[idx])
+                Q = A.dot(A.T)
+                l = -2*np.sum(target_field[idx]*weights[idx], axis=1).dot(A.T)
+                return np.vstack([l, Q])
 
         else:
             raise ValueError('Invalid shape for weights')
 
+        l_Q = _sum_leadfield_chunks(l_Q_chunk, leadfield, n_workers=self.n_workers)
+        l, Q = l_Q[0], l_Q[1:]
+
         # For numerical reasons
         P = np.linalg.pinv(np.vstack([-np.ones(len(l)), np.eye(len(l))]))
         l = l.dot(P)
@@ -542,7 +614,8 @@ class TESDistributed(TESConstraints):
         return _least_squares_tes_opt(
             self.l, self.Q,
             self.max_el_current, self.max_total_current,
-            log_level=log_level
+            log_level=log_level,
+            qp_stats=self.qp_stats
         )
 
 class TESDistributedElecConstrained(TESDistributed):
@@ -555,10 +628,11 @@ class TESDistributedElecConstrained(TESDistributed):
                  leadfield, target_field,
                  weights=None,
                  max_total_current=1e4,
-                 max_el_current=1e4):
+                 max_el_current=1e4,
+                 n_workers=1):
 
         super().__init__(leadfield, target_field, weights,
-                         max_total_current, max_el_current)
+                         max_total_current, max_el_current, n_workers)
         self.n_elec = n_elec
 
     def _solve_reduced(self, linear, quadratic, extra_ineq=None):
@@ -568,11 +642,13 @@ class TESDistributedElecConstrained(TESDistributed):
             l, Q,
             self.max_el_current, self.max_total_current,
             extra_ineq=extra_ineq,
-            log_level=10
+            log_level=10,
+            qp_stats=self.qp_stats
         )
         return x, l.dot(x) + x.dot(Q).dot(x)
 
     def solve(self, log_level=20, eps_bb=1e-1, max_bb_iter=500, init_startegy='compact'):
+        self.qp_stats.reset()
         # Heuristically eliminate electrodes
         max_el_current = min(self.max_el_current, self.max_total_current)
         el = np.arange(self.n)
@@ -580,7 +656,8 @@ class TESDistributedElecConstrained(TESDistributed):
             x = _least_squares_tes_opt(
                 self.l, self.Q,
                 self.max_el_current, self.max_total_current,
-                log_level=10
+                log_level=10,
+                qp_stats=self.qp_stats
             )
             active = np.abs(x) > 1e-3 * max_el_current
             if not np.any(active):
@@ -605,14 +682,32 @@ class TESDistributedElecConstrained(TESDistributed):
         final_state = _branch_and_bound(
             init, bounds_function,
             eps_bb, max_bb_iter,
-            log_level=log_level
+            log_level=log_level,
+            n_workers=self.n_workers,
+            qp_stats=self.qp_stats
         )
+        logger.log(log_level, f'QP statistics: {self.qp_stats}')
 
         return final_state.x_ub
 
 
 
-def _calc_l(leadfield, target_indices, target_direction, weights):
+def _calc_Q(leadfield, weights, n_workers=1):
+    ''' Calculates the energy matrix of a leadfield with a reference electrode
+
+    x.dot(Q.dot(x)) is the average squared electric field norm, where "x" are the
+    currents in all electrodes, including the reference
+    '''
+    Q = _calc_gram(leadfield, weights, n_workers=n_workers)
+    Q /= np.sum(weights)
+
+    P = np.linalg.pinv(np.vstack([-np.ones(Q.shape[0]), np.eye(Q.shape[0])]))
+
+    Q = P.T.dot(Q).dot(P)
+    return Q
+
+
+def _calc_l(leadfield, target_indices, target_direction, weights, n_workers=1):
     ''' Calculates the matrix "l" (eq. 14 in Saturnino et al. 2019)
     '''
     target_indices = np.atleast_1d(target_indices)
@@ -627,11 +722,13 @@ def _calc_l(leadfield, target_indices, target_direction, weights):
     target_direction = target_direction/\
         np.linalg.norm(target_direction, axis=1)[:, None]
 
-    lf_t = leadfield[:, target_indices]
     w_idx = weights[target_indices]
-    lf_t *= w_idx[None, :, None]
-    lf_t /= np.sum(w_idx)
-    l = np.einsum('ijk, jk -> i', lf_t, target_direction)
+    weighted_direction = target_direction * w_idx[:, None]
+    l = _sum_leadfield_chunks(
+        lambda lf_t, idx: np.einsum('ijk, jk -> i', lf_t, weighted_direction[idx]),
+        leadfield, target_indices, n_workers
+    )
+    l /= np.sum(w_idx)
 
     P = np.linalg.pinv(
         np.vstack([-np.ones(len(l)), np.eye(len(l))])
@@ -640,16 +737,14 @@ def _calc_l(leadfield, target_indices, target_direction, weights):
     return l.dot(P)
 
 
-def _calc_Qnorm(leadfield, target_indices, weights):
+def _calc_Qnorm(leadfield, target_indices, weights, n_workers=1):
     ''' Calculates the matrix "Qnorm" (like eq. 21 in Saturnino et al. 2019,
     but for all field components and not just)
     '''
     n = leadfield.shape[0]
     target_indices = np.atleast_1d(target_indices)
-    lf_t = leadfield[:, target_indices]
     w_idx = weights[target_indices]
-    Q_in = sum(
-        lf_t[..., i].dot((lf_t[..., i]*w_idx[None, :]).T) for i in range(3))
+    Q_in = _calc_gram(leadfield, w_idx, target_indices, n_workers)
     Q_in /= np.sum(w_idx)
 
     P = np.linalg.pinv(
@@ -660,10 +755,68 @@ def _calc_Qnorm(leadfield, target_indices, weights):
     return Qnorm
 
 
+def _gram(lf, weights):
+    ''' sum_k lf[..., k] W lf[..., k]^T for a dense chunk of the leadfield '''
+    lf = lf.reshape(lf.shape[0], -1)
+    return lf.dot((lf * np.repeat(weights, lf.shape[1] // len(weights))).T)
+
+
+def _calc_gram(leadfield, weights, indices=None, n_workers=1):
+    ''' Calculates sum_k L[..., k] W L[..., k]^T, where L are the leadfield
+    columns in indices (default: all) and W the diagonal matrix of weights
+    (one weight per index) '''
+    return _sum_leadfield_chunks(
+        lambda lf, idx: _gram(lf, weights[idx]),
+        leadfield, indices, n_workers
+    )
+
+
+def _sum_leadfield_chunks(func, leadfield, indices=None, n_workers=1, chunk_size=None):
+    ''' Sums func(lf, idx) over chunks of the leadfield columns
+
+    Only one chunk per worker is read at a time, so the leadfield can be a
+    LazyLeadfield with the data on disk
+
+    Parameters
+    -----------
+    func: callable
+        Function of a dense leadfield chunk (N_elec x N_chunk x N_comp) and the
+        positions of the chunk in indices (or in the columns, if indices is None)
+    leadfield: N_elec x N_roi x N_comp ndarray or LazyLeadfield
+        Leadfield
+    indices: ndarray of ints (optional)
+        Leadfield columns to use. Default: all
+    n_workers: int (optional)
+        Number of threads. Default: 1
+    chunk_size: int (optional)
+        Number of columns per chunk. Default: about _LEADFIELD_CHUNK_BYTES of data
+    '''
+    n_columns = leadfield.shape[1] if indices is None else len(indices)
+    if chunk_size is None:
+        chunk_size = max(
+            1, _LEADFIELD_CHUNK_BYTES // (8 * int(np.prod(leadfield.shape)) // leadfield.shape[1])
+        )
+
+    def run(starts):
+        total = 0
+        for start in starts:
+            idx = slice(start, min(start + chunk_size, n_columns))
+            cols = idx if indices is None else indices[idx]
+            lf = np.asarray(leadfield[:, cols], dtype=float)
+            total = total + func(lf, idx)
+        return total
+
+    starts = range(0, n_columns, chunk_size)
+    if n_workers > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(n_workers) as executor:
+            return sum(executor.map(run, [starts[i::n_workers] for i in range(n_workers)]))
+    return run(starts)
+
+
 def _linear_constrained_tes_opt(l, target_mean, Q,
                                 max_el_current, max_total_current,
                                 extra_ineq=None, extra_eq=None,
-                                log_level=10):
+                                log_level=10, qp_stats=None):
 
         assert l.shape[0] == target_mean.shape[0], \
             "Please specify one target mean per target"
@@ -717,7 +870,8 @@ def _linear_constrained_tes_opt(l, target_mean, Q,
             np.zeros(2*n), Q_,
             np.vstack([C_b, C_]), np.hstack([d_b, d_]),
             x_, eps,
-            np.vstack([A_, l_]), np.hstack([b_, f])  # I use "f"
+            np.vstack([A_, l_]), np.hstack([b_, f]),  # I use "f"
+            stats=qp_stats
         )
 
         x = x_[:n] - x_[n:]
@@ -736,7 +890,7 @@ def _linear_angle_constrained_tes_opt(
     extra_ineq=None,
     extra_eq=None,
     eps_linear=1e-5,
-    eps_angle=1e-1, log_level=20):
+    eps_angle=1e-1, log_level=20, qp_stats=None):
 
     max_angle = np.deg2rad(max_angle)
     logger.log(log_level, 'Running optimization with angle constraint')
@@ -750,7 +904,8 @@ def _linear_angle_constrained_tes_opt(
         l, target_mean, Q,
         max_el_current, max_total_current,
         extra_ineq=extra_ineq, extra_eq=extra_eq,
-        log_level=log_level-10
+        log_level=log_level-10,
+        qp_stats=qp_stats
     )
 
     if _calc_angle(x, Qin, l) <= max_angle:
@@ -765,7 +920,8 @@ def _linear_angle_constrained_tes_opt(
             l, alpha*target_mean, Qin,
             max_el_current, max_total_current,
             extra_ineq=extra_ineq, extra_eq=extra_eq,
-            log_level=log_level-10
+            log_level=log_level-10,
+            qp_stats=qp_stats
         )
         return x_l
 
@@ -833,7 +989,8 @@ def _linear_angle_constrained_tes_opt(
                 l, target_mean, (1 - alpha) * Q + alpha * Qin,
                 max_el_current, max_total_current,
                 extra_ineq=extra_ineq, extra_eq=extra_eq,
-                log_level=log_level-10
+                log_level=log_level-10,
+                qp_stats=qp_stats
             )
             angle = _calc_angle(x, Qin, l)
             logger.log(
@@ -897,12 +1054,16 @@ def _bb_bounds_tes_problem(state, max_l0, linear, quadratic, max_el_current, fun
     x_lb = np.zeros(n)
     x_lb[ac] = x_ac
     ## Upper bound calculation
-    # Solve PS2
-    x_ac, _ = func(
-        linear_ac, quadratic_ac
-    )
+    # Solve PS2. It only depends on the active + unassigned electrodes, so the solution
+    # of the parent can be re-used if they did not change
+    if state.relaxed is not None and np.array_equal(state.relaxed[0], ac):
+        x_relaxed = state.relaxed[1]
+    else:
+        x_relaxed, _ = func(
+            linear_ac, quadratic_ac
+        )
     x_ub1 = np.zeros(n)
-    x_ub1[ac] = x_ac
+    x_ub1[ac] = x_relaxed
 
     # Solve problem PS3
     # Select the "l0 - active" largest unassigned electrodes
@@ -924,6 +1085,8 @@ def _bb_bounds_tes_problem(state, max_l0, linear, quadratic, max_el_current, fun
     split_var = state.unassigned[np.argmax(np.abs(x_ub[state.unassigned]))]
     child1 = state.activate(split_var)
     child2 = state.inactivate(split_var)
+    # Activating an electrode keeps the active + unassigned electrodes
+    child1.relaxed = (ac, x_relaxed)
     state.x_ub = x_ub
     state.x_lb = x_lb
 
@@ -953,7 +1116,7 @@ def _norm_constrained_tes_opt(
     Qnorm, target_norm, Q,
     max_el_current, max_total_current,
     extra_ineq=None, extra_eq=None,
-    log_level=20, n_start=20, eigval_cutoff=1e-6):
+    log_level=20, n_start=20, eigval_cutoff=1e-6, qp_stats=None):
     ''' Convex-concave algorithm to solve the problem
     minimize   x^T Q x
     subject to x^T Q_{i} x = t_i^2,  i = 1, 2, ...
@@ -984,7 +1147,8 @@ def _norm_constrained_tes_opt(
             max_el_current, max_total_current,
             extra_ineq=extra_ineq,
             extra_eq=extra_eq,
-            log_level=log_level-10
+            log_level=log_level-10,
+            qp_stats=qp_stats
         )
         if np.sum(norm) > np.sum(max_norm):
             max_norm = np.sum(norm)
@@ -1002,7 +1166,7 @@ def _norm_opt_x0(
     x0, Qnorm, target_norm, Q,
     max_el_current, max_total_current,
     extra_ineq=None, extra_eq=None,
-    log_level=20):
+    log_level=20, qp_stats=None):
 
     x = x0.copy()
     n = len(x)
@@ -1120,7 +1284,8 @@ def _norm_opt_x0(
         # Sometimes due to numerical instabilities this can fail
         try:
             x_ = _active_set_QP(
-                a_, Q_, C_, d_, x_, A=A_, b=b_, eps=1e-3*np.max(np.abs(x))
+                a_, Q_, C_, d_, x_, A=A_, b=b_, eps=1e-3*np.max(np.abs(x)),
+                stats=qp_stats
             )
         except ValueError:
             return None, np.inf, 0
@@ -1151,7 +1316,7 @@ def _norm_opt_x0(
 def _least_squares_tes_opt(l, Q,
                            max_el_current, max_total_current,
                            extra_ineq=None, extra_eq=None,
-                           log_level=10):
+                           log_level=10, qp_stats=None):
         n = Q.shape[1]
         tes_constraints = TESConstraints(n, max_total_current, max_el_current)
         # First solve an LP to get a feasible starting point
@@ -1190,13 +1355,146 @@ def _least_squares_tes_opt(l, Q,
         x_ = _active_set_QP(
             np.squeeze(l_), 2*Q_,
             np.vstack([C_b, C_]), np.hstack([d_b, d_]),
-            x_, eps, A_, b_
+            x_, eps, A_, b_, stats=qp_stats
         )
 
         x = x_[:n] - x_[n:]
         return x
 
-def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
+class QPStatistics(object):
+    ''' Iteration and timing statistics of the active-set QP solver
+
+    Attributes
+    ----------
+    n_calls: int
+        Number of QPs solved
+    n_iter: int
+        Total number of iterations
+    n_added: int
+        Number of constraints added to the working set
+    n_removed: int
+        Number of constraints removed from the working set
+    time: float
+        Total time spent in the QP solver, in seconds
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.n_calls = 0
+        self.n_iter = 0
+        self.n_added = 0
+        self.n_removed = 0
+        self.time = 0.
+
+    def add(self, n_iter, n_added, n_removed, time):
+        with self._lock:
+            self.n_calls += 1
+            self.n_iter += n_iter
+            self.n_added += n_added
+            self.n_removed += n_removed
+            self.time += time
+
+    def update(self, other):
+        ''' Adds the statistics in "other", e.g. collected in another process '''
+        with self._lock:
+            self.n_calls += other.n_calls
+            self.n_iter += other.n_iter
+            self.n_added += other.n_added
+            self.n_removed += other.n_removed
+            self.time += other.time
+
+    def __str__(self):
+        n_calls = max(self.n_calls, 1)
+        return (
+            f'{self.n_calls} QPs, {self.n_iter/n_calls:.1f} iterations and '
+            f'{1e3*self.time/n_calls:.2f} ms per QP, '
+            f'{self.n_added} constraints added, {self.n_removed} removed'
+        )
+
+
+def _qp_add_constraint(ZY, R, Q_z, n_active, a):
+    ''' Updates the factorizations when the constraint "a" enters the working set
+
+    ZY = [Y, Z] and R are the complete QR factors of the working set (Active.T),
+    Q_z = Z^T Q Z is the reduced Hessian
+    '''
+    n = ZY.shape[0]
+    w = ZY.T.dot(a)
+    if n_active < n:
+        # Householder reflection of Z which aligns its first column with "a"
+        v = w[n_active:].copy()
+        sigma = -np.copysign(np.linalg.norm(v), v[0])
+        v[0] -= sigma
+        vv = v.dot(v)
+        if vv > 0:
+            beta = 2 / vv
+            Z = ZY[:, n_active:]
+            Z -= beta * np.outer(Z.dot(v), v)
+            q = Q_z.dot(v)
+            u = beta * q - 0.5 * beta**2 * v.dot(q) * v
+            Q_z = Q_z - np.outer(v, u) - np.outer(u, v)
+        w[n_active] = sigma
+        w[n_active + 1:] = 0.
+        # The first column of Z goes to Y
+        Q_z = Q_z[1:, 1:]
+    R = np.hstack([R, w[:, None]])
+    return ZY, R, Q_z
+
+
+def _qp_remove_constraint(ZY, R, Q_z, n_active, k, Q):
+    ''' Updates the factorizations when the constraint "k" leaves the working set
+
+    See _qp_add_constraint
+    '''
+    n = ZY.shape[0]
+    if n_active > 1:
+        # The rotations only act on the columns of Y
+        ZY, R = scipy.linalg.qr_delete(ZY, R, k, which='col')
+    else:
+        R = R[:, :0]
+    if n_active <= n:
+        # The last column of Y goes to Z, border the reduced Hessian
+        z = ZY[:, n_active - 1]
+        Qz = Q.dot(z)
+        h = ZY[:, n_active:].T.dot(Qz)
+        Q_z = np.block([
+            [np.atleast_2d(z.dot(Qz)), h[None, :]],
+            [h[:, None], Q_z]
+        ])
+    return ZY, R, Q_z
+
+
+def _qp_reduced_direction(Q_z, g_z, rtol=1e-10):
+    ''' Solves Q_z w = g_z for the search direction in the null space of the working set
+
+    Q_z is positive semi-definite and, in the TES problems, often singular. A small
+    multiple of the identity is added to it, so that the direction does not depend on
+    the basis of the null space and is always a descent direction. Along the null space
+    of Q_z the objective is linear, and the direction is large enough to take a full
+    step to the next blocking constraint
+    '''
+    delta = rtol * max(np.max(np.abs(np.diag(Q_z)), initial=0.), np.finfo(float).tiny)
+    try:
+        c = scipy.linalg.cho_factor(
+            Q_z + delta * np.eye(len(Q_z)), check_finite=False
+        )
+        return scipy.linalg.cho_solve(c, g_z, check_finite=False)
+    except np.linalg.LinAlgError:
+        return np.linalg.lstsq(Q_z, g_z, rcond=None)[0]
+
+
+def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None, stats=None):
     ''' Solves the problem
     minimize l^T x + 1/2 x^T Q x
     subject to  Cx <= d
@@ -1204,11 +1502,19 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
     
     Numerically stable methods for quadratic programminga, Gill and Murray
     https://link.springer.com/article/10.1007/BF01588976
+
+    The QR factorization of the working set and the reduced Hessian are updated when
+    constraints enter or leave the working set, instead of being re-calculated. If
+    "stats" is a QPStatistics object, the iteration and timing statistics are added to
+    it
     '''
+    start_time = time.perf_counter()
     # get the active set:
     x = np.copy(x0)
     n = len(x0)
     n_iter = 0
+    n_added = 0
+    n_removed = 0
     active = np.abs(C.dot(x) - d) < eps
     if np.any(np.abs(C.dot(x) - d) < -eps):
         raise ValueError('Infeasible Start!')
@@ -1232,10 +1538,11 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
 
     else:
         ZY = np.eye(n)
-        R = np.zeros((n, n))
+        R = np.zeros((n, 0))
 
-    Y = ZY[:, :n_active]
+    # Reduced Hessian
     Z = ZY[:, n_active:]
+    Q_z = Z.T.dot(Q).dot(Z)
     while n_iter <= max_iter:
         l_i = l + Q.dot(x)
         Y = ZY[:, :n_active]
@@ -1243,10 +1550,7 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
         if n_active >= n:
             p = np.zeros(n)
         else:
-            try:
-                w_z = np.linalg.solve(Z.T.dot(Q).dot(Z), - Z.T.dot(l_i))
-            except np.linalg.LinAlgError:
-                w_z = np.linalg.lstsq(Z.T.dot(Q).dot(Z), - Z.T.dot(l_i), rcond=None)[0]
+            w_z = _qp_reduced_direction(Q_z, - Z.T.dot(l_i))
             p = Z.dot(w_z)
             p = np.squeeze(p.T)
         # If no update, check the duals and try to terminate
@@ -1270,10 +1574,9 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
                 break
 
             Active = np.delete(Active, min_C_dual, axis=0)
-            ZY, R = scipy.linalg.qr_delete(ZY, R,
-                                           min_C_dual,
-                                           which='col')
+            ZY, R, Q_z = _qp_remove_constraint(ZY, R, Q_z, n_active, min_C_dual, Q)
             n_active -= 1
+            n_removed += 1
 
         else:
             den = C.dot(p)
@@ -1290,15 +1593,12 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
                 indices = np.where(s)[0]
                 added_iq_constraint = indices[went_to_bounds]
                 Active = np.vstack([Active, C[added_iq_constraint, :]])
-                # Update the QR decomposition
-                if n_active > 0:
-                    ZY, R = scipy.linalg.qr_insert(ZY, R,
-                                                   C[added_iq_constraint, :], n_active,
-                                                   which='col')
-                    n_active += 1
-                else:
-                    ZY, R = np.linalg.qr(np.atleast_2d(C[added_iq_constraint, :]).T, 'complete')
-                    n_active += 1
+                # Update the QR decomposition and the reduced Hessian
+                ZY, R, Q_z = _qp_add_constraint(
+                    ZY, R, Q_z, n_active, C[added_iq_constraint, :]
+                )
+                n_active += 1
+                n_added += 1
             x = x + alpha * p
 
         n_iter += 1
@@ -1306,6 +1606,9 @@ def _active_set_QP(l, Q, C, d, x0, eps=1e-5, A=None, b=None):
         #raise ValueError('Maximal number of iterations reached!')
         pass
 
+    if stats is not None:
+        stats.add(n_iter, n_added, n_removed, time.perf_counter() - start_time)
+
     return x
 
 
@@ -1331,6 +1634,8 @@ class bb_state(object):
         self.unassigned = unassigned
         self.x_lb = None
         self.x_ub = None
+        # Solution of the relaxed problem of the parent, as (mask, x)
+        self.relaxed = None
 
     def inactivate(self, i):
         if i not in self.unassigned:
@@ -1360,17 +1665,21 @@ class bb_node(object):
     ''' Node for branch and bound algorithm.
     Contains the current state
     bounds_funct is a funtiom wich takes in a state and return the upper bound, lower
-    bound, children1 and children2 '''
-    def __init__(self, state, bounds_func):
+    bound, children1 and children2
+    bounds can be given if bounds_func(state) has already been evaluated '''
+    def __init__(self, state, bounds_func, bounds=None):
         self.state = state
         self.bounds_func = bounds_func
-        self.ub_val, self.lb_val, self.child1, self.child2 = self.bounds_func(self.state)
+        if bounds is None:
+            bounds = self.bounds_func(self.state)
+        self.ub_val, self.lb_val, self.child1, self.child2 = bounds
 
     def split(self):
         ''' Returns 2 child nodes '''
         return bb_node(self.child1, self.bounds_func), bb_node(self.child2, self.bounds_func)
 
-def _branch_and_bound(init, function, eps, max_k, log_level=20):
+def _branch_and_bound(init, function, eps, max_k, log_level=20, n_workers=1,
+                      qp_stats=None):
     '''Brach and Bound Algorithm
     Parameters:
     --------
@@ -1383,7 +1692,33 @@ def _branch_and_bound(init, function, eps, max_k, log_level=20):
         Tolerance between upper and lower bound
     max_k: int
         Maximum depth
+    n_workers: int
+        Number of processes. If > 1, the "n_workers" nodes with the lowest lower
+        bounds are split in each iteration and their children are evaluated in a
+        process pool. "function" and the states need to be picklable. Default: 1
+    qp_stats: QPStatistics (optional)
+        Statistics updated by "function". The statistics of the worker processes are
+        added to it
     '''
+    if n_workers > 1:
+        from ..simulation.fem import SharedObjects, _shared_initializer
+        # Best upper bound, shared by the workers to skip children which would be
+        # pruned anyway
+        incumbent = multiprocessing.Value('d', np.inf)
+        with SharedObjects(function, qp_stats) as shared, \
+                ProcessPoolExecutor(n_workers,
+                                    initializer=_shared_initializer,
+                                    initargs=(_set_up_bb_worker, shared, incumbent)
+                                    ) as executor:
+            return _branch_and_bound_loop(
+                init, function, eps, max_k, log_level, n_workers,
+                qp_stats, executor, incumbent
+            )
+    return _branch_and_bound_loop(init, function, eps, max_k, log_level)
+
+
+def _branch_and_bound_loop(init, function, eps, max_k, log_level=20, n_workers=1,
+                           qp_stats=None, executor=None, incumbent=None):
     active_nodes = [bb_node(init, function)]
     k = 0
     return_val = None
@@ -1405,10 +1740,69 @@ def _branch_and_bound(init, function, eps, max_k, log_level=20):
                 logger.log(log_level, 'Maximum number of iterations reached, retunning')
             return_val = active_nodes[ub.argmin()].state
             break
-        q = active_nodes.pop(lb.argmin())
-        c1, c2 = q.split()
-        active_nodes.append(c1)
-        active_nodes.append(c2)
-        k += 1
+        if executor is None:
+            q = active_nodes.pop(lb.argmin())
+            c1, c2 = q.split()
+            active_nodes.append(c1)
+            active_nodes.append(c2)
+            k += 1
+        else:
+            # Split the nodes with the lowest lower bounds, leaving out the leaves
+            order = [i for i in np.argsort(lb, kind='stable')
+                     if active_nodes[i].child1 is not None]
+            expand = set(order[:min(n_workers, max_k - k)])
+            to_split = [active_nodes[i] for i in sorted(expand)]
+            active_nodes = [n for i, n in enumerate(active_nodes) if i not in expand]
+            incumbent.value = ub.min()
+            active_nodes += _split_nodes(to_split, function, executor, qp_stats)
+            k += len(to_split)
 
     return return_val
+
+
+def _split_nodes(nodes, function, executor, qp_stats=None):
+    ''' Evaluates the children of several nodes in the worker processes '''
+    futures = [
+        executor.submit(_bb_worker_bounds, c, n.lb_val)
+        for n in nodes for c in (n.child1, n.child2)
+    ]
+    children = []
+    for f in futures:
+        result = f.result()
+        if result is None:
+            continue
+        state, bounds, stats = result
+        if qp_stats is not None:
+            qp_stats.update(stats)
+        children.append(bb_node(state, function, bounds))
+    return children
+
+
+def _set_up_bb_worker(function, qp_stats, incumbent):
+    global bb_global_function
+    global bb_global_qp_stats
+    global bb_global_incumbent
+    bb_global_function = function
+    bb_global_qp_stats = qp_stats
+    bb_global_incumbent = incumbent
+
+
+def _bb_worker_bounds(state, parent_lb):
+    ''' Evaluates the bounds of a child node in a worker process
+
+    The lower bound of a child is at least the lower bound of its parent, so the
+    children of parents with a lower bound above the best upper bound found so far
+    are not evaluated and None is returned. Otherwise, returns the state, its bounds
+    and the QP statistics of the evaluation
+    '''
+    global bb_global_function
+    global bb_global_qp_stats
+    global bb_global_incumbent
+    if parent_lb > bb_global_incumbent.value:
+        return None
+    if bb_global_qp_stats is not None:
+        bb_global_qp_stats.reset()
+    bounds = bb_global_function(state)
+    with bb_global_incumbent.get_lock():
+        bb_global_incumbent.value = min(bb_global_incumbent.value, bounds[0])
+    return state, bounds, bb_global_qp_stats
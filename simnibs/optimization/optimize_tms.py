@@ -5,8 +5,14 @@ some examples on how to use these.
 Written by Ole Numssen & Konstantin Weise, 2019.
 Adapted by Guilherme Saturnino, 2019
 """
+import fmm3dpy
 import numpy as np
 
+from simnibs.simulation.tms_coil.tms_coil_element import (
+    DipoleElements,
+    LineSegmentElements,
+    SampledGridPointElements,
+)
 from simnibs.utils.mesh_element_properties import ElementTags
 
 
@@ -272,3 +278,123 @@ def get_opt_grid_ADM(mesh, pos, handle_direction_ref=None, distance=1., radius=2
     )[:, 1].T
 
     return matrices, directions
+
+
+def get_E_reciprocity(tms_coil, positions, currents, matsimnibs_list,
+                      eps=1e-3, line_quadrature=1, max_targets=2**20):
+    ''' Evaluates the E-field induced by a coil in a target for many coil positions
+    using reciprocity
+
+    The target E-field is the integral of -dA/dt of the coil weighted by the
+    total current density caused by a source in the target region. For dipole
+    and line segment elements, the field of the current density is evaluated
+    at the coil elements using the FMM, sampled grid elements are interpolated
+    at the current positions.
+
+    Parameters
+    ----------
+    tms_coil: simnibs.simulation.tms_coil.tms_coil.TmsCoil
+        TMS coil, can have elements of any type
+    positions: ndarray of size Nx3
+        Positions of the current sources (e.g. tetrahedra baricenters), in mm
+    currents: ndarray of size Nx3 or KxNx3
+        Currents at each position (current density times volume). Several
+        current distributions can be evaluated at once
+    matsimnibs_list: ndarray of size Mx4x4
+        Coil positions and orientations, in mm
+    eps: float (optional)
+        Precision of the FMM. Default: 1e-3
+    line_quadrature: int (optional)
+        Number of Gauss-Legendre points along each line segment. Default: 1
+        (midpoint, as used in LineSegmentElements.get_a_field)
+    max_targets: int (optional)
+        Maximum number of evaluation points per FMM call, to limit memory
+        usage. Default: 2**20
+
+    Returns
+    -------
+    E: ndarray of size M or KxM
+        E-field in the target for each coil position and current
+        distribution, for dI/dt = 1 A/s
+    '''
+    currents = np.asarray(currents, dtype=float)
+    single = currents.ndim == 2
+    if single:
+        currents = currents[None]
+    matsimnibs_list = np.asarray(matsimnibs_list, dtype=float).reshape(-1, 4, 4)
+    n_currents = currents.shape[0]
+    n_pos = len(matsimnibs_list)
+    positions = np.asarray(positions, dtype=float)
+    # FMM input: one density per current distribution and component
+    sources_m = np.ascontiguousarray(positions.T * 1e-3)
+    charges = np.ascontiguousarray(
+        currents.transpose(0, 2, 1).reshape(-1, len(positions)))
+
+    E = np.zeros((n_currents, n_pos))
+    for element in tms_coil.elements:
+        if isinstance(element, DipoleElements):
+            # E = -m . B_J(r_dipole)
+            points = element.get_points_m()
+            values = element.get_values()
+            E -= _eval_reciprocal_positional(
+                sources_m, charges, points, values,
+                matsimnibs_list, n_currents, eps, max_targets, curl=True)
+        elif isinstance(element, LineSegmentElements):
+            # E = - dl . A_J(r_segment), Gauss-Legendre along the segments
+            x, w = np.polynomial.legendre.leggauss(line_quadrature)
+            points = element.get_points_m()
+            values = element.get_values() * 1e-3
+            points = (points[None] + 0.5 * x[:, None, None] * values[None]).reshape(-1, 3)
+            values = (0.5 * w[:, None, None] * values[None]).reshape(-1, 3)
+            E -= _eval_reciprocal_positional(
+                sources_m, charges, points, values,
+                matsimnibs_list, n_currents, eps, max_targets, curl=False)
+        elif isinstance(element, SampledGridPointElements):
+            # E = - sum(J . A_coil(r_J))
+            for i, matsimnibs in enumerate(matsimnibs_list):
+                A = element.get_a_field(positions, matsimnibs, eps)
+                E[:, i] -= np.einsum('knc,nc->k', currents, A)
+        else:
+            raise ValueError(
+                f'Reciprocity is not implemented for coil elements of type '
+                f'{type(element).__name__}')
+    return E[0] if single else E
+
+
+def _eval_reciprocal_positional(sources_m, charges, points, values,
+                                matsimnibs_list, n_currents, eps, max_targets,
+                                curl):
+    ''' sum(values . F(points)) for each coil position, where F is the
+    vector potential of the currents (curl=False) or its curl (curl=True)
+
+    The points and values are given in the coil coordinate system, in meters.
+    The coil positions are processed in chunks of at most max_targets points
+    '''
+    n_points = len(points)
+    n_pos = len(matsimnibs_list)
+    out = np.empty((n_currents, n_pos))
+    chunk = max(1, max_targets // max(n_points, 1))
+    for start in range(0, n_pos, chunk):
+        mats = matsimnibs_list[start:start + chunk]
+        R = mats[:, :3, :3]
+        targets = (
+            np.einsum('pij,nj->pni', R, points) + mats[:, None, :3, 3] * 1e-3
+        ).reshape(-1, 3)
+        vals = np.einsum('pij,nj->pni', R, values)
+        res = fmm3dpy.lfmm3d(
+            eps=eps, sources=sources_m, charges=charges,
+            targets=np.ascontiguousarray(targets.T),
+            nd=charges.shape[0], pgt=2 if curl else 1
+        )
+        if curl:
+            g = res.gradtarg.reshape(n_currents, 3, 3, len(mats), n_points)
+            F = np.stack([
+                g[:, 2, 1] - g[:, 1, 2],
+                g[:, 0, 2] - g[:, 2, 0],
+                g[:, 1, 0] - g[:, 0, 1],
+            ], axis=-1)
+        else:
+            F = res.pottarg.reshape(
+                n_currents, 3, len(mats), n_points).transpose(0, 2, 3, 1)
+        out[:, start:start + chunk] = 1e-7 * np.einsum('kpnc,pnc->kp', F, vals)
+    return out
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 
 from .. import ADMlib
 
@@ -317,3 +318,27 @@ def test_ADMmag():
             assert np.allclose(magnE_adm[j, i], magnE)
 
 
+
+
+@pytest.mark.parametrize('n_threads', [1, 2])
+def test_reciprocalE(n_threads):
+    np.random.seed(3)
+    npos, ncoil, Nj = 11, 7, 4
+    rs = np.random.rand(3, ncoil)
+    ks = np.random.rand(3, ncoil, Nj)
+    A = np.zeros((4, 4, npos))
+    for i in range(npos):
+        A[:3, :3, i] = np.linalg.qr(np.random.rand(3, 3))[0]
+        A[:3, 3, i] = np.random.rand(3)
+        A[3, 3, i] = 1
+
+    robs = ADMlib.coilcopies(rs, A)
+    Hprimary = np.random.rand(3, npos * ncoil)
+    E = ADMlib.reciprocalE(Hprimary, ks, A, chunk_size=3, n_threads=n_threads)
+
+    for i in range(npos):
+        st, en = i * ncoil, (i + 1) * ncoil
+        assert np.allclose(robs[:, st:en], A[:3, :3, i].dot(rs) + A[:3, 3, i, None])
+        for j in range(Nj):
+            kp = A[:3, :3, i].dot(ks[:, :, j])
+            assert np.isclose(E[j, i], -np.sum(Hprimary[:, st:en] * kp))
@@ -1,5 +1,6 @@
 import os
 import csv
+import glob
 from mock import patch, MagicMock
 import tempfile
 
@@ -13,7 +14,12 @@ from ... import SIMNIBSDIR
 from ...mesh_tools import mesh_io
 from ...simulation import sim_struct
 from ...simulation import analytical_solutions
+from ...simulation.tms_coil.tms_coil import TmsCoil
+from ...simulation.tms_coil.tms_coil_element import DipoleElements
+from ...simulation.tms_coil.tms_stimulator import TmsStimulator
 from .. import opt_struct
+from .. import optimization_methods
+from ...utils import leadfield_utils
 
 
 @pytest.fixture()
@@ -70,6 +76,8 @@ def fn_surf(sphere_surf, leadfield_surf):
         f.create_dataset(dset, data=leadfield_surf)
     yield fn_leadfield
     os.remove(fn_leadfield)
+    for fn in glob.glob(fn_leadfield + '.Q_*'):
+        os.remove(fn)
 
 
 @pytest.fixture()
@@ -83,6 +91,8 @@ def fn_vol(sphere_vol, leadfield_vol):
         f.create_dataset(dset, data=leadfield_vol)
     yield fn_leadfield
     os.remove(fn_leadfield)
+    for fn in glob.glob(fn_leadfield + '.Q_*'):
+        os.remove(fn)
 
 
 @pytest.fixture()
@@ -280,6 +290,61 @@ class TestTMSOpt:
             E_analytical.append(np.linalg.norm(E))
         assert np.allclose(E_analytical, E_recp, rtol=0.1)
 
+    @pytest.mark.parametrize('target_direction', [None, [1., 0., 0.]])
+    @patch('simnibs.optimization.optimize_tms.get_opt_grid_ADM')
+    def test_reciprocal_tcd(self, get_opt_grid_mock, target_direction,
+                            sphere_msh, simple_coil_ccd):
+        fn_tcd = tempfile.mktemp('.tcd')
+        dipole_pos, dipole_moment = simple_coil()
+        TmsCoil([DipoleElements(
+            TmsStimulator('simple'), dipole_pos, dipole_moment
+        )]).write(fn_tcd)
+        coil_centers = [
+            [150., 0., 0.],
+            [0., 150., 0.],
+            [0., 0, 150.],
+        ]
+        center_matrices = []
+        for cc in coil_centers:
+            z_dir = -np.array(cc)/np.linalg.norm(cc)
+            y_dir = np.array([0., 1., 0.])
+            if np.isclose(np.abs(z_dir.dot(y_dir)), 1):
+                y_dir = np.array([1., 0., 0.])
+            p = np.eye(4)
+            p[:3, 0] = np.cross(y_dir, z_dir)
+            p[:3, 1] = y_dir
+            p[:3, 2] = z_dir
+            p[:3, 3] = cc
+            center_matrices.append(p)
+        coil_dir = []
+        for angle in np.linspace(-np.pi/2, np.pi/2, 3):
+            coil_dir.append([-np.sin(angle), np.cos(angle), 0])
+        coil_dir = np.array(coil_dir)
+
+        target_pos, target_region = sphere_msh.find_closest_element(
+            [85, 0, 0],
+            elements_of_interest=sphere_msh.elm.tetrahedra,
+            return_index=True
+        )
+        E = []
+        for fn_coil in [simple_coil_ccd, fn_tcd]:
+            get_opt_grid_mock.return_value = (
+                np.array(center_matrices).transpose(1, 2, 0),
+                coil_dir.T
+            )
+            tms_opt = opt_struct.TMSoptimize()
+            tms_opt.fnamecoil = fn_coil
+            tms_opt.mesh = sphere_msh
+            tms_opt.didt = 1e6
+            tms_opt.target_direction = target_direction
+            cond_field = sim_struct.SimuList.cond2elmdata(tms_opt)
+            E_recp, pos_matrices = tms_opt._ADM_optimize(
+                cond_field, np.atleast_1d(target_region))
+            E.append(E_recp)
+        os.remove(fn_tcd)
+        assert len(pos_matrices) == 9
+        assert np.allclose(E[0], E[1], rtol=1e-2, atol=1e-2 * np.max(np.abs(E[0])))
+
 
 class TestFindIndexes:
     @pytest.mark.parametrize('indexes', [3, [5, 2]])
@@ -915,6 +980,123 @@ class TestTDCSoptimize:
             if max_ac is not None:
                 assert np.linalg.norm(currents, 0) <= max_ac
 
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    @pytest.mark.parametrize('max_ac', [None, 3])
+    def test_optimize_batch(self, n_workers, max_ac, fn_surf, tmp_path):
+        p = opt_struct.TDCSoptimize(
+            leadfield_hdf=fn_surf, max_active_electrodes=max_ac
+        )
+        targets = []
+        for i in range(3):
+            targets.append(opt_struct.TDCStarget(
+                indexes=i + 1, directions=[1., 0., 0.], intensity=3e-4
+            ))
+        avoid = [opt_struct.TDCSavoid(indexes=[1, 2], weight=1e3)]
+        targets.append(([targets[0], targets[1]], avoid))
+
+        fn_csv = str(tmp_path.joinpath('batch.csv'))
+        fn_hdf5 = str(tmp_path.joinpath('batch.hdf5'))
+        currents, summary = p.optimize_batch(
+            targets, fn_out_csv=fn_csv, fn_out_hdf5=fn_hdf5, n_workers=n_workers
+        )
+        assert currents.shape == (4, 5)
+        for i in range(3):
+            p.target = [targets[i]]
+            assert np.allclose(currents[i], p.optimize(), atol=1e-6)
+        p.target = [targets[0], targets[1]]
+        p.avoid = avoid
+        assert np.allclose(currents[3], p.optimize(), atol=1e-6)
+
+        field = p.field(currents[3])
+        assert np.isclose(
+            summary['target_1_intensity'][3], targets[0].mean_intensity(field)
+        )
+        assert np.isclose(
+            summary['avoid_1_mean_field_norm'][3], avoid[0].mean_field_norm_in_region(field)
+        )
+        assert np.all(np.isnan(summary['target_2_intensity'][:3]))
+
+        with open(fn_csv) as f:
+            rows = list(csv.reader(f))
+        assert len(rows) == 5
+        assert rows[0][:5] == ['0', '1', '2', '3', '4']
+        assert np.allclose(np.array(rows[1][:5], dtype=float), currents[0])
+        with h5py.File(fn_hdf5, 'r') as f:
+            assert np.allclose(f['currents'][:], currents)
+            columns = list(f['summary'].attrs['columns'])
+            assert np.allclose(
+                f['summary'][:, columns.index('peak_field')], summary['peak_field']
+            )
+
+    def test_get_Q_cache(self, fn_surf, leadfield_surf):
+        opt_struct._TDCS_Q_CACHE.clear()
+        p = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
+        weights = p.get_weights()
+        Q = p.get_Q()
+        Q_ref = optimization_methods.TESOptimizationProblem(
+            leadfield_surf, weights=weights
+        ).Q
+        assert np.allclose(Q, Q_ref)
+        # A new problem with the same leadfield file re-uses the matrix
+        p2 = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
+        with patch.object(optimization_methods, '_calc_Q') as calc_Q:
+            assert p2.get_Q() is Q
+            calc_Q.assert_not_called()
+        # Changing the avoid regions changes the matrix
+        a = p2.add_avoid()
+        a.indexes = [1, 2]
+        assert not np.allclose(p2.get_Q(), Q)
+        assert len(opt_struct._TDCS_Q_CACHE) == 2
+        # Leadfields set directly are cached in the object
+        p3 = opt_struct.TDCSoptimize()
+        p3.mesh = p.mesh
+        p3.leadfield = 2 * leadfield_surf
+        assert np.allclose(p3.get_Q(), 4 * Q)
+        assert len(opt_struct._TDCS_Q_CACHE) == 2
+        assert len(p3._Q_cache) == 1
+
+    def test_get_Q_sidecar(self, fn_surf):
+        opt_struct._TDCS_Q_CACHE.clear()
+        p = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
+        Q = p.get_Q()
+        fn_Q, = glob.glob(fn_surf + '.Q_*.npy')
+        # A new session loads the matrix from the file
+        opt_struct._TDCS_Q_CACHE.clear()
+        p2 = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
+        with patch.object(optimization_methods, '_calc_Q') as calc_Q:
+            assert np.allclose(p2.get_Q(), Q)
+            calc_Q.assert_not_called()
+        # Changing the leadfield file invalidates it
+        with h5py.File(fn_surf, 'a') as f:
+            f['/mesh_leadfield/leadfields/tdcs_leadfield'][...] *= 2
+        opt_struct._TDCS_Q_CACHE.clear()
+        p3 = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
+        assert np.allclose(p3.get_Q(), 4 * Q)
+        fn_Q3, = glob.glob(fn_surf + '.Q_*.npy')
+        assert fn_Q3 != fn_Q
+
+    def test_optimize_lazy_leadfield(self, fn_surf, leadfield_surf):
+        p = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf, max_total_current=2e-3)
+        t = p.add_target()
+        t.indexes = [3, 1]
+        t.directions = [1., 0., 0.]
+        t.intensity = 3e-4
+        a = p.add_avoid()
+        a.indexes = 5
+        assert isinstance(p.leadfield, leadfield_utils.LazyLeadfield)
+        currents = p.optimize()
+
+        p2 = opt_struct.TDCSoptimize(max_total_current=2e-3)
+        p2.mesh = p.mesh
+        p2.leadfield = leadfield_surf
+        p2.target, p2.avoid = p.target, p.avoid
+        assert np.allclose(currents, p2.optimize(), atol=1e-6)
+        assert np.allclose(p.field(currents)[:], p2.field(currents)[:])
+
+        s = p.summary(currents, full_field=False)
+        assert 'Peak Value' not in s
+        assert s.splitlines()[-4:] == p2.summary(currents).splitlines()[-4:]
+
     def test_field_node(self, leadfield_surf, fn_surf):
         p = opt_struct.TDCSoptimize(leadfield_hdf=fn_surf)
         c = [1., -1., 0, 0., 0.]
@@ -1141,6 +1323,30 @@ class TestTDCSDistributedoptimize:
         assert np.allclose(m.field['normalField'][:], np.sum(leadfield_surf[0]*normals, axis=1))
         assert np.allclose(m.field['target_map'][:], sphere_surf.nodes[:, 0], atol=1e-3)
 
+    def test_optimize_single_precision(self, fn_surf, leadfield_surf):
+        dset = '/mesh_leadfield/leadfields/tdcs_leadfield'
+        with h5py.File(fn_surf, 'a') as f:
+            del f[dset]
+            f.create_dataset(dset, data=leadfield_surf.astype(np.float32))
+        target_img = np.random.rand(100, 100, 100)
+        affine = np.eye(4)
+        affine[:3, 3] = -100
+        affine[:3, :3] *= 2
+        p = opt_struct.TDCSDistributedOptimize(
+            leadfield_hdf=fn_surf, max_total_current=2e-3,
+            target_image=(target_img, affine), intensity=3e-5,
+            min_img_value=0, mni_space=False
+        )
+
+        class Stop(Exception):
+            pass
+
+        with patch.object(optimization_methods, 'TESDistributed', side_effect=Stop) as problem:
+            with pytest.raises(Stop):
+                p.optimize()
+        # The leadfield is weighted in double precision
+        assert problem.call_args[0][0].dtype == np.float64
+
     @pytest.mark.parametrize('intensity', [3e-5, -2e-5])
     @pytest.mark.parametrize('max_el_c', [1e-3, None])
     @pytest.mark.parametrize('max_tot_c', [2e-3, None])
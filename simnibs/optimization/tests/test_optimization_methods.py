@@ -1,11 +1,14 @@
 import itertools
+import multiprocessing
 from unittest import mock
+import h5py
 import numpy as np
 import scipy.optimize
 import pytest
 import warnings
 
 from .. import optimization_methods
+from ...utils.leadfield_utils import LazyLeadfield
 from ...simulation.analytical_solutions import fibonacci_sphere
 
 @pytest.fixture()
@@ -23,6 +26,29 @@ def optimization_variables():
                   [0, 0, 0, 1]])
     return l, Q, P
 
+def bb_bounds_func(s):
+    # Function with gives out the bounds as well as the new sets to split
+    a = np.array([4, 0, 1, 3, 2, 6, 7, 8, 9, 5]) * .1
+
+    if len(s.active) > 4:
+        return np.inf, np.inf, None, None
+
+    to_consider = s.active + s.unassigned
+    v_in_consideration = a[to_consider]
+    ub = np.sum(v_in_consideration)
+    lb = np.sum(np.sort(v_in_consideration)[:4])
+    for i in np.argsort(v_in_consideration):
+        el = to_consider[i]
+        if el in s.unassigned:
+            split1 = s.inactivate(el)
+            split2 = s.activate(el)
+            break
+    if len(s.unassigned) == 0:
+        split1 = None
+        split2 = None
+
+    return ub, lb, split1, split2
+
 def objective(l, Q, lam, x):
     P = np.vstack([-np.ones(len(l)), np.eye(len(l))])
     return l.dot(x) + 0.5 * x.T.dot(Q.dot(x)) + lam * np.linalg.norm(P.dot(x), 1)
@@ -248,6 +274,77 @@ class TestActiveSetQp:
         assert np.isclose(objective(l, Q, 0, x), objective(l, Q, 0, x_sp),
                           rtol=1e-4, atol=1e-4)
 
+    def test_stats(self):
+        optimum = np.array([2.5, 3, 1])
+        Q = np.array([[8, 0, 0], [0, 4, 0], [0, 0, 1]])
+        l = Q.dot(optimum)
+        C = np.vstack([np.eye(len(l)), -np.eye(len(l))])
+        x0 = 2 * np.ones(len(l))
+        d = 2 * np.ones(C.shape[0])
+        stats = optimization_methods.QPStatistics()
+        optimization_methods._active_set_QP(l, Q, C, d, x0, stats=stats)
+        optimization_methods._active_set_QP(l, Q, C, d, x0, stats=stats)
+        assert stats.n_calls == 2
+        assert stats.n_removed >= 2
+        assert stats.n_iter > 0
+        stats.reset()
+        assert stats.n_calls == 0
+
+    @pytest.mark.parametrize('seed', range(10))
+    def test_singular_hessian(self, seed):
+        # Same structure as the TES problems, where x = x+ - x- makes Q singular
+        rng = np.random.RandomState(seed)
+        n = 10
+        B = rng.randn(30, n)
+        B -= B.mean(axis=1, keepdims=True)
+        Q = np.vstack([np.hstack([B.T.dot(B), -B.T.dot(B)]),
+                       np.hstack([-B.T.dot(B), B.T.dot(B)])])
+        c = rng.randn(n)
+        l = np.hstack([c, -c])
+        C = np.vstack([np.eye(2 * n), -np.eye(2 * n), np.ones(2 * n)])
+        d = np.hstack([0.3 * np.ones(2 * n), np.zeros(2 * n), 1.])
+        A = np.hstack([np.ones(n), -np.ones(n)])[None, :]
+        b = np.zeros(1)
+        # Start in the interior, where the reduced Hessian is singular
+        x0 = 0.01 * np.ones(2 * n)
+        stats = optimization_methods.QPStatistics()
+        x = optimization_methods._active_set_QP(
+            l, Q, C, d, x0, eps=1e-6, A=A, b=b, stats=stats
+        )
+        x_sp = optimize_scipy(l, Q, C, d, A, b)
+        assert np.all(C.dot(x) <= d + 1e-6)
+        assert np.isclose(A.dot(x), b, atol=1e-6)
+        assert objective(l, Q, 0, x) <= objective(l, Q, 0, x_sp) + \
+            1e-4 * np.abs(objective(l, Q, 0, x_sp))
+        # The maximum number of iterations is not reached
+        assert stats.n_iter < 200
+
+    def test_update_factorizations(self):
+        np.random.seed(2)
+        B = np.random.random((6, 6))
+        Q = B.T.dot(B)
+        C = np.random.random((5, 6))
+        ZY, R = np.linalg.qr(C[:2].T, 'complete')
+        Q_z = ZY[:, 2:].T.dot(Q).dot(ZY[:, 2:])
+        Active = C[:2]
+        n_active = 2
+        for i in range(2, 5):
+            ZY, R, Q_z = optimization_methods._qp_add_constraint(
+                ZY, R, Q_z, n_active, C[i]
+            )
+            Active = np.vstack([Active, C[i]])
+            n_active += 1
+        ZY, R, Q_z = optimization_methods._qp_remove_constraint(
+            ZY, R, Q_z, n_active, 1, Q
+        )
+        Active = np.delete(Active, 1, axis=0)
+        n_active -= 1
+        assert np.allclose(ZY.T.dot(ZY), np.eye(6))
+        assert np.allclose(ZY.dot(R), Active.T)
+        assert np.allclose(np.tril(R[:n_active], -1), 0)
+        Z = ZY[:, n_active:]
+        assert np.allclose(Z.T.dot(Q).dot(Z), Q_z)
+
 
 class TestTESOptimizationProblem():
     def test_calc_Q(self):
@@ -263,6 +360,28 @@ class TestTESOptimizationProblem():
         currents = np.array([-1, 1, 0])
         assert np.allclose(currents.dot(tes_opt.Q.dot(currents)), energy)
 
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_calc_Q_chunks(self, n_workers, tmp_path):
+        A = np.random.random((4, 50, 3))
+        volumes = np.random.random(50)
+        Q = optimization_methods.TESOptimizationProblem(A, 1e3, 1e3, volumes).Q
+        fn_hdf5 = str(tmp_path / 'leadfield.hdf5')
+        with h5py.File(fn_hdf5, 'w') as f:
+            f.create_dataset('lf', data=A, chunks=(1, 10, 3))
+        with mock.patch.object(optimization_methods, '_LEADFIELD_CHUNK_BYTES', 7 * 4 * 3 * 8):
+            tes_opt = optimization_methods.TESOptimizationProblem(
+                LazyLeadfield(fn_hdf5, 'lf'), 1e3, 1e3, volumes,
+                n_workers=n_workers
+            )
+            targets = [3, 10, 49, 7]
+            Qnorm = optimization_methods._calc_Qnorm(
+                tes_opt.leadfield, targets, volumes, n_workers)
+            l = optimization_methods._calc_l(
+                tes_opt.leadfield, targets, np.ones((4, 3)), volumes, n_workers)
+        assert np.allclose(tes_opt.Q, Q)
+        assert np.allclose(Qnorm, optimization_methods._calc_Qnorm(A, targets, volumes))
+        assert np.allclose(l, optimization_methods._calc_l(A, targets, np.ones((4, 3)), volumes))
+
     def test_bound_constraints(self):
         A = np.random.random((2, 5, 3))
         tes_opt = optimization_methods.TESOptimizationProblem(
@@ -599,35 +718,31 @@ class TestBBAlgorithm:
         assert c2.lb_val == 0 + 1 + 2 + 3
         assert c2.ub_val == sum(range(0, 10))
 
-    def test_bb_algorithm(self):
-        # Function with gives out the bounds as well as the new sets to split
-        def bounds_func(s):
-            a = np.array([4, 0, 1, 3, 2, 6, 7, 8, 9, 5]) * .1
-
-            if len(s.active) > 4:
-                return np.inf, np.inf, None, None
-
-            to_consider = s.active + s.unassigned
-            v_in_consideration = a[to_consider]
-            ub = np.sum(v_in_consideration)
-            lb = np.sum(np.sort(v_in_consideration)[:4])
-            for i in np.argsort(v_in_consideration):
-                el = to_consider[i]
-                if el in s.unassigned:
-                    split1 = s.inactivate(el)
-                    split2 = s.activate(el)
-                    break
-            if len(s.unassigned) == 0:
-                split1 = None
-                split2 = None
-
-            return ub, lb, split1, split2
-
+    @pytest.mark.parametrize('n_workers', [1, 3])
+    def test_bb_algorithm(self, n_workers):
         init = optimization_methods.bb_state([], [], list(range(10)))
         eps = 1e-1
-        final_state = optimization_methods._branch_and_bound(init, bounds_func, eps, 100)
+        final_state = optimization_methods._branch_and_bound(
+            init, bb_bounds_func, eps, 100, n_workers=n_workers
+        )
         assert np.all(final_state.active == [1, 2, 4, 3])
 
+    def test_bb_worker_bounds(self):
+        incumbent = multiprocessing.Value('d', 1.)
+        qp_stats = optimization_methods.QPStatistics()
+        qp_stats.add(1, 0, 0, 0.)
+        optimization_methods._set_up_bb_worker(bb_bounds_func, qp_stats, incumbent)
+        state = optimization_methods.bb_state([], [], list(range(10)))
+        # Children of nodes which would be pruned are not evaluated
+        assert optimization_methods._bb_worker_bounds(state, 1.1) is None
+        state, bounds, stats = optimization_methods._bb_worker_bounds(state, 0.6)
+        assert np.allclose(bounds[:2], [4.5, 0.6])
+        assert stats.n_calls == 0
+        assert incumbent.value == 1.
+        incumbent.value = 5.
+        optimization_methods._bb_worker_bounds(state, 0.6)
+        assert np.isclose(incumbent.value, 4.5)
+
     def test_bb_bounds_tes_problem(self):
         state = optimization_methods.bb_state([1], [0], [2, 3, 4]) # 1 active, 0 inactive
         linear = [np.arange(5)[None, :]]
@@ -662,11 +777,38 @@ class TestBBAlgorithm:
         # Third call
         assert np.allclose(mock_fun.call_args_list[2][0][0][0], np.arange(1, 4))
         assert np.allclose(mock_fun.call_args_list[2][0][1][0], np.diag(np.arange(1, 4)))
+        # The relaxed solution is passed to the child with the same electrodes
+        assert np.all(child1.relaxed[0] == [False, True, True, True, True])
+        assert np.allclose(child1.relaxed[1], [4, 3, 2, 1])
+        assert child2.relaxed is None
+
+    def test_bb_bounds_tes_problem_relaxed(self):
+        state = optimization_methods.bb_state([1], [0], [2, 3, 4])
+        state.relaxed = (
+            np.array([False, True, True, True, True]), np.array([4, 3, 2, 1])
+        )
+        linear = [np.arange(5)[None, :]]
+        quadratic = [np.diag(np.arange(5))]
+
+        mock_fun = mock.Mock(
+            side_effect=[
+                (np.array([4, 3, 2, 1]), 2),
+                (np.array([4, 3, 2]), 4),
+            ]
+        )
+        ub, lb, child1, child2 = optimization_methods._bb_bounds_tes_problem(
+            state, 3, linear, quadratic, 4, mock_fun,
+        )
+        assert mock_fun.call_count == 2
+        assert ub == 4
+        assert lb == 2
+        assert np.allclose(mock_fun.call_args_list[1][0][0][0], np.arange(1, 4))
 
 
 class TestLinearElecConstrained:
+    @pytest.mark.parametrize('n_workers', [1, 2])
     @pytest.mark.parametrize('init_startegy', ['compact', 'full'])
-    def test_solve_feasible(self, init_startegy):
+    def test_solve_feasible(self, init_startegy, n_workers):
         np.random.seed(1)
         leadfield = np.random.random((5, 10, 3))
         np.random.seed(None)
@@ -679,11 +821,13 @@ class TestLinearElecConstrained:
         n_elec = 4
 
         tes_problem = optimization_methods.TESLinearElecConstrained(
-            n_elec, leadfield, max_total_current, max_el_current
+            n_elec, leadfield, max_total_current, max_el_current,
+            n_workers=n_workers
         )
         tes_problem.add_linear_constraint(targets, target_direction, target_mean)
 
         x = tes_problem.solve(init_startegy=init_startegy)
+        assert tes_problem.qp_stats.n_calls > 0
 
         x_bf = None
         obj_bf = np.inf
@@ -1162,6 +1306,21 @@ class TestDistributed:
         assert np.allclose(field[0], 1/2)
         assert np.allclose(field[1:], 0)
 
+    @pytest.mark.parametrize('weights_shape', [(30,), (30, 3)])
+    def test_calc_l_Q_chunks(self, weights_shape):
+        leadfield = np.random.rand(5, 30, 3)
+        target_field = np.random.rand(30, 3)
+        weights = np.random.rand(*weights_shape)
+        tes_problem = optimization_methods.TESDistributed(
+            leadfield, target_field, weights
+        )
+        with mock.patch.object(optimization_methods, '_LEADFIELD_CHUNK_BYTES', 4 * 5 * 3 * 8):
+            tes_chunks = optimization_methods.TESDistributed(
+                leadfield, target_field, weights, n_workers=2
+            )
+        assert np.allclose(tes_problem.l, tes_chunks.l)
+        assert np.allclose(tes_problem.Q, tes_chunks.Q)
+
     @pytest.mark.parametrize('max_el_current', [1e5, 1e-2])
     @pytest.mark.parametrize('max_total_current', [1e5, 1e-2])
     def test_solve_scalar_w(self, max_el_current, max_total_current):
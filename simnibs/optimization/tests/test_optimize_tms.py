@@ -160,3 +160,50 @@ def test_get_opt_grid_ADM(sphere3_msh):
         np.rad2deg(np.arctan2(coil_dir[0, :], coil_dir[1, :])),
         [-60., -30., 0., 30., 60.]
     )
+
+
+@pytest.mark.parametrize('element_type', ['dipole', 'line', 'grid'])
+def test_get_E_reciprocity(element_type):
+    from ...simulation.tms_coil.tms_coil import TmsCoil
+    from ...simulation.tms_coil.tms_stimulator import TmsStimulator
+    from ...simulation.tms_coil.tms_coil_element import (
+        DipoleElements, LineSegmentElements, SampledGridPointElements)
+    rng = np.random.default_rng(0)
+    positions = rng.normal(size=(200, 3)) * 20
+    currents = rng.normal(size=(2, 200, 3))
+    stimulator = TmsStimulator('test')
+    t = np.linspace(0, 2 * np.pi, 40, endpoint=False)
+    line = LineSegmentElements(
+        stimulator, np.c_[20 * np.cos(t), 20 * np.sin(t), np.zeros(40)])
+    if element_type == 'dipole':
+        element = DipoleElements(
+            stimulator, rng.normal(size=(20, 3)) * 10, rng.normal(size=(20, 3)))
+    elif element_type == 'line':
+        element = line
+    else:
+        grid = np.mgrid[-60:61:5, -60:61:5, -60:61:5].transpose(1, 2, 3, 0)
+        affine = np.eye(4)
+        affine[:3, :3] *= 5
+        affine[:3, 3] = -60
+        element = SampledGridPointElements(
+            stimulator,
+            line.get_a_field(grid.reshape(-1, 3), np.eye(4)).reshape(grid.shape),
+            affine)
+    coil = TmsCoil([element])
+    matsimnibs = []
+    for i in range(4):
+        R = scipy.spatial.transform.Rotation.from_euler('z', 0.3 * i).as_matrix()
+        M = np.eye(4)
+        M[:3, :3] = R
+        M[:3, 3] = [0, 0, 80 + i]
+        matsimnibs.append(M)
+
+    E = optimize_tms.get_E_reciprocity(
+        coil, positions, currents, matsimnibs, eps=1e-10, max_targets=50)
+    E_direct = np.array([
+        [-np.sum(c * coil.get_a_field(positions, M, eps=1e-10)) for M in matsimnibs]
+        for c in currents
+    ])
+    assert np.allclose(E, E_direct, rtol=1e-6)
+    E0 = optimize_tms.get_E_reciprocity(coil, positions, currents[0], matsimnibs)
+    assert np.allclose(E0, E_direct[0], rtol=1e-2)
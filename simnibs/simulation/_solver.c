@@ -10,6 +10,7 @@ static PetscErrorCode _petsc_finalize(void);
 static PetscErrorCode _petsc_prepare_ksp(int, char**, PetscInt, PetscInt[], PetscInt[], PetscScalar[], FILE*, KSP*);
 static PetscErrorCode _print_ksp_info(KSP, FILE*);
 static PetscErrorCode _petsc_solve_with_ksp(KSP, PetscInt, PetscScalar[], FILE*, PetscScalar[]);
+static PetscErrorCode _petsc_solve_many_with_ksp(KSP, PetscInt, PetscInt, PetscScalar[], FILE*, PetscScalar[]);
 static PetscErrorCode _dealloc(KSP);
 
 static PetscErrorCode _petsc_initialize(void){
@@ -134,6 +135,75 @@ static PetscErrorCode _petsc_solve_with_ksp(KSP ksp, PetscInt N, PetscScalar rhs
   return ierr;
 }
 
+/* Uses an already existing KSP object to solve a block of right-hand sides
+ * The vectors are created once and the arrays are swapped in place for each
+ * right-hand side, so that the whole block is solved in a single call
+ * ksp: KSP object
+ * N: size of the system
+ * n_rhs: number of right-hand sides
+ * rhs: right-hand-side vectors, stacked (n_rhs x N, C order)
+ * stream: Where to redirect stderr and stdout
+ * solution: placeholder for the solutions, stacked (n_rhs x N, C order)
+*/
+static PetscErrorCode _petsc_solve_many_with_ksp(KSP ksp, PetscInt N, PetscInt n_rhs, PetscScalar rhs[], FILE *stream, PetscScalar solution[]){
+  Vec                   x = NULL, b = NULL;         /* Solution, RHS*/
+  PetscErrorCode        ierr, ierr_cleanup;
+  KSPConvergedReason    reason = KSP_CONVERGED_ITERATING;
+  PetscReal             rnorm;
+  PetscInt              niter, i;
+  PetscBool             placed_b = PETSC_FALSE, placed_x = PETSC_FALSE;
+  int                   diverged = 0;
+
+
+  PETSC_STDOUT=stream;
+  PETSC_STDERR=stream;
+  /* Set-up RHS and solution vectors without arrays, they are placed below
+   * Errors go to "cleanup", so that the vectors are always released and never
+   * left pointing to the caller's arrays */
+  ierr = VecCreateSeqWithArray(PETSC_COMM_WORLD, 1, N, NULL, &b);if (ierr) goto cleanup;
+  ierr = VecCreateSeqWithArray(PETSC_COMM_WORLD, 1, N, NULL, &x);if (ierr) goto cleanup;
+
+  for (i = 0; i < n_rhs; i++){
+    ierr = VecPlaceArray(b, &rhs[N*i]);if (ierr) goto cleanup;
+    placed_b = PETSC_TRUE;
+    ierr = VecPlaceArray(x, &solution[N*i]);if (ierr) goto cleanup;
+    placed_x = PETSC_TRUE;
+
+    /* Solve */
+    ierr = KSPSolve(ksp, b, x);if (ierr) goto cleanup;
+
+    /* Information */
+    ierr = KSPGetResidualNorm(ksp, &rnorm);if (ierr) goto cleanup;
+    ierr = KSPGetIterationNumber(ksp, &niter);if (ierr) goto cleanup;
+    ierr = PetscPrintf(PETSC_COMM_WORLD, "System %i of %i - Number of iterations: %i Residual Norm: %.2e\n", i+1, n_rhs, niter, rnorm);if (ierr) goto cleanup;
+    ierr = KSPGetConvergedReason(ksp, &reason);if (ierr) goto cleanup;
+
+    ierr = VecResetArray(b);if (ierr) goto cleanup;
+    placed_b = PETSC_FALSE;
+    ierr = VecResetArray(x);if (ierr) goto cleanup;
+    placed_x = PETSC_FALSE;
+
+    if (reason < 0){
+      ierr = PetscPrintf(PETSC_COMM_WORLD, "KSP Diverged with reason: %i\n", reason);if (ierr) goto cleanup;
+      diverged = 1;
+      goto cleanup;
+    }
+  }
+  if (n_rhs > 0){
+    ierr = PetscPrintf(PETSC_COMM_WORLD, "KSP Converged with reason: %i\n", reason);if (ierr) goto cleanup;
+  }
+
+cleanup:
+  if (placed_b) VecResetArray(b);
+  if (placed_x) VecResetArray(x);
+  ierr_cleanup = VecDestroy(&x);
+  if (!ierr) ierr = ierr_cleanup;
+  ierr_cleanup = VecDestroy(&b);
+  if (!ierr) ierr = ierr_cleanup;
+  if (!ierr && diverged) ierr = 1;
+  return ierr;
+}
+
 /* Destroys the KSP object
  * ksp: KSP object to be destroyed
 */
@@ -559,6 +559,7 @@ def _add_logo(msh_stl):
 
     # shift logo along negative z to the top side of coil
     msh_logo.nodes.node_coord[:,2] += bbox_coil[0,2] - bbox_logo[0,2] - 5
+    msh_logo.nodes.mark_modified()
 
     msh_stl = msh_stl.join_mesh(msh_logo)
     return msh_stl
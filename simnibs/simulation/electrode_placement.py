@@ -1119,6 +1119,7 @@ def put_electrode_on_mesh(elec, mesh, elec_tag, skin_tag=[ElementTags.SCALP, Ele
     # Change the mesh
     tr_nodes = _apply_affine(inv_affine, tr_nodes)
     mesh.nodes.node_coord[roi_tr_nodes-1, :] = tr_nodes
+    mesh.nodes.mark_modified()
 
     # Build electrodes
     if plug_poly is None:
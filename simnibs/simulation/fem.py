@@ -3,9 +3,20 @@
     Functions for assembling and solving FEM systems
 '''
 
+import functools
 import gc
+import glob
+import hashlib
+import io
 import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import tempfile
+import threading
 import time
+import uuid
 import copy
 import warnings
 import atexit
@@ -30,6 +41,26 @@ DEFAULT_SOLVER_OPTIONS = \
         '-pc_hypre_type boomeramg ' \
         '-pc_hypre_boomeramg_coarsen_type HMIS'
 
+# Number of right-hand sides solved together in the leadfield-type simulations
+DEFAULT_BLOCK_SIZE = 8
+
+# Version of the on-disk FEM assembly cache, bump when the format changes
+_FEM_CACHE_VERSION = 2
+
+# Maximum size of a FEM cache folder, in bytes. The least recently used entries
+# are removed when it is exceeded
+_FEM_CACHE_MAX_BYTES = 10 * 2 ** 30
+
+# Number of coil files kept loaded in each process
+_COIL_CACHE_SIZE = 4
+
+# Approximate size of the HDF5 chunks of the leadfield-type outputs, in bytes
+_HDF5_CHUNK_BYTES = 2 ** 20
+
+# Arrays smaller than this are pickled with the objects sent to the workers
+# instead of being placed in shared memory
+_SHARED_MEMORY_MIN_BYTES = 2 ** 16
+
 '''
     This program is part of the SimNIBS package.
     Please check on www.simnibs.org how to cite our work in publications.
@@ -62,6 +93,117 @@ def _initialize_petsc():
         _PETSC_IS_INITILIZED = True
 
 
+# Objects loaded from shared memory in the current process, by key
+_loaded_shared_objects = {}
+
+
+class SharedObjects(object):
+    ''' Sends objects holding large arrays to worker processes through shared memory
+
+    The objects are pickled once, moving every numpy array larger than
+    _SHARED_MEMORY_MIN_BYTES to a .npy file in a temporary folder (in /dev/shm
+    if available). Sending a SharedObjects instance to a worker only transfers
+    the remainder of the pickle, and the workers memory-map the arrays instead
+    of each receiving a copy of the mesh, conductivities, FEM matrices and
+    gradient matrices.
+
+    The arrays are mapped copy-on-write: all workers share the same physical
+    memory, and a worker modifying an array only copies the modified pages.
+
+    Parameters
+    ----------
+    *objs:
+        Objects to be shared, such as meshes, ElementData, FEMSystem objects,
+        sparse matrices or arrays
+
+    Notes
+    -----
+    The memory is released by close(), only call it once all workers are done.
+    '''
+    def __init__(self, *objs):
+        self._key = uuid.uuid4().hex
+        self._folder = None
+        if os.path.isdir('/dev/shm'):
+            try:
+                self._dump(objs, '/dev/shm')
+            except OSError:
+                # /dev/shm is often small in containers
+                self.close()
+        if self._folder is None:
+            self._dump(objs, None)
+
+    def _dump(self, objs, folder_root):
+        self._folder = tempfile.mkdtemp(prefix='simnibs_shared_', dir=folder_root)
+        buffer = io.BytesIO()
+        try:
+            pickler = _SharedMemoryPickler(buffer, self._folder)
+            pickler.dump(objs)
+        except BaseException:
+            self.close()
+            raise
+        self._payload = buffer.getvalue()
+        logger.debug(
+            'Placed {0} arrays ({1:.1f} MB) in {2}'.format(
+                len(pickler.pids), pickler.nbytes / 2**20, self._folder))
+
+    def __getstate__(self):
+        # Only the process which created the folder removes it
+        return {'_key': self._key, '_folder': None, '_payload': self._payload}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self):
+        ''' Returns a tuple with the shared objects. The objects are only
+        unpickled once per process '''
+        if self._key not in _loaded_shared_objects:
+            _loaded_shared_objects[self._key] = \
+                _SharedMemoryUnpickler(io.BytesIO(self._payload)).load()
+        return _loaded_shared_objects[self._key]
+
+    def close(self):
+        ''' Releases the shared memory '''
+        _loaded_shared_objects.pop(self._key, None)
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+
+
+class _SharedMemoryPickler(pickle.Pickler):
+    ''' Pickler moving large arrays to .npy files in a folder '''
+    def __init__(self, file, folder):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.folder = folder
+        self.pids = {}
+        self.nbytes = 0
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or \
+           obj.nbytes < _SHARED_MEMORY_MIN_BYTES:
+            return None
+        if id(obj) not in self.pids:
+            fn = os.path.join(self.folder, '{0}.npy'.format(len(self.pids)))
+            np.save(fn, obj)
+            # keep a reference so that the id is not reused while pickling
+            self.pids[id(obj)] = (fn, obj)
+            self.nbytes += obj.nbytes
+        return self.pids[id(obj)][0]
+
+
+class _SharedMemoryUnpickler(pickle.Unpickler):
+    ''' Unpickler memory-mapping the arrays saved by _SharedMemoryPickler '''
+    def persistent_load(self, pid):
+        return np.load(pid, mmap_mode='c').view(np.ndarray)
+
+
+def _shared_initializer(initializer, shared, *args):
+    ''' Pool initializer calling initializer(*shared.load(), *args) '''
+    initializer(*shared.load(), *args)
+
+
 def calc_fields(potentials, fields, cond=None, dadt=None, units='mm', E=None):
     ''' Given a mesh and the electric potentials at the nodes,
     calculates the fields
@@ -492,6 +634,12 @@ class FEMSystem(object):
         Wether to store the gradient matrix. Default: False
     solver_options: str
         Options to be used by the solver. Default: DEFAULT_SOLVER_OPTIONS
+    cache_dir: str (optional)
+        Folder where the assembled matrix and gradient operator are cached.
+        If a cache file for the same mesh, conductivities and units exists,
+        the assembly is skipped. The least recently used entries are removed
+        when the folder grows above _FEM_CACHE_MAX_BYTES. Default: None (no
+        caching)
 
     Attributes
     ----------
@@ -514,16 +662,13 @@ class FEMSystem(object):
 
     '''
     def __init__(self, mesh, cond, dirichlet=None, units='mm', store_G=False,
-                 solver_options=None):
+                 solver_options=None, cache_dir=None):
         if units in ['mm', 'm']:
             self.units = units
         else:
             raise ValueError('Invalid unit: {0}'.format(units))
         self._mesh = mesh
-        if isinstance(cond, mesh_io.ElementData):
-            cond = cond.value.squeeze()
-            if cond.ndim == 2:
-                cond = cond.reshape(-1, 3, 3)
+        cond = _cond_array(cond)
         if self.mesh.elm.nr != len(cond):
             raise ValueError('Please define one conductivity for each element')
         self._cond = cond
@@ -537,6 +682,7 @@ class FEMSystem(object):
             self._solver_options = DEFAULT_SOLVER_OPTIONS
         else:
             self._solver_options = solver_options
+        self._cache_dir = cache_dir
         self.assemble_fem_matrix(store_G=store_G)
 
     @property
@@ -562,6 +708,8 @@ class FEMSystem(object):
     def assemble_fem_matrix(self, store_G=False):
         ''' Assembly of the l.h.s matrix A. !Only works with symmetric matrices!
         Based in the OptVS algorithm in Cuvelier et. al. 2016 '''
+        if self._cache_dir is not None and self._load_cache(store_G):
+            return
         logger.info('Assembling FEM Matrix')
         start = time.time()
         msh = self.mesh
@@ -581,6 +729,102 @@ class FEMSystem(object):
         time_assemble = time.time() - start
         logger.info(
             '{0:.2f}s to assemble FEM matrix'.format(time_assemble))
+        if self._cache_dir is not None:
+            self._save_cache(G if store_G else None)
+
+    def _cache_file(self):
+        ''' Name of the cache folder for the current mesh, conductivity and units '''
+        key = _fem_cache_key(self.mesh, self.cond, self.units)
+        return os.path.join(self._cache_dir, 'fem_{0}'.format(key))
+
+    def _load_cache(self, store_G=False):
+        ''' Loads the matrix and gradient operator from the cache
+
+        The arrays are memory-mapped (read-only). If the gradient operator is
+        requested but was not cached, it is calculated and added to the cache
+
+        Returns
+        -------
+        loaded: bool
+            True if a cache entry was found and loaded
+        '''
+        fn_cache = self._cache_file()
+        if not os.path.isdir(fn_cache):
+            return False
+        start = time.time()
+
+        def load(name):
+            # plain (read-only) arrays, so that they can be placed in shared memory
+            return np.load(
+                os.path.join(fn_cache, name + '.npy'), mmap_mode='r').view(np.ndarray)
+
+        try:
+            A = sparse.csc_matrix(
+                (load('data'), load('indices'), load('indptr')),
+                shape=tuple(load('shape')))
+            dof_map = dofMap(np.array(load('dof_inverse')))
+            G = None
+            if store_G and os.path.isfile(os.path.join(fn_cache, 'G.npy')):
+                G = load('G')
+        except (OSError, KeyError, ValueError) as e:
+            logger.warning(f'Could not read FEM cache {fn_cache}: {e}')
+            return False
+        self._A = A
+        self._dof_map = dof_map
+        # Mark the entry as recently used
+        try:
+            os.utime(fn_cache)
+        except OSError:
+            pass
+        if store_G:
+            if G is None:
+                G = _gradient_operator(self.mesh)
+                self._save_cache_array(fn_cache, 'G', G)
+            self._G = G
+        logger.info(
+            '{0:.2f}s to load FEM matrix from {1}'.format(time.time() - start, fn_cache))
+        return True
+
+    def _save_cache(self, G=None):
+        ''' Saves the matrix, DOF map and, if given, the gradient operator to
+        the cache, one .npy file per array '''
+        fn_cache = self._cache_file()
+        # Write to a temporary folder first so that concurrent runs never
+        # read partially written caches
+        fn_tmp = fn_cache + '.{0}.tmp'.format(os.getpid())
+        try:
+            os.makedirs(fn_tmp, exist_ok=True)
+            A = sparse.csc_matrix(self.A)
+            A.sort_indices()
+            arrays = dict(
+                data=A.data, indices=A.indices, indptr=A.indptr,
+                shape=np.array(A.shape), dof_inverse=self.dof_map.inverse)
+            if G is not None:
+                arrays['G'] = G
+            for name, array in arrays.items():
+                np.save(os.path.join(fn_tmp, name + '.npy'), array)
+            os.rename(fn_tmp, fn_cache)
+        except OSError as e:
+            shutil.rmtree(fn_tmp, ignore_errors=True)
+            if os.path.isdir(fn_cache):
+                # Written by another process in the meantime
+                return
+            logger.warning(f'Could not write FEM cache {fn_cache}: {e}')
+        else:
+            logger.info(f'Saved FEM matrix to {fn_cache}')
+            _prune_fem_cache(self._cache_dir, keep=fn_cache)
+
+    @staticmethod
+    def _save_cache_array(fn_cache, name, array):
+        ''' Adds an array to an existing cache entry '''
+        fn = os.path.join(fn_cache, name + '.npy')
+        fn_tmp = fn + '.{0}.tmp'.format(os.getpid())
+        try:
+            with open(fn_tmp, 'wb') as f:
+                np.save(f, array)
+            os.replace(fn_tmp, fn)
+        except OSError as e:
+            logger.warning(f'Could not write FEM cache file {fn}: {e}')
 
     def prepare_solver(self):
         '''Prepares the object to solve FEM systems
@@ -643,6 +887,54 @@ class FEMSystem(object):
         return np.squeeze(x)
 
 
+    def update_cond(self, cond, basis, reuse_preconditioner=False):
+        ''' Changes the conductivities, combining the matrices in a StiffnessBasis
+        instead of assembling the FEM matrix
+
+        Parameters
+        ----------
+        cond: ndarray or simnibs.mesh_io.msh.ElementData
+            New conductivity of each element. Only the conductivities of the
+            tissues in the basis can change
+        basis: StiffnessBasis
+            Tissue matrices of this mesh
+        reuse_preconditioner: bool (optional)
+            Keep the solver set up for the previous conductivities (e.g. the AMG
+            hierarchy) as a preconditioner and only update the matrix values. Only
+            used with PETSc solvers. Default: False
+
+        Returns
+        -------
+        reused: bool
+            Whether the preconditioner was kept
+
+        Notes
+        -----
+        Re-using the preconditioner is only efficient if the conductivities are
+        close to the ones it was built for
+        '''
+        if basis.dof_map != self.dof_map:
+            raise ValueError('The StiffnessBasis has a different DOF map')
+        A = basis.assemble(cond)
+        self._cond = _cond_array(cond)
+        self._A = A
+        if (reuse_preconditioner and self._solver is not None and
+                self._solver_options != 'pardiso'):
+            A = sparse.csc_matrix(A, copy=True)
+            A.sort_indices()
+            if self.dirichlet is not None:
+                A, _ = self.dirichlet.apply_to_matrix(A, copy.deepcopy(self.dof_map))
+            A.sort_indices()
+            if (np.array_equal(A.indptr, self._A_reduced.indptr) and
+                    np.array_equal(A.indices, self._A_reduced.indices)):
+                # PETSc uses the arrays of _A_reduced in place. The operator is
+                # updated but the preconditioner is not set-up again
+                self._A_reduced.data[:] = A.data
+                return True
+        self._solver = None
+        self._A_reduced = None
+        return False
+
     def calc_gradient(self, v):
         ''' Calculates gradients
 
@@ -679,7 +971,8 @@ class TMSFEM(FEMSystem):
             cond,
             solver_options=None,
             units='mm',
-            store_G=True
+            store_G=True,
+            cache_dir=None,
         ):
         '''Set up a TMS problem.
 
@@ -691,9 +984,12 @@ class TMSFEM(FEMSystem):
             Conductivity of each element.
         solver_options: str
             Options to be used by the solver. Default: DEFAULT_SOLVER_OPTIONS
+        cache_dir: str (optional)
+            Folder for caching the assembled FEM matrix. Default: None
         '''
         dirichlet_bc = set_ground_at_nodes(mesh)
-        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options)
+        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options,
+                         cache_dir)
 
     def assemble_rhs(self, dadt):
         '''Assemble the right-hand side for a TMS simulation.
@@ -757,6 +1053,7 @@ class TDCSFEMDirichlet(FEMSystem):
             solver_options=None,
             units='mm',
             store_G=False,
+            cache_dir=None,
         ):
         '''Set up a TDCS problem using Dirichlet boundary conditions in all
         electrodes.
@@ -773,13 +1070,16 @@ class TDCSFEMDirichlet(FEMSystem):
             list of the potentials each surface is to be set.
         solver_options: str
             Options to be used by the solver. Default: DEFAULT_SOLVER_OPTIONS
+        cache_dir: str (optional)
+            Folder for caching the assembled FEM matrix. Default: None
         '''
         self.electrodes = electrodes
         self.potentials = potentials
         # self.input_type = input_type
 
         dirichlet_bc = self._init_dirichlet_bcs(mesh)
-        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options)
+        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options,
+                         cache_dir)
 
     def _init_dirichlet_bcs(self, mesh):
         """Set Dirichlet boundary conditions on all electrodes."""
@@ -806,6 +1106,7 @@ class TDCSFEMNeumann(FEMSystem):
             solver_options=None,
             units='mm',
             store_G=False,
+            cache_dir=None,
         ):
         '''Set up a TDCS problem using Dirichlet boundary conditions in the
         ground electrode and Neumann boundary conditions in the other
@@ -824,6 +1125,8 @@ class TDCSFEMNeumann(FEMSystem):
         input_type: 'tag' or "nodes" (optional)
             Input can be either the tag of the electrode surface (default) or a
             list of nodes
+        cache_dir: str (optional)
+            Folder for caching the assembled FEM matrix. Default: None
         '''
         assert input_type in {"tag", "nodes"}
 
@@ -835,7 +1138,8 @@ class TDCSFEMNeumann(FEMSystem):
         self.areas = mesh.nodes_areas() if self.weigh_by_area else None
 
         dirichlet_bc = self._init_dirichlet_bc(mesh)
-        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options)
+        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options,
+                         cache_dir)
 
     def _init_dirichlet_bc(self, mesh):
         """Set Dirichlet boundary condition on the ground electrode only."""
@@ -913,6 +1217,7 @@ class DipoleFEM(FEMSystem):
             solver_options=None,
             units='mm',
             store_G=True,
+            cache_dir=None,
         ):
         '''Set up an electric dipole simulation using the selected source
         model (i.e., the "direct" approach).
@@ -925,9 +1230,12 @@ class DipoleFEM(FEMSystem):
             Conductivity of each element
         solver_options: str (optional)
             Options to be used by the solver. Default: DEFAULT_SOLVER_OPTIONS
+        cache_dir: str (optional)
+            Folder for caching the assembled FEM matrix. Default: None
         '''
         dirichlet_bc = set_ground_at_nodes(mesh)
-        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options)
+        super().__init__(mesh, cond, dirichlet_bc, units, store_G, solver_options,
+                         cache_dir)
 
     # def assemble_rhs(self, primary_j, source_model):
     def assemble_rhs(self, dip_pos, dip_mom, source_model):
@@ -1130,22 +1438,297 @@ def assemble_diagonal_mass_matrix(msh, units='mm'):
 
     # I'm using csc for consistency
     dof_map = dofMap(msh.nodes.node_number)
-    M = sparse.csc_matrix((dof_map.nr, dof_map.nr))
-    for i in range(4):
-        M += sparse.csc_matrix(
-            (.25 * vols,
-             (dof_map[th_nodes[:, i]],
-              dof_map[th_nodes[:, i]])),
-            shape=(dof_map.nr, dof_map.nr))
-
-    M.sum_duplicates()
+    diag = np.bincount(
+        dof_map[th_nodes.reshape(-1)],
+        np.repeat(.25 * vols, 4),
+        minlength=dof_map.nr)
     if units == 'mm':
-        M *= 1e-9
+        diag *= 1e-9
+
+    return sparse.diags(diag, format='csc')
+
 
-    return M
+class StiffnessPattern(object):
+    ''' Symbolic structure of a symmetric FEM matrix assembled over tetrahedra
 
+    The edges of the mesh are sorted and the duplicates found only once.
+    Afterwards, matrices with the same structure (e.g. with other
+    conductivities) are obtained with a numeric-only refill
+
+    Parameters
+    ----------
+    th_nodes: (n_th x 4) ndarray
+        Nodes of each tetrahedra
+    dof_map: dofMap
+        Mapping between nodes and rows/columns
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the matrix
+    nnz: int
+        Number of non-zeros in the (symbolic) matrix
+    '''
+    def __init__(self, th_nodes, dof_map):
+        n = dof_map.nr
+        self.shape = (n, n)
+        self._dofs = dof_map[th_nodes].astype(np.int64)
+        iu = np.triu_indices(4, 1)
+        ei = self._dofs[:, iu[0]].reshape(-1)
+        ej = self._dofs[:, iu[1]].reshape(-1)
+        keys = np.minimum(ei, ej) * n + np.maximum(ei, ej)
+        del ei, ej
+        order = np.argsort(keys)
+        keys = keys[order]
+        new = np.ones(len(keys), dtype=bool)
+        new[1:] = keys[1:] != keys[:-1]
+        self._n_edges = int(np.sum(new))
+        idx_dtype = np.int32 if self._n_edges + n < 2**31 else np.int64
+        # Edge of each local off-diagonal entry
+        self._edge = np.empty(len(keys), dtype=idx_dtype)
+        self._edge[order] = np.cumsum(new) - 1
+        del order
+        edges = keys[new]
+        del keys, new
+        i, j = edges // n, edges % n
+        del edges
+        # Find where each edge (both triangles) and diagonal entry is in the
+        # CSC data array, without any duplicates
+        diag = np.arange(n)
+        code = np.hstack([
+            np.arange(self._n_edges), np.arange(self._n_edges),
+            self._n_edges + diag]) + 1.
+        M = sparse.csc_matrix(
+            (code, (np.hstack([i, j, diag]), np.hstack([j, i, diag]))),
+            shape=self.shape)
+        M.sort_indices()
+        self._slot = M.data.astype(idx_dtype) - 1
+        self._indices = M.indices
+        self._indptr = M.indptr
+        self.nnz = M.nnz
+
+    def fill(self, Kg):
+        ''' Creates a matrix with this structure from the local matrices
+
+        Parameters
+        ----------
+        Kg: (n_th x 4 x 4) ndarray
+            Symmetric local matrix of each tetrahedra. Only the upper triangle
+            and the diagonal are used
+
+        Returns
+        -------
+        A: scipy.sparse.csc_matrix
+            Assembled matrix
+        '''
+        iu = np.triu_indices(4, 1)
+        if Kg.shape != (len(self._dofs), 4, 4):
+            raise ValueError('Wrong shape of the local matrices for this pattern')
+        values = np.hstack([
+            np.bincount(self._edge, weights=Kg[:, iu[0], iu[1]].reshape(-1),
+                        minlength=self._n_edges),
+            np.bincount(self._dofs.reshape(-1),
+                        weights=np.diagonal(Kg, axis1=1, axis2=2).reshape(-1),
+                        minlength=self.shape[0])
+        ])
+        return sparse.csc_matrix(
+            (values[self._slot], self._indices.copy(), self._indptr.copy()),
+            shape=self.shape)
+
+
+class StiffnessBasis(object):
+    ''' FEM matrix as a combination of the matrices of single tissues
+
+    A(sigma) = A_0 + sum_t sigma_t A_t
+
+    A_t is assembled with unit conductivity in the tetrahedra of tissue t, and A_0
+    with the conductivities of the other tetrahedra. All matrices are filled in
+    the same StiffnessPattern, so that the matrix for new tissue conductivities is
+    a combination of the data arrays, without any assembly
 
-def _gradient_operator(msh, volume_tag=None):
+    Parameters
+    ----------
+    mesh: simnibs.mesh_io.msh.Msh
+        Mesh structure
+    cond: ndarray or simnibs.mesh_io.msh.ElementData
+        Conductivity of each element. The conductivities of the tetrahedra
+        outside of the tissues in "tags" are kept fixed
+    tags: list of int
+        Tags of the tissues with varying conductivities. The conductivity needs to
+        be isotropic and constant in each tissue
+    units: {'mm' or 'm'} (optional)
+        Units of the mesh nodes. Default: mm
+
+    Attributes
+    ----------
+    tags: ndarray
+        Tags of the tissues with varying conductivities
+    dof_map: dofMap
+        Mapping between rows/columns of the matrices and DOFs
+    G: (n_th x 4 x 3) ndarray
+        Gradient operator
+    '''
+    def __init__(self, mesh, cond, tags, units='mm'):
+        cond = _cond_array(cond)
+        if mesh.elm.nr != len(cond):
+            raise ValueError('Please define one conductivity for each element')
+        self.tags = np.atleast_1d(np.array(tags, dtype=int))
+        self.dof_map = dofMap(mesh.nodes.node_number)
+        th = mesh.elm.elm_type == 4
+        self._th = th
+        self._th_tags = mesh.elm.tag1[th]
+        self._fixed = ~np.isin(self._th_tags, self.tags)
+        self._cond = cond[th][self._fixed]
+        # Checks the conductivities in the tissues
+        self.tissue_cond(cond)
+
+        th_nodes = mesh.elm.node_number_list[th]
+        self.G = _gradient_operator(mesh)
+        vols = _vol(mesh)
+        self._pattern = StiffnessPattern(th_nodes, self.dof_map)
+        scale = 1e-3 if units == 'mm' else 1.
+        self._data = np.empty((len(self.tags) + 1, self._pattern.nnz), dtype=float)
+        cond_fixed = cond[th].copy()
+        cond_fixed[~self._fixed] = 0.
+        self._data[0] = self._pattern.fill(
+            _local_matrices(vols, self.G, cond_fixed)).data * scale
+        del cond_fixed
+        K = _local_matrices(vols, self.G, np.ones(len(vols)))
+        for i, t in enumerate(self.tags):
+            self._data[i + 1] = self._pattern.fill(
+                K * (self._th_tags == t)[:, None, None]).data * scale
+
+    def tissue_cond(self, cond):
+        ''' Conductivity of each tissue in tags
+
+        Parameters
+        ----------
+        cond: ndarray or simnibs.mesh_io.msh.ElementData
+            Conductivity of each element
+
+        Returns
+        -------
+        sigma: ndarray
+            Conductivity of each tissue in tags
+
+        Raises
+        ------
+        ValueError
+            If the conductivities of the other tetrahedra changed or if a tissue in
+            tags does not have a constant isotropic conductivity
+        '''
+        cond = _cond_array(cond)
+        if len(cond) != len(self._th):
+            raise ValueError('Please define one conductivity for each element')
+        th = cond[self._th]
+        if not np.array_equal(th[self._fixed], self._cond):
+            raise ValueError(
+                'The conductivities outside of the tissues {0} changed'.format(
+                    self.tags.tolist()))
+        sigma = np.zeros(len(self.tags), dtype=float)
+        for i, t in enumerate(self.tags):
+            c = th[self._th_tags == t]
+            if c.ndim == 3:
+                iso = c[:, 0, 0]
+                if not np.array_equal(c, iso[:, None, None] * np.eye(3)):
+                    raise ValueError(
+                        'The conductivity of tissue {0} is anisotropic'.format(t))
+                c = iso
+            if len(c) > 0:
+                if np.any(c != c[0]):
+                    raise ValueError(
+                        'The conductivity of tissue {0} is not constant'.format(t))
+                sigma[i] = c[0]
+        return sigma
+
+    def matrix(self, sigma):
+        ''' FEM matrix for the tissue conductivities sigma
+
+        Parameters
+        ----------
+        sigma: ndarray
+            Conductivity of each tissue in tags
+
+        Returns
+        -------
+        A: scipy.sparse.csc_matrix
+            FEM matrix
+        '''
+        sigma = np.asarray(sigma, dtype=float)
+        if sigma.shape != self.tags.shape:
+            raise ValueError('Please define one conductivity for each tissue')
+        A = sparse.csc_matrix(
+            (self._data[0] + sigma.dot(self._data[1:]),
+             self._pattern._indices.copy(), self._pattern._indptr.copy()),
+            shape=self._pattern.shape)
+        A.eliminate_zeros()
+        return A
+
+    def assemble(self, cond):
+        ''' FEM matrix for the element conductivities cond (see tissue_cond) '''
+        return self.matrix(self.tissue_cond(cond))
+
+
+def _cond_array(cond):
+    ''' Conductivities as a (n_elm,) or (n_elm x 3 x 3) array '''
+    if isinstance(cond, mesh_io.ElementData):
+        cond = cond.value.squeeze()
+        if cond.ndim == 2:
+            cond = cond.reshape(-1, 3, 3)
+    return cond
+
+
+def _prune_fem_cache(cache_dir, max_bytes=None, keep=None):
+    ''' Removes the least recently used FEM cache entries until the folder is
+    smaller than max_bytes
+
+    Parameters
+    ----------
+    cache_dir: str
+        FEM cache folder
+    max_bytes: int (optional)
+        Maximum size of the cache folder. Default: _FEM_CACHE_MAX_BYTES
+    keep: str (optional)
+        Cache entry which is never removed
+    '''
+    if max_bytes is None:
+        max_bytes = _FEM_CACHE_MAX_BYTES
+    entries = []
+    for fn in glob.glob(os.path.join(cache_dir, 'fem_*')):
+        if not os.path.isdir(fn) or fn.endswith('.tmp'):
+            continue
+        try:
+            size = sum(
+                os.path.getsize(os.path.join(fn, f)) for f in os.listdir(fn))
+            entries.append((os.path.getmtime(fn), size, fn))
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+    total = sum(e[1] for e in entries)
+    for _, size, fn in sorted(entries):
+        if total <= max_bytes:
+            break
+        if keep is not None and os.path.samefile(fn, keep):
+            continue
+        shutil.rmtree(fn, ignore_errors=True)
+        total -= size
+        logger.info(f'Removed FEM cache entry {fn}')
+
+
+def _fem_cache_key(msh, cond, units='mm'):
+    ''' Content hash of the mesh geometry, conductivities and units, used as a
+    key for the FEM assembly cache '''
+    h = hashlib.sha1()
+    h.update('{0}-{1}'.format(_FEM_CACHE_VERSION, units).encode())
+    for a in (msh.nodes.node_number, msh.nodes.node_coord,
+              msh.elm.elm_type, msh.elm.node_number_list, cond):
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype, a.shape)).encode())
+        h.update(a.view(np.uint8))
+    return h.hexdigest()
+
+
+def _gradient_operator(msh, volume_tag=None, elements=None):
     ''' G calculates the gradient of a function in each tetrahedra
     The way it works: The operator has 2 parts
     G = T^{-1}A
@@ -1154,8 +1737,13 @@ def _gradient_operator(msh, volume_tag=None):
         [-1, 0, 1, 0]
         [-1, 0, 0, 1]
     And T is the transfomation to baricentric coordinates
+
+    If elements (indices of tetrahedra, starting at 0) is given, the operator
+    is only calculated for these tetrahedra
     '''
-    if volume_tag is None:
+    if elements is not None:
+        th = msh.nodes[msh.elm.node_number_list[elements]]
+    elif volume_tag is None:
         th = msh.nodes[msh.elm.node_number_list[msh.elm.elm_type == 4]]
     else:
         th = msh.nodes[msh.elm.node_number_list[(msh.elm.elm_type == 4) *
@@ -1165,34 +1753,18 @@ def _gradient_operator(msh, volume_tag=None):
     G = np.transpose(G, (0, 2, 1))
     return G
 
-def _assemble_matrix(vols, G, th_nodes, cond, dof_map, units='mm'):
-    '''Based in the OptVS algorithm in Cuvelier et. al. 2016 '''
-    A = sparse.csc_matrix((dof_map.nr, dof_map.nr), dtype=np.float64)
-    if cond.ndim == 1:
-        vGc = vols[:, None, None]*G*cond[:, None, None]
-    elif cond.ndim == 3:
-        vGc = vols[:, None, None]*np.einsum('aij, ajk -> aik', G, cond)
-    else:
-        raise ValueError('Invalid cond array')
-    ''' Off-diagonal '''
-    for i in range(4):
-        for j in range(i+1, 4):
-            Kg = (vGc[:, i, :]*G[:, j, :]).sum(axis=1)
-            A += sparse.csc_matrix(
-                (Kg, (dof_map[th_nodes[:, i]],
-                      dof_map[th_nodes[:, j]])),
-                shape=(dof_map.nr, dof_map.nr),
-                dtype=np.float64)
-
-    A += A.T
-    ''' Diagonal'''
-    for i in range(4):
-        Kg = (vGc[:, i, :]*G[:, i, :]).sum(axis=1)
-        A += sparse.csc_matrix(
-            (Kg, (dof_map[th_nodes[:, i]],
-                  dof_map[th_nodes[:, i]])),
-            shape=(dof_map.nr, dof_map.nr),
-            dtype=np.float64)
+def _assemble_matrix(vols, G, th_nodes, cond, dof_map, units='mm', pattern=None):
+    '''Based in the OptVS algorithm in Cuvelier et. al. 2016
+
+    The local contributions are summed directly into the CSC structure
+    given by a StiffnessPattern. If the pattern is given, only the values
+    are computed
+    '''
+    Kg = _local_matrices(vols, G, cond)
+
+    if pattern is None:
+        pattern = StiffnessPattern(th_nodes, dof_map)
+    A = pattern.fill(Kg)
 
     if units == 'mm':
         A *= 1e-3  # * 1e6 from the gradiend operator, 1e-9 from the volume
@@ -1201,7 +1773,18 @@ def _assemble_matrix(vols, G, th_nodes, cond, dof_map, units='mm'):
     return A
 
 
-def grad_matrix(msh, G=None, split=False):
+def _local_matrices(vols, G, cond):
+    ''' Local (4 x 4) matrix of each tetrahedra '''
+    if cond.ndim == 1:
+        vGc = vols[:, None, None]*G*cond[:, None, None]
+    elif cond.ndim == 3:
+        vGc = vols[:, None, None]*np.einsum('aij, ajk -> aik', G, cond)
+    else:
+        raise ValueError('Invalid cond array')
+    return np.matmul(vGc, np.transpose(G, (0, 2, 1)))
+
+
+def grad_matrix(msh, G=None, split=False, roi=None):
     ''' Matrix that calculates the gradients at the elements
 
     Parameters
@@ -1213,6 +1796,11 @@ def grad_matrix(msh, G=None, split=False):
     split: bool (optional)
         If true, will return a list of sparse matrices, one for each component.
         Default: False
+    roi: ndarray of bool (optional)
+        Mask of the elements where the gradient is to be calculated. If set,
+        D only has rows for these elements, and the gradient operator and the
+        tetrahedra corresponding to the triangles are only calculated for the
+        ROI. Default: all elements
 
     Returns
     -------
@@ -1228,6 +1816,8 @@ def grad_matrix(msh, G=None, split=False):
         The triangle values are also assigned
 
     '''
+    if roi is not None:
+        return _grad_matrix_roi(msh, roi, G, split)
     if G is None:
         G = _gradient_operator(msh)
     th = msh.elm.elm_number[msh.elm.elm_type == 4] - 1
@@ -1240,24 +1830,66 @@ def grad_matrix(msh, G=None, split=False):
     th_nodes = np.zeros((msh.elm.nr, 4), dtype=int)
     th_nodes[th] = msh.elm.node_number_list[msh.elm.elm_type == 4]
     th_nodes[tr] = th_nodes[cp]
+    cols = np.repeat(th_nodes[:, None, :] - 1, 3, axis=1)
     if not split:
-        D = sparse.csc_matrix((3 * msh.elm.nr, msh.nodes.nr))
-        for j in range(3):
-            for i in range(4):
-                D += sparse.csc_matrix(
-                    (G[:, i, j], (j + 3 * np.arange(msh.elm.nr),
-                     th_nodes[:, i] - 1)),
-                    shape=D.shape)
+        rows = np.repeat(
+            3 * np.arange(msh.elm.nr)[:, None] + np.arange(3)[None, :], 4, axis=1)
+        D = sparse.csc_matrix(
+            (np.transpose(G, (0, 2, 1)).reshape(-1),
+             (rows.reshape(-1), cols.reshape(-1))),
+            shape=(3 * msh.elm.nr, msh.nodes.nr))
     if split:
         D = []
+        rows = np.repeat(np.arange(msh.elm.nr), 4)
         for j in range(3):
-            D.append(sparse.csc_matrix((msh.elm.nr, msh.nodes.nr)))
-            for i in range(4):
-                D[-1] += sparse.csc_matrix(
-                    (G[:, i, j], (np.arange(msh.elm.nr),
-                     th_nodes[:, i] - 1)),
-                    shape=D[-1].shape)
+            D.append(sparse.csc_matrix(
+                (G[:, :, j].reshape(-1),
+                 (rows, cols[:, j].reshape(-1))),
+                shape=(msh.elm.nr, msh.nodes.nr)))
+
+    return D
 
+
+def _grad_matrix_roi(msh, roi, G=None, split=False):
+    ''' grad_matrix restricted to the elements in the roi mask '''
+    roi_elm = np.where(roi)[0]
+    n_roi = len(roi_elm)
+    is_th = msh.elm.elm_type[roi_elm] == 4
+    is_tr = msh.elm.elm_type[roi_elm] == 2
+    # Tetrahedra used for the gradient in each ROI element
+    th_roi = -np.ones(n_roi, dtype=int)
+    th_roi[is_th] = roi_elm[is_th]
+    if np.any(is_tr):
+        th_roi[is_tr] = msh.find_corresponding_tetrahedra(
+            msh.elm.elm_number[roi_elm[is_tr]]) - 1
+    has_th = th_roi >= 0
+
+    G_roi = np.zeros((n_roi, 4, 3), dtype=float)
+    if G is None:
+        G_roi[has_th] = _gradient_operator(msh, elements=th_roi[has_th])
+    else:
+        th_position = np.cumsum(msh.elm.elm_type == 4) - 1
+        G_roi[has_th] = G[th_position[th_roi[has_th]]]
+    th_nodes = np.ones((n_roi, 4), dtype=int)
+    th_nodes[has_th] = msh.elm.node_number_list[th_roi[has_th]]
+    cols = np.repeat(th_nodes[:, None, :] - 1, 3, axis=1)
+    if not split:
+        rows = np.repeat(
+            3 * np.arange(n_roi)[:, None] + np.arange(3)[None, :], 4, axis=1)
+        D = sparse.csc_matrix(
+            (np.transpose(G_roi, (0, 2, 1)).reshape(-1),
+             (rows.reshape(-1), cols.reshape(-1))),
+            shape=(3 * n_roi, msh.nodes.nr))
+    else:
+        D = []
+        rows = np.repeat(np.arange(n_roi), 4)
+        for j in range(3):
+            D.append(sparse.csc_matrix(
+                (G_roi[:, :, j].reshape(-1),
+                 (rows, cols[:, j].reshape(-1))),
+                shape=(n_roi, msh.nodes.nr)))
+    for d in D if split else [D]:
+        d.eliminate_zeros()
     return D
 
 
@@ -1272,7 +1904,7 @@ def _vol(msh, volume_tag=None):
 
 
 def tdcs(mesh, cond, currents, electrode_surface_tags, n_workers=1, units='mm',
-         solver_options=None):
+         solver_options=None, cache_dir=None):
     ''' Simulates a tDCS electric potential.
 
     Parameters
@@ -1286,6 +1918,8 @@ def tdcs(mesh, cond, currents, electrode_surface_tags, n_workers=1, units='mm',
     electrode_surface_tags: list
         A list of the indices of the surfaces where the dirichlet BC is to be
         applied.
+    cache_dir: str (optional)
+        Folder for caching the assembled FEM matrix. Default: None
 
     Returns
     -------
@@ -1309,15 +1943,20 @@ def tdcs(mesh, cond, currents, electrode_surface_tags, n_workers=1, units='mm',
     if n_workers == 1:
         for el_surf, el_c in zip(electrode_surface_tags[1:], currents[1:]):
             total_p += _sim_tdcs_pair(
-                mesh, cond, ref_electrode, el_surf, el_c, units, solver_options)
+                mesh, cond, ref_electrode, el_surf, el_c, units, solver_options,
+                cache_dir)
     else:
-        with multiprocessing.Pool(processes=n_workers) as pool:
+        with SharedObjects(mesh, cond) as shared, \
+             multiprocessing.Pool(processes=n_workers,
+                                  initializer=_shared_initializer,
+                                  initargs=(_set_up_tdcs_pair_global, shared)) as pool:
             sims = []
             for el_surf, el_c in zip(electrode_surface_tags[1:], currents[1:]):
                 sims.append(
                     pool.apply_async(
-                        _sim_tdcs_pair,
-                        (mesh, cond, ref_electrode, el_surf, el_c, units, solver_options)))
+                        _run_tdcs_pair,
+                        (ref_electrode, el_surf, el_c, units, solver_options,
+                         cache_dir)))
             for s in sims:
                 total_p += s.get()
             pool.close()
@@ -1326,13 +1965,38 @@ def tdcs(mesh, cond, currents, electrode_surface_tags, n_workers=1, units='mm',
     return mesh_io.NodeData(total_p, 'v', mesh=mesh)
 
 
-def _sim_tdcs_pair(mesh, cond, ref_electrode, el_surf, el_c, units, solver_options):
+def _set_up_tdcs_pair_global(mesh, cond):
+    global tdcs_pair_global_mesh
+    global tdcs_pair_global_cond
+    tdcs_pair_global_mesh = mesh
+    tdcs_pair_global_cond = cond
+
+
+def _run_tdcs_pair(ref_electrode, el_surf, el_c, units, solver_options, cache_dir=None):
+    global tdcs_pair_global_mesh
+    global tdcs_pair_global_cond
+    return _sim_tdcs_pair(
+        tdcs_pair_global_mesh, tdcs_pair_global_cond, ref_electrode, el_surf,
+        el_c, units, solver_options, cache_dir)
+
+
+def _sim_tdcs_pair(mesh, cond, ref_electrode, el_surf, el_c, units, solver_options,
+                   cache_dir=None):
     logger.info('Simulating electrode pair {0} - {1}'.format(
         ref_electrode, el_surf))
 
-    s = TDCSFEMDirichlet(mesh, cond,  [ref_electrode, el_surf], [0., 1.], solver_options)
-    v = s.solve()
+    s = TDCSFEMDirichlet(mesh, cond,  [ref_electrode, el_surf], [0., 1.], solver_options,
+                         cache_dir=cache_dir)
+    v = _calibrate_tdcs_pair(
+        s.solve(), mesh, cond, ref_electrode, el_surf, el_c, units)
+    del s
+    gc.collect()
+    return v
+
 
+def _calibrate_tdcs_pair(v, mesh, cond, ref_electrode, el_surf, el_c, units='mm'):
+    ''' Scales the potential for a 1V difference between two electrodes to the
+    current el_c, using the current flowing through the electrodes '''
     v = mesh_io.NodeData(v, name='v', mesh=mesh)
     flux = np.array([
         _calc_flux_electrodes(v, cond,
@@ -1349,8 +2013,6 @@ def _sim_tdcs_pair(mesh, cond, ref_electrode, el_surf, el_c, units, solver_optio
         logger.info('Estimated current calibration error: {0:.1%}'.format(error))
     else:
         logger.warning(f'The current calibration error exceeded 10%! Estimated error value: {error*100:.2f}%')
-    del s
-    gc.collect()
     return el_c / current * v.value
 
 
@@ -1427,7 +2089,8 @@ def tms_dadt(mesh, cond, dAdt, solver_options=None):
 
 
 def tms_coil(mesh, cond, cond_list, fn_coil, fields, matsimnibs_list, didt_list,
-             output_names, geo_names=None, solver_options=None, n_workers=1):
+             output_names, geo_names=None, solver_options=None, n_workers=1,
+             cache_dir=None):
     '''Simulates TMS fields using a coil + matsimnibs + dIdt definition.
 
     Parameters
@@ -1452,6 +2115,8 @@ def tms_coil(mesh, cond, cond_list, fn_coil, fields, matsimnibs_list, didt_list,
         Options for the solver
     n_workers: int
         Number of workers to use
+    cache_dir: str (optional)
+        Folder for caching the assembled FEM matrix. Default: None
     fn_stl: string
         Name of stl-file for coil visualization
 
@@ -1467,38 +2132,51 @@ def tms_coil(mesh, cond, cond_list, fn_coil, fields, matsimnibs_list, didt_list,
     if geo_names is None:
         geo_names = [None for i in range(n_sims)]
 
-    S = TMSFEM(mesh, cond, solver_options)
+    S = TMSFEM(mesh, cond, solver_options, cache_dir=cache_dir)
     if n_workers == 1:
-        _set_up_global_solver(S)
+        _set_up_global_solver(S, cond, fn_coil)
         for matsimnibs, didt, fn_out, fn_geo in zip(
                 matsimnibs_list, didt_list, output_names, geo_names):
             _run_tms(
-                mesh, cond, cond_list, fn_coil, fields,
+                cond_list, fn_coil, fields,
                 matsimnibs, didt, fn_out, fn_geo)
         _finalize_global_solver()
     else:
-        with multiprocessing.Pool(processes=n_workers,
-                                  initializer=_set_up_global_solver,
-                                  initargs=(S,)) as pool:
+        with SharedObjects(S, cond) as shared, \
+             multiprocessing.Pool(processes=n_workers,
+                                  initializer=_shared_initializer,
+                                  initargs=(_set_up_global_solver, shared, fn_coil)) as pool:
             sims = []
             for matsimnibs, didt, fn_out, fn_geo in zip(
                     matsimnibs_list, didt_list, output_names, geo_names):
                 sims.append(
                     pool.apply_async(
                         _run_tms,
-                        (mesh, cond, cond_list, fn_coil, fields,
+                        (cond_list, fn_coil, fields,
                          matsimnibs, didt, fn_out, fn_geo)))
             pool.close()
             pool.join()
 
 
-def _set_up_global_solver(S):
+def _set_up_global_solver(S, cond, fn_coil=None):
     global tms_global_solver
+    global tms_global_cond
     tms_global_solver = S
+    tms_global_cond = cond
+    if fn_coil is not None:
+        try:
+            _load_coil(fn_coil)
+        except Exception:
+            # Errors are raised again when the simulations load the coil, as
+            # an exception in a pool initializer would stall the pool
+            pass
 
 
-def _run_tms(mesh, cond, cond_list, fn_coil, fields, matsimnibs, didt, fn_out, fn_geo):
+def _run_tms(cond_list, fn_coil, fields, matsimnibs, didt, fn_out, fn_geo):
     global tms_global_solver
+    global tms_global_cond
+    mesh = tms_global_solver.mesh
+    cond = tms_global_cond
     logger.info('Calculating dA/dt field')
     start = time.time()
 
@@ -1525,7 +2203,7 @@ def _run_tms(mesh, cond, cond_list, fn_coil, fields, matsimnibs, didt, fn_out, f
             visible_tags=[ElementTags.GM_TH_SURFACE.value],
             visible_fields=['magnE'],
             cond_list=cond_list)
-        TmsCoil.from_file(fn_coil).append_simulation_visualization(v, fn_geo, skin_mesh, matsimnibs)
+        _load_coil(fn_coil).append_simulation_visualization(v, fn_geo, skin_mesh, matsimnibs)
 
         mesh_io.write_geo_triangles(skin_mesh.elm.node_number_list - 1,
                                         skin_mesh.nodes.node_coord, fn_geo,
@@ -1548,21 +2226,54 @@ def _run_tms(mesh, cond, cond_list, fn_coil, fields, matsimnibs, didt, fn_out, f
     del dAdt, v, b
     gc.collect()
 
+def _load_coil(fn_coil):
+    ''' Loads a coil file, reusing the coil loaded by an earlier call in the same
+    process as long as the file was not modified
+
+    Parameters
+    ----------
+    fn_coil: str
+        Path to the coil file
+
+    Returns
+    -------
+    tms_coil: simnibs.simulation.tms_coil.tms_coil.TmsCoil
+        The coil. It is shared between calls and should not be modified
+    '''
+    fn_coil = os.path.abspath(fn_coil)
+    return _load_coil_cached(fn_coil, os.path.getmtime(fn_coil))
+
+
+@functools.lru_cache(maxsize=_COIL_CACHE_SIZE)
+def _load_coil_cached(fn_coil, mtime):
+    logger.debug(f'Loading coil file {fn_coil}')
+    return TmsCoil.from_file(fn_coil)
+
+
 def _get_da_dt_from_coil(fn_coil, mesh, didt, matsimnibs):
-    tms_coil = TmsCoil.from_file(fn_coil)
+    tms_coil = _load_coil(fn_coil)
+    stimulators = list(tms_coil.get_elements_grouped_by_stimulators().keys())
+    # the coil is cached, restore the original dI/dt values afterwards
+    original_didt = [stimulator.di_dt for stimulator in stimulators]
 
     didt = np.atleast_1d(didt)
-    if len(didt) == 1:
-        for stimulator in tms_coil.get_elements_grouped_by_stimulators().keys():
-            stimulator.di_dt = didt
-    else:
-        for stimulator, stimulator_didt in zip(tms_coil.get_elements_grouped_by_stimulators().keys(), didt):
+    try:
+        if len(didt) == 1:
+            for stimulator in stimulators:
+                stimulator.di_dt = didt
+        else:
+            for stimulator, stimulator_didt in zip(stimulators, didt):
+                stimulator.di_dt = stimulator_didt
+        return tms_coil.get_da_dt(mesh, matsimnibs)
+    finally:
+        for stimulator, stimulator_didt in zip(stimulators, original_didt):
             stimulator.di_dt = stimulator_didt
-    return tms_coil.get_da_dt(mesh, matsimnibs)
 
 def _finalize_global_solver():
     global tms_global_solver
+    global tms_global_cond
     del tms_global_solver
+    del tms_global_cond
     gc.collect()
 
 
@@ -1601,7 +2312,8 @@ def tdcs_neumann(mesh, cond, currents, electrode_surface_tags):
 def tdcs_leadfield(mesh, cond, electrode_surface, fn_hdf5, dataset,
                    current=1., roi=None, post_pro=None, field='E',
                    solver_options=None, n_workers=1, input_type='tag',
-                   weigh_by_area=True):
+                   weigh_by_area=True, block_size=DEFAULT_BLOCK_SIZE,
+                   cache_dir=None, dtype=np.float64, compression='gzip'):
     '''Simulates tDCS fields using Neumann boundary conditions and writes the
     output electric fields to an HDF5 file.
 
@@ -1632,10 +2344,11 @@ def tdcs_leadfield(mesh, cond, electrode_surface, fn_hdf5, dataset,
         Default: None
     field: 'E' or 'J' (optional)
         Which field to save (electric field E or current density J). Default: 'E'
-    post_pro: callable (optional)
+    post_pro: callable or sparse matrix (optional)
         callable f_post = post_pro(f), where f is an input field in the ROI and
         f_post is an Nx3 ndarray. The postprocessing result will be saved instead of the
-        field
+        field. If a sparse matrix M, f_post = M.dot(f). M is then composed with the
+        gradient matrix, so that the field in the ROI is never calculated
     solver_options: str (optional)
         Options to be used by the solver. Default: Hypre solver
     n_workers: int
@@ -1645,6 +2358,21 @@ def tdcs_leadfield(mesh, cond, electrode_surface, fn_hdf5, dataset,
     weigh_by_area: bool
         Weigh current by node area. If `input_type == "tag"` this is ignored
         and area weighting is implied.
+    block_size: int (optional)
+        Number of right-hand sides solved together in a single call to the
+        solver. Larger blocks amortise the solver overhead but need memory for
+        block_size potentials and fields. Default: DEFAULT_BLOCK_SIZE
+    cache_dir: str (optional)
+        Folder for caching the assembled FEM matrix. Default: None
+    dtype: numpy dtype (optional)
+        Data type used to store the leadfield. np.float32 and np.float16
+        halve or quarter the size of the leadfield at the cost of precision.
+        np.float16 can only represent values up to 65504. Default: np.float64
+    compression: str or None (optional)
+        HDF5 compression filter, e.g. 'gzip' or 'lzf' (faster, but larger
+        files). If None, the leadfield is stored uncompressed and contiguously,
+        which allows memory-mapping it with
+        simnibs.utils.leadfield_utils.LazyLeadfield. Default: 'gzip'
 
     Returns
     -------
@@ -1693,169 +2421,396 @@ def tdcs_leadfield(mesh, cond, electrode_surface, fn_hdf5, dataset,
         input_type,
         weigh_by_area,
         solver_options,
+        cache_dir=cache_dir,
     )
 
     logger.info("Computing gradient matrix")
-    D = grad_matrix(mesh, split=True)
     n_out = mesh.elm.nr
-    # Separate out the part of the gradiend that is in the ROI
+    cond_roi = cond.value
+    # Only calculate the part of the gradient that is in the ROI
     if roi is not None:
         roi = np.in1d(mesh.elm.tag1, roi)
-        D = [d.tocsc() for d in D]
-        D = [d[roi] for d in D]
+        D = grad_matrix(mesh, split=True, roi=roi)
         n_out = np.sum(roi)
         cond_roi = cond.value[roi]
+    else:
+        D = grad_matrix(mesh, split=True)
 
     # Figure out size of the postprocessing output
-    if post_pro is not None:
+    if sparse.issparse(post_pro):
+        logger.info("Composing post-processing and gradient matrices")
+        D = _compose_post_pro(D, post_pro, field, cond_roi)
+        n_out = post_pro.shape[0]
+        # D now calculates the output directly
+        field, post_pro = 'E', None
+    elif post_pro is not None:
         n_out = len(post_pro(np.zeros((n_out, 3))))
 
     # Create HDF5 dataset
-    with h5py.File(fn_hdf5, 'a') as f:
-        f.create_dataset(
-            dataset,
-            (len(electrode_surface) - 1, n_out, 3),
-            dtype=float, compression="gzip")
+    _create_rows_dataset(
+        fn_hdf5, dataset, (len(electrode_surface) - 1, n_out, 3),
+        dtype=dtype, compression=compression)
 
     n_sims = len(electrode_surface) - 1
     currents = [current]*n_sims if isinstance(current, float) else current
     assert len(currents) == n_sims, f"Number of currents ({len(currents)}) do not correspond to the number of simulations ({n_sims})"
+    blocks = _split_in_blocks(n_sims, block_size, n_workers)
 
     # Run simulations (sequential)
     if n_workers == 1:
-        for i, (el_tag, current) in enumerate(zip(electrode_surface[1:], currents)):
-            logger.info('Running Simulation {0} out of {1}'.format(
-                i+1, n_sims))
-            b = S.assemble_rhs([el_tag], [current])
-            v = S.solve(b)
-
-            #TODO implement calibration error also for element/node defined electrodes
-            # when input_type == "nodes"
-            if input_type == "tag":
-                # estimate calibration error
-                ref_electrode = el_tag
-                # other_electrodes = [x for x in electrode_surface if np.all(x!=ref_electrode)][0]  
-                other_electrodes = np.array([x for x in electrode_surface if x!=ref_electrode])             
-
-                v_ = mesh_io.NodeData(v, name='v', mesh=mesh)
-                flux = np.array([
-                    _calc_flux_electrodes(v_, cond,
-                                        [other_electrodes - 1000, other_electrodes - 600,
-                                        other_electrodes - 2000, other_electrodes - 1600],
-                                        units='mm'),
-                    _calc_flux_electrodes(v_, cond,
-                                        [ref_electrode - 1000, ref_electrode - 600,
-                                        ref_electrode - 2000, ref_electrode - 1600],
-                                        units='mm')])
-                current_ = np.average(np.abs(flux))
-                error = np.abs(np.abs(flux[0]) - np.abs(flux[1])) / current_
-                if error > 0.1:
-                    logger.warning(f'The current calibration error exceeded 10%! Estimated error value: {error*100:.2f}%')
-
-            E = np.vstack([-d.dot(v) for d in D]).T * 1e3
-            if field == 'E':
-                out_field = E
-            elif field == 'J':
-                out_field = calc_J(E, cond_roi)
-            else:
-                raise ValueError
-            if post_pro is not None:
-                out_field = post_pro(out_field)
-            with h5py.File(fn_hdf5, 'a') as f:
-                f[dataset][i] = out_field
+        with _HDF5Writer(fn_hdf5, dataset) as writer:
+            for block in blocks:
+                logger.info('Running Simulations {0} to {1} out of {2}'.format(
+                    block.start + 1, block.stop, n_sims))
+                b = np.stack([
+                    S.assemble_rhs([electrode_surface[i + 1]], [currents[i]])
+                    for i in block], axis=1)
+                v = S.solve(b).reshape(S.dof_map.nr, -1)
+
+                #TODO implement calibration error also for element/node defined electrodes
+                # when input_type == "nodes"
+                if input_type == "tag":
+                    for j, i in enumerate(block):
+                        # estimate calibration error
+                        ref_electrode = electrode_surface[i + 1]
+                        # other_electrodes = [x for x in electrode_surface if np.all(x!=ref_electrode)][0]
+                        other_electrodes = np.array([x for x in electrode_surface if x!=ref_electrode])
+                        _check_calibration_error(
+                            v[:, j], mesh, cond, ref_electrode, other_electrodes)
+
+                out_field = _tdcs_leadfield_output(v, D, field, cond_roi, post_pro)
+                writer.write(block.start, out_field)
 
         del S, b, v
         gc.collect()
         
     # Run simulations (parallel)
     else:
-        # Lock has to be passed through inheritance
-        S.lock = multiprocessing.Lock()
-        with multiprocessing.Pool(processes=n_workers,
-                                  initializer=_set_up_tdcs_global_solver,
-                                  initargs=(S, n_sims, D, post_pro, cond_roi, field)) as pool:
-            sims = []
-            for i, (el_tag, current) in enumerate(zip(electrode_surface[1:], currents)):
-                if input_type == "tag":
-                    ref_electrode = el_tag
-                    other_electrodes = np.array([x for x in electrode_surface if x!=ref_electrode])
-                else:
-                    ref_electrode = el_tag
-                    other_electrodes = [x for x in electrode_surface if np.all(x!=ref_electrode)][0]
-                sims.append(
-                    pool.apply_async(
-                        _run_tdcs_leadfield,
-                        (i, [el_tag], [current], fn_hdf5, dataset, input_type, mesh, cond, ref_electrode, other_electrodes)))
-            [s.get() for s in sims]
+        with SharedObjects(S, D, cond_roi, cond) as shared, \
+             multiprocessing.Pool(processes=n_workers,
+                                  initializer=_shared_initializer,
+                                  initargs=(_set_up_tdcs_global_solver, shared,
+                                            n_sims, post_pro, field)) as pool:
+            def block_args(block):
+                el_tags = []
+                other_electrodes = []
+                for i in block:
+                    el_tag = electrode_surface[i + 1]
+                    el_tags.append(el_tag)
+                    if input_type == "tag":
+                        other_electrodes.append(np.array([x for x in electrode_surface if x!=el_tag]))
+                    else:
+                        other_electrodes.append([x for x in electrode_surface if np.all(x!=el_tag)][0])
+                return (block, el_tags, currents[block.start:block.stop],
+                        input_type, el_tags, other_electrodes)
+
+            # The writer is started after the workers are forked
+            with _HDF5Writer(fn_hdf5, dataset) as writer:
+                _run_blocks_in_pool(
+                    pool, _run_tdcs_leadfield, blocks, block_args, writer, n_workers)
             pool.close()
             pool.join()
 
 
+def _run_blocks_in_pool(pool, func, blocks, block_args, writer, n_workers):
+    ''' Runs the blocks of simulations in the pool and writes the results
+
+    At most 2*n_workers blocks are submitted and not yet written at any time,
+    so that the results waiting for the writer do not pile up in memory.
+    Results are written as soon as they finish, keyed by the first row of the
+    block, regardless of the submission order.
+
+    Parameters
+    ----------
+    pool: multiprocessing.Pool
+        Pool of workers
+    func: callable
+        Function which runs a block of simulations
+    blocks: list of range
+        Blocks of simulations
+    block_args: callable
+        Returns the arguments of "func" for a given block
+    writer: _HDF5Writer
+        Writer for the output rows
+    n_workers: int
+        Number of workers in the pool
+    '''
+    max_in_flight = 2 * max(n_workers, 1)
+    done = queue.Queue()
+    in_flight = 0
+    for block in blocks:
+        if in_flight >= max_in_flight:
+            _write_finished_block(done, writer)
+            in_flight -= 1
+        pool.apply_async(
+            func, block_args(block),
+            callback=lambda out, start=block.start: done.put((start, out, None)),
+            error_callback=lambda e: done.put((None, None, e)))
+        in_flight += 1
+    while in_flight > 0:
+        _write_finished_block(done, writer)
+        in_flight -= 1
+
+
+def _write_finished_block(done, writer):
+    ''' Waits for a block to finish and writes it '''
+    start, out, error = done.get()
+    if error is not None:
+        raise error
+    writer.write(start, out)
+
+
+def _split_in_blocks(n_sims, block_size, n_workers=1):
+    ''' Splits the simulations in contiguous blocks of at most block_size
+    simulations, making sure all workers get at least one block '''
+    block_size = max(1, min(block_size, int(np.ceil(n_sims / max(n_workers, 1)))))
+    return [range(i, min(i + block_size, n_sims)) for i in range(0, n_sims, block_size)]
+
+
+def _create_rows_dataset(fn_hdf5, dataset, shape, dtype=float, compression='gzip'):
+    ''' Creates a dataset where each simulation is a row
+
+    With compression, each chunk covers a part of a single row, so that
+    writing blocks of rows never needs to read back and recompress partially
+    written chunks. Without compression, the dataset is stored contiguously
+    so that it can be memory-mapped.
+    '''
+    if compression is None:
+        chunks = None
+    elif len(shape) > 1:
+        row_item = int(np.prod(shape[2:])) * np.dtype(dtype).itemsize
+        n = max(1, _HDF5_CHUNK_BYTES // max(row_item, 1))
+        chunks = (1, max(1, min(shape[1], n))) + tuple(max(1, s) for s in shape[2:])
+    else:
+        chunks = True
+    with h5py.File(fn_hdf5, 'a') as f:
+        f.create_dataset(
+            dataset, shape, dtype=dtype, compression=compression, chunks=chunks)
+
+
+class _HDF5Writer(object):
+    ''' Writes blocks of rows of an HDF5 dataset from a background thread
+
+    The file is kept open while the writer runs, and blocks waiting in the
+    queue which are contiguous are merged into a single write. The solver only
+    waits for the compression and the disk when max_queued blocks are waiting.
+
+    Parameters
+    ----------
+    fn_hdf5: str
+        Name of the HDF5 file
+    dataset: str
+        Name of the dataset. Must exist in the file
+    max_queued: int (optional)
+        Maximum number of blocks waiting to be written. Default: 4
+    '''
+    def __init__(self, fn_hdf5, dataset, max_queued=4):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._thread = threading.Thread(
+            target=self._run, args=(fn_hdf5, dataset), daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def write(self, start, rows):
+        ''' Queues rows to be written starting at row "start" '''
+        if self._error is not None:
+            raise self._error
+        self._queue.put((start, np.asarray(rows)))
+
+    def close(self):
+        ''' Waits for all queued blocks to be written and closes the file '''
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self, fn_hdf5, dataset):
+        finished = False
+        try:
+            with h5py.File(fn_hdf5, 'a') as f:
+                dset = f[dataset]
+                while not finished:
+                    items = [self._queue.get()]
+                    while items[-1] is not None:
+                        try:
+                            items.append(self._queue.get_nowait())
+                        except queue.Empty:
+                            break
+                    if items[-1] is None:
+                        finished = True
+                        items.pop()
+                    for start, rows in _merge_row_blocks(items):
+                        dset[start:start + len(rows)] = rows
+        except Exception as e:
+            self._error = e
+            # keep consuming so that write() does not block
+            while not finished:
+                finished = self._queue.get() is None
+
+
+def _merge_row_blocks(items):
+    ''' Merges (start, rows) blocks which are contiguous '''
+    merged = []
+    for start, rows in sorted(items, key=lambda x: x[0]):
+        if merged and merged[-1][0] + sum(len(r) for r in merged[-1][1]) == start:
+            merged[-1][1].append(rows)
+        else:
+            merged.append((start, [rows]))
+    return [
+        (start, rows[0] if len(rows) == 1 else np.concatenate(rows))
+        for start, rows in merged
+    ]
+
+
+def _check_calibration_error(v, mesh, cond, ref_electrode, other_electrodes):
+    ''' Estimates the current calibration error of a leadfield simulation and
+    warns if it exceeds 10% '''
+    v_ = mesh_io.NodeData(v, name='v', mesh=mesh)
+    flux = np.array([
+        _calc_flux_electrodes(v_, cond,
+                            [other_electrodes - 1000, other_electrodes - 600,
+                            other_electrodes - 2000, other_electrodes - 1600],
+                            units='mm'),
+        _calc_flux_electrodes(v_, cond,
+                            [ref_electrode - 1000, ref_electrode - 600,
+                            ref_electrode - 2000, ref_electrode - 1600],
+                            units='mm')])
+    current_ = np.average(np.abs(flux))
+    error = np.abs(np.abs(flux[0]) - np.abs(flux[1])) / current_
+    if error > 0.1:
+        logger.warning(f'The current calibration error exceeded 10%! Estimated error value: {error*100:.2f}%')
+
+
+def _compose_post_pro(D, M, field, cond):
+    ''' Composes a linear post-processing M with the gradient matrices
+
+    Parameters
+    ----------
+    D: list of sparse matrices
+        Gradient matrix in the ROI, split by component
+    M: sparse matrix
+        Post-processing matrix (n_out x n_roi)
+    field: 'E' or 'J'
+        Field which is post-processed
+    cond: ndarray
+        Conductivity in the ROI, Nx1 (scalar) or Nx9 (tensor)
+
+    Returns
+    -------
+    D_out: list of sparse matrices
+        Matrices (n_out x n_nodes) such that -1e3 * D_out[i].dot(v) is the
+        component i of the post-processed field
+    '''
+    M = sparse.csr_matrix(M)
+    if field == 'E':
+        return [(M @ d).tocsr() for d in D]
+    elif field != 'J':
+        raise ValueError(f"Field shoud be either 'E' or 'J' (got {field})")
+    cond = np.asarray(cond)
+    if cond.ndim == 1 or cond.shape[1] == 1:
+        M_cond = M @ sparse.diags(cond.reshape(-1))
+        return [(M_cond @ d).tocsr() for d in D]
+    elif cond.shape[1] == 9:
+        # J_j = sum_k cond[k, j] E_k, as in calc_J
+        cond = cond.reshape(-1, 3, 3)
+        return [
+            (M @ sum(sparse.diags(cond[:, k, j]) @ D[k] for k in range(3))).tocsr()
+            for j in range(3)
+        ]
+    else:
+        raise ValueError('Conductivity should be a Nx1 or an Nx9 vector')
+
+
+def _tdcs_leadfield_output(v, D, field, cond, post_pro):
+    ''' Calculates the leadfield output for a block of potentials
+
+    Parameters
+    ----------
+    v: (n_nodes x n_block) ndarray
+        Potentials
+    D: list of sparse matrices
+        Gradient matrix, split by component
+
+    Returns
+    -------
+    out_field: (n_block x n_out x 3) ndarray
+        Output field for each simulation in the block
+    '''
+    E = np.stack([-d.dot(v) for d in D], axis=-1) * 1e3
+    out_field = []
+    for j in range(v.shape[1]):
+        if field == 'E':
+            f = E[:, j]
+        elif field == 'J':
+            f = calc_J(E[:, j], cond)
+        else:
+            raise ValueError
+        if post_pro is not None:
+            f = post_pro(f)
+        out_field.append(f)
+    return np.array(out_field)
+
+
 # ### Functions for running tDCS leadfields in parallel ####
-def _set_up_tdcs_global_solver(S, n, D, post_pro, cond, field):
+def _set_up_tdcs_global_solver(S, D, cond, mesh_cond, n, post_pro, field):
     global tdcs_global_solver
     global tdcs_global_nsims
     global tdcs_global_grad_matrix
     global tdcs_global_post_pro
     global tdcs_global_cond
+    global tdcs_global_mesh_cond
     global tdcs_global_field
     tdcs_global_solver = S
     tdcs_global_nsims = n
     tdcs_global_grad_matrix = D
     tdcs_global_post_pro = post_pro
     tdcs_global_cond = cond
+    tdcs_global_mesh_cond = mesh_cond
     tdcs_global_field = field
 
 
-def _run_tdcs_leadfield(i, el_tags, currents, fn_hdf5, dataset, input_type, mesh, cond, ref_electrode, other_electrodes):
+def _run_tdcs_leadfield(block, el_tags, currents, input_type, ref_electrodes, other_electrodes):
     global tdcs_global_solver
     global tdcs_global_nsims
     global tdcs_global_grad_matrix
     global tdcs_global_post_pro
     global tdcs_global_cond
+    global tdcs_global_mesh_cond
     global tdcs_global_field
-    logger.info('Running Simulation {0} out of {1}'.format(
-        i+1, tdcs_global_nsims))
-    b = tdcs_global_solver.assemble_rhs(el_tags, currents)
-    v = tdcs_global_solver.solve(b)
+    logger.info('Running Simulations {0} to {1} out of {2}'.format(
+        block.start + 1, block.stop, tdcs_global_nsims))
+    b = np.stack([
+        tdcs_global_solver.assemble_rhs([el_tag], [current])
+        for el_tag, current in zip(el_tags, currents)], axis=1)
+    v = tdcs_global_solver.solve(b).reshape(tdcs_global_solver.dof_map.nr, -1)
 
     #TODO implement calibration error also for element/node defined electrodes
     # when input_type == "nodes"
     if input_type == "tag":
-        v_ = mesh_io.NodeData(v, name='v', mesh=mesh)
-        flux = np.array([
-            _calc_flux_electrodes(v_, cond,
-                                [other_electrodes - 1000, other_electrodes - 600,
-                                other_electrodes - 2000, other_electrodes - 1600],
-                                units='mm'),
-            _calc_flux_electrodes(v_, cond,
-                                [ref_electrode - 1000, ref_electrode - 600,
-                                ref_electrode - 2000, ref_electrode - 1600],
-                                units='mm')])
-        current_ = np.average(np.abs(flux))
-        error = np.abs(np.abs(flux[0]) - np.abs(flux[1])) / current_
-        if error > 0.1:
-            logger.warning(f'The current calibration error exceeded 10%! Estimated error value: {error*100:.2f}%')
+        for j, (ref_electrode, others) in enumerate(zip(ref_electrodes, other_electrodes)):
+            _check_calibration_error(
+                v[:, j], tdcs_global_solver.mesh, tdcs_global_mesh_cond,
+                ref_electrode, others)
 
     # Calculate E and postprocessing
-    E = np.vstack([-d.dot(v) for d in tdcs_global_grad_matrix]).T * 1e3
-    if tdcs_global_field == 'E':
-        out_field = E
-    elif tdcs_global_field == 'J':
-        out_field = calc_J(E, tdcs_global_cond)
-    else:
-        raise ValueError
+    out_field = _tdcs_leadfield_output(
+        v, tdcs_global_grad_matrix, tdcs_global_field,
+        tdcs_global_cond, tdcs_global_post_pro)
 
-    if tdcs_global_post_pro is not None:
-        out_field = tdcs_global_post_pro(out_field)
-    # Write out
-    tdcs_global_solver.lock.acquire()
-    with h5py.File(fn_hdf5, 'a') as f:
-        f[dataset][i] = out_field
-    tdcs_global_solver.lock.release()
-    
     del b, v
     gc.collect()
+    return out_field
 
 
 def _finalize_tdcs_global_solver():
@@ -1867,13 +2822,18 @@ def _finalize_tdcs_global_solver():
     del tdcs_global_grad_matrix
     global tdcs_global_post_pro
     del tdcs_global_post_pro
+    global tdcs_global_cond
+    del tdcs_global_cond
+    global tdcs_global_mesh_cond
+    del tdcs_global_mesh_cond
     gc.collect()
 
 
 def tms_many_simulations(
     mesh, cond, fn_coil, matsimnibs_list, didt_list,
     fn_hdf5, dataset, roi=None, field='E', post_pro=None,
-    solver_options=None, n_workers=1):
+    solver_options=None, n_workers=1, block_size=DEFAULT_BLOCK_SIZE,
+    cache_dir=None):
     ''' Function for running a large amount of TMS simulations.
 
     Parameters
@@ -1907,22 +2867,26 @@ def tms_many_simulations(
         Options to be used by the solver. Default: Hypre solver
     n_workers: int
         Number of workers to use
+    block_size: int (optional)
+        Number of coil positions solved together in a single call to the
+        solver. Default: DEFAULT_BLOCK_SIZE
+    cache_dir: str (optional)
+        Folder for caching the assembled FEM matrix. Default: None
     '''
     for f in field:
         if f not in 'EDJv':
             raise ValueError("Field must be one or more of 'E', 'D', 'J', 'v'")
     if len(matsimnibs_list) != len(didt_list):
         raise ValueError("matsimnibs_list and didt_list should have the same length")
-    D = grad_matrix(mesh, split=True)
-    S = TMSFEM(mesh, cond, solver_options)
+    S = TMSFEM(mesh, cond, solver_options, cache_dir=cache_dir)
     n_out = mesh.elm.nr
-    # Separate out the part of the gradient that is in the ROI
+    # Only calculate the part of the gradient that is in the ROI
     if roi is not None:
         roi = np.in1d(mesh.elm.tag1, roi)
-        D = [d.tocsc() for d in D]
-        D = [d[roi] for d in D]
+        D = grad_matrix(mesh, split=True, roi=roi)
         cond = cond.value[roi]
     else:
+        D = grad_matrix(mesh, split=True)
         roi = np.ones(mesh.elm.nr, dtype=bool)
 
     n_roi = np.sum(roi)
@@ -1938,74 +2902,91 @@ def tms_many_simulations(
 
     n_sims = len(matsimnibs_list)
     # Create HDF5 dataset
-    with h5py.File(fn_hdf5, 'a') as f:
-        f.create_dataset(
-            dataset,
-            (n_sims,) + n_out,
-            dtype=float, compression="gzip")
+    _create_rows_dataset(fn_hdf5, dataset, (n_sims,) + n_out)
 
+    blocks = _split_in_blocks(n_sims, block_size, n_workers)
     # Run sequentially
     if n_workers == 1:
-        for i, matsimnibs, didt in zip(range(n_sims), matsimnibs_list, didt_list):
-            logger.info(
-                f'Running Simulation {i+1} out of {n_sims}')
-            dAdt = coil_lib.set_up_tms(mesh, fn_coil, matsimnibs, didt)
-            # b = S.assemble_tms_rhs(dAdt)
-            b = S.assemble_rhs(dAdt)
-            v = S.solve(b)
-            E = np.vstack([-d.dot(v) for d in D]).T * 1e3
-            dAdt = dAdt[roi]
-            E -= dAdt
-
-            # build output fields
-            out_field = []
-            if 'E' in field:
-                out_field.append(E)
-            if 'D' in field:
-                out_field.append(dAdt)
-            if 'J' in field:
-                out_field.append(calc_J(E, cond))
-            if 'v' in field:
-                out_field.append(v)
-            out_field = tuple(out_field)
-
-            # if only one field to output, un-tuple
-            if len(out_field) == 1:
-                out_field = out_field[0]
-            if post_pro is not None:
-                out_field = post_pro(out_field)
-            with h5py.File(fn_hdf5, 'a') as f:
-                f[dataset][i] = out_field
+        with _HDF5Writer(fn_hdf5, dataset) as writer:
+            for block in blocks:
+                logger.info(
+                    f'Running Simulations {block.start+1} to {block.stop} out of {n_sims}')
+                out_field = _run_tms_many_block(
+                    S, fn_coil, matsimnibs_list[block.start:block.stop],
+                    didt_list[block.start:block.stop], D, roi, cond, field, post_pro)
+                writer.write(block.start, out_field)
+
+                del out_field
+                gc.collect()
 
-            del b
-            gc.collect()
-            
         del S
         gc.collect()
 
     # Run in parallel
     else:
-        # Lock has to be passed through inheritance
-        S.lock = multiprocessing.Lock()
-        with multiprocessing.Pool(
+        with SharedObjects(S, D, cond, roi) as shared, \
+             multiprocessing.Pool(
                 processes=n_workers,
-                initializer=_set_up_tms_many_global_solver,
-                initargs=(S, fn_coil, n_sims, D, post_pro, cond, field, roi)) as pool:
-            sims = []
-            for i, matsimnibs, didt in zip(
-                    range(n_sims), matsimnibs_list, didt_list):
-                sims.append(
-                    pool.apply_async(
-                        _run_tms_many_simulations,
-                        (i, matsimnibs, didt,
-                         fn_hdf5, dataset)))
-            [s.get() for s in sims]
+                initializer=_shared_initializer,
+                initargs=(_set_up_tms_many_global_solver, shared,
+                          fn_coil, n_sims, post_pro, field)) as pool:
+            def block_args(block):
+                return (block, matsimnibs_list[block.start:block.stop],
+                        didt_list[block.start:block.stop])
+
+            # The writer is started after the workers are forked
+            with _HDF5Writer(fn_hdf5, dataset) as writer:
+                _run_blocks_in_pool(
+                    pool, _run_tms_many_simulations, blocks, block_args, writer, n_workers)
             pool.close()
             pool.join()
 
 
+def _run_tms_many_block(S, fn_coil, matsimnibs_list, didt_list, D, roi, cond, field, post_pro):
+    ''' Runs a block of TMS simulations with a single call to the solver
+
+    Returns
+    -------
+    out_field: ndarray
+        Output field for each simulation in the block, stacked in the first axis
+    '''
+    dAdt = [
+        coil_lib.set_up_tms(S.mesh, fn_coil, matsimnibs, didt)
+        for matsimnibs, didt in zip(matsimnibs_list, didt_list)
+    ]
+    b = np.stack([S.assemble_rhs(d) for d in dAdt], axis=1)
+    v = S.solve(b).reshape(S.dof_map.nr, -1)
+    E = np.stack([-d.dot(v) for d in D], axis=-1) * 1e3
+    del b
+
+    out = []
+    for j in range(v.shape[1]):
+        dAdt_roi = dAdt[j][roi]
+        E_j = E[:, j] - dAdt_roi
+
+        # build output fields
+        out_field = []
+        if 'E' in field:
+            out_field.append(E_j)
+        if 'D' in field:
+            out_field.append(dAdt_roi)
+        if 'J' in field:
+            out_field.append(calc_J(E_j, cond))
+        if 'v' in field:
+            out_field.append(v[:, j])
+        out_field = tuple(out_field)
+
+        # if only one field to output, un-tuple
+        if len(out_field) == 1:
+            out_field = out_field[0]
+        if post_pro is not None:
+            out_field = post_pro(out_field)
+        out.append(out_field)
+    return np.array(out)
+
+
 ### Functions for running man TMS simulations in parallel ####
-def _set_up_tms_many_global_solver(S, fn_coil, n, D, post_pro, cond, field, roi):
+def _set_up_tms_many_global_solver(S, D, cond, roi, fn_coil, n, post_pro, field):
     global tms_many_global_solver
     global tms_many_global_fn_coil
     global tms_many_global_nsims
@@ -2024,7 +3005,7 @@ def _set_up_tms_many_global_solver(S, fn_coil, n, D, post_pro, cond, field, roi)
     tms_many_global_roi = roi
 
 
-def _run_tms_many_simulations(i, matsimnibs, didt, fn_hdf5, dataset):
+def _run_tms_many_simulations(block, matsimnibs_list, didt_list):
     global tms_many_global_solver
     global tms_many_global_fn_coil
     global tms_many_global_nsims
@@ -2033,48 +3014,16 @@ def _run_tms_many_simulations(i, matsimnibs, didt, fn_hdf5, dataset):
     global tms_many_global_cond
     global tms_many_global_field
     global tms_many_global_roi
-    logger.info('Running Simulation {0} out of {1}'.format(
-        i+1, tms_many_global_nsims))
-    # RHS
-    dAdt = coil_lib.set_up_tms(
-        tms_many_global_solver.mesh,
-        tms_many_global_fn_coil,
-        matsimnibs, didt
-    )
-    b = tms_many_global_solver.assemble_rhs(dAdt)
-    # Simulate
-    v = tms_many_global_solver.solve(b)
-    # Calculate E and postprocessing
-    E = np.vstack([-d.dot(v) for d in tms_many_global_grad_matrix]).T * 1e3
-    E -= dAdt[tms_many_global_roi]
-
-    # build output fields
-    out_field = []
-    if 'E' in tms_many_global_field:
-        out_field.append(E)
-    if 'D' in tms_many_global_field:
-        out_field.append(dAdt)
-    if 'J' in tms_many_global_field:
-        out_field.append(calc_J(E, tms_many_global_cond))
-    if 'v' in tms_many_global_field:
-        out_field.append(v)
-    out_field = tuple(out_field)
-
-    # if only one field to output, un-tuple
-    if len(out_field) == 1:
-        out_field = out_field[0]
-
-    if tms_many_global_post_pro is not None:
-        out_field = tms_many_global_post_pro(out_field)
-    # Write out
-    tms_many_global_solver.lock.acquire()
-    with h5py.File(fn_hdf5, 'a') as f:
-        f[dataset][i] = out_field
-    tms_many_global_solver.lock.release()
-    
-    del b
+    logger.info('Running Simulations {0} to {1} out of {2}'.format(
+        block.start + 1, block.stop, tms_many_global_nsims))
+    out_field = _run_tms_many_block(
+        tms_many_global_solver, tms_many_global_fn_coil,
+        matsimnibs_list, didt_list,
+        tms_many_global_grad_matrix, tms_many_global_roi,
+        tms_many_global_cond, tms_many_global_field,
+        tms_many_global_post_pro)
     gc.collect()
-
+    return out_field
 
 
 def _finalize_tms_many_simulations_global_solver():
@@ -20,7 +20,9 @@
 
 '''
 from __future__ import print_function
+import multiprocessing
 import os
+import uuid
 
 import h5py
 import numpy as np
@@ -40,6 +42,11 @@ from ..utils.simnibs_logger import logger
 
 FIELD_NAME = {'v': 'v', 'E': 'E', 'e': 'magnE', 'J': 'J', 'j': 'magnJ'}
 
+# FEM systems of the samplers with reuse_fem, kept between samples. They are
+# stored here and not in the samplers, as the samplers are copied to each
+# process evaluating samples
+_sampler_fem = {}
+
 def write_data_hdf5(data, data_name, hdf5_fn, path='data/', compression='gzip'):
     ''' Saves a field in an hdf5 file
 
@@ -565,6 +572,7 @@ def run_tms_gpc(poslist, fn_simu, cpus=1, tissues=[ElementTags.GM], eps=1e-2,
             poslist.fnamecoil, matsimnibs, p.didt,
             roi=tissues)
         sampler.create_hdf5()
+        sampler.reuse_fem = True
         reg, phi = pygpc.adaptive.run_reg_adaptive_grid(
             pdf_type, pdfshape, limits,
             sampler.run_simulation,
@@ -574,6 +582,7 @@ def run_tms_gpc(poslist, fn_simu, cpus=1, tissues=[ElementTags.GM], eps=1e-2,
             n_cpus=cpus,
             print_function=logger.info,
             min_iter=min_iter)
+        sampler.clear_fem_cache()
         gpc_reg = gPC_regression(random_vars,
                                  pdf_type, pdfshape, limits, reg.poly_idx,
                                  reg.grid.coords_norm, 'TMS',
@@ -639,6 +648,7 @@ def run_tcs_gpc(poslist, fn_simu, cpus=1, tissues=[2], eps=1e-2,
         electrode_surfaces, poslist.currents,
         roi=tissues)
     sampler.create_hdf5()
+    sampler.reuse_fem = True
     reg, phi = pygpc.adaptive.run_reg_adaptive_grid(
         pdf_type, pdfshape, limits,
         sampler.run_simulation,
@@ -649,6 +659,7 @@ def run_tcs_gpc(poslist, fn_simu, cpus=1, tissues=[2], eps=1e-2,
         n_cpus=cpus,
         print_function=logger.info,
         min_iter=min_iter)
+    sampler.clear_fem_cache()
     gpc_reg = gPC_regression(random_vars,
                              pdf_type, pdfshape, limits, reg.poly_idx,
                              reg.grid.coords_norm, 'TCS',
@@ -679,6 +690,14 @@ class gPCSampler(object):
     qoi_function: OrderedDict
         dictionaty with functions for each QOI.
         The first QOI will be passed to the gPC algorithm.
+    reuse_fem: bool
+        Whether to keep the FEM system between samples. The FEM matrix of each
+        sample is then a combination of the matrices of the tissues with random
+        conductivities (see fem.StiffnessBasis). Default: False
+    preconditioner_tol: float
+        With reuse_fem, the preconditioner is kept while the tissue conductivities
+        differ by less than this fraction from the ones it was built for.
+        Default: 0.2
 
 
     Parameters
@@ -705,6 +724,9 @@ class gPCSampler(object):
         self._gpc_vars = prep_gpc(poslist)
         self.identifiers = self._gpc_vars[0]
         self.qoi_function = OrderedDict([('E', self._calc_E)])
+        self.reuse_fem = False
+        self.preconditioner_tol = 0.2
+        self._fem_id = uuid.uuid4().hex
 
     def create_hdf5(self):
         '''Creates an HDF5 file to store the data '''
@@ -761,8 +783,105 @@ class gPCSampler(object):
             dset[-1, ...] = data
 
     def run_simulation(self, random_vars):
+        ''' Runs a simulation and records it in the HDF5 file
+
+        Parameters
+        ----------
+        random_vars: list
+            Values of the random variables
+
+        Returns
+        -------
+        qoi: ndarray
+            First QOI, flattened
+        '''
+        return self._record_sample(random_vars, self._simulate(random_vars))
+
+    def _simulate(self, random_vars):
+        ''' Returns the potential (NodeData) for the random variables '''
         raise NotImplementedError('This method is to be implemented in a subclass!')
 
+    def _qoi_args(self):
+        ''' Extra arguments of the QOI functions '''
+        return ()
+
+    def _record_sample(self, random_vars, v):
+        ''' Calculates the QOIs of a sample and records them in the HDF5 file '''
+        qoi_args = self._qoi_args()
+        self.mesh.nodedata = [v]
+        cropped = self.mesh.crop_mesh(self.roi)
+        v_c = cropped.nodedata[0]
+        self.mesh.nodedata = []
+
+        qois = []
+        for qoi_name, qoi_f in self.qoi_function.items():
+            qois.append(qoi_f(v_c, random_vars, *qoi_args))
+
+        self.record_data_matrix(random_vars, 'random_var_samples', '/')
+        self.record_data_matrix(v.value, 'v_samples', 'mesh/data_matrices')
+        self.record_data_matrix(v_c.value, 'v_samples', 'mesh_roi/data_matrices')
+        for qoi_name, qoi_v in zip(self.qoi_function.keys(), qois):
+            self.record_data_matrix(
+                qoi_v, qoi_name + '_samples', 'mesh_roi/data_matrices')
+
+        del cropped
+        del v
+        del v_c
+
+        return np.atleast_1d(qois[0]).reshape(-1)
+
+    def _fem_system(self, key, cond, create):
+        ''' FEM system for the conductivities cond
+
+        Without reuse_fem, the system is created for every sample. Otherwise,
+        the system is created for the first sample and updated in later samples
+        by combining tissue matrices
+
+        Parameters
+        ----------
+        key: hashable
+            Identifier of the system, e.g. the electrode
+        cond: simnibs.msh.mesh_io.ElementData
+            Conductivity of each element
+        create: function
+            Creates the FEM system from cond
+        '''
+        if not self.reuse_fem:
+            return create(cond)
+        cache = _sampler_fem.setdefault(self._fem_id, {'basis': None, 'systems': {}})
+        if cache['basis'] is False:
+            return create(cond)
+        if key not in cache['systems']:
+            s = create(cond)
+            if cache['basis'] is None:
+                tags = [iden for iden in self.identifiers if type(iden) == int]
+                try:
+                    cache['basis'] = fem.StiffnessBasis(
+                        self.mesh, cond, tags, units=s.units)
+                except ValueError as e:
+                    logger.warning(
+                        f'Assembling the FEM matrix in each sample: {e}')
+                    cache['basis'] = False
+                    return s
+            cache['systems'][key] = [s, cache['basis'].tissue_cond(cond)]
+            return s
+        s, sigma_ref = cache['systems'][key]
+        sigma = cache['basis'].tissue_cond(cond)
+        reuse = np.all(
+            np.abs(sigma - sigma_ref) <= self.preconditioner_tol * np.abs(sigma_ref))
+        if not s.update_cond(cond, cache['basis'], reuse_preconditioner=reuse):
+            # The solver is set-up again with these conductivities
+            cache['systems'][key][1] = sigma
+        return s
+
+    def clear_fem_cache(self):
+        ''' Removes the FEM systems kept with reuse_fem in this process '''
+        _sampler_fem.pop(self._fem_id, None)
+
+    def _prepare_workers(self):
+        ''' Prepares the sampler before being copied to worker processes '''
+        pass
+
     def _calc_E(self, v, random_vars, dAdt=None):
         grad = v.gradient()
         grad.assign_triangle_values()
@@ -778,14 +897,49 @@ class gPCSampler(object):
                 poslist.cond[iden-1].value = random_vars[i]
         return poslist
 
-    def run_N_random_simulations(self, N):
+    def run_N_random_simulations(self, N, n_workers=1):
+        ''' Runs simulations for N random samples
+
+        Parameters
+        ----------
+        N: int
+            Number of samples
+        n_workers: int (optional)
+            Number of processes simulating the samples. The samples are recorded
+            in this process. Default: 1
+        '''
         grid = pygpc.randomgrid(pdftype=self._gpc_vars[1],
                                 gridshape=self._gpc_vars[2],
                                 limits=self._gpc_vars[3],
                                 N=N)
-        for i, x in enumerate(grid.coords):
-            logger.info('Running simulation {0} out of {1}'.format(i + 1, N))
-            self.run_simulation(x)
+        if n_workers == 1:
+            for i, x in enumerate(grid.coords):
+                logger.info('Running simulation {0} out of {1}'.format(i + 1, N))
+                self.run_simulation(x)
+            return
+
+        self._prepare_workers()
+        with multiprocessing.Pool(processes=n_workers,
+                                  initializer=_set_up_sampler_global,
+                                  initargs=(self,)) as pool:
+            sims = [pool.apply_async(_simulate_sampler_global, (x,))
+                    for x in grid.coords]
+            for i, (x, sim) in enumerate(zip(grid.coords, sims)):
+                logger.info('Recording simulation {0} out of {1}'.format(i + 1, N))
+                v = mesh_io.NodeData(sim.get(), 'v', mesh=self.mesh)
+                self._record_sample(x, v)
+            pool.close()
+            pool.join()
+
+
+def _set_up_sampler_global(sampler):
+    global sampler_global
+    sampler_global = sampler
+
+
+def _simulate_sampler_global(random_vars):
+    global sampler_global
+    return sampler_global._simulate(random_vars).value
 
 
 class TDCSgPCSampler(gPCSampler):
@@ -855,36 +1009,23 @@ class TDCSgPCSampler(gPCSampler):
             s.mesh, s.poslist, s.fn_hdf5, el_tags, el_currents,
             roi=s.roi)
 
-    def run_simulation(self, random_vars):
+    def _simulate(self, random_vars):
         poslist = self._update_poslist(random_vars)
         cond = poslist.cond2elmdata(self.mesh)
-        v = fem.tdcs(
-            self.mesh, cond, self.el_currents,
-            self.el_tags, units='mm')
-
-
-        self.mesh.nodedata = [v]
-        cropped = self.mesh.crop_mesh(self.roi)
-        v_c = cropped.nodedata[0]
-        self.mesh.nodedata = []
-
-        qois = []
-        for qoi_name, qoi_f in self.qoi_function.items():
-            qois.append(qoi_f(v_c, random_vars))
-
-        self.record_data_matrix(random_vars, 'random_var_samples', '/')
-        self.record_data_matrix(v.value, 'v_samples', 'mesh/data_matrices')
-        self.record_data_matrix(v_c.value, 'v_samples', 'mesh_roi/data_matrices')
-        for qoi_name, qoi_v in zip(self.qoi_function.keys(), qois):
-            self.record_data_matrix(
-                qoi_v, qoi_name + '_samples', 'mesh_roi/data_matrices')
-
-        del cropped
-        del cond
-        del v
-        del v_c
-
-        return np.atleast_1d(qois[0]).reshape(-1)
+        if not self.reuse_fem:
+            return fem.tdcs(
+                self.mesh, cond, self.el_currents,
+                self.el_tags, units='mm')
+
+        ref = self.el_tags[0]
+        v = np.zeros(self.mesh.nodes.nr, dtype=float)
+        for el_surf, el_c in zip(self.el_tags[1:], self.el_currents[1:]):
+            s = self._fem_system(
+                el_surf, cond,
+                lambda c: fem.TDCSFEMDirichlet(self.mesh, c, [ref, el_surf], [0., 1.]))
+            v += fem._calibrate_tdcs_pair(
+                s.solve(), self.mesh, cond, ref, el_surf, el_c, units='mm')
+        return mesh_io.NodeData(v, 'v', mesh=self.mesh)
 
 
 class TMSgPCSampler(gPCSampler):
@@ -957,9 +1098,8 @@ class TMSgPCSampler(gPCSampler):
             s.mesh, s.poslist, s.fn_hdf5, fnamecoil,
             matsimnibs, didt, roi=s.roi)
 
-    def run_simulation(self, random_vars):
-        poslist = self._update_poslist(random_vars)
-        cond = poslist.cond2elmdata(self.mesh)
+    def _get_dAdt(self):
+        ''' dA/dt field in the mesh and in the ROI, calculated once '''
         if self.constant_dAdt:
             try:
                 dAdt = self.dAdt
@@ -988,26 +1128,19 @@ class TMSgPCSampler(gPCSampler):
         else:
             raise NotImplementedError
 
-        v = fem.tms_dadt(self.mesh, cond, dAdt)
-        self.mesh.nodedata = [v]
-        cropped = self.mesh.crop_mesh(self.roi)
-        v_c = cropped.nodedata[0]
-        self.mesh.nodedata = []
+        return dAdt, dAdt_roi
 
-        qois = []
-        for qoi_name, qoi_f in self.qoi_function.items():
-            qois.append(qoi_f(v_c, random_vars, dAdt_roi))
+    def _prepare_workers(self):
+        self._get_dAdt()
 
-        self.record_data_matrix(random_vars, 'random_var_samples', '/')
-        self.record_data_matrix(v.value, 'v_samples', 'mesh/data_matrices')
-        self.record_data_matrix(v_c.value, 'v_samples',
-                                'mesh_roi/data_matrices')
-        for qoi_name, qoi_v in zip(self.qoi_function.keys(), qois):
-            self.record_data_matrix(
-                qoi_v, qoi_name + '_samples', 'mesh_roi/data_matrices')
-
-        del cropped
-        del cond
-        del v
+    def _qoi_args(self):
+        return (self._get_dAdt()[1], )
 
-        return np.atleast_1d(qois[0]).reshape(-1)
+    def _simulate(self, random_vars):
+        poslist = self._update_poslist(random_vars)
+        cond = poslist.cond2elmdata(self.mesh)
+        dAdt = self._get_dAdt()[0]
+        if not self.reuse_fem:
+            return fem.tms_dadt(self.mesh, cond, dAdt)
+        s = self._fem_system('tms', cond, lambda c: fem.TMSFEM(self.mesh, c))
+        return mesh_io.NodeData(s.solve(s.assemble_rhs(dAdt)), name='v', mesh=self.mesh)
@@ -34,6 +34,9 @@ cdef extern from "_solver.c" nogil:
     PetscErrorCode _petsc_solve_with_ksp(
         PetscKSP ksp, PetscInt N, PetscScalar rhs[],
         FILE *stream, PetscScalar solution[])
+    PetscErrorCode _petsc_solve_many_with_ksp(
+        PetscKSP ksp, PetscInt N, PetscInt n_rhs, PetscScalar rhs[],
+        FILE *stream, PetscScalar solution[])
     PetscErrorCode _print_ksp_info(PetscKSP ksp, FILE *stream)
     PetscErrorCode _dealloc(PetscKSP KSP)
     PetscErrorCode _petsc_initialize()
@@ -143,36 +146,39 @@ cdef class Solver:
         ------------
         x: (N x n_sims) np.ndarray
             Solutions
+
+        Notes
+        -------
+        All right-hand sides are solved as a single block, re-using the KSP
+        set-up (and the preconditioner) as well as the PETSc vectors
         '''
         if b.ndim == 1:
             b = b[:, None]
         cdef int n_sims = b.shape[1]
-        cdef int i
         cdef PetscErrorCode err
-        cdef np.ndarray[PetscScalar, ndim=1] rhs = b.T.reshape(-1) # get the right-hand side in C order
+        cdef np.ndarray[PetscScalar, ndim=1] rhs = np.ascontiguousarray(b.T, dtype=float).reshape(-1) # get the right-hand side in C order
         cdef np.ndarray[PetscScalar, ndim=1] solution = np.zeros(b.shape, dtype=float).reshape(-1)
-        for i in range(n_sims):
-            # Print KSP info
-            logger.log(self.log_level, 'Solving system {0} of {1}'.format(i+1, n_sims))
-            err = _print_ksp_info(self.ksp, self._log_stream)
-            start = time.time()
-            if err:
-                self.log_level = 50
-                raise SolverError('There was an error during the solve.\n'
-                                  'PETSc returned error code: {}'.format(err))
-            self._log_record()
-            # Solve
-            with nogil:
-                err = _petsc_solve_with_ksp(
-                    self.ksp, self._N, &rhs[self._N*i], self._log_stream, &solution[self._N*i])
-
-            if err:
-                self.log_level = 50
-                raise SolverError('There was an error during the solve.\n'
-                                  'PETSc returned error code: {}'.format(err))
-            self._log_record()
-            end = time.time()
-            logger.log(self.log_level, 'Time to solve system: {0:.2f}s'.format(end-start))
+        # Print KSP info
+        logger.log(self.log_level, 'Solving {0} system(s)'.format(n_sims))
+        err = _print_ksp_info(self.ksp, self._log_stream)
+        start = time.time()
+        if err:
+            self.log_level = 50
+            raise SolverError('There was an error during the solve.\n'
+                              'PETSc returned error code: {}'.format(err))
+        self._log_record()
+        # Solve
+        with nogil:
+            err = _petsc_solve_many_with_ksp(
+                self.ksp, self._N, n_sims, &rhs[0], self._log_stream, &solution[0])
+
+        if err:
+            self.log_level = 50
+            raise SolverError('There was an error during the solve.\n'
+                              'PETSc returned error code: {}'.format(err))
+        self._log_record()
+        end = time.time()
+        logger.log(self.log_level, 'Time to solve {0} system(s): {1:.2f}s'.format(n_sims, end-start))
 
         return solution.reshape(n_sims, -1).T
 
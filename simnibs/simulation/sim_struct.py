@@ -25,7 +25,6 @@ import copy
 import glob
 import gc
 import logging
-import functools
 from typing import Union
 
 import numpy as np
@@ -88,6 +87,10 @@ class SESSION(object):
         Fields to be calculated for the simulations
     eeg_cap: str
         Name of eeg cap (in subject space)
+    fem_cache: bool
+        Whether to cache the assembled FEM matrices in the m2m folder, so that
+        later runs with the same head mesh and conductivities skip the
+        assembly. Default: False
 
     Parameters
     ------------------------
@@ -116,6 +119,7 @@ class SESSION(object):
         self.fiducials = FIDUCIALS()
         self.fields = 'eE'
         self.eeg_cap = None
+        self.fem_cache = False
         self._prepared = False
         self._log_handlers = []
 
@@ -207,6 +211,8 @@ class SESSION(object):
                 PL.postprocess = self.fields
                 PL.fn_tensor_nifti = self.fname_tensor
                 PL.eeg_cap = self.eeg_cap
+                if self.fem_cache and self.subpath:
+                    PL.fem_cache_dir = os.path.join(self.subpath, 'fem_cache')
                 PL._prepare()
                 if not PL.mesh:
                     PL.mesh = mesh
@@ -617,6 +623,8 @@ class SimuList(object):
         Maximum eigenvalue of a conductivity tensor.
     solver_options: str (optional)
         Options for the FEM solver
+    fem_cache_dir: str (optional)
+        Folder for caching the assembled FEM matrices. Default: None (no caching)
     """
 
     def __init__(self, mesh=None):
@@ -636,6 +644,7 @@ class SimuList(object):
         self.aniso_maxratio = 10
         self.aniso_maxcond = 2
         self.solver_options = None
+        self.fem_cache_dir = None
         self._anisotropy_type = 'scalar'
         self._postprocess = ['e', 'E', 'j', 'J']
 
@@ -1167,7 +1176,8 @@ class TMSLIST(SimuList):
         # call tms_coil
         fem.tms_coil(self.mesh, cond, self.cond, self.fnamecoil, self.postprocess,
                      matsimnibs_list, didt_list, output_names, geo_names,
-                     solver_options=self.solver_options, n_workers=cpus)
+                     solver_options=self.solver_options, n_workers=cpus,
+                     cache_dir=self.fem_cache_dir)
 
 
         logger.info('Creating visualizations')
@@ -1684,7 +1694,8 @@ class TDCSLIST(SimuList):
         v = fem.tdcs(mesh_elec, cond, self.currents,
                      np.unique(electrode_surfaces),
                      solver_options=self.solver_options,
-                     n_workers=cpus)
+                     n_workers=cpus,
+                     cache_dir=self.fem_cache_dir)
         m = fem.calc_fields(v, self.postprocess, cond=cond)
         final_name = fn_simu + '_' + self.anisotropy_type + '.msh'
         mesh_io.write_msh(m, final_name)
@@ -2285,6 +2296,13 @@ class TDCSLEADFIELD(LEADFIELD):
         in the eeg cap. If a list of electrodes, each electrode should correspond to an
         entry in the cap. If is a list and eeg_cap is set to None, will place the
         electrodes based on their centre and pos_ydir properties.
+    leadfield_dtype: str
+        Data type used to store the leadfield, 'float64', 'float32' or 'float16'.
+        Default: 'float64'
+    leadfield_compression: str or None
+        HDF5 compression filter used to store the leadfield, e.g. 'gzip' or
+        'lzf'. None stores it uncompressed, so that it can be memory-mapped.
+        Default: 'gzip'
     Parameters
     ------------------------
     matlab_struct: (optional) scipy.io.loadmat()
@@ -2301,6 +2319,8 @@ class TDCSLEADFIELD(LEADFIELD):
         self.electrode.shape = 'ellipse'
         self.electrode.dimensions = [10, 10]
         self.electrode.thickness = [4]
+        self.leadfield_dtype = 'float64'
+        self.leadfield_compression = 'gzip'
 
         if matlab_struct:
             self.read_mat_struct(matlab_struct)
@@ -2632,19 +2652,14 @@ class TDCSLEADFIELD(LEADFIELD):
                     logger.warning(
                         f'Could not find tissues number {self.tissues}')
 
-            # Create interpolation matrix
-            M = roi_msh.interp_matrix(
+            # Create interpolation matrix. It is used as postprocessing
+            # operation, and composed with the gradient in fem.tdcs_leadfield
+            post_pro = roi_msh.interp_matrix(
                 mesh_lf.nodes.node_coord,
                 out_fill='nearest',
                 th_indices=th_indices,
                 element_wise=True
             )
-
-            # Define postprocessing operation
-
-            def post(out_field, M):
-                return M.dot(out_field)
-            post_pro = functools.partial(post, M=M)
         else:
 
             # Write roi, scalp and electrode surfaces hdf5
@@ -2683,6 +2698,8 @@ class TDCSLEADFIELD(LEADFIELD):
             n_workers=cpus,
             input_type=input_type,
             weigh_by_area=weigh_by_area,
+            dtype=np.dtype(self.leadfield_dtype),
+            compression=self.leadfield_compression,
         )
 
         with h5py.File(fn_hdf5, 'a') as f:
@@ -2730,6 +2747,12 @@ class TDCSLEADFIELD(LEADFIELD):
         SimuList.read_cond_mat_struct(self, mat)
         self.eeg_cap = try_to_read_matlab_field(
             mat, 'eeg_cap', str, self.eeg_cap)
+        self.leadfield_dtype = try_to_read_matlab_field(
+            mat, 'leadfield_dtype', str, self.leadfield_dtype)
+        self.leadfield_compression = try_to_read_matlab_field(
+            mat, 'leadfield_compression', str, self.leadfield_compression)
+        if self.leadfield_compression == 'none':
+            self.leadfield_compression = None
 
         if len(mat['electrode']) > 0:
             if type(mat['electrode'][0]) is np.str_ and mat['electrode'][0] == 'none':
@@ -2753,6 +2776,11 @@ class TDCSLEADFIELD(LEADFIELD):
                 electrode = [self.electrode]
             mat['electrode'] = save_electrode_mat(electrode)
         mat['eeg_cap'] = remove_None(self.eeg_cap)
+        mat['leadfield_dtype'] = remove_None(self.leadfield_dtype)
+        if self.leadfield_compression is None:
+            mat['leadfield_compression'] = 'none'
+        else:
+            mat['leadfield_compression'] = self.leadfield_compression
         return mat
 
 
@@ -1,7 +1,9 @@
 import copy
+import multiprocessing
 import os
+import pickle
 import sys
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 import tempfile
 import pytest
 import h5py
@@ -15,6 +17,9 @@ from .. import analytical_solutions
 from .. import coil_numpy as coil_lib
 from .. import petsc_solver
 from ...mesh_tools import mesh_io
+from ..tms_coil.tms_coil import TmsCoil
+from ..tms_coil.tms_coil_element import DipoleElements
+from ..tms_coil.tms_stimulator import TmsStimulator
 
 fem._initialize_petsc()
 
@@ -282,6 +287,18 @@ class TestAssemble:
                 z = cube_msh.nodes.node_coord[:, i]
                 assert np.allclose(D[i].dot(z), 1, atol=1e-2)
 
+    @pytest.mark.parametrize('split', [False, True])
+    @pytest.mark.parametrize('pass_G', [False, True])
+    def test_grad_matrix_roi(self, split, pass_G, sphere3_msh):
+        roi = np.isin(sphere3_msh.elm.tag1, [3, 1003, 5])
+        G = fem._gradient_operator(sphere3_msh) if pass_G else None
+        D_full = fem.grad_matrix(sphere3_msh, split=True)
+        D_roi = fem.grad_matrix(sphere3_msh, G=G, split=split, roi=roi)
+        if not split:
+            D_roi = [D_roi[i::3] for i in range(3)]
+        for d_full, d_roi in zip(D_full, D_roi):
+            assert d_roi.shape == (np.sum(roi), sphere3_msh.nodes.nr)
+            assert np.allclose(d_full.tocsr()[roi].toarray(), d_roi.toarray())
 
 
     def test_vol(self, sphere3_msh):
@@ -295,6 +312,47 @@ class TestAssemble:
                           1e-9 * 4./3. * np.pi * 95 ** 3,
                           rtol=1e-2)
 
+    def test_stiffness_pattern_refill(self, sphere3_msh):
+        msh = sphere3_msh
+        th_nodes = msh.elm.node_number_list[msh.elm.elm_type == 4]
+        G = fem._gradient_operator(msh)
+        vols = fem._vol(msh)
+        dof_map = fem.dofMap(msh.nodes.node_number)
+        pattern = fem.StiffnessPattern(th_nodes, dof_map)
+        np.random.seed(0)
+        for cond in [np.ones(len(th_nodes)), np.random.rand(len(th_nodes))]:
+            A = fem._assemble_matrix(vols, G, th_nodes, cond, dof_map)
+            A_refill = fem._assemble_matrix(
+                vols, G, th_nodes, cond, dof_map, pattern=pattern)
+            assert A.shape == A_refill.shape == pattern.shape
+            assert np.allclose(abs(A - A_refill).max(), 0)
+            assert np.allclose(abs(A - A.T).max(), 0)
+            assert np.allclose(A.dot(np.ones(A.shape[0])), 0)
+
+    def test_stiffness_basis(self, sphere3_msh):
+        msh = sphere3_msh
+        cond = np.ones(msh.elm.nr)
+        cond[msh.elm.tag1 == 4] = 0.5
+        basis = fem.StiffnessBasis(msh, cond, [3, 5])
+        assert np.allclose(basis.tissue_cond(cond), [1, 1])
+        for sigma in [[2., 0.1], [0.3, 4.]]:
+            cond_s = cond.copy()
+            cond_s[msh.elm.tag1 == 3] = sigma[0]
+            cond_s[msh.elm.tag1 == 5] = sigma[1]
+            A = fem.FEMSystem(msh, cond_s).A
+            A_basis = basis.assemble(mesh_io.ElementData(cond_s, mesh=msh))
+            assert np.allclose(basis.tissue_cond(cond_s), sigma)
+            assert np.allclose(abs(A - A_basis).max(), 0)
+        # Conductivities of the other tissues are fixed
+        cond_s = cond.copy()
+        cond_s[msh.elm.tag1 == 4] = 1.
+        with pytest.raises(ValueError):
+            basis.assemble(cond_s)
+        cond_s = cond.copy()
+        cond_s[np.where(msh.elm.tag1 == 3)[0][0]] = 2.
+        with pytest.raises(ValueError):
+            basis.assemble(cond_s)
+
 
 class TestFEMSystem:
     def test_assemble_fem_matrix(self, sphere3_msh):
@@ -309,6 +367,75 @@ class TestFEMSystem:
         assert np.allclose(s.A.dot(np.pi*np.ones(s.A.shape[0])), 0)
         assert np.allclose(s.A.T.toarray(), s.A.toarray())
 
+    def test_fem_cache(self, tms_sphere, tmp_path):
+        m, cond, dAdt, E_analytical = tms_sphere
+        S = fem.TMSFEM(m, cond, cache_dir=str(tmp_path))
+        assert len(list(tmp_path.glob('fem_*'))) == 1
+        with patch.object(fem, '_assemble_matrix') as mock_assemble:
+            S_cached = fem.TMSFEM(m, cond, cache_dir=str(tmp_path))
+            mock_assemble.assert_not_called()
+        # memory-mapped from the cache
+        assert not S_cached.A.data.flags.writeable
+        # and placed in shared memory when sent to the workers
+        assert type(S_cached.A.data) is np.ndarray
+        with fem.SharedObjects(S_cached.A) as shared:
+            assert len(os.listdir(shared._folder)) >= 2
+        assert np.allclose(S_cached.A.toarray(), S.A.toarray())
+        assert np.allclose(S_cached._G, S._G)
+        assert S_cached.dof_map == S.dof_map
+        # Changing the conductivities gives a new cache entry
+        cond2 = mesh_io.ElementData(2 * cond.value, mesh=m)
+        S2 = fem.TMSFEM(m, cond2, cache_dir=str(tmp_path))
+        assert len(list(tmp_path.glob('fem_*'))) == 2
+        assert np.allclose(S2.A.toarray(), 2 * S.A.toarray())
+
+    def test_fem_cache_G(self, tms_sphere, tmp_path):
+        m, cond, dAdt, E_analytical = tms_sphere
+        S = fem.FEMSystem(m, cond, cache_dir=str(tmp_path))
+        fn_cache, = tmp_path.glob('fem_*')
+        # G is only stored when requested
+        assert not (fn_cache / 'G.npy').exists()
+        S_G = fem.FEMSystem(m, cond, cache_dir=str(tmp_path), store_G=True)
+        assert (fn_cache / 'G.npy').exists()
+        assert np.allclose(S_G._G, fem._gradient_operator(m))
+        assert np.allclose(S_G.A.toarray(), S.A.toarray())
+
+    def test_prune_fem_cache(self, tms_sphere, tmp_path):
+        m, cond, dAdt, E_analytical = tms_sphere
+        fem.FEMSystem(m, cond, cache_dir=str(tmp_path))
+        fn_old, = tmp_path.glob('fem_*')
+        os.utime(fn_old, (0, 0))
+        cond2 = mesh_io.ElementData(2 * cond.value, mesh=m)
+        with patch.object(fem, '_FEM_CACHE_MAX_BYTES', 1):
+            fem.FEMSystem(m, cond2, cache_dir=str(tmp_path))
+        # The least recently used entry is removed, the new one is kept
+        fn_new, = tmp_path.glob('fem_*')
+        assert fn_new != fn_old
+
+    def test_update_cond(self, tms_sphere):
+        m, cond, dAdt, E_analytical = tms_sphere
+        basis = fem.StiffnessBasis(m, cond, [3])
+        S = fem.TMSFEM(m, cond)
+        # Solver set-up as in prepare_solver
+        A, _ = S.dirichlet.apply_to_matrix(
+            sparse.csc_matrix(S.A, copy=True), copy.deepcopy(S.dof_map))
+        A.sort_indices()
+        S._solver = Mock()
+        S._A_reduced = A
+        cond2 = mesh_io.ElementData(cond.value.copy(), mesh=m)
+        cond2.value[m.elm.tag1 == 3] *= 1.1
+        assert S.update_cond(cond2, basis, reuse_preconditioner=True)
+        assert S._A_reduced is A
+        S2 = fem.TMSFEM(m, cond2)
+        assert np.allclose(abs(S.A - S2.A).max(), 0)
+        A2, _ = S2.dirichlet.apply_to_matrix(
+            sparse.csc_matrix(S2.A, copy=True), copy.deepcopy(S2.dof_map))
+        A2.sort_indices()
+        assert np.allclose(A.data, A2.data)
+        assert np.allclose(S.assemble_rhs(dAdt), S2.assemble_rhs(dAdt))
+        assert not S.update_cond(cond, basis)
+        assert S._solver is None
+
     def test_set_up_tms(self, tms_sphere):
         m, cond, dAdt, E_analytical = tms_sphere
         S = fem.TMSFEM(m, cond)
@@ -635,12 +762,40 @@ class TestTMS:
             assert np.abs(mag(E, E_analytical)) < np.log(1.1)
 
 
+    def test_get_da_dt_from_coil_cached(self, tms_sphere, tmp_path):
+        m, _, _, _ = tms_sphere
+        stimulator = TmsStimulator('stimulator')
+        coil = TmsCoil([DipoleElements(
+            stimulator, [[0., 0., 100.], [10., 0., 100.]], [[0., 0., 1.], [0., 1., 0.]]
+        )])
+        fn_coil = str(tmp_path / 'coil.tcd')
+        coil.write(fn_coil)
+        matsimnibs = np.eye(4)
+        dAdt = TmsCoil.from_file(fn_coil).get_da_dt(m, matsimnibs)
+
+        fem._load_coil_cached.cache_clear()
+        with patch.object(fem.TmsCoil, 'from_file', wraps=TmsCoil.from_file) as from_file:
+            dAdt_1 = fem._get_da_dt_from_coil(fn_coil, m, 2., matsimnibs)
+            dAdt_2 = fem._get_da_dt_from_coil(fn_coil, m, 3., matsimnibs)
+            assert from_file.call_count == 1
+            assert fem._load_coil(fn_coil).elements[0].stimulator.di_dt == 1.
+            # modifying the file invalidates the cache
+            os.utime(fn_coil, (0, 0))
+            fem._get_da_dt_from_coil(fn_coil, m, 2., matsimnibs)
+            assert from_file.call_count == 2
+        fem._load_coil_cached.cache_clear()
+
+        assert np.allclose(dAdt_1.value, 2 * dAdt.value)
+        assert np.allclose(dAdt_2.value, 3 * dAdt.value)
+
+
 class TestLeadfield:
+    @pytest.mark.parametrize('block_size', [1, 8])
     @pytest.mark.parametrize('post_pro', [False, True])
     @pytest.mark.parametrize('field', ['E', 'J'])
     @pytest.mark.parametrize('n_workers', [1, 2])
     @pytest.mark.parametrize('input_type', ['tag', 'nodes'])
-    def test_leadfield(self, input_type, n_workers, field, post_pro, cube_msh):
+    def test_leadfield(self, input_type, n_workers, field, post_pro, block_size, cube_msh):
         if sys.platform in ['win32', 'darwin'] and n_workers > 1:
             ''' Same as above, does not work on windows or MacOS'''
             return
@@ -690,6 +845,7 @@ class TestLeadfield:
             n_workers=n_workers,
             input_type=input_type,
             weigh_by_area = weigh_by_area,
+            block_size=block_size,
         )
 
         if not post_pro:
@@ -710,12 +866,33 @@ class TestLeadfield:
 
         os.remove(fn_hdf5)
 
+    @pytest.mark.parametrize('cond_type', ['scalar', 'tensor'])
+    @pytest.mark.parametrize('field', ['E', 'J'])
+    def test_compose_post_pro(self, field, cond_type, sphere3_msh):
+        roi = np.isin(sphere3_msh.elm.tag1, [3, 5])
+        n_roi = np.sum(roi)
+        D = fem.grad_matrix(sphere3_msh, split=True, roi=roi)
+        np.random.seed(0)
+        if cond_type == 'scalar':
+            cond = np.random.rand(n_roi)
+        else:
+            cond = np.random.rand(n_roi, 9)
+        M = sparse.random(20, n_roi, density=0.01, format='csc')
+        v = np.random.rand(sphere3_msh.nodes.nr, 2)
+        D_out = fem._compose_post_pro(D, M, field, cond)
+        assert all(d.shape == (20, sphere3_msh.nodes.nr) for d in D_out)
+        assert np.allclose(
+            fem._tdcs_leadfield_output(v, D_out, 'E', None, None),
+            fem._tdcs_leadfield_output(v, D, field, cond, M.dot)
+        )
+
 
 class TestTMSMany:
+    @pytest.mark.parametrize('block_size', [1, 8])
     @pytest.mark.parametrize('post_pro', [False, True])
     @pytest.mark.parametrize('n_workers', [1, 2])
     @patch.object(coil_lib, 'set_up_tms')
-    def test_many_simulations(self, mock_set_up, n_workers, post_pro, tms_sphere):
+    def test_many_simulations(self, mock_set_up, n_workers, post_pro, block_size, tms_sphere):
         if sys.platform in ['win32', 'darwin'] and n_workers > 1:
             ''' Same as above, does not work on windows '''
             return
@@ -735,7 +912,8 @@ class TestTMSMany:
             2*[matsimnibs], 2*[didt],
             fn_hdf5, dataset, roi=[3],
             post_pro=post,
-            n_workers=n_workers
+            n_workers=n_workers,
+            block_size=block_size
         )
         roi_select = m.elm.tag1 == 3
         with h5py.File(fn_hdf5, 'r') as f:
@@ -748,6 +926,102 @@ class TestTMSMany:
                     assert mag(E, E_analytical[roi_select]) < np.log(1.1)
         os.remove(fn_hdf5)
 
+    @pytest.mark.parametrize('n_workers', [1, 2])
+    def test_split_in_blocks(self, n_workers):
+        blocks = fem._split_in_blocks(11, 4, n_workers)
+        assert [i for b in blocks for i in b] == list(range(11))
+        assert len(blocks) >= n_workers
+        assert all(len(b) <= 4 for b in blocks)
+
+    def test_run_blocks_in_pool(self):
+        from multiprocessing.pool import ThreadPool
+        blocks = fem._split_in_blocks(20, 2, 1)
+        running = []
+        max_running = [0]
+
+        def run_block(block):
+            running.append(block)
+            max_running[0] = max(max_running[0], len(running))
+            return np.full((len(block), 3), block.start)
+
+        class Writer:
+            rows = {}
+            def write(self, start, rows):
+                running.pop()
+                self.rows[start] = rows
+
+        writer = Writer()
+        with ThreadPool(2) as pool:
+            fem._run_blocks_in_pool(
+                pool, run_block, blocks, lambda b: (b,), writer, 2)
+        assert sorted(writer.rows) == [b.start for b in blocks]
+        assert all(np.all(r == s) for s, r in writer.rows.items())
+        assert max_running[0] <= 4
+
+
+class TestHDF5Writer:
+    def test_write(self, tmp_path):
+        fn_hdf5 = str(tmp_path / 'out.hdf5')
+        fem._create_rows_dataset(fn_hdf5, 'data', (10, 100, 3))
+        data = np.random.rand(10, 100, 3)
+        with fem._HDF5Writer(fn_hdf5, 'data', max_queued=2) as writer:
+            for start in [4, 0, 8, 2, 6]:
+                writer.write(start, data[start:start + 2])
+        with h5py.File(fn_hdf5, 'r') as f:
+            assert f['data'].chunks[0] == 1
+            assert np.allclose(f['data'][:], data)
+
+    def test_error(self, tmp_path):
+        fn_hdf5 = str(tmp_path / 'out.hdf5')
+        fem._create_rows_dataset(fn_hdf5, 'data', (2, 100, 3))
+        with pytest.raises(Exception):
+            with fem._HDF5Writer(fn_hdf5, 'data') as writer:
+                writer.write(0, np.zeros((2, 10, 3)))
+
+    def test_merge_row_blocks(self):
+        a = np.zeros((2, 3))
+        merged = fem._merge_row_blocks([(4, a), (0, a), (2, a), (8, a)])
+        assert [m[0] for m in merged] == [0, 8]
+        assert merged[0][1].shape == (6, 3)
+
+
+def _sum_shared(shared):
+    m, A = shared.load()
+    m.nodes.node_coord[0] = 0.
+    return m.nodes.node_coord.sum(), A.sum()
+
+
+class TestSharedObjects:
+    def test_load(self, sphere3_msh):
+        A = sparse.random(1000, 1000, density=0.1, format='csr')
+        with fem.SharedObjects(sphere3_msh, A, 'small') as shared:
+            shared = pickle.loads(pickle.dumps(shared))
+            m, A_shared, small = shared.load()
+            assert small == 'small'
+            assert np.all(m.nodes.node_coord == sphere3_msh.nodes.node_coord)
+            assert np.all(m.elm.node_number_list == sphere3_msh.elm.node_number_list)
+            assert np.allclose((A_shared - A).toarray(), 0)
+            assert shared.load()[0] is m
+            # copy-on-write
+            m.nodes.node_coord[0] = 0.
+            assert not np.all(sphere3_msh.nodes.node_coord[0] == 0.)
+
+    def test_pool(self, sphere3_msh):
+        if sys.platform in ['win32', 'darwin']:
+            return
+        A = sparse.random(1000, 1000, density=0.1, format='csr')
+        with fem.SharedObjects(sphere3_msh, A) as shared:
+            with multiprocessing.Pool(2) as pool:
+                out = pool.map(_sum_shared, [shared] * 4)
+        # workers modify their own copy only
+        assert not np.all(sphere3_msh.nodes.node_coord[0] == 0.)
+        for coord_sum, A_sum in out:
+            assert np.isclose(
+                coord_sum,
+                sphere3_msh.nodes.node_coord.sum() - sphere3_msh.nodes.node_coord[0].sum())
+            assert np.isclose(A_sum, A.sum())
+
+
 class TestDipole:
     # st. venant fails with dipole [80,0,0], [1,0,0]!
     @pytest.mark.parametrize('source_model', ["partial integration"])#, "st. venant"])
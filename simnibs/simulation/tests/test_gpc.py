@@ -192,6 +192,12 @@ def sampler_args(sphere3):
     return sphere3, poslist, fn_hdf5, [3]
 
 
+class _CoordSampler(simnibs_gpc.gPCSampler):
+    def _simulate(self, random_vars):
+        v = random_vars[0] * self.mesh.nodes.node_coord[:, 0]
+        return mesh_io.NodeData(v, 'v', mesh=self.mesh)
+
+
 class TestSampler:
     def test_set_up_sampler(self, sampler_args):
         mesh, poslist, fn_hdf5, roi = sampler_args
@@ -267,6 +273,42 @@ class TestSampler:
             assert c[0][0][0] <= .4
             assert c[0][0][0] >= .3
 
+    def test_run_N_random_simulations_pool(self, sampler_args):
+        mesh, poslist, fn_hdf5, roi = sampler_args
+        S = _CoordSampler(mesh, poslist, fn_hdf5, roi)
+        S.run_N_random_simulations(4, n_workers=2)
+        x = mesh.crop_mesh(roi).nodes.node_coord[:, 0]
+        with h5py.File(fn_hdf5, 'r') as f:
+            rand = f['random_var_samples'][()]
+            v_roi = f['mesh_roi/data_matrices/v_samples'][()]
+        assert rand.shape == (4, 1)
+        assert np.allclose(v_roi, rand * x)
+
+    @patch.object(simnibs_gpc, 'fem')
+    def test_tdcs_reuse_fem(self, mock_fem, sampler_args):
+        mesh, poslist, fn_hdf5, roi = sampler_args
+        v = mesh.nodes.node_coord[:, 0]
+        mock_fem._calibrate_tdcs_pair.return_value = v
+        basis = mock_fem.StiffnessBasis.return_value
+        basis.tissue_cond.side_effect = [np.array([s]) for s in [0.3, 0.33, 0.4]]
+        system = mock_fem.TDCSFEMDirichlet.return_value
+        system.update_cond.return_value = True
+
+        S = simnibs_gpc.TDCSgPCSampler(
+            mesh, poslist, fn_hdf5, [1101, 1102], [-1, 1], roi)
+        S.reuse_fem = True
+        for x in [0.3, 0.33, 0.4]:
+            E = S.run_simulation([x])
+            assert np.allclose(E.reshape(-1, 3), [-1e3, 0, 0])
+        mock_fem.TDCSFEMDirichlet.assert_called_once()
+        mock_fem.StiffnessBasis.assert_called_once()
+        assert mock_fem.StiffnessBasis.call_args[0][2] == [3]
+        reuse = [c[1]['reuse_preconditioner'] for c in system.update_cond.call_args_list]
+        assert reuse == [True, False]
+        assert S._fem_id in simnibs_gpc._sampler_fem
+        S.clear_fem_cache()
+        assert S._fem_id not in simnibs_gpc._sampler_fem
+
     def test_tdcs_set_up(self, sampler_args):
         mesh, poslist, fn_hdf5, roi = sampler_args
         S = simnibs_gpc.TDCSgPCSampler(mesh, poslist, fn_hdf5, [1101, 1102], [-1, 1],
@@ -120,6 +120,10 @@ class TestCalcdAdt:
         np.testing.assert_allclose(da_dt[:, 1], 1e6, atol=1e-6)
         np.testing.assert_allclose(da_dt[:, 2], 3e6, atol=1e-6)
 
+        sampled_elements.data = 2 * field
+        da_dt = sampled_elements.get_da_dt(sphere3_msh.nodes.node_coord, coil_matrix)
+        np.testing.assert_allclose(da_dt[:, 0], 4e6, atol=1e-6)
+
 
 class TestTransformationAndDeformation:
     def test_freeze_element_dipole(sself):
@@ -729,6 +733,20 @@ class TestGetFunctions:
             element.get_points(apply_deformation=False), [[1, 2, 3]]
         )
 
+    def test_get_points_m(self):
+        element = DipoleElements(None, [[1, 2, 3]], [[4, 5, 6]])
+        affine = np.array(
+            [[0, 1, 0, 10], [1, 0, 0, 20], [0, 0, 1, 30], [0, 0, 0, 1]], dtype=float
+        )
+
+        np.testing.assert_allclose(
+            element.get_points_m(affine), element.get_points(affine) * 1e-3
+        )
+        element.points = [[2, 4, 6]]
+        np.testing.assert_allclose(
+            element.get_points_m(apply_deformation=False), [[2e-3, 4e-3, 6e-3]]
+        )
+
     def test_get_values_no_transformation(self):
         element = DipoleElements(None, [[1, 2, 3]], [[4, 5, 6]])
 
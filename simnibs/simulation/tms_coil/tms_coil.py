@@ -672,6 +672,7 @@ class TmsCoil(TcdElement):
 
         # shift logo along negative z to the top side of coil
         msh_logo.nodes.node_coord[:, 2] += bbox_coil[0, 2] - bbox_logo[0, 2] - 5
+        msh_logo.nodes.mark_modified()
 
         mesh = mesh.join_mesh(msh_logo)
         return mesh
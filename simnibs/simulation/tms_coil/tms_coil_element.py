@@ -420,6 +420,47 @@ class PositionalTmsCoilElements(TmsCoilElements, ABC):
                 f"Expected the same amount of 'points' and 'values' ({len(self.values)} != {len(self.points)})"
             )
 
+    @property
+    def points(self) -> npt.NDArray[np.float_]:
+        return self._points
+
+    @points.setter
+    def points(self, points: npt.ArrayLike):
+        self._points = np.array(points, dtype=np.float64)
+        self._points_m = None
+
+    def get_points_m(
+        self,
+        affine_matrix: Optional[npt.NDArray[np.float_]] = None,
+        apply_deformation: bool = True,
+    ) -> npt.NDArray[np.float_]:
+        """Returns the positions of the stimulation elements in meters,
+        optionally transformed by the affine matrix and deformed by the element deformation.
+        The untransformed positions in meters are only calculated once
+
+        Parameters
+        ----------
+        affine_matrix : Optional[npt.NDArray[np.float_]], optional
+            The affine transformation that is applied to the coil element, by default None
+        apply_deformation : bool, optional
+            Whether or not to apply the current coil element deformations, by default True
+
+        Returns
+        -------
+        npt.NDArray[np.float_]
+            The positions of the stimulation elements in meters
+        """
+        if self._points_m is None:
+            self._points_m = self._points * 1e-3
+        if affine_matrix is None:
+            affine_matrix = np.eye(4)
+        if apply_deformation:
+            affine_matrix = self.get_combined_transformation(affine_matrix)
+        return (
+            self._points_m @ affine_matrix[:3, :3].T
+            + affine_matrix[None, :3, 3] * 1e-3
+        )
+
     def get_points(
         self,
         affine_matrix: Optional[npt.NDArray[np.float_]] = None,
@@ -499,7 +540,7 @@ class DipoleElements(PositionalTmsCoilElements):
             The A field at every target positions in Tesla*meter
         """
         dipole_moment = self.get_values(coil_affine, apply_deformation)
-        dipole_position_m = self.get_points(coil_affine, apply_deformation) * 1e-3
+        dipole_position_m = self.get_points_m(coil_affine, apply_deformation)
         target_positions_m = target_positions * 1e-3
         if dipole_moment.shape[0] < 300:
             out = fmm3dpy.l3ddir(
@@ -680,7 +721,7 @@ class LineSegmentElements(PositionalTmsCoilElements):
             The A field at every target positions in Tesla*meter
         """
         directions_m = self.get_values(coil_affine, apply_deformation) * 1e-3
-        segment_position_m = self.get_points(coil_affine, apply_deformation) * 1e-3
+        segment_position_m = self.get_points_m(coil_affine, apply_deformation)
         target_positions_m = target_positions * 1e-3
 
         if directions_m.shape[0] >= 300:
@@ -804,8 +845,42 @@ class SampledGridPointElements(TmsCoilElements):
         deformations: Optional[list[TmsCoilDeformation]] = None,
     ):
         super().__init__(stimulator, name, casing, deformations)
-        self.data = np.array(data, dtype=np.float64)
-        self.affine = np.array(affine, dtype=np.float64)
+        self.data = data
+        self.affine = affine
+
+    @property
+    def data(self) -> npt.NDArray[np.float_]:
+        return self._data
+
+    @data.setter
+    def data(self, data: npt.ArrayLike):
+        self._data = np.array(data, dtype=np.float64)
+        self._grid = None
+
+    @property
+    def affine(self) -> npt.NDArray[np.float_]:
+        return self._affine
+
+    @affine.setter
+    def affine(self, affine: npt.ArrayLike):
+        self._affine = np.array(affine, dtype=np.float64)
+        self._inv_affine = np.linalg.pinv(self._affine)
+
+    def _get_grid(self) -> list[npt.NDArray[np.float32]]:
+        """Returns the sampled field as one contiguous float32 volume per component.
+        The volumes are created on first use and reused by every later interpolation
+
+        Returns
+        -------
+        list[npt.NDArray[np.float32]]
+            The x, y and z component of the sampled field
+        """
+        if self._grid is None:
+            self._grid = [
+                np.ascontiguousarray(self._data[..., dim], dtype=np.float32)
+                for dim in range(3)
+            ]
+        return self._grid
 
     def get_a_field(
         self,
@@ -835,7 +910,7 @@ class SampledGridPointElements(TmsCoilElements):
         combined_affine = coil_affine
         if apply_deformation:
             combined_affine = self.get_combined_transformation(combined_affine)
-        iM = np.linalg.pinv(self.affine) @ np.linalg.pinv(combined_affine)
+        iM = self._inv_affine @ np.linalg.pinv(combined_affine)
 
         target_voxle_coordinates = (
             iM[:3, :3] @ target_positions.T + iM[:3, 3][:, np.newaxis]
@@ -843,9 +918,9 @@ class SampledGridPointElements(TmsCoilElements):
 
         # Interpolates the values of the field in the given coordinates
         out = np.zeros((3, target_voxle_coordinates.shape[1]))
-        for dim in range(3):
-            out[dim] = ndimage.map_coordinates(
-                np.asanyarray(self.data)[..., dim], target_voxle_coordinates, order=1
+        for dim, grid in enumerate(self._get_grid()):
+            ndimage.map_coordinates(
+                grid, target_voxle_coordinates, output=out[dim], order=1
             )
 
         # Rotates the field
@@ -9,11 +9,13 @@ import h5py
 import numpy as np
 
 from ..mesh_tools import mesh_io
+from .leadfield_utils import LazyLeadfield
 
 
 def load_leadfield(leadfield_hdf, 
                    leadfield_path = '/mesh_leadfield/leadfields/tdcs_leadfield',
-                   mesh_path = '/mesh_leadfield/'):
+                   mesh_path = '/mesh_leadfield/',
+                   lazy = False):
     """
     load leadfield, mesh on which leadfield was calculated and mapping from 
     electrode names to index in the leadfield
@@ -28,10 +30,14 @@ def load_leadfield(leadfield_hdf,
     mesh_path : string, optional
         path inside the hdf5 file to the mesh.
         The default is '/mesh_leadfield/'.
+    lazy : bool, optional
+        If True, the leadfield is not loaded into memory. Instead, a 
+        LazyLeadfield is returned, which reads the rows of the electrodes 
+        when they are indexed. The default is False.
 
     Returns
     -------
-    leadfield : np.ndarray
+    leadfield : np.ndarray or simnibs.utils.leadfield_utils.LazyLeadfield
         Leadfield matrix (N_elec -1 x M x 3) where M is either the number of 
         nodes (for surface-based leadfields) or the number of elements 
         (tet-based leadfields) in the mesh.
@@ -43,7 +49,10 @@ def load_leadfield(leadfield_hdf,
     """
     with h5py.File(leadfield_hdf, 'r') as f:
         lf_struct = f[leadfield_path]
-        leadfield = lf_struct[:] # elecs x mesh nodes x 3
+        if lazy:
+            leadfield = LazyLeadfield(leadfield_hdf, leadfield_path)
+        else:
+            leadfield = lf_struct[:] # elecs x mesh nodes x 3
         
         # make a dict: elec name --> index in leadfield matrix
         name_elecs = lf_struct.attrs.get('electrode_names')
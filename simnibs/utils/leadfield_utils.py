@@ -0,0 +1,155 @@
+'''
+    Lazy access to leadfields stored in HDF5 files
+
+    This program is part of the SimNIBS package.
+    Please check on www.simnibs.org how to cite our work in publications.
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import numbers
+
+import h5py
+import numpy as np
+
+# Selections of at most 1 / _POINT_SELECTION_RATIO of a row are read with a
+# point selection, larger ones read the whole row and index it in memory
+_POINT_SELECTION_RATIO = 256
+
+
+class LazyLeadfield(object):
+    ''' Leadfield stored in an HDF5 file, read one electrode (row) at a time
+
+    Indexing a LazyLeadfield only reads the requested rows from the file.
+    The remaining indices (e.g. the ROI columns) are applied to one row at a
+    time, so that at most one full row is held in memory in addition to the
+    result. Uncompressed contiguous datasets are memory-mapped instead.
+
+    Parameters
+    ----------
+    fn_hdf5: str
+        Name of the HDF5 file
+    path: str
+        Path to the leadfield dataset in the HDF5 file
+    dtype: numpy dtype (optional)
+        Data type of the returned arrays. Default: data type of the dataset
+
+    Attributes
+    ----------
+    shape: tuple
+        Shape of the leadfield (N_elec - 1 x M x 3)
+    dtype: numpy dtype
+        Data type of the returned arrays
+    attrs: dict
+        Attributes of the dataset
+
+    Example
+    -------
+    >>> lf = LazyLeadfield('leadfield.hdf5', '/mesh_leadfield/leadfields/tdcs_leadfield')
+    >>> E = lf[2] - lf[5]  # reads two rows
+    >>> E_roi = lf[:, roi]  # reads all rows, keeps the ROI columns
+    '''
+    def __init__(self, fn_hdf5, path, dtype=None):
+        self.fn_hdf5 = fn_hdf5
+        self.path = path
+        self._file = None
+        self._memmap = None
+        with h5py.File(fn_hdf5, 'r') as f:
+            dset = f[path]
+            self.shape = dset.shape
+            self._storage_dtype = dset.dtype
+            self.attrs = dict(dset.attrs)
+            # Offset of the data in the file, if it can be memory-mapped
+            self._offset = None
+            if dset.chunks is None and dset.compression is None:
+                self._offset = dset.id.get_offset()
+        self.dtype = np.dtype(dtype) if dtype is not None else self._storage_dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_memmap'] = None
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        ''' Closes the HDF5 file, it will be re-opened when needed '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._memmap = None
+
+    def _read_row(self, i, other=()):
+        if self._offset is not None:
+            if self._memmap is None:
+                self._memmap = np.memmap(
+                    self.fn_hdf5, dtype=self._storage_dtype, mode='r',
+                    offset=self._offset, shape=self.shape)
+            return self._memmap[i][other]
+        if self._file is None:
+            self._file = h5py.File(self.fn_hdf5, 'r')
+        dset = self._file[self.path]
+        # Let HDF5 select slices and small sorted index lists, so that only
+        # the requested part of the row is read
+        fancy = [k for k in other if not (
+            isinstance(k, (numbers.Integral, type(Ellipsis))) or
+            (isinstance(k, slice) and (k.step is None or k.step > 0)))]
+        if len(fancy) == 0:
+            return dset[(i,) + other]
+        if len(fancy) == 1 and _is_small_selection(fancy[0], self.shape[1]):
+            return dset[(i,) + other]
+        return dset[i][other]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        rows, other = key[0], key[1:]
+        if isinstance(rows, numbers.Integral):
+            if rows < 0:
+                rows += self.shape[0]
+            return np.asarray(self._read_row(rows, other), dtype=self.dtype)
+        rows = np.arange(self.shape[0])[rows]
+        out = None
+        for j, i in enumerate(rows):
+            row = self._read_row(i, other)
+            if out is None:
+                out = np.empty((len(rows),) + row.shape, dtype=self.dtype)
+            out[j] = row
+        if out is None:
+            row_shape = np.broadcast_to(np.empty(()), self.shape[1:])[other].shape
+            out = np.empty((0,) + row_shape, dtype=self.dtype)
+        return out
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def _is_small_selection(index, size):
+    ''' Whether index is a short, strictly increasing list of positions '''
+    if not isinstance(index, np.ndarray) or index.ndim != 1 or index.dtype.kind not in 'iu':
+        return False
+    if len(index) == 0 or len(index) * _POINT_SELECTION_RATIO > size:
+        return False
+    return index[0] >= 0 and bool(np.all(np.diff(index) > 0))
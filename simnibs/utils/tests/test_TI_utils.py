@@ -44,8 +44,9 @@ def test_load_leadfield(fn_surf):
     leadfield, mesh, idx_lf = TI.load_leadfield(fn_surf)
     assert idx_lf == {'a': 0, 'b': 1, 'c': 2, 'd': 3, 'e': None}
 
-def test_get_field(fn_surf):
-    leadfield, mesh, idx_lf = TI.load_leadfield(fn_surf)
+@pytest.mark.parametrize('lazy', [False, True])
+def test_get_field(fn_surf, lazy):
+    leadfield, mesh, idx_lf = TI.load_leadfield(fn_surf, lazy=lazy)
     
     ef = TI.get_field(['a','b',1000.],leadfield,idx_lf)
     assert np.all(ef == -1000.)
@@ -0,0 +1,58 @@
+import pickle
+
+import h5py
+import numpy as np
+import pytest
+
+from .. import leadfield_utils
+
+
+@pytest.fixture(params=[{}, {'compression': 'gzip', 'chunks': (1, 10, 3)}])
+def fn_leadfield(tmp_path, request):
+    fn = str(tmp_path / 'leadfield.hdf5')
+    leadfield = np.random.rand(5, 100, 3)
+    with h5py.File(fn, 'w') as f:
+        f.create_dataset('lf', data=leadfield.astype(np.float32), **request.param)
+        f['lf'].attrs['field'] = 'E'
+    return fn, leadfield.astype(np.float32)
+
+
+class TestLazyLeadfield:
+    def test_index(self, fn_leadfield):
+        fn, leadfield = fn_leadfield
+        roi = np.zeros(100, dtype=bool)
+        roi[10:30] = True
+        with leadfield_utils.LazyLeadfield(fn, 'lf') as lf:
+            assert lf.shape == leadfield.shape
+            assert lf.dtype == np.float32
+            assert lf.attrs['field'] == 'E'
+            assert np.all(lf[2] == leadfield[2])
+            assert np.all(lf[-1, 5] == leadfield[-1, 5])
+            assert np.all(lf[[3, 1]] == leadfield[[3, 1]])
+            assert np.all(lf[:, roi] == leadfield[:, roi])
+            assert np.all(lf[1:3, roi, 0] == leadfield[1:3, roi, 0])
+            assert lf[[], roi].shape == (0, 20, 3)
+            assert np.all(np.asarray(lf) == leadfield)
+
+    def test_point_selection(self, fn_leadfield, monkeypatch):
+        fn, leadfield = fn_leadfield
+        monkeypatch.setattr(leadfield_utils, '_POINT_SELECTION_RATIO', 10)
+        with leadfield_utils.LazyLeadfield(fn, 'lf') as lf:
+            assert np.all(lf[:, np.array([3, 20, 51])] == leadfield[:, [3, 20, 51]])
+            assert np.all(lf[1, np.array([20, 3])] == leadfield[1, [20, 3]])
+            assert np.all(lf[1, np.arange(50)] == leadfield[1, :50])
+
+    def test_dtype(self, fn_leadfield):
+        fn, leadfield = fn_leadfield
+        lf = leadfield_utils.LazyLeadfield(fn, 'lf', dtype=np.float64)
+        assert lf[0].dtype == np.float64
+        assert lf[:2].dtype == np.float64
+        assert np.allclose(lf[:2], leadfield[:2])
+
+    def test_pickle(self, fn_leadfield):
+        fn, leadfield = fn_leadfield
+        lf = leadfield_utils.LazyLeadfield(fn, 'lf')
+        lf[0]
+        lf = pickle.loads(pickle.dumps(lf))
+        assert np.all(lf[1] == leadfield[1])
+        lf.close()
@@ -1,4 +1,6 @@
+import copy
 import os
+from unittest.mock import patch
 
 import numpy as np
 import pytest
@@ -667,6 +669,37 @@ def test_surfacemorph(sphere3_msh):
     np.testing.assert_allclose(np.sum(values[from_tris] * weights, 1), field_est, atol=1e-4)
 
 
+@pytest.mark.parametrize('fields, expected', [
+    (['v', 'E', 'magnE'], {'v', 'E_magn', 'E_normal', 'E_tangent', 'E_angle'}),
+    # magnE is skipped in favour of E_magn also if E is not requested
+    (['v', 'magnE'], {'v'}),
+])
+def test_middle_gm_interpolation(fields, expected, sphere3_msh, tmp_path):
+    m = copy.deepcopy(sphere3_msh)
+    # Spheres with WM, GM and CSF
+    m.elm.tag1[m.elm.tag1 == 3] = 1
+    m.elm.tag1[m.elm.tag1 == 4] = 2
+    m.elm.tag1[m.elm.tag1 == 5] = 3
+    E = m.elements_baricenters().value
+    m.add_node_field(m.nodes.node_coord[:, 0], 'v')
+    m.add_element_field(E, 'E')
+    m.add_element_field(np.linalg.norm(E, axis=1), 'magnE')
+    m.add_element_field(2 * E, 'J')
+    fn_mesh = str(tmp_path / 'sim.msh')
+    mesh_io.write_msh(m, fn_mesh)
+    # Middle GM surface
+    surf = sphere3_msh.crop_mesh(1003)
+    surf.nodes.node_coord *= 87 / 85
+    surfaces = lambda *args: {'lh': copy.deepcopy(surf), 'rh': copy.deepcopy(surf)}
+    out_folder = str(tmp_path / 'out')
+    with patch.object(mesh_io, 'load_subject_surfaces', side_effect=surfaces), \
+         patch.object(mesh_io, 'load_reference_surfaces', side_effect=surfaces):
+        transformations.middle_gm_interpolation(
+            fn_mesh, str(tmp_path / 'm2m_sub'), out_folder, fields=fields)
+    out = mesh_io.read_msh(os.path.join(out_folder, 'sim_central.msh'))
+    assert set(out.field.keys()) == expected
+    assert np.allclose(out.field['v'][:], out.nodes.node_coord[:, 0], atol=1)
+
 def test_get_triangle_neighbors():
     """Triangulate an array of points and test neighbors like
     """
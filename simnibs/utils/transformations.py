@@ -1656,7 +1656,12 @@ def middle_gm_interpolation(
                 raise ValueError("Invalid quantity: {0}".format(q))
         return d
 
-    m = mesh_io.read_msh(mesh_fn)
+    # Scalar fields such as magnE are skipped below when the vector field they
+    # are derived from is in the mesh, so the vector fields are also read
+    read_fields = None
+    if fields is not None:
+        read_fields = list(fields) + [name[-1] for name in fields]
+    m = mesh_io.read_msh(mesh_fn, fields=read_fields)
     _, sim_name = os.path.split(mesh_fn)
     sim_name = "." + os.path.splitext(sim_name)[0]
 